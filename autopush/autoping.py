@@ -0,0 +1,124 @@
+"""Websocket pings of the connections of a node, swept in slices
+
+Instead of autobahn's auto-ping, which gives every connection timers of
+its own to send pings and time out their pongs, a connection node pings
+its connections from a single :class:`PingSweeper`. Every
+``interval`` seconds the sweeper walks its connections in slices of at
+most ``slice_size`` of them, one slice per step of a single
+:class:`~twisted.internet.task.LoopingCall` with the steps spread evenly
+over the interval, and has each connection check itself and send a
+ping. Each step also expires the pings that weren't answered within
+``timeout`` seconds, so there are at least enough steps for pings to
+expire on time.
+
+"""
+import collections
+import math
+
+from twisted.internet import reactor, task
+
+
+class PingSweeper(object):
+    """Sweeps the open connections of a node, pinging a slice at a time
+
+    Connections are added once they connect and discarded once they
+    close, and have to provide ``sweep_ping(now, interval)``, returning
+    whether they sent a ping, and ``expire_ping(sent)``.
+
+    """
+    def __init__(self, interval, timeout, slice_size=1000, clock=reactor):
+        """Create a new PingSweeper
+
+        :param interval: Seconds between the pings of a connection.
+        :param timeout: Seconds a connection has to answer a ping, 0 to
+                        never expire pings.
+        :param slice_size: Maximum amount of connections swept per step.
+        :param clock: Provider of ``seconds()`` and ``callLater``, the
+                      reactor by default.
+
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.slice_size = slice_size
+        self.clock = clock
+        self.connections = set()
+        # Connections of the current sweep, the position reached, the
+        # connections swept per step and the steps left
+        self._sweep = []
+        self._position = 0
+        self._chunk = 0
+        self._steps_left = 0
+        # (sent, connection) of the pings awaiting a pong, oldest first
+        self._awaiting = collections.deque()
+        self._loop = None
+
+    def add(self, connection):
+        """Sweep a connection from the next sweep on"""
+        self.connections.add(connection)
+
+    def discard(self, connection):
+        """Stop sweeping a connection"""
+        self.connections.discard(connection)
+
+    def start(self):
+        """Start sweeping
+
+        :returns: The :class:`~twisted.internet.task.LoopingCall` stepping
+                  through the sweeps.
+
+        """
+        self._loop = task.LoopingCall(self.step)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+        return self._loop
+
+    def stop(self):
+        """Stop sweeping"""
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def step(self):
+        """Expire the pings past their timeout, and sweep the next slice
+        of connections, starting a new sweep once one went through"""
+        now = self.clock.seconds()
+        self.expire(now)
+        if self._steps_left <= 0:
+            self._begin()
+        self._steps_left -= 1
+        end = self._position + self._chunk
+        for connection in self._sweep[self._position:end]:
+            # Skip connections closed since the sweep began
+            if connection in self.connections:
+                pinged = connection.sweep_ping(now, self.interval)
+                if pinged and self.timeout:
+                    self._awaiting.append((now, connection))
+        self._position = end
+        if self._position >= len(self._sweep):
+            # Don't hold on to closed connections until the next sweep
+            self._sweep = []
+            self._position = 0
+
+    def _begin(self):
+        """Begin a sweep of the connections open now, in as many steps
+        over the interval as its slices or the expiry of pings need"""
+        self._sweep = list(self.connections)
+        self._position = 0
+        steps = max(1, int(math.ceil(len(self._sweep) /
+                                     float(self.slice_size))))
+        if self.timeout:
+            steps = max(steps, int(math.ceil(self.interval /
+                                             float(self.timeout))))
+        self._chunk = int(math.ceil(len(self._sweep) / float(steps)))
+        self._steps_left = steps
+        if self._loop is not None:
+            self._loop.interval = self.interval / float(steps)
+
+    def expire(self, now):
+        """Expire the pings sent ``timeout`` seconds ago or more"""
+        deadline = now - self.timeout
+        awaiting = self._awaiting
+        while awaiting and awaiting[0][0] <= deadline:
+            sent, connection = awaiting.popleft()
+            if connection in self.connections:
+                connection.expire_ping(sent)
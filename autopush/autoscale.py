@@ -0,0 +1,307 @@
+"""Throughput autoscaler of the router and storage tables
+
+The ``autopush-autoscale`` script polls the consumed read and write
+capacity of each router and storage table from the
+``ConsumedReadCapacityUnits`` and ``ConsumedWriteCapacityUnits``
+CloudWatch metrics, and updates the provisioned throughput of the tables
+to keep the busiest minute of the last few under a target utilization.
+
+Throughput is raised as soon as a table needs more, and lowered only
+once it needed less for a while. DynamoDB allows a table a limited amount
+of decreases per UTC day, so the decreases of a table are counted, and
+read and write throughput are lowered by the same update. Tables being
+created or updated are left alone until they are ``ACTIVE`` again.
+
+The throughput of global secondary indexes, such as the router table's
+``AccessIndex``, is left as it is.
+
+With ``--dry_run`` the decisions are printed without updating the tables.
+The ``autopush-fakedb`` stand-in serves the CloudWatch metrics of the
+capacity it saw consumed, so the autoscaler can run against local tables.
+
+"""
+import datetime
+import math
+import time
+
+import configargparse
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.ec2.cloudwatch import CloudWatchConnection
+
+from autopush.db import (
+    compact_tablename,
+    map_tablename,
+    rotating_tablename,
+    shard_tablenames,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.utils import str2bool
+
+
+NAMESPACE = "AWS/DynamoDB"
+
+METRICS = dict(read="ConsumedReadCapacityUnits",
+               write="ConsumedWriteCapacityUnits")
+
+THROUGHPUT_KEYS = dict(read="ReadCapacityUnits",
+                       write="WriteCapacityUnits")
+
+
+def utc_day(when):
+    """UTC date of a time in seconds, which decreases are counted by"""
+    return datetime.datetime.utcfromtimestamp(when).date()
+
+
+def desired_throughput(consumed, target, bounds):
+    """Throughput keeping a consumption rate at a target utilization,
+    within the ``(minimum, maximum)`` bounds"""
+    minimum, maximum = bounds
+    wanted = int(math.ceil(consumed / float(target)))
+    return max(minimum, min(maximum, wanted))
+
+
+class ThroughputController(object):
+    """Scales the provisioned throughput of tables to their consumption"""
+    def __init__(self, connection, cloudwatch, tables, target=0.7,
+                 window=300, scale_down_wait=3600, max_decreases=4,
+                 dry_run=False, clock=time.time):
+        """Create a new ThroughputController
+
+        :param connection: DynamoDB
+                           :class:`~boto.dynamodb2.layer1.DynamoDBConnection`.
+        :param cloudwatch: :class:`~boto.ec2.cloudwatch.CloudWatchConnection`
+                           to read the consumed capacity from.
+        :param tables: Dict of table name to a dict of the ``read`` and
+                       ``write`` throughput bounds, each a tuple of the
+                       minimum and maximum units.
+        :param target: Fraction of the provisioned throughput the busiest
+                       minute should consume.
+        :param window: Seconds of consumption looked at.
+        :param scale_down_wait: Seconds a table must need less throughput
+                                before it's lowered.
+        :param max_decreases: Decreases allowed per table per UTC day.
+        :param dry_run: Only print the decisions.
+        :param clock: Function returning the current time.
+
+        """
+        self.connection = connection
+        self.cloudwatch = cloudwatch
+        self.tables = tables
+        self.target = target
+        self.window = window
+        self.scale_down_wait = scale_down_wait
+        self.max_decreases = max_decreases
+        self.dry_run = dry_run
+        self.clock = clock
+        # Time since which each (table, kind) needed less throughput
+        self._low_since = {}
+        # UTC day and amount of decreases of each table that day
+        self._decreases = {}
+        self.counts = dict(polls=0, increases=0, decreases=0,
+                           deferred=0, skipped=0, updates=0)
+
+    def consumed(self, tablename, kind, now):
+        """Units per second the busiest minute of the window consumed"""
+        end = datetime.datetime.utcfromtimestamp(now)
+        start = end - datetime.timedelta(seconds=self.window)
+        points = self.cloudwatch.get_metric_statistics(
+            60, start, end, METRICS[kind], NAMESPACE, ["Sum"],
+            dimensions={"TableName": tablename})
+        return max([point["Sum"] for point in points] or [0]) / 60.0
+
+    def decreases_left(self, tablename, description, now):
+        """Decreases the table has left today, counting the larger of the
+        amount DynamoDB reports and the amount made by this controller"""
+        day = utc_day(now)
+        counted_day, counted = self._decreases.get(tablename, (day, 0))
+        if counted_day != day:
+            counted = 0
+        reported = description["ProvisionedThroughput"].get(
+            "NumberOfDecreasesToday", 0)
+        return self.max_decreases - max(counted, reported)
+
+    def poll(self):
+        """Scale each table to its consumption
+
+        :returns: List of the decisions, dicts of the ``table`` name and
+                  its current and new ``read`` and ``write`` throughput.
+        :rtype: list
+
+        """
+        self.counts["polls"] += 1
+        decisions = []
+        for tablename in sorted(self.tables):
+            decision = self.scale(tablename)
+            if decision:
+                decisions.append(decision)
+        return decisions
+
+    def scale(self, tablename):
+        """Scale a table to its consumption
+
+        :returns: The decision if the throughput changes, else None.
+
+        """
+        now = self.clock()
+        description = self.connection.describe_table(tablename)["Table"]
+        if description["TableStatus"] != "ACTIVE":
+            self.counts["skipped"] += 1
+            return None
+        provisioned = description["ProvisionedThroughput"]
+        can_decrease = self.decreases_left(tablename, description, now) > 0
+        decision = dict(table=tablename)
+        changed = decreased = False
+        for kind in ("read", "write"):
+            current = provisioned[THROUGHPUT_KEYS[kind]]
+            consumed = self.consumed(tablename, kind, now)
+            wanted = desired_throughput(consumed, self.target,
+                                        self.tables[tablename][kind])
+            new = current
+            if wanted > current:
+                new = wanted
+                self._low_since.pop((tablename, kind), None)
+                self.counts["increases"] += 1
+            elif wanted < current:
+                since = self._low_since.setdefault((tablename, kind), now)
+                waited = now - since >= self.scale_down_wait
+                if waited and can_decrease:
+                    new = wanted
+                    decreased = True
+                elif waited:
+                    self.counts["deferred"] += 1
+            else:
+                self._low_since.pop((tablename, kind), None)
+            decision[kind] = (current, new)
+            decision["consumed_" + kind] = consumed
+            changed = changed or new != current
+        if not changed:
+            return None
+        if decreased:
+            self.counts["decreases"] += 1
+        self.report(decision)
+        if self.dry_run:
+            return decision
+        self.connection.update_table(tablename, provisioned_throughput={
+            THROUGHPUT_KEYS[kind]: decision[kind][1]
+            for kind in ("read", "write")})
+        self.counts["updates"] += 1
+        if decreased:
+            day = utc_day(now)
+            counted_day, counted = self._decreases.get(tablename, (day, 0))
+            self._decreases[tablename] = (
+                day, counted + 1 if counted_day == day else 1)
+            for kind in ("read", "write"):
+                if decision[kind][1] < decision[kind][0]:
+                    self._low_since.pop((tablename, kind), None)
+        return decision
+
+    def run(self, interval=60, polls=0, sleep=time.sleep):
+        """Poll the tables every ``interval`` seconds
+
+        :param polls: Amount of polls, 0 to poll forever.
+        :returns: The counts of polls, increases, decreases, decreases
+                  deferred for lack of decreases left, polls of tables
+                  that weren't active and table updates.
+        :rtype: dict
+
+        """
+        while True:
+            self.poll()
+            if polls and self.counts["polls"] >= polls:
+                return self.counts
+            sleep(interval)
+
+    def report(self, decision):
+        """Print a scaling decision"""
+        print ("Autoscale: %s%s read %d -> %d (%.1f/s), write %d -> %d "
+               "(%.1f/s)" % (
+                   "[dry run] " if self.dry_run else "", decision["table"],
+                   decision["read"][0], decision["read"][1],
+                   decision["consumed_read"], decision["write"][0],
+                   decision["write"][1], decision["consumed_write"]))
+
+
+def _parse_autoscale(sysargs):
+    """Parse out the arguments for the autoscaler"""
+    parser = configargparse.ArgumentParser(
+        description='Scales the throughput of the router and storage '
+                    'tables to their consumed capacity.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('--router_max_read_throughput',
+                        help="Maximum router read throughput, the router "
+                        "read throughput being the minimum", type=int,
+                        default=100)
+    parser.add_argument('--router_max_write_throughput',
+                        help="Maximum router write throughput, the router "
+                        "write throughput being the minimum", type=int,
+                        default=100)
+    parser.add_argument('--storage_max_read_throughput',
+                        help="Maximum storage read throughput, the storage "
+                        "read throughput being the minimum", type=int,
+                        default=100)
+    parser.add_argument('--storage_max_write_throughput',
+                        help="Maximum storage write throughput, the storage "
+                        "write throughput being the minimum", type=int,
+                        default=100)
+    parser.add_argument('--target_utilization',
+                        help="Fraction of the throughput the busiest minute "
+                        "should consume", type=float, default=0.7)
+    parser.add_argument('--window',
+                        help="Seconds of consumed capacity looked at",
+                        type=int, default=300)
+    parser.add_argument('--scale_down_wait',
+                        help="Seconds a table must need less throughput "
+                        "before it's lowered", type=int, default=3600)
+    parser.add_argument('--max_decreases',
+                        help="Throughput decreases allowed per table per "
+                        "UTC day", type=int, default=4)
+    parser.add_argument('--interval', help="Seconds between polls",
+                        type=int, default=60)
+    parser.add_argument('--polls', help="Amount of polls, 0 to poll "
+                        "forever", type=int, default=0)
+    parser.add_argument('--dry_run',
+                        help="Only print the scaling decisions", type=bool,
+                        default=False)
+    return parser.parse_args(sysargs)
+
+
+def autoscaled_tables(args, when=None):
+    """Table names of the router and storage shards and their throughput
+    bounds, the storage tables of the current month when rotating"""
+    router_tablename = args.router_tablename
+    storage_tablename = args.storage_tablename
+    if args.compact_items:
+        router_tablename = compact_tablename(router_tablename)
+        storage_tablename = compact_tablename(storage_tablename)
+    if args.storage_map:
+        storage_tablename = map_tablename(storage_tablename)
+    if args.storage_rotation:
+        storage_tablename = rotating_tablename(
+            storage_tablename, when or datetime.datetime.utcnow())
+    router_bounds = dict(
+        read=(args.router_read_throughput, args.router_max_read_throughput),
+        write=(args.router_write_throughput,
+               args.router_max_write_throughput))
+    storage_bounds = dict(
+        read=(args.storage_read_throughput,
+              args.storage_max_read_throughput),
+        write=(args.storage_write_throughput,
+               args.storage_max_write_throughput))
+    tables = dict((name, router_bounds) for name in
+                  shard_tablenames(router_tablename, args.router_shards))
+    tables.update((name, storage_bounds) for name in
+                  shard_tablenames(storage_tablename, args.storage_shards))
+    return tables
+
+
+def main(sysargs=None):
+    """Scale the table throughput, aka the autopush-autoscale script"""
+    args = _parse_autoscale(sysargs)
+    controller = ThroughputController(
+        DynamoDBConnection(), CloudWatchConnection(),
+        autoscaled_tables(args), target=args.target_utilization,
+        window=args.window, scale_down_wait=args.scale_down_wait,
+        max_decreases=args.max_decreases, dry_run=args.dry_run)
+    return controller.run(args.interval, polls=args.polls)
@@ -0,0 +1,137 @@
+"""Database backend interfaces
+
+The nodes keep notifications and router items in a storage and a router
+abstraction. :class:`~autopush.db.Storage` and :class:`~autopush.db.Router`
+implement them on DynamoDB tables, which the settings set up themselves.
+Other backends implement :class:`IBackend` to provide their own, selected
+with ``--db_backend``.
+
+Abstractions whose methods never block, or return deferreds, set a
+``deferred`` attribute to True so :func:`~autopush.db.deferToDB` calls them
+directly in the reactor instead of the thread pool.
+
+"""
+
+
+class IStorage(object):
+    """Storage of the notifications of disconnected clients"""
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID
+
+        :param consistent: Whether to make a consistent read.
+        :returns: List of notifications, each with a ``chid`` and
+                  ``version``, in chid order.
+
+        """
+        raise NotImplementedError("fetch_notifications must be implemented")
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID
+
+        :param page_size: Maximum amount of notifications in the page.
+        :param start_key: Key returned with the previous page to continue
+                          from.
+        :param consistent: Whether to make a consistent read.
+        :returns: Tuple of the notifications and the key to fetch the next
+                  page with, None for the last page.
+
+        """
+        raise NotImplementedError("fetch_notifications_page must be "
+                                  "implemented")
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID, unless a newer version of the
+        channel is saved
+
+        :returns: Whether the notification was saved.
+        :rtype: bool
+
+        """
+        raise NotImplementedError("save_notification must be implemented")
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID, only if it holds the
+        ``version`` if given
+
+        :returns: Whether or not the notification was able to be deleted.
+        :rtype: bool
+
+        """
+        raise NotImplementedError("delete_notification must be implemented")
+
+    def delete_notifications(self, keys):
+        """Delete several notifications regardless of their version
+
+        :param keys: List of (uaid, chid) tuples to delete.
+        :returns: Whether or not the notifications were able to be deleted.
+        :rtype: bool
+
+        """
+        raise NotImplementedError("delete_notifications must be implemented")
+
+
+class IRouterTable(object):
+    """Storage of the router items recording where each UAID is connected"""
+    def get_uaid(self, uaid, consistent=True):
+        """Get the router item for the UAID
+
+        :param consistent: Whether to make a consistent read.
+        :returns: User item, a dict or dict-like object.
+        :raises: :exc:`~boto.dynamodb2.exceptions.ItemNotFound` if there is
+                 no record for this UAID.
+
+        """
+        raise NotImplementedError("get_uaid must be implemented")
+
+    def get_uaids(self, uaids, consistent=True):
+        """Get the router items for several UAIDs
+
+        :returns: Dict of UAID to user item, UAIDs without a record are
+                  left out.
+
+        """
+        raise NotImplementedError("get_uaids must be implemented")
+
+    def register_user(self, data):
+        """Register this user, unless a record exists with a node and a
+        newer, or the same, ``connected_at``
+
+        :returns: Tuple of whether the user was registered, and the
+                  attributes the record had before if it was.
+
+        """
+        raise NotImplementedError("register_user must be implemented")
+
+    def invalidate(self, uaid):
+        """Drop any locally cached record for the UAID"""
+        raise NotImplementedError("invalidate must be implemented")
+
+    def clear_node(self, item):
+        """Remove the ``node_id`` of a router item, only if the record
+        still holds the item's ``node_id`` and ``connected_at``
+
+        :returns: Whether the node was cleared or not.
+        :rtype: bool
+
+        """
+        raise NotImplementedError("clear_node must be implemented")
+
+
+class IBackend(object):
+    """Database backend providing the storage and router of a node"""
+    def open(self, metrics):
+        """Open the storage and router, blocking until they're ready
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :returns: Tuple of the :class:`IStorage` and :class:`IRouterTable`
+                  implementations.
+
+        """
+        raise NotImplementedError("open must be implemented")
+
+    def preflight(self, storage, router):
+        """Check the storage and router can be used, raising an exception
+        otherwise"""
+        raise NotImplementedError("preflight must be implemented")
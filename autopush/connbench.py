@@ -0,0 +1,148 @@
+"""Memory footprint benchmark of idle websocket connections
+
+The ``autopush-connbench`` script opens a number of
+:class:`~autopush.websocket.SimplePushServerProtocol` connections in
+process, without sockets, takes each through the websocket factory's
+connection setup, ``onConnect`` and a hello, and reports the resident
+memory they grew the process by per connection. Connection nodes hold
+their idle clients for hours, so this footprint is what bounds the clients
+a node can hold.
+
+The transport and handshake request are shared stand-ins, so only the
+state the protocol keeps for itself, and the state autobahn keeps for
+each connection, is measured.
+
+"""
+import gc
+import resource
+import sys
+
+import configargparse
+import txaio
+from autobahn.twisted.websocket import WebSocketServerFactory
+from twisted.internet.address import IPv4Address
+
+from autopush.metrics import SinkMetrics
+from autopush.utils import str2bool
+from autopush.websocket import SimplePushServerProtocol
+
+
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0",
+    "Mozilla/5.0 (Windows NT 10.0; WOW64; rv:45.0) Gecko/20100101 "
+    "Firefox/45.0",
+    "Mozilla/5.0 (Android; Mobile; rv:45.0) Gecko/45.0 Firefox/45.0",
+]
+
+
+class BenchSettings(object):
+    """Stand-in of the settings a connection uses while idle"""
+    def __init__(self):
+        self.metrics = SinkMetrics()
+        self.clients = {}
+        self.ping_sweeper = None
+
+
+class BenchTransport(object):
+    """Stand-in transport shared by the connections"""
+    bufferSize = 0
+
+    def getPeer(self):
+        return IPv4Address("TCP", "127.0.0.1", 40000)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+
+class BenchRequest(object):
+    """Stand-in handshake request carrying a user agent"""
+    def __init__(self, user_agent):
+        self.headers = {"user-agent": user_agent}
+
+
+def resident_bytes():
+    """Resident memory of the process in bytes
+
+    Read from ``/proc`` where there is one, otherwise the peak resident
+    memory is used, which only grows as connections are added.
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError):
+        # Kilobytes on Linux, bytes on OS X
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def open_connections(count, settings, hello=True):
+    """Open ``count`` idle connections
+
+    :param settings: Settings of the connections, see
+                     :class:`BenchSettings`.
+    :param hello: Whether connections said hello, getting a UAID and
+                  joining the settings' clients.
+    :returns: List of the connections.
+
+    """
+    # The connection setup runs outside of a reactor here
+    txaio.use_twisted()
+    factory = WebSocketServerFactory("ws://localhost:8080/")
+    # Idle connections are past the handshake and its timeout
+    factory.setProtocolOptions(openHandshakeTimeout=0)
+    factory.protocol = type("BenchProtocol", (SimplePushServerProtocol,),
+                            dict(ap_settings=settings))
+    transport = BenchTransport()
+    requests = [BenchRequest(agent) for agent in USER_AGENTS]
+    connections = []
+    for number in xrange(count):
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(transport)
+        proto.onConnect(requests[number % len(requests)])
+        if hello:
+            proto.uaid = "%032x" % number
+            settings.clients[proto.uaid] = proto
+        connections.append(proto)
+    return connections
+
+
+def measure(count=20000, hello=True):
+    """Measure the memory each of ``count`` idle connections takes
+
+    :returns: Dict of the ``count``, the ``total`` resident bytes the
+              connections took and the bytes ``per_connection``.
+
+    """
+    settings = BenchSettings()
+    gc.collect()
+    before = resident_bytes()
+    connections = open_connections(count, settings, hello)
+    gc.collect()
+    total = resident_bytes() - before
+    report = dict(count=len(connections), total=total,
+                  per_connection=total / float(count))
+    del connections
+    return report
+
+
+def _parse_connbench(sysargs):
+    """Parse out the arguments for the connection memory benchmark"""
+    parser = configargparse.ArgumentParser(
+        description='Measures the memory idle websocket connections take.')
+    parser.register('type', bool, str2bool)
+    parser.add_argument('--connections', help="Amount of connections",
+                        type=int, default=20000)
+    parser.add_argument('--no_hello', help="Measure connections that "
+                        "haven't said hello", type=bool, default=False)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Print the memory per connection, aka the autopush-connbench script"""
+    args = _parse_connbench(sysargs)
+    report = measure(args.connections, hello=not args.no_hello)
+    print ("Connections: %(count)d, resident %(total)d bytes, "
+           "%(per_connection).0f bytes per connection" % report)
+    return report
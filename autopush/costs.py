@@ -0,0 +1,244 @@
+"""Database cost accounting
+
+Attributes every DynamoDB request to the protocol action that caused it,
+such as a websocket ``hello`` or an endpoint ``push``, to report the
+average amount of requests and capacity units each action costs.
+
+A call site starts a :class:`DBAction` from the node's
+:class:`CostLedger`, and makes its database calls while the action is
+current with :func:`acting`. :func:`~autopush.db.deferToDB` carries the
+current action into the reactor thread pool, and wrappers that call the
+database later from callbacks carry it along with :func:`bound`. The
+DynamoDB connection counts each request, and the capacity units it
+consumed, for the action current when the request was made.
+
+Requests made while no action is current are counted for
+``unattributed``. Batches gathered across actions, like the ack delete
+queue, are counted under their own name by making their requests while a
+plain string is current instead of an action.
+
+"""
+import collections
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+
+_context = threading.local()
+
+
+def current_action():
+    """The action database calls are made for in this thread, if any"""
+    return getattr(_context, "action", None)
+
+
+@contextmanager
+def acting(action):
+    """Context manager making ``action`` the current action"""
+    previous = getattr(_context, "action", None)
+    _context.action = action
+    try:
+        yield action
+    finally:
+        _context.action = previous
+
+
+def call_in_action(action, func, *args, **kwargs):
+    """Call a function with ``action`` as the current action"""
+    with acting(action):
+        return func(*args, **kwargs)
+
+
+def bound(func):
+    """Bind a function to the current action, so it runs with the action
+    current when called later, from another thread or a callback"""
+    action = current_action()
+    if action is None:
+        return func
+    return partial(call_in_action, action, func)
+
+
+def start_action(ledger, name):
+    """Start an action if there is a ledger to record it with
+
+    :returns: The :class:`DBAction`, or None without a ledger.
+
+    """
+    if ledger is None:
+        return None
+    return ledger.start(name)
+
+
+def finish_action(result, action, outcome=None):
+    """Finish an action if there is one, passing through ``result`` so it
+    can be added as a callback"""
+    if action is not None:
+        action.finish(outcome)
+    return result
+
+
+class DBAction(object):
+    """A protocol action accumulating the requests made for it
+
+    The requests and units are recorded with the ledger once the action
+    finishes, under its name followed by the outcome if any. Requests that
+    complete after the action finished are recorded on their own.
+
+    """
+    def __init__(self, ledger, name):
+        """Create a new DBAction
+
+        :param ledger: :class:`CostLedger` to record the action with.
+        :param name: Name of the action.
+
+        """
+        self.ledger = ledger
+        self.name = name
+        self.outcome = None
+        self.calls = 0
+        self.units = 0
+        self.finished = False
+
+    @property
+    def label(self):
+        """Name the action is recorded under"""
+        if self.outcome:
+            return "%s.%s" % (self.name, self.outcome)
+        return self.name
+
+    def request(self, units):
+        """Count a request made for the action"""
+        with self.ledger.lock:
+            if not self.finished:
+                self.calls += 1
+                self.units += units
+                return
+        self.ledger.record(self.label, calls=1, units=units)
+
+    def finish(self, outcome=None):
+        """Record the action and its requests, with an optional outcome"""
+        with self.ledger.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if outcome is not None:
+            self.outcome = outcome
+        self.ledger.record(self.label, count=1, calls=self.calls,
+                           units=self.units)
+
+
+class CostLedger(object):
+    """Rolling totals of the actions of a node and the requests they made
+
+    The totals are kept in slots of a fraction of the ``window``, dropped
+    once they are out of it. Every recorded action also increments the
+    ``db.action.<label>`` counter, and its ``.calls`` and ``.units``
+    counters by its requests and units.
+
+    """
+    def __init__(self, metrics, window=60, slots=6, clock=time.time):
+        """Create a new CostLedger
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param window: Seconds to report the averages over.
+        :param slots: Amount of slots the window is split into.
+        :param clock: Function returning the current time in seconds.
+
+        """
+        self.metrics = metrics
+        self.window = window
+        self.slot_length = float(window) / slots
+        self.slots = slots
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Slot numbers and their totals of each label, oldest first
+        self._totals = collections.deque()
+
+    def start(self, name):
+        """Start an action
+
+        :returns: The :class:`DBAction`.
+
+        """
+        return DBAction(self, name)
+
+    def request(self, action, units):
+        """Count a request made while ``action`` was current, an action,
+        the name of a batch or None"""
+        if isinstance(action, DBAction):
+            action.request(units)
+        else:
+            self.record(action or "unattributed", calls=1, units=units)
+
+    def record(self, label, count=0, calls=0, units=0):
+        """Add an amount of actions, requests and units to a label"""
+        with self.lock:
+            totals = self._slot().setdefault(label, [0, 0, 0])
+            totals[0] += count
+            totals[1] += calls
+            totals[2] += units
+        if count:
+            self.metrics.increment("db.action.%s" % label, count)
+        if calls:
+            self.metrics.increment("db.action.%s.calls" % label, calls)
+        if units:
+            self.metrics.increment("db.action.%s.units" % label, units)
+
+    def _slot(self):
+        """The totals of the current slot, dropping slots out of the
+        window"""
+        current = int(self.clock() / self.slot_length)
+        self._expire(current)
+        if not self._totals or self._totals[-1][0] != current:
+            self._totals.append((current, {}))
+        return self._totals[-1][1]
+
+    def _expire(self, current):
+        """Drop the slots out of the window"""
+        while self._totals and self._totals[0][0] <= current - self.slots:
+            self._totals.popleft()
+
+    def averages(self):
+        """Totals and averages of each label over the window
+
+        :returns: Dict of label to a dict of the ``count`` of actions, their
+                  ``calls`` and ``units``, and the ``calls_per_action`` and
+                  ``units_per_action``, which are None for batches.
+
+        """
+        summed = {}
+        with self.lock:
+            self._expire(int(self.clock() / self.slot_length))
+            for _, totals in self._totals:
+                for label, (count, calls, units) in totals.iteritems():
+                    entry = summed.setdefault(label, [0, 0, 0])
+                    entry[0] += count
+                    entry[1] += calls
+                    entry[2] += units
+        averages = {}
+        for label, (count, calls, units) in summed.iteritems():
+            averages[label] = dict(
+                count=count,
+                calls=calls,
+                units=units,
+                calls_per_action=float(calls) / count if count else None,
+                units_per_action=float(units) / count if count else None,
+            )
+        return averages
+
+    def report(self):
+        """Gauge the averages of every action over the window as
+        ``db.action.<label>.calls_per_action`` and ``.units_per_action``
+
+        :returns: The :meth:`averages`.
+
+        """
+        averages = self.averages()
+        for label, entry in averages.iteritems():
+            if entry["count"]:
+                self.metrics.gauge("db.action.%s.calls_per_action" % label,
+                                   entry["calls_per_action"])
+                self.metrics.gauge("db.action.%s.units_per_action" % label,
+                                   entry["units_per_action"])
+        return averages
@@ -1,76 +1,342 @@
 """Database Interaction"""
+import base64
+import datetime
+import hashlib
+import heapq
+import itertools
+import re
+import time
 import uuid
 
+from boto.dynamodb.types import Binary, NonBooleanDynamizer
 from boto.exception import JSONResponseError
 from boto.dynamodb2.exceptions import (
     ConditionalCheckFailedException,
     ItemNotFound,
     ProvisionedThroughputExceededException,
+    ResourceInUseException,
+    ResourceNotFoundException,
 )
 from boto.dynamodb2.fields import HashKey, RangeKey, GlobalKeysOnlyIndex
+from boto.dynamodb2.items import Item
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.table import Table
-from boto.dynamodb2.types import NUMBER
+from boto.dynamodb2.types import BINARY, NUMBER, QUERY_OPERATORS, STRING
+from repoze.lru import LRUCache
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    FirstError,
+    gatherResults,
+    inlineCallbacks,
+    maybeDeferred,
+    returnValue,
+    succeed,
+)
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+from autopush.backend import IRouterTable, IStorage
+from autopush.costs import acting, bound, call_in_action, current_action
+
+
+def pack_uuid(value):
+    """Pack a UUID string into its 16 bytes
+
+    UUIDs spelled other than in the canonical lowercase form are kept as
+    their UTF-8 text, always longer than 16 bytes, so they read back
+    unchanged.
+
+    :raises: :exc:`ValueError` if the value isn't a UUID.
+
+    """
+    parsed = uuid.UUID(value)
+    if str(parsed) == value:
+        return parsed.bytes
+    return value.encode("utf8")
+
+
+def unpack_uuid(data):
+    """Unpack a UUID string packed by :func:`pack_uuid`"""
+    if len(data) == 16:
+        return str(uuid.UUID(bytes=data))
+    return data.decode("utf8")
+
+
+class CompactDynamizer(NonBooleanDynamizer):
+    """Dynamizer storing UUID strings, such as UAIDs and channel IDs, as
+    binary values of 16 bytes instead of strings of 36 characters"""
+    def encode(self, attr):
+        if isinstance(attr, basestring):
+            try:
+                return {BINARY: Binary(pack_uuid(attr)).encode()}
+            except ValueError:
+                pass
+        return super(CompactDynamizer, self).encode(attr)
+
+    def _decode_b(self, attr):
+        return unpack_uuid(base64.b64decode(attr))
+
+
+class CompactTable(Table):
+    """Table of the compact item schema, keyed by binary UUIDs, see
+    :class:`CompactDynamizer`
+
+    Compact router items also store the small integer a
+    :class:`NodeRegistry` assigned to their node instead of its URL.
+
+    """
+    # Binary channel IDs are queried without a lower bound
+    min_chid = None
+
+    def __init__(self, *args, **kwargs):
+        super(CompactTable, self).__init__(*args, **kwargs)
+        self._dynamizer = CompactDynamizer()
 
 
 def create_router_table(tablename="router", read_throughput=5,
-                        write_throughput=5):
-    """Create a new router table"""
-    return Table.create(tablename,
-                        schema=[HashKey("uaid")],
-                        throughput=dict(read=read_throughput,
-                                        write=write_throughput),
-                        global_indexes=[
-                            GlobalKeysOnlyIndex(
-                                'AccessIndex',
-                                parts=[HashKey('last_connect',
-                                               data_type=NUMBER)],
-                                throughput=dict(read=5, write=5))],
-                        )
+                        write_throughput=5, compact=False):
+    """Create a new router table, of the compact item schema with
+    ``compact``"""
+    table_cls = CompactTable if compact else Table
+    key_type = BINARY if compact else STRING
+    return table_cls.create(tablename,
+                            schema=[HashKey("uaid", data_type=key_type)],
+                            throughput=dict(read=read_throughput,
+                                            write=write_throughput),
+                            global_indexes=[
+                                GlobalKeysOnlyIndex(
+                                    'AccessIndex',
+                                    parts=[HashKey('last_connect',
+                                                   data_type=NUMBER)],
+                                    throughput=dict(
+                                        read=read_throughput,
+                                        write=write_throughput))],
+                            )
 
 
 def create_storage_table(tablename="storage", read_throughput=5,
-                         write_throughput=5):
-    """Create a new storage table for simplepush style notification storage"""
+                         write_throughput=5, compact=False):
+    """Create a new storage table for simplepush style notification
+    storage, of the compact item schema with ``compact``"""
+    table_cls = CompactTable if compact else Table
+    key_type = BINARY if compact else STRING
+    return table_cls.create(tablename,
+                            schema=[HashKey("uaid", data_type=key_type),
+                                    RangeKey("chid", data_type=key_type)],
+                            throughput=dict(read=read_throughput,
+                                            write=write_throughput),
+                            )
+
+
+def create_map_storage_table(tablename="storage_map", read_throughput=5,
+                             write_throughput=5, compact=False):
+    """Create a new storage table holding the notifications of each UAID in
+    a single item, see :class:`MapStorage`"""
+    table_cls = CompactTable if compact else Table
+    key_type = BINARY if compact else STRING
+    return table_cls.create(tablename,
+                            schema=[HashKey("uaid", data_type=key_type)],
+                            throughput=dict(read=read_throughput,
+                                            write=write_throughput),
+                            )
+
+
+def create_node_table(tablename="router_nodes", read_throughput=5,
+                      write_throughput=5):
+    """Create a new node registry table, see :class:`NodeRegistry`"""
     return Table.create(tablename,
-                        schema=[HashKey("uaid"), RangeKey("chid")],
+                        schema=[HashKey("key")],
                         throughput=dict(read=read_throughput,
                                         write=write_throughput),
                         )
 
 
+def table_exists(table):
+    """Whether a table exists, checked with a DescribeTable request"""
+    try:
+        table.describe()
+        return True
+    except JSONResponseError as exc:
+        # boto doesn't map a missing table to its own exception
+        if "ResourceNotFoundException" not in (exc.body or {}).get(
+                "__type", ""):
+            raise
+        return False
+
+
 def get_router_table(tablename="router", read_throughput=5,
-                     write_throughput=5):
+                     write_throughput=5, compact=False):
     """Get the main router table object
 
     Creates the table if it doesn't already exist, otherwise returns the
     existing table.
 
     """
-    db = DynamoDBConnection()
-    dblist = db.list_tables()["TableNames"]
-    if tablename not in dblist:
+    table = (CompactTable if compact else Table)(tablename)
+    if not table_exists(table):
         return create_router_table(tablename, read_throughput,
-                                   write_throughput)
-    else:
-        return Table(tablename)
+                                   write_throughput, compact)
+    return table
 
 
 def get_storage_table(tablename="storage", read_throughput=5,
-                      write_throughput=5):
+                      write_throughput=5, compact=False):
     """Get the main storage table object
 
     Creates the table if it doesn't already exist, otherwise returns the
     existing table.
 
     """
-    db = DynamoDBConnection()
-    dblist = db.list_tables()["TableNames"]
-    if tablename not in dblist:
+    table = (CompactTable if compact else Table)(tablename)
+    if not table_exists(table):
         return create_storage_table(tablename, read_throughput,
-                                    write_throughput)
-    else:
-        return Table(tablename)
+                                    write_throughput, compact)
+    return table
+
+
+def get_map_storage_table(tablename="storage_map", read_throughput=5,
+                          write_throughput=5, compact=False):
+    """Get the storage table object of the single item per UAID layout,
+    creating it if it doesn't already exist"""
+    table = (CompactTable if compact else Table)(tablename)
+    if not table_exists(table):
+        return create_map_storage_table(tablename, read_throughput,
+                                        write_throughput, compact)
+    return table
+
+
+def get_node_table(tablename="router_nodes", read_throughput=5,
+                   write_throughput=5):
+    """Get the node registry table object, creating it if it doesn't
+    already exist"""
+    table = Table(tablename)
+    if not table_exists(table):
+        return create_node_table(tablename, read_throughput,
+                                 write_throughput)
+    return table
+
+
+def compact_tablename(tablename):
+    """Name of the compact item schema table replacing a table"""
+    return tablename + "_compact"
+
+
+def map_tablename(tablename):
+    """Name of the single item per UAID storage table replacing a storage
+    table"""
+    return tablename + "_map"
+
+
+def shard_tablenames(tablename, shards=1):
+    """Names of the tables a table is split into
+
+    A single shard keeps the plain table name, so an unsharded deployment
+    needs no migration.
+
+    """
+    if shards <= 1:
+        return [tablename]
+    return ["%s_%d" % (tablename, shard) for shard in range(shards)]
+
+
+def shard_index(uaid, shards):
+    """Shard holding a UAID, from a stable hash of it"""
+    if shards <= 1:
+        return 0
+    if isinstance(uaid, unicode):
+        uaid = uaid.encode("utf8")
+    return int(hashlib.md5(uaid).hexdigest()[:8], 16) % shards
+
+
+def storage_month(when, months_ago=0):
+    """Year and month of the storage table ``months_ago`` months before
+    the datetime ``when``"""
+    index = when.year * 12 + when.month - 1 - months_ago
+    return index // 12, index % 12 + 1
+
+
+def rotating_tablename(tablename, when, months_ago=0):
+    """Name of the storage table holding the notifications saved in a
+    month, such as ``storage_2016_03``"""
+    return "%s_%04d_%02d" % ((tablename,) + storage_month(when, months_ago))
+
+
+def expired_tablenames(tablenames, tablename, when, retention):
+    """Names of the rotating storage tables, and their shards, of months
+    before the last ``retention`` ones"""
+    pattern = re.compile(r"^%s_(\d{4})_(\d{2})(_\d+)?$" %
+                         re.escape(tablename))
+    oldest = storage_month(when, retention - 1)
+    expired = []
+    for name in tablenames:
+        match = pattern.match(name)
+        if match and (int(match.group(1)), int(match.group(2))) < oldest:
+            expired.append(name)
+    return expired
+
+
+def drop_expired_tables(tablename, retention, when=None, connection=None):
+    """Drop the rotating storage tables of months before the last
+    ``retention`` ones, freeing their notifications without spending
+    any write throughput
+
+    Tables another node is already dropping are skipped.
+
+    :returns: Names of the dropped tables.
+    :rtype: list
+
+    """
+    conn = connection or DynamoDBConnection()
+    tablenames = []
+    start = None
+    while True:
+        result = conn.list_tables(exclusive_start_table_name=start)
+        tablenames.extend(result.get("TableNames", []))
+        start = result.get("LastEvaluatedTableName")
+        if not start:
+            break
+    dropped = []
+    for name in expired_tablenames(tablenames, tablename,
+                                   when or datetime.datetime.utcnow(),
+                                   retention):
+        try:
+            conn.delete_table(name)
+            dropped.append(name)
+        except (ResourceInUseException, ResourceNotFoundException):
+            continue
+    return dropped
+
+
+def deferToDB(func, *args, **kwargs):
+    """Call a database method and return a deferred for its result
+
+    Methods of objects flagged as ``deferred`` (such as :class:`AsyncStorage`
+    and :class:`AsyncRouter`) already return a deferred, or never block,
+    and are called directly in the reactor, blocking methods are run in
+    the reactor thread pool with the current action of
+    :mod:`autopush.costs`.
+
+    """
+    owner = getattr(func, "im_self", None)
+    if getattr(owner, "deferred", False) is True:
+        return maybeDeferred(func, *args, **kwargs)
+    return deferToThread(bound(func), *args, **kwargs)
+
+
+def unwrap_first_error(fail):
+    """errBack replacing a :exc:`FirstError` of a gathered request with
+    the failure that caused it"""
+    if fail.check(FirstError):
+        return fail.value.subFailure
+    return fail
+
+
+def trap_condition(fail, result):
+    """errBack returning ``result`` when a conditional check failed"""
+    fail.trap(ConditionalCheckFailedException)
+    return result
 
 
 def preflight_check(storage, router):
@@ -80,19 +346,30 @@ def preflight_check(storage, router):
     Failure to run correctly will raise an exception.
 
     """
+    preflight_storage(storage)
+    preflight_router(router)
+
+
+def preflight_storage(storage):
+    """Store a notification, fetch it and delete it, see
+    :func:`preflight_check`"""
     uaid = str(uuid.uuid4())
     chid = str(uuid.uuid4())
-    node_id = "mynode:2020"
-    connected_at = 0
     version = 12
 
-    # Store a notification, fetch it, delete it
     storage.save_notification(uaid, chid, version)
     notifs = storage.fetch_notifications(uaid)
     assert len(notifs) > 0
     storage.delete_notification(uaid, chid, version)
 
-    # Store a router entry, fetch it, delete it
+
+def preflight_router(router):
+    """Store a router entry, fetch it and delete it, see
+    :func:`preflight_check`"""
+    uaid = str(uuid.uuid4())
+    node_id = "mynode:2020"
+    connected_at = 0
+
     router.register_user(dict(uaid=uaid, node_id=node_id,
                               connected_at=connected_at))
     item = router.get_uaid(uaid)
@@ -100,7 +377,111 @@ def preflight_check(storage, router):
     router.clear_node(item)
 
 
-class Storage(object):
+class NodeRegistry(object):
+    """Registry of the small integers compact router items store in place
+    of node URLs
+
+    Integers come from an atomic counter and are never reused, so both
+    directions of the mapping are cached for good once looked up. The
+    lookups block, :meth:`lookup_id` and :meth:`lookup_url` make them from
+    the thread pool unless the answer is cached.
+
+    """
+    def __init__(self, table):
+        """Create a new NodeRegistry
+
+        :param table: Node registry :class:`Table`, see
+                      :func:`get_node_table`.
+
+        """
+        self.table = table
+        self._ids = {}
+        self._urls = {}
+
+    def _remember(self, node, url):
+        """Cache both directions of a mapping"""
+        self._ids[url] = node
+        self._urls[node] = url
+
+    def _get(self, key):
+        """Get a registry item, None if there is none"""
+        try:
+            return self.table.get_item(consistent=True, key=key)
+        except ProvisionedThroughputExceededException:
+            raise
+        except (ItemNotFound, JSONResponseError):
+            # Moto returns text instead of JSON when looking up values in
+            # empty tables
+            return None
+
+    def node_id(self, url):
+        """Integer of a node URL, registering the URL on first use"""
+        node = self._ids.get(url)
+        if node is None:
+            item = self._get("url:" + url)
+            node = int(item["node"]) if item else self._register(url)
+            self._remember(node, url)
+        return node
+
+    def _register(self, url):
+        """Allocate the next integer for a node URL"""
+        conn = self.table.connection
+        result = conn.update_item(
+            self.table.table_name,
+            {"key": {"S": "counter"}},
+            update_expression="ADD #node :one",
+            expression_attribute_names={"#node": "node"},
+            expression_attribute_values={":one": {"N": "1"}},
+            return_values="UPDATED_NEW",
+        )
+        node = int(result["Attributes"]["node"]["N"])
+        # Make the integer resolvable before the URL can be found
+        self.table.put_item(data={"key": "id:%d" % node, "url": url},
+                            overwrite=True)
+        try:
+            conn.put_item(
+                self.table.table_name,
+                item=self.table._encode_keys({"key": "url:" + url,
+                                              "node": node}),
+                condition_expression="attribute_not_exists(#key)",
+                expression_attribute_names={"#key": "key"},
+            )
+        except ConditionalCheckFailedException:
+            # Another node registered the URL first
+            node = int(self._get("url:" + url)["node"])
+        return node
+
+    def node_url(self, node):
+        """URL of a node integer
+
+        :raises: :exc:`ItemNotFound` if the integer isn't registered.
+
+        """
+        url = self._urls.get(node)
+        if url is None:
+            item = self._get("id:%d" % node)
+            if item is None:
+                raise ItemNotFound("node %d not registered" % node)
+            url = item["url"]
+            self._remember(node, url)
+        return url
+
+    def lookup_id(self, url):
+        """Deferred firing with the integer of a node URL, see
+        :meth:`node_id`"""
+        if url in self._ids:
+            return succeed(self._ids[url])
+        return deferToThread(self.node_id, url)
+
+    def lookup_url(self, node):
+        """Deferred firing with the URL of a node integer, see
+        :meth:`node_url`"""
+        if node in self._urls:
+            return succeed(self._urls[node])
+        return deferToThread(self.node_url, node)
+
+
+class Storage(IStorage):
     """Create a Storage table abstraction on top of a DynamoDB Table object"""
     def __init__(self, table, metrics):
         """Create a new Storage object
@@ -113,23 +494,78 @@ class Storage(object):
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
+        # Channel IDs all sort after this one
+        self.min_chid = getattr(table, "min_chid", " ")
 
-    def fetch_notifications(self, uaid):
+    def _conditions(self, uaid):
+        """Key conditions querying every notification of a UAID"""
+        conditions = dict(uaid__eq=uaid)
+        if self.min_chid is not None:
+            conditions["chid__gt"] = self.min_chid
+        return conditions
+
+    def fetch_notifications(self, uaid, consistent=True):
         """Fetch all notifications for a UAID
 
+        :param consistent: Whether to make a consistent read, or an
+                           eventually consistent one at half the capacity.
         :raises:
             :exc:`ProvisionedThroughputExceededException` if dynamodb table
             exceeds throughput.
 
         """
         try:
-            notifs = self.table.query_2(consistent=True, uaid__eq=uaid,
-                                        chid__gt=" ")
+            notifs = self.table.query_2(consistent=consistent,
+                                        **self._conditions(uaid))
             return list(notifs)
         except ProvisionedThroughputExceededException:
             self.metrics.increment("error.provisioned.fetch_notifications")
             raise
 
+    def _page_query(self, uaid, page_size, start_key, consistent):
+        """Query arguments for a page of a UAID's notification versions"""
+        key_conditions = self.table._build_filters(
+            self._conditions(uaid), using=QUERY_OPERATORS)
+        return dict(key_conditions=key_conditions,
+                    attributes_to_get=["chid", "version"],
+                    consistent_read=consistent,
+                    limit=page_size,
+                    exclusive_start_key=start_key)
+
+    def _load_page(self, result):
+        """Decode a page of a query into items and the next page's key"""
+        notifs = []
+        for raw in result.get("Items", []):
+            item = Item(self.table)
+            item.load({"Item": raw})
+            notifs.append(item)
+        return notifs, result.get("LastEvaluatedKey")
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, holding only the
+        chid and version of each
+
+        :param page_size: Maximum amount of notifications in the page.
+        :param start_key: Key returned with the previous page to continue
+                          from.
+        :param consistent: Whether to make a consistent read.
+        :returns: Tuple of the notifications and the key to fetch the next
+                  page with, None for the last page.
+        :raises:
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        try:
+            result = self.table.connection.query(
+                self.table.table_name,
+                **self._page_query(uaid, page_size, start_key, consistent))
+            return self._load_page(result)
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.fetch_notifications")
+            raise
+
     def save_notification(self, uaid, chid, version):
         """Save a notification for the UAID
 
@@ -174,24 +610,66 @@ class Storage(object):
             self.metrics.increment("error.provisioned.delete_notification")
             return False
 
+    def delete_notifications(self, keys):
+        """Delete several notifications with batch writes of up to 25
+        items, resending unprocessed items
+
+        Unlike :meth:`delete_notification` the deletes can't be
+        conditioned on the version, so ack'd notifications aren't deleted
+        this way.
+
+        :param keys: List of (uaid, chid) tuples to delete.
+        :returns: Whether or not the notifications were able to be deleted.
+        :rtype: bool
+
+        """
+        try:
+            with self.table.batch_write() as batch:
+                for uaid, chid in keys:
+                    batch.delete_item(uaid=uaid, chid=chid)
+            return True
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.delete_notifications")
+            return False
+
 
-class Router(object):
+class Router(IRouterTable):
     """Create a Router table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    def __init__(self, table, metrics, registry=None):
         """Create a new Router object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param registry: :class:`NodeRegistry` of the node integers stored
+                         in place of node URLs, for compact tables.
 
         """
         self.table = table
         self.metrics = metrics
+        self.registry = registry
         self.encode = table._encode_keys
 
-    def get_uaid(self, uaid):
+    def _compact_node(self, item):
+        """Node integer a compact item stores, None if it stores a URL"""
+        node = item.get("node_id") if item else None
+        if self.registry is None or node is None or \
+                isinstance(node, basestring):
+            return None
+        return int(node)
+
+    def _load_node(self, item):
+        """Swap the node integer of a compact item for the node URL"""
+        node = self._compact_node(item)
+        if node is not None:
+            item["node_id"] = self.registry.node_url(node)
+        return item
+
+    def get_uaid(self, uaid, consistent=True):
         """Get the database record for the UAID
 
+        :param consistent: Whether to make a consistent read, or an
+                           eventually consistent one at half the capacity.
         :returns: User item
         :rtype: :class:`~boto.dynamodb2.items.Item`
         :raises:
@@ -201,7 +679,8 @@ class Router(object):
 
         """
         try:
-            return self.table.get_item(consistent=True, uaid=uaid)
+            return self._load_node(
+                self.table.get_item(consistent=consistent, uaid=uaid))
         except ProvisionedThroughputExceededException:
             self.metrics.increment("error.provisioned.get_uaid")
             raise
@@ -211,6 +690,60 @@ class Router(object):
             # correct ItemNotFound exception
             raise ItemNotFound("uaid not found")
 
+    def get_uaids(self, uaids, consistent=True):
+        """Get the database records for several UAIDs in one batch read
+
+        :param consistent: Whether to make a consistent read.
+        :returns: Dict of UAID to user item, UAIDs without a record are
+                  left out.
+        :rtype: dict
+        :raises:
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        try:
+            items = self.table.batch_get(
+                keys=[dict(uaid=uaid) for uaid in uaids],
+                consistent=consistent)
+            return dict((item["uaid"], self._load_node(item))
+                        for item in items)
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.get_uaid")
+            raise
+
+    def _register_args(self, data, node=None):
+        """Build the key and ``update_item`` arguments to register a user,
+        storing the ``node`` integer in place of the node URL if given"""
+        db_key = self.encode({"uaid": data.pop("uaid")})
+        if node is not None:
+            data = dict(data, node_id=node)
+        # Generate our update expression
+        expr = "SET " + ", ".join(["%s=:%s" % (x, x) for x in data.keys()])
+        expr_values = self.encode({":%s" % k: v for k, v in data.items()})
+        cond = " or ".join([
+            "attribute_not_exists(node_id)",
+            "(connected_at < :connected_at)",
+        ])
+        return db_key, dict(
+            update_expression=expr,
+            condition_expression=cond,
+            expression_attribute_values=expr_values,
+            return_values="ALL_OLD",
+        )
+
+    def _decode_attributes(self, result):
+        """Decode the old attributes returned from ``update_item``"""
+        if "Attributes" in result:
+            r = {}
+            for key, value in result["Attributes"].items():
+                try:
+                    r[key] = self.table._dynamizer.decode(value)
+                except AttributeError:
+                    r[key] = value
+            result = r
+        return result
+
     def register_user(self, data):
         """Register this user
 
@@ -225,38 +758,43 @@ class Router(object):
 
         """
         conn = self.table.connection
-        db_key = self.encode({"uaid": data.pop("uaid")})
-        # Generate our update expression
-        expr = "SET " + ", ".join(["%s=:%s" % (x, x) for x in data.keys()])
-        expr_values = self.encode({":%s" % k: v for k, v in data.items()})
+        node = None
+        if self.registry is not None and data.get("node_id"):
+            node = self.registry.node_id(data["node_id"])
+        db_key, kwargs = self._register_args(data, node)
         try:
-            cond = " or ".join([
-                "attribute_not_exists(node_id)",
-                "(connected_at < :connected_at)",
-            ])
-            result = conn.update_item(
-                self.table.table_name,
-                db_key,
-                update_expression=expr,
-                condition_expression=cond,
-                expression_attribute_values=expr_values,
-                return_values="ALL_OLD",
-            )
-            if "Attributes" in result:
-                r = {}
-                for key, value in result["Attributes"].items():
-                    try:
-                        r[key] = self.table._dynamizer.decode(value)
-                    except AttributeError:
-                        r[key] = value
-                result = r
-            return (True, result)
+            result = conn.update_item(self.table.table_name, db_key, **kwargs)
+            return (True, self._load_node(self._decode_attributes(result)))
         except ConditionalCheckFailedException:
             return (False, {})
         except ProvisionedThroughputExceededException:
             self.metrics.increment("error.provisioned.register_user")
             raise
 
+    def invalidate(self, uaid):
+        """Drop any locally cached record for the UAID
+
+        The DynamoDB router keeps no local copies, so there is nothing to do.
+
+        """
+
+    def _clear_args(self, item, node_id):
+        """Build the key and ``update_item`` arguments to clear a node
+
+        Only the node and connection time are removed, so the record keeps
+        the ``last_connect`` the idle UAID reaper goes by.
+
+        """
+        return self.encode({"uaid": item["uaid"]}), dict(
+            update_expression="REMOVE node_id, connected_at",
+            condition_expression="(node_id = :node) and "
+                                 "(connected_at = :conn)",
+            expression_attribute_values=self.encode({
+                ":node": node_id,
+                ":conn": item["connected_at"],
+            }),
+        )
+
     def clear_node(self, item):
         """Given a router item and remove the node_id
 
@@ -274,21 +812,1817 @@ class Router(object):
         # Pop out the node_id
         node_id = item["node_id"]
         del item["node_id"]
+        if self.registry is not None:
+            node_id = self.registry.node_id(node_id)
 
         try:
-            cond = "(node_id = :node) and (connected_at = :conn)"
-            conn.put_item(
-                self.table.table_name,
-                item=item.get_raw_keys(),
-                condition_expression=cond,
-                expression_attribute_values=self.encode({
-                    ":node": node_id,
-                    ":conn": item["connected_at"],
-                }),
-            )
+            db_key, kwargs = self._clear_args(item, node_id)
+            conn.update_item(self.table.table_name, db_key, **kwargs)
             return True
         except ConditionalCheckFailedException:
             return False
         except ProvisionedThroughputExceededException:
             self.metrics.increment("error.provisioned.clear_node")
             raise
+
+
+class AsyncStorage(Storage):
+    """Storage table abstraction whose methods return deferreds
+
+    The ``table`` must use a non-blocking connection such as
+    :class:`~autopush.dynamodb.AsyncDynamoDBConnection`.
+
+    """
+    deferred = True
+
+    @inlineCallbacks
+    def _query(self, uaid, consistent):
+        """Query every page of notifications for a UAID"""
+        conn = self.table.connection
+        key_conditions = self.table._build_filters(
+            self._conditions(uaid), using=QUERY_OPERATORS)
+        notifs = []
+        last_key = None
+        action = current_action()
+        while True:
+            result = yield call_in_action(action, conn.query,
+                                          self.table.table_name,
+                                          key_conditions=key_conditions,
+                                          consistent_read=consistent,
+                                          exclusive_start_key=last_key)
+            for raw in result.get("Items", []):
+                item = Item(self.table)
+                item.load({"Item": raw})
+                notifs.append(item)
+            last_key = result.get("LastEvaluatedKey")
+            if not last_key:
+                returnValue(notifs)
+
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID
+
+        :returns: Deferred firing with a list of notification items.
+
+        """
+        d = self._query(uaid, consistent)
+        d.addErrback(self._provisioned_err, "fetch_notifications")
+        return d
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`Storage.fetch_notifications_page`
+
+        :returns: Deferred firing with a tuple of the notifications and the
+                  key to fetch the next page with.
+
+        """
+        d = self.table.connection.query(
+            self.table.table_name,
+            **self._page_query(uaid, page_size, start_key, consistent))
+        d.addCallback(self._load_page)
+        d.addErrback(self._provisioned_err, "fetch_notifications")
+        return d
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID
+
+        :returns: Deferred firing with whether the notification was saved.
+
+        """
+        conn = self.table.connection
+        cond = "attribute_not_exists(version) or version < :ver"
+        d = conn.put_item(
+            self.table.table_name,
+            item=self.encode(dict(uaid=uaid, chid=chid, version=version)),
+            condition_expression=cond,
+            expression_attribute_values={
+                ":ver": {'N': str(version)}
+            }
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(trap_condition, False)
+        d.addErrback(self._provisioned_err, "save_notification")
+        return d
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID
+
+        :returns: Deferred firing with whether or not the notification was
+                  able to be deleted.
+
+        """
+        conn = self.table.connection
+        kwargs = {}
+        if version:
+            kwargs["condition_expression"] = "version = :ver"
+            kwargs["expression_attribute_values"] = {
+                ":ver": {'N': str(version)}
+            }
+        d = conn.delete_item(self.table.table_name,
+                             self.encode(dict(uaid=uaid, chid=chid)),
+                             **kwargs)
+        d.addCallback(lambda _: True)
+        d.addErrback(trap_condition, True)
+        d.addErrback(self._delete_err)
+        return d
+
+    @inlineCallbacks
+    def _batch_delete(self, keys):
+        """Delete keys 25 at a time, retrying unprocessed items"""
+        conn = self.table.connection
+        name = self.table.table_name
+        requests = [
+            {"DeleteRequest": {"Key": self.encode(dict(uaid=uaid,
+                                                       chid=chid))}}
+            for uaid, chid in keys
+        ]
+        attempt = 0
+        action = current_action()
+        while requests:
+            if attempt:
+                yield deferLater(reactor, min(0.05 * 2 ** attempt, 1),
+                                 lambda: None)
+            chunk, requests = requests[:25], requests[25:]
+            result = yield call_in_action(action, conn.batch_write_item,
+                                          {name: chunk})
+            unprocessed = result.get("UnprocessedItems", {}).get(name, [])
+            requests.extend(unprocessed)
+            attempt = attempt + 1 if unprocessed else 0
+        returnValue(True)
+
+    def delete_notifications(self, keys):
+        """Delete several notifications with batch writes of up to 25
+        items, see :meth:`Storage.delete_notifications`
+
+        :returns: Deferred firing with whether or not the notifications
+                  were able to be deleted.
+
+        """
+        d = self._batch_delete(keys)
+        d.addErrback(self._delete_err, "delete_notifications")
+        return d
+
+    def _provisioned_err(self, fail, name):
+        """errBack recording provisioned throughput errors"""
+        fail.trap(ProvisionedThroughputExceededException)
+        self.metrics.increment("error.provisioned.%s" % name)
+        return fail
+
+    def _delete_err(self, fail, name="delete_notification"):
+        """errBack for a delete exceeding throughput, reported as not
+        deleted"""
+        fail.trap(ProvisionedThroughputExceededException)
+        self.metrics.increment("error.provisioned.%s" % name)
+        return False
+
+
+class MapStorage(Storage):
+    """Storage table abstraction keeping every notification of a UAID in a
+    single item, as a map of chid to version
+
+    Fetching the notifications takes a single GetItem instead of a Query,
+    and deleting several of a UAID's notifications a single UpdateItem. The
+    notifications are returned as dicts of the ``uaid``, ``chid`` and
+    ``version``.
+
+    """
+    map_attribute = "chids"
+
+    # Most channels removed by one update
+    max_remove = 100
+
+    def _load(self, uaid, result):
+        """Load the notifications of a ``get_item`` result"""
+        raw = (result or {}).get("Item", {}).get(self.map_attribute)
+        if not raw:
+            return []
+        chids = self.table._dynamizer.decode(raw)
+        return [dict(uaid=uaid, chid=chid, version=chids[chid])
+                for chid in sorted(chids)]
+
+    def _page(self, notifs, page_size, start_key):
+        """Cut a page of notifications after the ``start_key`` chid"""
+        if start_key is not None:
+            notifs = [notif for notif in notifs if notif["chid"] > start_key]
+        page = notifs[:page_size]
+        if len(notifs) > page_size:
+            return page, page[-1]["chid"]
+        return page, None
+
+    def _get_item(self, uaid, consistent):
+        """Read the item of a UAID"""
+        return self.table.connection.get_item(self.table.table_name,
+                                              self.encode({"uaid": uaid}),
+                                              consistent_read=consistent)
+
+    def _save_attempts(self, uaid, chid, version):
+        """``update_item`` arguments of the attempts to save a notification
+
+        The version is set in the map of an existing item, unless a newer
+        one is there. Without a map the item is created, and should another
+        node create it first the first attempt is retried.
+
+        """
+        names = {"#map": self.map_attribute, "#chid": chid}
+        values = {":ver": {"N": str(version)}}
+        update = dict(
+            update_expression="SET #map.#chid = :ver",
+            condition_expression="attribute_exists(#map) and "
+                                 "(attribute_not_exists(#map.#chid) or "
+                                 "#map.#chid < :ver)",
+            expression_attribute_names=names,
+            expression_attribute_values=values,
+        )
+        create = dict(
+            update_expression="SET #map = :map",
+            condition_expression="attribute_not_exists(#map)",
+            expression_attribute_names={"#map": self.map_attribute},
+            expression_attribute_values={
+                ":map": {"M": {chid: values[":ver"]}}},
+        )
+        return [update, create, update]
+
+    def _remove_args(self, chids, version=None):
+        """``update_item`` arguments removing channels from the map, only
+        if they hold the ``version`` if given"""
+        names = {"#map": self.map_attribute}
+        paths = []
+        for i, chid in enumerate(chids):
+            names["#c%d" % i] = chid
+            paths.append("#map.#c%d" % i)
+        kwargs = dict(
+            update_expression="REMOVE " + ", ".join(paths),
+            condition_expression="attribute_exists(#map)",
+            expression_attribute_names=names,
+        )
+        if version:
+            kwargs["condition_expression"] += " and #map.#c0 = :ver"
+            kwargs["expression_attribute_values"] = {
+                ":ver": {"N": str(version)}}
+        return kwargs
+
+    def _removals(self, keys):
+        """Group (uaid, chid) keys into the removals of up to
+        :attr:`max_remove` channels of a UAID"""
+        grouped = {}
+        for uaid, chid in keys:
+            grouped.setdefault(uaid, []).append(chid)
+        for uaid, chids in grouped.items():
+            for i in range(0, len(chids), self.max_remove):
+                yield uaid, chids[i:i + self.max_remove]
+
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID, see
+        :meth:`Storage.fetch_notifications`"""
+        try:
+            return self._load(uaid, self._get_item(uaid, consistent))
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.fetch_notifications")
+            raise
+        except JSONResponseError:
+            # Moto returns text instead of JSON when looking up values in
+            # empty tables
+            return []
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`Storage.fetch_notifications_page`
+
+        The whole item is read for every page, the page key is the last
+        chid of the page.
+
+        """
+        return self._page(self.fetch_notifications(uaid, consistent),
+                          page_size, start_key)
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID, see
+        :meth:`Storage.save_notification`"""
+        conn = self.table.connection
+        key = self.encode({"uaid": uaid})
+        try:
+            for kwargs in self._save_attempts(uaid, chid, version):
+                try:
+                    conn.update_item(self.table.table_name, key, **kwargs)
+                    return True
+                except ConditionalCheckFailedException:
+                    pass
+            return False
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.save_notification")
+            raise
+
+    def _remove(self, uaid, chids, version=None):
+        """Remove channels from the map of a UAID"""
+        try:
+            self.table.connection.update_item(
+                self.table.table_name, self.encode({"uaid": uaid}),
+                **self._remove_args(chids, version))
+        except ConditionalCheckFailedException:
+            pass
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID, see
+        :meth:`Storage.delete_notification`"""
+        try:
+            self._remove(uaid, [chid], version)
+            return True
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.delete_notification")
+            return False
+
+    def delete_notifications(self, keys):
+        """Delete several notifications, removing each UAID's channels with
+        one update, see :meth:`Storage.delete_notifications`"""
+        try:
+            for uaid, chids in self._removals(keys):
+                self._remove(uaid, chids)
+            return True
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.delete_notifications")
+            return False
+
+
+class AsyncMapStorage(MapStorage, AsyncStorage):
+    """Single item per UAID storage abstraction whose methods return
+    deferreds, see :class:`MapStorage` and :class:`AsyncStorage`"""
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID
+
+        :returns: Deferred firing with a list of notifications.
+
+        """
+        d = self._get_item(uaid, consistent)
+        d.addCallback(lambda result: self._load(uaid, result))
+        d.addErrback(self._provisioned_err, "fetch_notifications")
+        return d
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`MapStorage.fetch_notifications_page`
+
+        :returns: Deferred firing with a tuple of the notifications and the
+                  key to fetch the next page with.
+
+        """
+        d = self.fetch_notifications(uaid, consistent)
+        d.addCallback(self._page, page_size, start_key)
+        return d
+
+    @inlineCallbacks
+    def _save(self, uaid, chid, version):
+        """Make the attempts to save a notification"""
+        conn = self.table.connection
+        key = self.encode({"uaid": uaid})
+        action = current_action()
+        for kwargs in self._save_attempts(uaid, chid, version):
+            try:
+                yield call_in_action(action, conn.update_item,
+                                     self.table.table_name, key, **kwargs)
+                returnValue(True)
+            except ConditionalCheckFailedException:
+                pass
+        returnValue(False)
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID
+
+        :returns: Deferred firing with whether the notification was saved.
+
+        """
+        d = self._save(uaid, chid, version)
+        d.addErrback(self._provisioned_err, "save_notification")
+        return d
+
+    def _remove(self, uaid, chids, version=None):
+        """Remove channels from the map of a UAID"""
+        d = self.table.connection.update_item(
+            self.table.table_name, self.encode({"uaid": uaid}),
+            **self._remove_args(chids, version))
+        d.addCallback(lambda _: True)
+        d.addErrback(trap_condition, True)
+        return d
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID
+
+        :returns: Deferred firing with whether or not the notification was
+                  able to be deleted.
+
+        """
+        d = self._remove(uaid, [chid], version)
+        d.addErrback(self._delete_err)
+        return d
+
+    def delete_notifications(self, keys):
+        """Delete several notifications, see
+        :meth:`MapStorage.delete_notifications`
+
+        :returns: Deferred firing with whether or not the notifications
+                  were able to be deleted.
+
+        """
+        d = gatherResults([self._remove(uaid, chids)
+                           for uaid, chids in self._removals(keys)],
+                          consumeErrors=True)
+        d.addCallback(lambda _: True)
+        d.addErrback(unwrap_first_error)
+        d.addErrback(self._delete_err, "delete_notifications")
+        return d
+
+
+class AsyncRouter(Router):
+    """Router table abstraction whose methods return deferreds
+
+    The ``table`` must use a non-blocking connection such as
+    :class:`~autopush.dynamodb.AsyncDynamoDBConnection`.
+
+    """
+    deferred = True
+
+    def get_uaid(self, uaid, consistent=True):
+        """Get the database record for the UAID
+
+        :returns: Deferred firing with the user item, or failing with
+                  :exc:`ItemNotFound` if there is no record for this UAID.
+
+        """
+        d = self.table.connection.get_item(self.table.table_name,
+                                           self.encode({"uaid": uaid}),
+                                           consistent_read=consistent)
+        d.addCallback(self._load_item)
+        d.addCallback(self._resolve_node)
+        d.addErrback(self._provisioned_err, "get_uaid")
+        return d
+
+    def _resolve_node(self, item):
+        """Swap the node integer of a compact item for the node URL
+
+        :returns: The item, or a deferred firing with it once the node URL
+                  is known.
+
+        """
+        node = self._compact_node(item)
+        if node is None:
+            return item
+
+        def swap(url):
+            item["node_id"] = url
+            return item
+        return self.registry.lookup_url(node).addCallback(swap)
+
+    @inlineCallbacks
+    def _batch_get(self, uaids, consistent):
+        """Read the records of several UAIDs, retrying unprocessed keys"""
+        conn = self.table.connection
+        name = self.table.table_name
+        keys = [self.encode({"uaid": uaid}) for uaid in uaids]
+        found = {}
+        attempt = 0
+        action = current_action()
+        while keys:
+            if attempt:
+                yield deferLater(reactor, min(0.05 * 2 ** attempt, 1),
+                                 lambda: None)
+            result = yield call_in_action(action, conn.batch_get_item, {
+                name: {"Keys": keys, "ConsistentRead": consistent}
+            })
+            for raw in result.get("Responses", {}).get(name, []):
+                item = Item(self.table)
+                item.load({"Item": raw})
+                found[item["uaid"]] = yield self._resolve_node(item)
+            keys = result.get("UnprocessedKeys", {}).get(
+                name, {}).get("Keys", [])
+            attempt += 1
+        returnValue(found)
+
+    def get_uaids(self, uaids, consistent=True):
+        """Get the database records for several UAIDs in one batch read
+
+        :returns: Deferred firing with a dict of UAID to user item, UAIDs
+                  without a record are left out.
+
+        """
+        d = self._batch_get(uaids, consistent)
+        d.addErrback(self._provisioned_err, "get_uaid")
+        return d
+
+    def register_user(self, data):
+        """Register this user
+
+        :returns: Deferred firing with a tuple of whether the user was
+                  registered, and the previous user data.
+
+        """
+        if self.registry is not None and data.get("node_id"):
+            d = self.registry.lookup_id(data["node_id"])
+        else:
+            d = succeed(None)
+        d.addCallback(bound(self._register), data)
+        d.addErrback(self._provisioned_err, "register_user")
+        return d
+
+    def _register(self, node, data):
+        """Register a user once the integer of its node is known"""
+        db_key, kwargs = self._register_args(data, node)
+        d = self.table.connection.update_item(self.table.table_name, db_key,
+                                              **kwargs)
+        d.addCallback(self._decode_attributes)
+        d.addCallback(self._resolve_node)
+        d.addCallback(lambda previous: (True, previous))
+        d.addErrback(trap_condition, (False, {}))
+        return d
+
+    def clear_node(self, item):
+        """Given a router item and remove the node_id
+
+        :returns: Deferred firing with whether the node was cleared or not.
+
+        """
+        node_id = item["node_id"]
+        del item["node_id"]
+
+        if self.registry is not None:
+            d = self.registry.lookup_id(node_id)
+        else:
+            d = succeed(node_id)
+        d.addCallback(bound(self._clear), item)
+        d.addCallback(lambda _: True)
+        d.addErrback(trap_condition, False)
+        d.addErrback(self._provisioned_err, "clear_node")
+        return d
+
+    def _clear(self, node, item):
+        """Clear the node once its integer is known"""
+        db_key, kwargs = self._clear_args(item, node)
+        return self.table.connection.update_item(self.table.table_name,
+                                                 db_key, **kwargs)
+
+    def _load_item(self, result):
+        """Load a ``get_item`` result into an Item"""
+        if not result or "Item" not in result:
+            raise ItemNotFound("uaid not found")
+        item = Item(self.table)
+        item.load(result)
+        return item
+
+    def _provisioned_err(self, fail, name):
+        """errBack recording provisioned throughput errors"""
+        fail.trap(ProvisionedThroughputExceededException)
+        self.metrics.increment("error.provisioned.%s" % name)
+        return fail
+
+
+def fire_waiters(result, waiters):
+    """Fire every deferred in ``waiters`` with a shared result or failure"""
+    for d in waiters:
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+def merge_notifications(notifs):
+    """Keep only the newest version of each channel's notification"""
+    newest = {}
+    for notif in notifs:
+        kept = newest.get(notif["chid"])
+        if kept is None or int(notif["version"]) > int(kept["version"]):
+            newest[notif["chid"]] = notif
+    return newest.values()
+
+
+def copy_item(item):
+    """Copy a router item so callers can't modify a cached instance"""
+    if isinstance(item, Item):
+        return Item(item.table, data=dict(item.items()), loaded=True)
+    return dict(item)
+
+
+class CachedRouter(object):
+    """Read-through cache of router items in front of a router table
+
+    Items are kept in a bounded LRU cache for up to ``ttl`` seconds. Local
+    :meth:`register_user` and :meth:`clear_node` calls, and callers that
+    find the cached ``node_id`` no longer delivers (:meth:`invalidate`),
+    drop the cached item so the next lookup reads it from the table again.
+
+    """
+    deferred = True
+
+    def __init__(self, router, size=10000, ttl=30):
+        """Create a new CachedRouter
+
+        :param router: :class:`Router` or :class:`AsyncRouter` to cache.
+        :param size: Maximum amount of router items to keep.
+        :param ttl: Seconds a router item is used before being re-read.
+
+        """
+        self.router = router
+        self.table = router.table
+        self.metrics = router.metrics
+        self.ttl = ttl
+        self._cache = LRUCache(size)
+        # Lookups in progress, so invalidated ones aren't cached
+        self._fetching = {}
+
+    def get_uaid(self, uaid, consistent=True):
+        """Get the router item for the UAID, from the cache if it's fresh
+
+        :param consistent: Whether a cache miss is read consistently.
+        :returns: Deferred firing with a copy of the user item.
+
+        """
+        entry = self._cache.get(uaid)
+        if entry is not None:
+            expires, item = entry
+            if expires > time.time():
+                self.metrics.increment("router.cache.hit")
+                return succeed(copy_item(item))
+            self.metrics.increment("router.cache.stale")
+            self._cache.invalidate(uaid)
+        else:
+            self.metrics.increment("router.cache.miss")
+
+        token = self._fetching[uaid] = object()
+        d = deferToDB(self.router.get_uaid, uaid, consistent=consistent)
+        d.addBoth(self._fetched, uaid, token)
+        return d
+
+    def _fetched(self, result, uaid, token):
+        """Store a looked up item unless it was invalidated meanwhile"""
+        if self._fetching.get(uaid) is token:
+            del self._fetching[uaid]
+            if not isinstance(result, Failure):
+                self._cache.put(uaid, (time.time() + self.ttl, result))
+                return copy_item(result)
+        return result
+
+    def invalidate(self, uaid):
+        """Drop the cached item for the UAID as its data is stale"""
+        if self._cache.get(uaid) is not None:
+            self.metrics.increment("router.cache.stale")
+        self._drop(uaid)
+        self.router.invalidate(uaid)
+
+    def register_user(self, data):
+        """Register this user, see :meth:`Router.register_user`"""
+        self._drop(data["uaid"])
+        return deferToDB(self.router.register_user, data)
+
+    def clear_node(self, item):
+        """Clear the node for the user, see :meth:`Router.clear_node`"""
+        self._drop(item["uaid"])
+        return deferToDB(self.router.clear_node, item)
+
+    def _drop(self, uaid):
+        """Remove the UAID from the cache and any lookup in progress"""
+        self._fetching.pop(uaid, None)
+        self._cache.invalidate(uaid)
+
+
+class CoalescingRouter(object):
+    """Router wrapper sharing concurrent lookups of the same UAID
+
+    While a :meth:`get_uaid` for a UAID is in flight, further lookups of it
+    wait for the same request and share its result or failure.
+
+    With a ``batch_window``, lookups of different UAIDs arriving within the
+    window are gathered and read with a single ``BatchGetItem`` request of
+    up to ``batch_size`` keys.
+
+    """
+    deferred = True
+
+    def __init__(self, router, batch_window=0, batch_size=100):
+        """Create a new CoalescingRouter
+
+        :param router: :class:`Router` or :class:`AsyncRouter` to coalesce
+                       lookups for.
+        :param batch_window: Seconds to gather lookups for a batch, 0 looks
+                             up each UAID on its own.
+        :param batch_size: Maximum amount of keys in a batch, at most 100.
+
+        """
+        self.router = router
+        self.table = router.table
+        self.metrics = router.metrics
+        self.batch_window = batch_window
+        self.batch_size = min(batch_size, 100)
+        # Deferreds waiting on the lookup in flight for each UAID
+        self._waiting = {}
+        # UAIDs and their waiters gathered for the next batch
+        self._batch = []
+        self._batch_call = None
+
+    def get_uaid(self, uaid, consistent=True):
+        """Get the router item for the UAID, sharing a lookup in flight
+
+        Consistent and eventually consistent lookups are shared separately.
+
+        :returns: Deferred firing with a copy of the user item.
+
+        """
+        d = Deferred()
+        key = (uaid, consistent)
+        waiters = self._waiting.get(key)
+        if waiters is not None:
+            self.metrics.increment("router.coalesce.shared")
+            waiters.append(d)
+            return d
+
+        waiters = self._waiting[key] = [d]
+        if not self.batch_window:
+            lookup = deferToDB(self.router.get_uaid, uaid,
+                               consistent=consistent)
+            lookup.addBoth(self._finish, key, waiters)
+            return d
+
+        self._batch.append((key, waiters))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif not self._batch_call:
+            self._batch_call = reactor.callLater(self.batch_window,
+                                                 self._flush)
+        return d
+
+    def _finish(self, result, key, waiters):
+        """Fire the waiters of a lookup with its result"""
+        if self._waiting.get(key) is waiters:
+            del self._waiting[key]
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(copy_item(result))
+
+    def _flush(self):
+        """Look up the gathered UAIDs in batches"""
+        if self._batch_call and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        pending, self._batch = self._batch, []
+        for consistent in (True, False):
+            lookups = [entry for entry in pending
+                       if entry[0][1] is consistent]
+            for start in range(0, len(lookups), self.batch_size):
+                chunk = lookups[start:start + self.batch_size]
+                self.metrics.gauge("router.coalesce.batch_size", len(chunk))
+                with acting("router.batch"):
+                    d = deferToDB(self.router.get_uaids,
+                                  [uaid for (uaid, _), _ in chunk],
+                                  consistent=consistent)
+                d.addBoth(self._finish_batch, chunk)
+
+    def _finish_batch(self, result, chunk):
+        """Fire the waiters of every UAID in a batch"""
+        if isinstance(result, Failure):
+            for key, waiters in chunk:
+                self._finish(result, key, waiters)
+            return
+
+        for key, waiters in chunk:
+            item = result.get(key[0])
+            if item is None:
+                self._finish(Failure(ItemNotFound("uaid not found")), key,
+                             waiters)
+            else:
+                self._finish(item, key, waiters)
+
+    def invalidate(self, uaid):
+        """Start a new lookup for later requests of the UAID"""
+        self._forget(uaid)
+        return self.router.invalidate(uaid)
+
+    def register_user(self, data):
+        """Register this user, see :meth:`Router.register_user`"""
+        self._forget(data["uaid"])
+        return deferToDB(self.router.register_user, data)
+
+    def clear_node(self, item):
+        """Clear the node for the user, see :meth:`Router.clear_node`"""
+        self._forget(item["uaid"])
+        return deferToDB(self.router.clear_node, item)
+
+    def _forget(self, uaid):
+        """Stop sharing the lookups in flight for the UAID"""
+        self._waiting.pop((uaid, True), None)
+        self._waiting.pop((uaid, False), None)
+
+
+class WriteBehindStorage(object):
+    """Storage wrapper coalescing notification writes
+
+    Notifications saved with :meth:`save_notification` are queued for a
+    short window instead of being written at once. Saves for the same UAID
+    and channel within the window collapse into one conditional write of
+    the highest version, as the storage table only keeps the newest version
+    for a channel anyway.
+
+    The queue is flushed when the window ends or ``max_pending`` channels
+    are queued. Every save fires once its write is done, with the result
+    of the write it collapsed into.
+
+    """
+    deferred = True
+
+    def __init__(self, storage, window=0.01, max_pending=500):
+        """Create a new WriteBehindStorage
+
+        :param storage: :class:`Storage` or :class:`AsyncStorage` to write
+                        notifications to.
+        :param window: Seconds to queue writes before flushing them.
+        :param max_pending: Amount of queued channels that flushes the
+                            queue early.
+
+        """
+        self.storage = storage
+        self.table = storage.table
+        self.metrics = storage.metrics
+        self.window = window
+        self.max_pending = max_pending
+        # (uaid, chid) -> [version, waiting deferreds]
+        self._pending = {}
+        self._saves = 0
+        self._flush_call = None
+
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID, see
+        :meth:`Storage.fetch_notifications`"""
+        return deferToDB(self.storage.fetch_notifications, uaid,
+                         consistent=consistent)
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`Storage.fetch_notifications_page`"""
+        return deferToDB(self.storage.fetch_notifications_page, uaid,
+                         page_size, start_key, consistent=consistent)
+
+    def save_notification(self, uaid, chid, version):
+        """Queue a notification for the UAID to be saved
+
+        :returns: Deferred firing with whether the notification was saved,
+                  once the queued write is done.
+
+        """
+        self._saves += 1
+        key = (uaid, chid)
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.metrics.increment("storage.writebehind.collapsed")
+            if version <= pending[0]:
+                # The queued version would already fail this one's condition
+                return succeed(False)
+            pending[0] = version
+            d = Deferred()
+            pending[1].append(d)
+            return d
+
+        d = Deferred()
+        self._pending[key] = [version, [d]]
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+        elif not self._flush_call:
+            self._flush_call = reactor.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        """Write out all queued notifications"""
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        pending, self._pending = self._pending, {}
+        saves, self._saves = self._saves, 0
+        self.metrics.gauge("storage.writebehind.queue_depth", len(pending))
+        if saves:
+            self.metrics.gauge("storage.writebehind.collapse_ratio",
+                               1 - float(len(pending)) / saves)
+        with acting("storage.write_behind"):
+            for (uaid, chid), (version, waiters) in pending.iteritems():
+                d = deferToDB(self.storage.save_notification, uaid=uaid,
+                              chid=chid, version=version)
+                d.addBoth(fire_waiters, waiters)
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID, see
+        :meth:`Storage.delete_notification`"""
+        return deferToDB(self.storage.delete_notification, uaid, chid,
+                         version)
+
+    def delete_notifications(self, keys):
+        """Delete several notifications, see
+        :meth:`Storage.delete_notifications`"""
+        return deferToDB(self.storage.delete_notifications, keys)
+
+
+class DeleteQueue(object):
+    """Node-wide queue gathering notification deletes into batch writes
+
+    Deletes requested by any connection within the ``window`` are sent
+    together through :meth:`Storage.delete_notifications`, which splits
+    them into batch writes of up to 25 items.
+
+    """
+    deferred = True
+
+    def __init__(self, storage, window=0.01, max_pending=100):
+        """Create a new DeleteQueue
+
+        :param storage: :class:`Storage` or :class:`AsyncStorage` to delete
+                        notifications from.
+        :param window: Seconds to gather deletes before flushing them.
+        :param max_pending: Amount of queued deletes that flushes the queue
+                            early.
+
+        """
+        self.storage = storage
+        self.metrics = storage.metrics
+        self.window = window
+        self.max_pending = max_pending
+        self._keys = set()
+        self._waiters = []
+        self._flush_call = None
+
+    def delete_notifications(self, keys):
+        """Queue notifications to be deleted
+
+        :param keys: List of (uaid, chid) tuples to delete.
+        :returns: Deferred firing with whether or not the batch holding
+                  these notifications was deleted.
+
+        """
+        d = Deferred()
+        self._keys.update(keys)
+        self._waiters.append(d)
+        if len(self._keys) >= self.max_pending:
+            self.flush()
+        elif not self._flush_call:
+            self._flush_call = reactor.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        """Delete all queued notifications"""
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        keys, self._keys = list(self._keys), set()
+        waiters, self._waiters = self._waiters, []
+        self.metrics.gauge("storage.delete_queue.size", len(keys))
+        with acting("storage.delete_queue"):
+            d = deferToDB(self.storage.delete_notifications, keys)
+        d.addBoth(fire_waiters, waiters)
+
+
+def stale_router_item(item):
+    """Whether a router item read eventually consistent may be outdated, as
+    it has no ``connected_at`` yet"""
+    return item.get("connected_at") is None
+
+
+class ReadPolicy(object):
+    """Consistency of the table reads made at each call site
+
+    Reads at the ``eventual`` call sites are eventually consistent, at half
+    the read capacity of a consistent read. When the result looks stale, it
+    is read again consistently. Eventual reads are counted with
+    ``db.read.eventual.<site>`` metrics, and the consistent reads they fall
+    back to with ``db.read.fallback.<site>``.
+
+    The call sites are:
+
+    ``endpoint``
+        Endpoint lookup of the UAID a notification is sent to.
+    ``router``
+        Lookup of the node to notify after a notification was stored.
+    ``redeliver``
+        Lookup of the node a client reconnected to, to notify it of the
+        notifications it wasn't sent on its old connection.
+    ``fetch``
+        Fetch of the stored notifications for a client.
+
+    """
+    sites = ("endpoint", "router", "redeliver", "fetch")
+
+    def __init__(self, metrics, eventual=()):
+        """Create a new ReadPolicy
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param eventual: Call sites that read eventually consistent.
+        :raises:
+            :exc:`ValueError` for an unknown call site.
+
+        """
+        unknown = set(eventual) - set(self.sites)
+        if unknown:
+            raise ValueError("Unknown read sites: %s" %
+                             ", ".join(sorted(unknown)))
+        self.metrics = metrics
+        self.eventual = frozenset(eventual)
+
+    def get_uaid(self, router, uaid, site, stale=stale_router_item):
+        """Get the router item for the UAID, see :meth:`Router.get_uaid`
+
+        An eventually consistent read falls back to a consistent one when
+        the UAID wasn't found or ``stale`` returns True for its item. Any
+        lookup of the UAID cached by the router is invalidated first.
+
+        :returns: Deferred firing with the user item.
+
+        """
+        if site not in self.eventual:
+            return deferToDB(router.get_uaid, uaid)
+
+        def fallback():
+            router.invalidate(uaid)
+            return deferToDB(router.get_uaid, uaid)
+        d = deferToDB(router.get_uaid, uaid, consistent=False)
+        return self._check(d, site, stale, bound(fallback),
+                           missing=ItemNotFound)
+
+    def fetch_notifications(self, storage, uaid, site, stale=None):
+        """Fetch all notifications for a UAID, see
+        :meth:`Storage.fetch_notifications`
+
+        An eventually consistent read falls back to a consistent one when
+        ``stale`` returns True for the notifications.
+
+        :returns: Deferred firing with a list of notification items.
+
+        """
+        if site not in self.eventual:
+            return deferToDB(storage.fetch_notifications, uaid)
+        d = deferToDB(storage.fetch_notifications, uaid, consistent=False)
+        return self._check(
+            d, site, stale,
+            bound(lambda: deferToDB(storage.fetch_notifications, uaid)))
+
+    def fetch_notifications_page(self, storage, uaid, page_size, site,
+                                 start_key=None, stale=None):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`Storage.fetch_notifications_page`
+
+        An eventually consistent read falls back to a consistent one when
+        ``stale`` returns True for the page tuple.
+
+        :returns: Deferred firing with a tuple of the notifications and the
+                  key to fetch the next page with.
+
+        """
+        if site not in self.eventual:
+            return deferToDB(storage.fetch_notifications_page, uaid,
+                             page_size, start_key)
+        d = deferToDB(storage.fetch_notifications_page, uaid, page_size,
+                      start_key, consistent=False)
+        return self._check(
+            d, site, stale,
+            bound(lambda: deferToDB(storage.fetch_notifications_page, uaid,
+                                    page_size, start_key)))
+
+    def _check(self, d, site, stale, fallback, missing=None):
+        """Fall back to a consistent read if an eventual read's result is
+        stale, or it failed with the ``missing`` exception"""
+        self.metrics.increment("db.read.eventual.%s" % site)
+
+        def check_result(result):
+            if stale is None or not stale(result):
+                return result
+            return self._fallback(site, fallback)
+
+        def check_failure(fail):
+            if missing is None:
+                return fail
+            fail.trap(missing)
+            return self._fallback(site, fallback)
+        d.addCallbacks(check_result, check_failure)
+        return d
+
+    def _fallback(self, site, fallback):
+        """Make the consistent read replacing a stale one"""
+        self.metrics.increment("db.read.fallback.%s" % site)
+        return fallback()
+
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+#: Fraction of a throttle's ``max_queue`` at which requests of each
+#: priority are shed
+SHED_AT = {
+    PRIORITY_LOW: 0.25,
+    PRIORITY_NORMAL: 0.5,
+    PRIORITY_HIGH: 1.0,
+}
+
+
+class AdaptiveThrottle(object):
+    """Token bucket pacing requests of one operation on a table
+
+    The allowed rate adapts to the throughput the table sustains with
+    additive increase, multiplicative decrease (AIMD): every successful
+    request raises the rate slightly, while a request that exceeded the
+    provisioned throughput cuts it by ``decrease``, at most once per
+    ``cooldown`` seconds.
+
+    Requests arriving faster than the allowed rate are queued by priority.
+    Once the queue is too long for a request's priority it is shed,
+    failing with :exc:`ProvisionedThroughputExceededException` without
+    being sent. Low priority requests are shed at a quarter of
+    ``max_queue``, normal ones at half and high priority ones when it is
+    full.
+
+    """
+    def __init__(self, table_name, operation, metrics, max_rate=1000,
+                 min_rate=1, max_queue=1000, increase=1, decrease=0.5,
+                 cooldown=1, clock=reactor):
+        """Create a new AdaptiveThrottle
+
+        :param table_name: Name of the table, for metrics.
+        :param operation: Name of the operation, for metrics.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param max_rate: Requests per second allowed at most, and at
+                         first.
+        :param min_rate: Requests per second allowed at least.
+        :param max_queue: Amount of requests that may wait for a token.
+        :param increase: Requests per second added to the rate over a
+                         second of successful requests.
+        :param decrease: Factor to multiply the rate by when the table
+                         exceeded its throughput.
+        :param cooldown: Seconds between decreases of the rate.
+        :param clock: Reactor to schedule queued requests with.
+
+        """
+        self.metrics = metrics
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_queue = max_queue
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.rate = float(max_rate)
+        self.tokens = self.rate
+        self._prefix = "throttle.%s.%s" % (table_name, operation)
+        self._updated = clock.seconds()
+        self._decreased = None
+        self._queue = []
+        self._order = itertools.count()
+        self._drain_call = None
+
+    @property
+    def queued(self):
+        """Amount of requests waiting for a token"""
+        return len(self._queue)
+
+    def _refill(self):
+        """Add the tokens earned since the last refill"""
+        now = self.clock.seconds()
+        self.tokens = min(max(self.rate, 1),
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """Wait for a token to send a request with
+
+        :returns: Deferred firing when the request may be sent, or failing
+                  with :exc:`ProvisionedThroughputExceededException` if it
+                  was shed.
+
+        """
+        self._refill()
+        if not self._queue and self.tokens >= 1:
+            self.tokens -= 1
+            return succeed(None)
+
+        if len(self._queue) >= self.max_queue * SHED_AT[priority]:
+            self.metrics.increment(self._prefix + ".shed")
+            # Fail once a token could be available, so callers retrying
+            # a shed request right away are paced as well
+            return deferLater(self.clock, 1 / self.rate, self._shed)
+
+        d = Deferred()
+        heapq.heappush(self._queue, (-priority, next(self._order), d))
+        self.metrics.gauge(self._prefix + ".queue", len(self._queue))
+        self._schedule()
+        return d
+
+    def _shed(self):
+        """Fail a shed request"""
+        raise ProvisionedThroughputExceededException(
+            None, None, body={"message": "Request shed by throttle"})
+
+    def _schedule(self):
+        """Schedule a drain of the queue for when the next token is due"""
+        if self._drain_call or not self._queue:
+            return
+        delay = max(0, (1 - self.tokens) / self.rate)
+        self._drain_call = self.clock.callLater(delay, self._drain)
+
+    def _drain(self):
+        """Release queued requests for the available tokens"""
+        self._drain_call = None
+        self._refill()
+        while self._queue and self.tokens >= 1:
+            self.tokens -= 1
+            _, _, d = heapq.heappop(self._queue)
+            d.callback(None)
+        self.metrics.gauge(self._prefix + ".queue", len(self._queue))
+        self._schedule()
+
+    def succeeded(self):
+        """Record a request the table processed, raising the rate"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+            self.metrics.gauge(self._prefix + ".rate", self.rate)
+
+    def throttled(self):
+        """Record a request that exceeded the throughput, cutting the
+        rate"""
+        now = self.clock.seconds()
+        if self._decreased is not None and \
+                now - self._decreased < self.cooldown:
+            return
+        self._decreased = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = min(self.tokens, self.rate)
+        self.metrics.gauge(self._prefix + ".rate", self.rate)
+
+
+class ThrottledTable(object):
+    """Base for wrappers pacing the operations of a table abstraction with
+    an :class:`AdaptiveThrottle` per operation"""
+    deferred = True
+
+    #: Priority of each operation, others use :data:`PRIORITY_NORMAL`
+    priorities = {}
+
+    #: Operations reporting exceeding the throughput by returning False,
+    #: others return False for failed conditions
+    false_throttled = ()
+
+    def __init__(self, target, **throttle_args):
+        """Create a new throttled table wrapper
+
+        :param target: Table abstraction such as :class:`Storage` or
+                       :class:`Router` to wrap.
+
+        Remaining ``throttle_args`` are passed through to every
+        :class:`AdaptiveThrottle`.
+
+        """
+        self.target = target
+        self.table = target.table
+        self.metrics = target.metrics
+        self.throttle_args = throttle_args
+        self.throttles = {}
+
+    def throttle(self, operation):
+        """The throttle for an operation, created on first use"""
+        throttle = self.throttles.get(operation)
+        if throttle is None:
+            throttle = self.throttles[operation] = AdaptiveThrottle(
+                self.table.table_name, operation, self.metrics,
+                **self.throttle_args)
+        return throttle
+
+    def _call(self, operation, *args, **kwargs):
+        """Run an operation of the table once its throttle allows it"""
+        throttle = self.throttle(operation)
+        func = getattr(self.target, operation)
+        d = throttle.acquire(self.priorities.get(operation, PRIORITY_NORMAL))
+        d.addCallback(bound(self._send), operation, throttle, func, args,
+                      kwargs)
+        return d
+
+    def _send(self, _, operation, throttle, func, args, kwargs):
+        """Send a request the throttle let through"""
+        d = deferToDB(func, *args, **kwargs)
+        d.addBoth(self._record, operation, throttle)
+        return d
+
+    def _record(self, result, operation, throttle):
+        """Adapt the throttle to the outcome of a request"""
+        if isinstance(result, Failure):
+            exceeded = result.check(ProvisionedThroughputExceededException)
+        else:
+            exceeded = result is False and operation in self.false_throttled
+        if exceeded:
+            throttle.throttled()
+        elif not isinstance(result, Failure):
+            throttle.succeeded()
+        return result
+
+
+class ThrottledStorage(ThrottledTable):
+    """Storage wrapper pacing each operation with an
+    :class:`AdaptiveThrottle`, shedding ack deletes first"""
+    priorities = {
+        "delete_notification": PRIORITY_LOW,
+        "delete_notifications": PRIORITY_LOW,
+    }
+    false_throttled = ("delete_notification", "delete_notifications")
+
+    def fetch_notifications(self, uaid, consistent=True):
+        """See :meth:`Storage.fetch_notifications`"""
+        return self._call("fetch_notifications", uaid, consistent=consistent)
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """See :meth:`Storage.fetch_notifications_page`"""
+        return self._call("fetch_notifications_page", uaid, page_size,
+                          start_key, consistent=consistent)
+
+    def save_notification(self, uaid, chid, version):
+        """See :meth:`Storage.save_notification`"""
+        return self._call("save_notification", uaid=uaid, chid=chid,
+                          version=version)
+
+    def delete_notification(self, uaid, chid, version=None):
+        """See :meth:`Storage.delete_notification`"""
+        return self._call("delete_notification", uaid, chid, version)
+
+    def delete_notifications(self, keys):
+        """See :meth:`Storage.delete_notifications`"""
+        return self._call("delete_notifications", keys)
+
+
+class ThrottledRouter(ThrottledTable):
+    """Router wrapper pacing each operation with an
+    :class:`AdaptiveThrottle`, keeping registration of connecting clients
+    going the longest"""
+    priorities = {
+        "register_user": PRIORITY_HIGH,
+    }
+
+    def get_uaid(self, uaid, consistent=True):
+        """See :meth:`Router.get_uaid`"""
+        return self._call("get_uaid", uaid, consistent=consistent)
+
+    def get_uaids(self, uaids, consistent=True):
+        """See :meth:`Router.get_uaids`"""
+        return self._call("get_uaids", uaids, consistent=consistent)
+
+    def register_user(self, data):
+        """See :meth:`Router.register_user`"""
+        return self._call("register_user", data)
+
+    def clear_node(self, item):
+        """See :meth:`Router.clear_node`"""
+        return self._call("clear_node", item)
+
+    def invalidate(self, uaid):
+        """See :meth:`Router.invalidate`"""
+        return self.target.invalidate(uaid)
+
+
+class InstrumentedTable(object):
+    """Base for wrappers timing the operations of a table abstraction
+
+    Each operation records how long it waited for a thread of the reactor
+    thread pool (``db.<operation>.wait``), and how long it then took to be
+    served (``db.<operation>.service``), in milliseconds tagged by table
+    and operation. Operations of abstractions returning deferreds don't
+    wait for a thread.
+
+    """
+    deferred = True
+
+    def __init__(self, target):
+        """Create a new instrumented table wrapper
+
+        :param target: Table abstraction such as :class:`Storage` or
+                       :class:`Router` to time.
+
+        """
+        self.target = target
+        self.table = target.table
+        self.metrics = target.metrics
+
+    def _tags(self, operation):
+        return ["table:%s" % self.table.table_name,
+                "operation:%s" % operation]
+
+    def _call(self, operation, *args, **kwargs):
+        """Run an operation of the table, timing it"""
+        func = getattr(self.target, operation)
+        # Time the operation was queued, then the time it started
+        started = [time.time()]
+        if getattr(self.target, "deferred", False) is True:
+            d = maybeDeferred(func, *args, **kwargs)
+        else:
+            d = deferToThread(bound(self._start), operation, started, func,
+                              args, kwargs)
+        d.addBoth(self._finish, operation, started)
+        return d
+
+    def _start(self, operation, started, func, args, kwargs):
+        """Record the wait for a thread and run a blocking operation"""
+        now = time.time()
+        self.metrics.timing("db.%s.wait" % operation,
+                            (now - started[0]) * 1000,
+                            tags=self._tags(operation))
+        started[0] = now
+        return func(*args, **kwargs)
+
+    def _finish(self, result, operation, started):
+        """Record the service time of an operation"""
+        self.metrics.timing("db.%s.service" % operation,
+                            (time.time() - started[0]) * 1000,
+                            tags=self._tags(operation))
+        return result
+
+
+class InstrumentedStorage(InstrumentedTable):
+    """Storage wrapper timing each operation, see
+    :class:`InstrumentedTable`"""
+    def fetch_notifications(self, uaid, consistent=True):
+        """See :meth:`Storage.fetch_notifications`"""
+        return self._call("fetch_notifications", uaid, consistent=consistent)
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """See :meth:`Storage.fetch_notifications_page`"""
+        return self._call("fetch_notifications_page", uaid, page_size,
+                          start_key, consistent=consistent)
+
+    def save_notification(self, uaid, chid, version):
+        """See :meth:`Storage.save_notification`"""
+        return self._call("save_notification", uaid=uaid, chid=chid,
+                          version=version)
+
+    def delete_notification(self, uaid, chid, version=None):
+        """See :meth:`Storage.delete_notification`"""
+        return self._call("delete_notification", uaid, chid, version)
+
+    def delete_notifications(self, keys):
+        """See :meth:`Storage.delete_notifications`"""
+        return self._call("delete_notifications", keys)
+
+
+class InstrumentedRouter(InstrumentedTable):
+    """Router wrapper timing each operation, see
+    :class:`InstrumentedTable`"""
+    def get_uaid(self, uaid, consistent=True):
+        """See :meth:`Router.get_uaid`"""
+        return self._call("get_uaid", uaid, consistent=consistent)
+
+    def get_uaids(self, uaids, consistent=True):
+        """See :meth:`Router.get_uaids`"""
+        return self._call("get_uaids", uaids, consistent=consistent)
+
+    def register_user(self, data):
+        """See :meth:`Router.register_user`"""
+        return self._call("register_user", data)
+
+    def clear_node(self, item):
+        """See :meth:`Router.clear_node`"""
+        return self._call("clear_node", item)
+
+    def invalidate(self, uaid):
+        """See :meth:`Router.invalidate`"""
+        return self.target.invalidate(uaid)
+
+
+class ShardedTable(object):
+    """Table wrapper spreading UAIDs over several tables by a stable hash
+
+    Each shard is a complete table abstraction (such as a :class:`Router`
+    or a :class:`ThrottledRouter`) over its own table, with its own
+    throughput. Every request is counted on its shard with a
+    ``db.shard.<table>.<operation>`` metric.
+
+    While migrating from an unsharded table, the ``legacy`` table is still
+    read for records that weren't moved to their shard yet.
+
+    """
+    deferred = True
+    metric_prefix = "db.shard"
+
+    def __init__(self, shards, metrics, legacy=None):
+        """Create a new ShardedTable
+
+        :param shards: Table abstractions of each shard, in shard order.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param legacy: Optional table abstraction of the unsharded table
+                       being migrated.
+
+        """
+        self.shards = shards
+        self.metrics = metrics
+        self.legacy = legacy
+        self.table = shards[0].table
+
+    @property
+    def tables(self):
+        """Tables of every shard"""
+        return [shard.table for shard in self.shards]
+
+    def shard(self, uaid):
+        """Table abstraction of the shard holding a UAID"""
+        return self.shards[shard_index(uaid, len(self.shards))]
+
+    def _call(self, operation, uaid, *args, **kwargs):
+        """Call an operation on the shard of a UAID"""
+        shard = self.shard(uaid)
+        self.metrics.increment("%s.%s.%s" % (
+            self.metric_prefix, shard.table.table_name, operation))
+        return deferToDB(getattr(shard, operation), *args, **kwargs)
+
+    def _group(self, keys, uaid=lambda key: key):
+        """Group keys by the shard of their UAID"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.shard(uaid(key)), []).append(key)
+        return groups
+
+    def _call_groups(self, operation, groups, *args, **kwargs):
+        """Call an operation on each shard with its group of keys"""
+        calls = []
+        for shard, group in groups.items():
+            self.metrics.increment("%s.%s.%s" % (
+                self.metric_prefix, shard.table.table_name, operation))
+            calls.append(deferToDB(getattr(shard, operation), group,
+                                   *args, **kwargs))
+        d = gatherResults(calls, consumeErrors=True)
+        d.addErrback(unwrap_first_error)
+        return d
+
+
+class ShardedStorage(ShardedTable):
+    """Storage wrapper spreading UAIDs over several storage tables, see
+    :class:`ShardedTable`
+
+    During a migration the notifications of a UAID are fetched from both
+    its shard and the legacy table, while new notifications are only saved
+    to the shard. Deletes apply to both, though nodes not migrating yet
+    may still save newer versions to the legacy table.
+
+    """
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID, see
+        :meth:`Storage.fetch_notifications`"""
+        d = self._call("fetch_notifications", uaid, uaid,
+                       consistent=consistent)
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_notifications), uaid, consistent)
+        return d
+
+    def _legacy_notifications(self, notifs, uaid, consistent):
+        """Add the notifications left in the legacy table, keeping the
+        newest version of each channel"""
+        d = deferToDB(self.legacy.fetch_notifications, uaid,
+                      consistent=consistent)
+        d.addCallback(lambda legacy: merge_notifications(notifs + legacy))
+        return d
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`Storage.fetch_notifications_page`
+
+        During a migration the pages of the shard are followed by the
+        pages of the legacy table, with a page key marking which table
+        to continue in.
+
+        """
+        if self.legacy is None:
+            return self._call("fetch_notifications_page", uaid, uaid,
+                              page_size, start_key, consistent=consistent)
+
+        in_legacy, key = start_key or (False, None)
+        if in_legacy:
+            d = deferToDB(self.legacy.fetch_notifications_page, uaid,
+                          page_size, key, consistent=consistent)
+        else:
+            d = self._call("fetch_notifications_page", uaid, uaid,
+                           page_size, key, consistent=consistent)
+        d.addCallback(self._page_key, in_legacy)
+        return d
+
+    def _page_key(self, page, in_legacy):
+        """Mark the key of a page with the table to continue in, moving on
+        to the legacy table once the shard has no more pages"""
+        notifs, key = page
+        if in_legacy:
+            return notifs, (True, key) if key else None
+        return notifs, (not key, key)
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID, see
+        :meth:`Storage.save_notification`"""
+        return self._call("save_notification", uaid, uaid, chid, version)
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID, see
+        :meth:`Storage.delete_notification`"""
+        d = self._call("delete_notification", uaid, uaid, chid, version)
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_delete), uaid, chid, version)
+        return d
+
+    def _legacy_delete(self, result, uaid, chid, version):
+        """Delete a notification from the legacy table too
+
+        The legacy table may hold an older version than the deleted one,
+        or a newer one saved by a node that isn't migrating yet. Its
+        version is read first, and the row is deleted on the condition it
+        still holds that version, unless it's newer.
+
+        """
+        if not version:
+            d = deferToDB(self.legacy.delete_notification, uaid, chid)
+        else:
+            d = deferToDB(self.legacy.fetch_notifications, uaid)
+            d.addCallback(self._legacy_delete_read, uaid, chid, version)
+        d.addCallback(lambda legacy_result: result and legacy_result)
+        return d
+
+    def _legacy_delete_read(self, notifs, uaid, chid, version):
+        """Delete the legacy version of a notification read, unless it's
+        newer than the deleted one"""
+        for notif in notifs:
+            if notif["chid"] == chid:
+                legacy_version = int(notif["version"])
+                if legacy_version > version:
+                    return True
+                return deferToDB(self.legacy.delete_notification, uaid,
+                                 chid, legacy_version)
+        return True
+
+    def delete_notifications(self, keys):
+        """Delete several notifications, see
+        :meth:`Storage.delete_notifications`"""
+        d = self._call_groups("delete_notifications",
+                              self._group(keys, lambda key: key[0]))
+        d.addCallback(all)
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_delete_batch), keys)
+        return d
+
+    def _legacy_delete_batch(self, result, keys):
+        """Delete the notifications from the legacy table too"""
+        d = deferToDB(self.legacy.delete_notifications, keys)
+        d.addCallback(lambda legacy_result: result and legacy_result)
+        return d
+
+
+class ShardedRouter(ShardedTable):
+    """Router wrapper spreading UAIDs over several router tables, see
+    :class:`ShardedTable`
+
+    During a migration a UAID missing from its shard is looked up in the
+    legacy table, and registering it in its shard returns the legacy
+    record as the previous one.
+
+    """
+    def get_uaid(self, uaid, consistent=True):
+        """Get the database record for the UAID, see
+        :meth:`Router.get_uaid`"""
+        d = self._call("get_uaid", uaid, uaid, consistent=consistent)
+        if self.legacy is not None:
+            d.addErrback(bound(self._legacy_get_uaid), uaid, consistent)
+        return d
+
+    def _legacy_get_uaid(self, fail, uaid, consistent):
+        """errBack looking up a UAID not moved to its shard yet"""
+        fail.trap(ItemNotFound)
+        return deferToDB(self.legacy.get_uaid, uaid, consistent=consistent)
+
+    def get_uaids(self, uaids, consistent=True):
+        """Get the database records for several UAIDs, see
+        :meth:`Router.get_uaids`"""
+        d = self._call_groups("get_uaids", self._group(uaids),
+                              consistent=consistent)
+        d.addCallback(self._merge_found)
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_get_uaids), uaids, consistent)
+        return d
+
+    def _merge_found(self, results):
+        """Merge the records found in each shard"""
+        found = {}
+        for result in results:
+            found.update(result)
+        return found
+
+    def _legacy_get_uaids(self, found, uaids, consistent):
+        """Look up the UAIDs not found in their shard in the legacy table"""
+        missing = [uaid for uaid in uaids if uaid not in found]
+        if not missing:
+            return found
+        d = deferToDB(self.legacy.get_uaids, missing, consistent=consistent)
+        d.addCallback(lambda legacy: dict(legacy, **found))
+        return d
+
+    def register_user(self, data):
+        """Register this user, see :meth:`Router.register_user`"""
+        uaid = data["uaid"]
+        d = self._call("register_user", uaid, data)
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_previous), uaid)
+        return d
+
+    def _legacy_previous(self, result, uaid):
+        """Return the legacy record as the previous one of a UAID newly
+        registered in its shard"""
+        registered, previous = result
+        if not registered or previous:
+            return result
+        d = deferToDB(self.legacy.get_uaid, uaid)
+        d.addCallback(lambda item: (True, dict(item.items())))
+        d.addErrback(self._no_previous)
+        return d
+
+    def _no_previous(self, fail):
+        """errBack for a UAID without a legacy record"""
+        fail.trap(ItemNotFound)
+        return (True, {})
+
+    def clear_node(self, item):
+        """Clear the node for the user, see :meth:`Router.clear_node`
+
+        During a migration the node is cleared in the legacy table too, as
+        the item may have been read from it.
+
+        """
+        d = self._call("clear_node", item["uaid"], copy_item(item))
+        if self.legacy is not None:
+            d.addCallback(bound(self._legacy_clear_node), copy_item(item))
+        return d
+
+    def _legacy_clear_node(self, result, item):
+        """Clear the node in the legacy table too"""
+        d = deferToDB(self.legacy.clear_node, item)
+        d.addCallback(lambda legacy_result: result or legacy_result)
+        return d
+
+    def invalidate(self, uaid):
+        """See :meth:`Router.invalidate`"""
+        self.shard(uaid).invalidate(uaid)
+        if self.legacy is not None:
+            self.legacy.invalidate(uaid)
+
+
+class RotatingStorage(ShardedStorage):
+    """Storage wrapper keeping notifications in a table per month
+
+    New notifications are saved to the current month's table, while
+    fetches and deletes also cover the previous month's table, which
+    takes the place of the legacy table of :class:`ShardedStorage`.
+    Tables of older months are dropped whole by
+    :func:`drop_expired_tables` instead of deleting their rows.
+
+    Each month's table abstraction may itself be a :class:`ShardedStorage`.
+    Requests are counted with ``db.rotation.<table>.<operation>`` metrics.
+
+    """
+    metric_prefix = "db.rotation"
+
+    def __init__(self, current, previous, metrics):
+        """Create a new RotatingStorage
+
+        :param current: Storage abstraction of the current month's table.
+        :param previous: Storage abstraction of the previous month's table.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+
+        """
+        super(RotatingStorage, self).__init__([current], metrics,
+                                              legacy=previous)
+
+    @property
+    def current(self):
+        """Storage abstraction of the current month's table"""
+        return self.shards[0]
+
+    @property
+    def previous(self):
+        """Storage abstraction of the previous month's table"""
+        return self.legacy
+
+    def _legacy_delete(self, result, uaid, chid, version):
+        """Delete a notification from the previous month's table too
+
+        New versions are only saved to the current month's table, so the
+        previous one holds the deleted version or an older one, which is
+        deleted regardless of its version.
+
+        """
+        d = deferToDB(self.legacy.delete_notification, uaid, chid)
+        d.addCallback(lambda legacy_result: result and legacy_result)
+        return d
+
+    def rotate(self, current):
+        """Switch to a new month's table, the current one becoming the
+        previous one"""
+        self.legacy = self.shards[0]
+        self.shards = [current]
+        self.table = current.table
@@ -0,0 +1,460 @@
+"""Bulk export and import of the router and storage tables
+
+The ``autopush-db`` script copies a table into a snapshot directory, and
+loads a snapshot into a table, to move tables across regions or rebuild
+them after a schema change::
+
+    autopush-db export router --snapshot=/data/router
+    autopush-db import router --snapshot=/data/router --table=router_new
+
+An export scans the table with a parallel segmented scan, writing the
+items of each segment as lines of JSON in DynamoDB's own attribute value
+format to a gzip file of the segment. An import writes the lines of each
+segment file with batch writes, creating the table with the schema of its
+kind if it doesn't exist yet. Items are copied as they are, so a snapshot
+of a compact item table must be imported into one.
+
+Both are resumable. Each segment records its progress next to its file,
+the scan key and file size of its last written page for an export, and
+the amount of lines written for an import, so running the same command
+again picks up where it stopped. Imports only overwrite items, so the
+lines since the last recorded progress are simply written again.
+
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import configargparse
+from boto.dynamodb2.table import Table
+
+from autopush.db import (
+    CompactTable,
+    compact_tablename,
+    get_map_storage_table,
+    get_router_table,
+    get_storage_table,
+    map_tablename,
+    table_exists,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.reaper import RateLimiter, consumed_units
+from autopush.utils import str2bool
+
+
+# Table getters creating the table with the schema of its kind
+TABLE_KINDS = dict(
+    router=get_router_table,
+    storage=get_storage_table,
+    storage_map=get_map_storage_table,
+)
+
+# Maximum items of a batch write
+BATCH_SIZE = 25
+
+
+def _write_json(path, data):
+    """Replace a JSON file atomically"""
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.rename(path + ".tmp", path)
+
+
+def _read_json(path, default=None):
+    """Read a JSON file, ``default`` if it doesn't exist"""
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+class Snapshot(object):
+    """Directory of a table snapshot
+
+    Holds a ``manifest.json`` of the table's kind, name, item schema and
+    amount of segments, the ``segment-NNNN.jsonl.gz`` file of each
+    segment, and their ``.export`` and ``.import`` progress files.
+
+    """
+    def __init__(self, path):
+        """Create a new Snapshot
+
+        :param path: Directory of the snapshot, created if missing.
+
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def manifest(self):
+        """The manifest dict, None for a new snapshot"""
+        return _read_json(os.path.join(self.path, "manifest.json"))
+
+    def save_manifest(self, **manifest):
+        """Write the manifest"""
+        _write_json(os.path.join(self.path, "manifest.json"), manifest)
+
+    def segment_path(self, segment):
+        """Path of the file of a segment"""
+        return os.path.join(self.path, "segment-%04d.jsonl.gz" % segment)
+
+    def progress(self, segment, action):
+        """Recorded progress of a segment's ``export`` or ``import``"""
+        return _read_json("%s.%s" % (self.segment_path(segment), action),
+                          {})
+
+    def save_progress(self, segment, action, **progress):
+        """Record the progress of a segment's ``export`` or ``import``"""
+        _write_json("%s.%s" % (self.segment_path(segment), action),
+                    progress)
+
+
+class SnapshotJob(object):
+    """Moves the segments of a snapshot in parallel, counting and
+    reporting the progress"""
+    action = None
+
+    def __init__(self, table, snapshot, workers=8, rate=0,
+                 report_every=100000, clock=time.time):
+        """Create a new SnapshotJob
+
+        :param table: :class:`~boto.dynamodb2.table.Table` to move the
+                      items of.
+        :param snapshot: :class:`Snapshot` to move them to or from.
+        :param workers: Amount of segments moved in parallel.
+        :param rate: Maximum items per second, 0 for no limit.
+        :param report_every: Amount of items between progress reports.
+        :param clock: Function returning the current time.
+
+        """
+        self.table = table
+        self.snapshot = snapshot
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.report_every = report_every
+        self.clock = clock
+        self.started = clock()
+        self.counts = dict(items=0, segments=0, resumed=0, skipped=0,
+                           retries=0, capacity=0)
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Move every segment
+
+        :returns: Counts of the moved items, moved segments, segments
+                  resumed, segments skipped as already moved, resent
+                  unprocessed batches and consumed capacity units.
+        :rtype: dict
+
+        """
+        segments = self.prepare()
+        pool = ThreadPool(max(min(self.workers, segments), 1))
+        try:
+            pool.map(self.move_segment, range(segments))
+        finally:
+            pool.close()
+            pool.join()
+        self.report()
+        return self.counts
+
+    def prepare(self):
+        """Check the snapshot before moving segments
+
+        :returns: Amount of segments.
+
+        """
+        raise NotImplementedError("No prepare implemented")
+
+    def move_segment(self, segment):
+        """Move the items of a segment"""
+        raise NotImplementedError("No move_segment implemented")
+
+    def _count(self, **counts):
+        """Add to the counts, reporting the progress now and then"""
+        with self._lock:
+            before = self.counts["items"] // self.report_every
+            for name, count in counts.items():
+                self.counts[name] += count
+            if self.counts["items"] // self.report_every > before:
+                self.report()
+
+    def report(self):
+        """Print the progress"""
+        counts = dict(self.counts)
+        counts["rate"] = counts["items"] / max(
+            self.clock() - self.started, 0.001)
+        counts["action"] = self.action.capitalize()
+        counts["table"] = self.table.table_name
+        print ("%(action)s %(table)s: items %(items)d (%(rate).1f/s), "
+               "segments %(segments)d, resumed %(resumed)d, skipped "
+               "%(skipped)d, retries %(retries)d, capacity "
+               "%(capacity).1f" % counts)
+
+
+class TableExport(SnapshotJob):
+    """Exports a table into a snapshot with a parallel segmented scan
+
+    Each page of a segment is appended to its file as a gzip member of
+    its own, followed by recording the scan key and file size, so a
+    resumed export truncates whatever was written after the last recorded
+    page and scans on from its key.
+
+    """
+    action = "export"
+
+    def __init__(self, table, snapshot, kind, segments=16, page_size=1000,
+                 compact=False, **kwargs):
+        """Create a new TableExport
+
+        :param kind: Kind of the table, a key of :data:`TABLE_KINDS`.
+        :param segments: Amount of segments the table is scanned in, the
+                         amount of the snapshot when resuming.
+        :param page_size: Maximum items read per scan request.
+        :param compact: Whether the table has the compact item schema.
+
+        See :meth:`SnapshotJob.__init__` for the other parameters.
+
+        """
+        super(TableExport, self).__init__(table, snapshot, **kwargs)
+        self.kind = kind
+        self.segments = segments
+        self.page_size = page_size
+        self.compact = compact
+
+    def prepare(self):
+        """Write the manifest of a new snapshot, or check it's one of this
+        table when resuming"""
+        manifest = self.snapshot.manifest
+        if manifest is None:
+            self.snapshot.save_manifest(
+                kind=self.kind, table=self.table.table_name,
+                compact=self.compact, segments=self.segments)
+            return self.segments
+        if manifest["table"] != self.table.table_name:
+            raise ValueError("Snapshot of another table: %s" %
+                             manifest["table"])
+        return manifest["segments"]
+
+    def move_segment(self, segment):
+        """Scan a segment into its file"""
+        progress = self.snapshot.progress(segment, "export")
+        if progress.get("done"):
+            self._count(skipped=1)
+            return
+        path = self.snapshot.segment_path(segment)
+        size = progress.get("size", 0)
+        if progress:
+            self._count(resumed=1)
+        with open(path, "ab") as f:
+            # Drop anything written after the last recorded page
+            f.truncate(size)
+        start_key = progress.get("key")
+        total = self.snapshot.manifest["segments"]
+        while True:
+            self.limiter.acquire(self.page_size)
+            result = self.table.connection.scan(
+                self.table.table_name,
+                limit=self.page_size,
+                exclusive_start_key=start_key,
+                segment=segment,
+                total_segments=total,
+                return_consumed_capacity="TOTAL",
+            )
+            items = result.get("Items", [])
+            if items:
+                with open(path, "ab") as f:
+                    with gzip.GzipFile(fileobj=f, mode="wb") as page:
+                        for item in items:
+                            page.write(json.dumps(item, sort_keys=True))
+                            page.write("\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+            start_key = result.get("LastEvaluatedKey")
+            self.snapshot.save_progress(segment, "export", key=start_key,
+                                        size=size, done=not start_key)
+            self._count(items=len(items),
+                        capacity=consumed_units(result))
+            if not start_key:
+                self._count(segments=1)
+                return
+
+
+class TableImport(SnapshotJob):
+    """Imports a snapshot into a table with batch writes
+
+    The amount of lines written from each segment file is recorded every
+    ``checkpoint_every`` items, a resumed import skips as many lines.
+
+    """
+    action = "import"
+
+    def __init__(self, table, snapshot, kind, compact=False,
+                 checkpoint_every=1000, **kwargs):
+        """Create a new TableImport
+
+        :param kind: Kind of the table, a key of :data:`TABLE_KINDS`.
+        :param compact: Whether the table has the compact item schema.
+        :param checkpoint_every: Amount of items between progress records.
+
+        See :meth:`SnapshotJob.__init__` for the other parameters.
+
+        """
+        super(TableImport, self).__init__(table, snapshot, **kwargs)
+        self.kind = kind
+        self.compact = compact
+        self.checkpoint_every = checkpoint_every
+
+    def prepare(self):
+        """Check the snapshot is complete and of the table's kind and item
+        schema"""
+        manifest = self.snapshot.manifest
+        if manifest is None:
+            raise ValueError("No snapshot at %s" % self.snapshot.path)
+        if manifest["kind"] != self.kind:
+            raise ValueError("Snapshot of a %s table" % manifest["kind"])
+        if manifest["compact"] != self.compact:
+            raise ValueError("Snapshot item schema doesn't match the table")
+        for segment in range(manifest["segments"]):
+            if not self.snapshot.progress(segment, "export").get("done"):
+                raise ValueError("Snapshot export isn't complete")
+        return manifest["segments"]
+
+    def move_segment(self, segment):
+        """Write the items of a segment file into the table"""
+        progress = self.snapshot.progress(segment, "import")
+        if progress.get("done"):
+            self._count(skipped=1)
+            return
+        done = progress.get("lines", 0)
+        if done:
+            self._count(resumed=1)
+        path = self.snapshot.segment_path(segment)
+        lines = done
+        batch = []
+        with gzip.open(path, "rb") as f:
+            for number, line in enumerate(f):
+                if number < done:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) == BATCH_SIZE:
+                    lines = self._flush(segment, batch, lines)
+                    batch = []
+        lines = self._flush(segment, batch, lines)
+        self.snapshot.save_progress(segment, "import", lines=lines,
+                                    done=True)
+        self._count(segments=1)
+
+    def _flush(self, segment, batch, lines):
+        """Write a batch, recording the progress now and then
+
+        :returns: Amount of lines written from the segment file.
+
+        """
+        if not batch:
+            return lines
+        self._batch_write(batch)
+        written = lines + len(batch)
+        if written // self.checkpoint_every > lines // self.checkpoint_every:
+            self.snapshot.save_progress(segment, "import", lines=written,
+                                        done=False)
+        return written
+
+    def _batch_write(self, items):
+        """Put up to 25 items, resending unprocessed ones"""
+        requests = [{"PutRequest": {"Item": item}} for item in items]
+        name = self.table.table_name
+        attempt = 0
+        while requests:
+            if attempt:
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+                self._count(retries=1)
+            self.limiter.acquire(len(requests))
+            result = self.table.connection.batch_write_item(
+                {name: requests}, return_consumed_capacity="TOTAL")
+            processed = len(requests)
+            requests = (result.get("UnprocessedItems") or {}).get(name, [])
+            self._count(items=processed - len(requests),
+                        capacity=consumed_units(result))
+            attempt += 1
+
+
+def _parse_dbtool(sysargs):
+    """Parse out the arguments for the export and import tool"""
+    parser = configargparse.ArgumentParser(
+        description='Exports tables into snapshots and imports snapshots '
+                    'into tables.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('action', choices=["export", "import"],
+                        help="Export a table or import a snapshot")
+    parser.add_argument('kind', choices=sorted(TABLE_KINDS),
+                        help="Kind of table, the schema a created table "
+                        "gets")
+    parser.add_argument('--snapshot', help="Directory of the snapshot",
+                        type=str, required=True)
+    parser.add_argument('--table',
+                        help="Table name, the configured one of its kind "
+                        "by default", type=str, default=None)
+    parser.add_argument('--segments',
+                        help="Amount of segments a table is exported in",
+                        type=int, default=16)
+    parser.add_argument('--workers',
+                        help="Amount of segments moved in parallel",
+                        type=int, default=8)
+    parser.add_argument('--rate',
+                        help="Maximum items per second, 0 for no limit",
+                        type=float, default=0)
+    parser.add_argument('--page_size',
+                        help="Maximum items read per scan request",
+                        type=int, default=1000)
+    return parser.parse_args(sysargs)
+
+
+def default_tablename(args):
+    """Configured name of the table of a kind"""
+    if args.kind == "router":
+        tablename = args.router_tablename
+    else:
+        tablename = args.storage_tablename
+    if args.compact_items:
+        tablename = compact_tablename(tablename)
+    if args.kind == "storage_map":
+        tablename = map_tablename(tablename)
+    return tablename
+
+
+def main(sysargs=None):
+    """Export a table or import a snapshot, aka the autopush-db script
+
+    :returns: Counts of the export or import, see :meth:`SnapshotJob.run`.
+
+    """
+    args = _parse_dbtool(sysargs)
+    tablename = args.table or default_tablename(args)
+    snapshot = Snapshot(args.snapshot)
+    options = dict(workers=args.workers, rate=args.rate,
+                   compact=args.compact_items)
+    if args.action == "export":
+        table = (CompactTable if args.compact_items else Table)(tablename)
+        if not table_exists(table):
+            raise ValueError("No table named %s" % tablename)
+        job = TableExport(table, snapshot, args.kind,
+                          segments=args.segments,
+                          page_size=args.page_size, **options)
+    else:
+        if args.kind == "router":
+            read, write = (args.router_read_throughput,
+                           args.router_write_throughput)
+        else:
+            read, write = (args.storage_read_throughput,
+                           args.storage_write_throughput)
+        table = TABLE_KINDS[args.kind](tablename, read, write,
+                                       args.compact_items)
+        job = TableImport(table, snapshot, args.kind, **options)
+    return job.run()
@@ -0,0 +1,276 @@
+"""Non-blocking DynamoDB Connection
+
+A :class:`~boto.dynamodb2.layer1.DynamoDBConnection` that issues its requests
+with a Twisted :class:`~twisted.web.client.Agent` instead of blocking
+``httplib`` calls. Every layer1 operation (``get_item``, ``put_item``,
+``query``, etc.) builds its parameters exactly as boto does, but returns a
+deferred that fires with the decoded JSON response.
+
+Requests are signed with boto's SigV4 auth handler, sent over a pool of
+persistent HTTP(S) connections, and the number of requests in flight is
+bounded by a semaphore rather than the size of the reactor thread pool.
+An HTTP proxy set up in boto's configuration is honored for plain HTTP
+connections.
+
+Both it and the blocking :class:`MeteredDynamoDBConnection` can be given
+a metrics object to request and record the capacity units each request
+consumes, and a :class:`~autopush.costs.CostLedger` to attribute them to
+the current protocol action.
+
+"""
+import json
+from StringIO import StringIO
+
+from boto.dynamodb2.exceptions import (
+    InternalServerError,
+    ProvisionedThroughputExceededException,
+    ValidationException,
+)
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.exception import DynamoDBResponseError
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore,
+    inlineCallbacks,
+    returnValue,
+)
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.task import deferLater
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    ProxyAgent,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from autopush.costs import current_action
+from autopush.utils import canonical_url
+
+
+# Operations that report the capacity they consumed when asked to
+CAPACITY_ACTIONS = frozenset(["GetItem", "PutItem", "UpdateItem",
+                              "DeleteItem", "Query", "Scan", "BatchGetItem",
+                              "BatchWriteItem"])
+
+
+class MeteredDynamoDBConnection(DynamoDBConnection):
+    """Blocking DynamoDB connection recording the capacity units consumed
+    by each request
+
+    With a ``metrics`` object, requests ask for their consumed capacity
+    and the units are counted with a ``db.capacity.<action>`` metric
+    tagged by table and action.
+
+    With a ``costs`` ledger, every request and the units it consumed are
+    counted for the protocol action current when it was made, see
+    :mod:`autopush.costs`. Failed requests are counted without units.
+
+    """
+    def __init__(self, metrics=None, costs=None, **kwargs):
+        """Create a new MeteredDynamoDBConnection
+
+        :param metrics: Optional metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param costs: Optional :class:`~autopush.costs.CostLedger`.
+
+        Remaining ``kwargs`` are passed through to
+        :class:`~boto.dynamodb2.layer1.DynamoDBConnection`.
+
+        """
+        super(MeteredDynamoDBConnection, self).__init__(**kwargs)
+        self.metrics = metrics
+        self.costs = costs
+
+    def _with_capacity(self, action, body):
+        """Ask for the consumed capacity in a request body"""
+        if self.metrics is None and self.costs is None or \
+                action not in CAPACITY_ACTIONS:
+            return body
+        params = json.loads(body)
+        params["ReturnConsumedCapacity"] = "TOTAL"
+        return json.dumps(params)
+
+    def _record_capacity(self, action, result, db_action=None):
+        """Count the capacity units a response reports as consumed, for
+        the protocol action the request was made for"""
+        consumed = (result or {}).get("ConsumedCapacity") or []
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        units = 0
+        for entry in consumed:
+            units += entry.get("CapacityUnits", 0)
+            if self.metrics is not None:
+                self.metrics.increment(
+                    "db.capacity.%s" % action, entry.get("CapacityUnits", 0),
+                    tags=["table:%s" % entry.get("TableName"),
+                          "operation:%s" % action])
+        if self.costs is not None:
+            self.costs.request(db_action, units)
+        return result
+
+    def make_request(self, action, body):
+        """Send a request to DynamoDB, recording its consumed capacity"""
+        db_action = current_action()
+        try:
+            result = super(MeteredDynamoDBConnection, self).make_request(
+                action, self._with_capacity(action, body))
+        except Exception:
+            self._record_capacity(action, None, db_action)
+            raise
+        return self._record_capacity(action, result, db_action)
+
+
+class AsyncDynamoDBConnection(MeteredDynamoDBConnection):
+    """DynamoDB connection returning deferreds from a pooled Twisted Agent"""
+    # Flag for :func:`autopush.db.deferToDB` that calls return deferreds
+    deferred = True
+
+    _faults = dict(DynamoDBConnection._faults,
+                   ValidationException=ValidationException)
+
+    def __init__(self, max_connections=50, connect_timeout=5, agent=None,
+                 metrics=None, costs=None, **kwargs):
+        """Create a new AsyncDynamoDBConnection
+
+        :param max_connections: Maximum amount of requests in flight, and
+                                persistent connections kept open.
+        :param connect_timeout: Seconds to wait for a connection to be
+                                established.
+        :param agent: Optional :class:`~twisted.web.client.Agent` to use
+                      instead of creating a new pooled one.
+        :param metrics: Optional metrics object to record the consumed
+                        capacity with, see
+                        :class:`MeteredDynamoDBConnection`.
+        :param costs: Optional :class:`~autopush.costs.CostLedger` to
+                      attribute the requests with.
+
+        Remaining ``kwargs`` are passed through to
+        :class:`~boto.dynamodb2.layer1.DynamoDBConnection`.
+
+        :raises: :exc:`ValueError` for a proxy of secure connections,
+                 which would need tunneling the agent doesn't do.
+
+        """
+        super(AsyncDynamoDBConnection, self).__init__(metrics=metrics,
+                                                      costs=costs, **kwargs)
+        if agent is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = max_connections
+            if self.use_proxy and not self.skip_proxy(self.host):
+                if self.is_secure:
+                    raise ValueError("Secure connections through a proxy "
+                                     "aren't supported")
+                endpoint = TCP4ClientEndpoint(reactor, self.proxy,
+                                              int(self.proxy_port),
+                                              timeout=connect_timeout)
+                agent = ProxyAgent(endpoint, reactor, pool=pool)
+            else:
+                agent = Agent(reactor, connectTimeout=connect_timeout,
+                              pool=pool)
+        self.agent = agent
+        self.max_connections = max_connections
+        self._semaphore = DeferredSemaphore(max_connections)
+
+    @property
+    def pending(self):
+        """Amount of requests waiting for a free connection slot"""
+        return len(self._semaphore.waiting)
+
+    @inlineCallbacks
+    def make_request(self, action, body):
+        """Send a request to DynamoDB, retrying throughput and server errors
+        with the same truncated exponential backoff boto uses
+
+        :returns: Deferred that fires with the decoded JSON response.
+
+        """
+        attempt = 0
+        body = self._with_capacity(action, body)
+        # The current action is only known until the first yield
+        db_action = current_action()
+        while True:
+            try:
+                result = yield self._semaphore.run(self._send, action, body)
+            except ProvisionedThroughputExceededException:
+                self.throughput_exceeded_events += 1
+                attempt += 1
+                if attempt >= self.NumberRetries:
+                    self._record_capacity(action, None, db_action)
+                    raise
+            except InternalServerError:
+                attempt += 1
+                if attempt >= self.NumberRetries:
+                    self._record_capacity(action, None, db_action)
+                    raise
+            except Exception:
+                self._record_capacity(action, None, db_action)
+                raise
+            else:
+                returnValue(self._record_capacity(action, result,
+                                                  db_action))
+            yield deferLater(reactor,
+                             self._truncated_exponential_time(attempt),
+                             lambda: None)
+
+    def _send(self, action, body):
+        """Sign and send a single request"""
+        headers = {
+            'X-Amz-Target': '%s.%s' % (self.TargetPrefix, action),
+            'Host': self.host,
+            'Content-Type': 'application/x-amz-json-1.0',
+            'Content-Length': str(len(body)),
+        }
+        http_request = self.build_base_http_request(
+            method='POST', path='/', auth_path='/', params={},
+            headers=headers, data=body, host=self.host)
+        http_request.authorize(connection=self)
+
+        # The Agent sets the Content-Length from the body producer
+        raw_headers = Headers()
+        for name, value in http_request.headers.items():
+            if name.lower() != 'content-length':
+                raw_headers.addRawHeader(name, str(value))
+
+        # With a proxy boto already made the path an absolute URL
+        url = http_request.path
+        if not url.startswith(http_request.protocol + "://"):
+            url = canonical_url(http_request.protocol, http_request.host,
+                                http_request.port) + url
+        d = self.agent.request(
+            "POST",
+            url.encode("utf8"),
+            raw_headers,
+            FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._read_response)
+        return d
+
+    def _read_response(self, response):
+        """Read the response body and decode it"""
+        d = readBody(response)
+        d.addCallback(self._decode_response, response)
+        return d
+
+    def _decode_response(self, body, response):
+        """Decode the response body, raising the matching boto exception
+        for DynamoDB errors, or a
+        :exc:`~boto.exception.DynamoDBResponseError` with the raw body for
+        errors that aren't JSON, such as a proxy's 502 page"""
+        body = body.decode('utf-8')
+        if response.code == 200:
+            if body:
+                return json.loads(body)
+            return None
+
+        try:
+            json_body = json.loads(body)
+        except ValueError:
+            # boto's JSON errors decode the body they're created with
+            error = DynamoDBResponseError(response.code, response.phrase)
+            error.body = body
+            raise error
+        fault_name = json_body.get('__type', '').split('#')[-1]
+        exception_class = self._faults.get(fault_name, self.ResponseError)
+        raise exception_class(response.code, response.phrase, body=json_body)
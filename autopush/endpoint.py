@@ -193,7 +193,10 @@ from twisted.internet.defer import Deferred
 from twisted.internet.threads import deferToThread
 from twisted.python import failure, log
 
+from autopush.costs import acting, finish_action, start_action
+from autopush.db import deferToDB
 from autopush.router.interface import RouterException
+from autopush.router.simple import stale_node
 from autopush.utils import (
     generate_hash,
     validate_hash,
@@ -249,6 +252,8 @@ class AutoendpointHandler(cyclone.web.RequestHandler):
         self._uaid = ""
         self.ap_settings = ap_settings
         self.metrics = ap_settings.metrics
+        # Database requests made for the request, see autopush.costs
+        self._db_action = None
 
     def prepare(self):
         """Common request preparation"""
@@ -256,6 +261,16 @@ class AutoendpointHandler(cyclone.web.RequestHandler):
             self.set_header("Access-Control-Allow-Origin", "*")
             self.set_header("Access-Control-Allow-Methods", self.cors_methods)
 
+        # Turn requests away until the database is set up
+        if not self.ap_settings.ready:
+            self.set_status(503)
+            self.write("Service starting")
+            self.finish()
+
+    def on_finish(self):
+        """Record the database requests made for the request"""
+        finish_action(None, self._db_action)
+
     def write_error(self, code, **kwargs):
         """Write the error (otherwise unhandled exception when dealing with
         unknown method specifications.)
@@ -359,6 +374,7 @@ class EndpointHandler(AutoendpointHandler):
         """
         self.start_time = time.time()
         fernet = self.ap_settings.fernet
+        self._db_action = start_action(self.ap_settings.db_costs, "push")
 
         version, data = parse_request_params(self.request)
         if data and len(data) > self.ap_settings.max_data:
@@ -380,7 +396,10 @@ class EndpointHandler(AutoendpointHandler):
         self.uaid, chid = result.split(":")
         notification = Notification(version=version, data=data,
                                     channel_id=chid)
-        d = deferToThread(self.ap_settings.router.get_uaid, self.uaid)
+        with acting(self._db_action):
+            d = self.ap_settings.read_policy.get_uaid(
+                self.ap_settings.router, self.uaid, "endpoint",
+                stale=stale_node)
         d.addCallback(self._uaid_lookup_results, notification)
         d.addErrback(self._uaid_not_found_err)
         self._db_error_handling(d)
@@ -397,7 +416,8 @@ class EndpointHandler(AutoendpointHandler):
         d.addErrback(self._response_err)
 
         # Call the prepared router
-        d.callback(notification)
+        with acting(self._db_action):
+            d.callback(notification)
 
     def _router_completed(self, response, uaid_data):
         """Called after router has completed successfully"""
@@ -411,7 +431,8 @@ class EndpointHandler(AutoendpointHandler):
             else:
                 uaid_data["router_data"] = response.router_data
             uaid_data["connected_at"] = int(time.time()*1000)
-            d = deferToThread(self.ap_settings.router.register_user,
+            with acting(self._db_action):
+                d = deferToDB(self.ap_settings.router.register_user,
                               uaid_data)
             response.router_data = None
             d.addCallback(lambda x: self._router_completed(response,
@@ -462,7 +483,10 @@ class RegistrationHandler(AutoendpointHandler):
 
         self.uaid = uaid
         self.chid = str(uuid.uuid4())
-        d = deferToThread(self.ap_settings.router.get_uaid, uaid)
+        self._db_action = start_action(self.ap_settings.db_costs,
+                                       "registration.get")
+        with acting(self._db_action):
+            d = deferToDB(self.ap_settings.router.get_uaid, uaid)
         d.addCallback(self._return_router_data)
         d.addErrback(self._overload_err)
         d.addErrback(self._uaid_not_found_err)
@@ -499,6 +523,8 @@ class RegistrationHandler(AutoendpointHandler):
             return self._error(400, "Invalid arguments")
         self.chid = params["channelID"]
         if new_uaid:
+            self._db_action = start_action(self.ap_settings.db_costs,
+                                           "registration.post")
             router = self.ap_settings.routers[router_type]
             d = Deferred()
             d.addCallback(router.register, params.get("data", {}))
@@ -507,7 +533,8 @@ class RegistrationHandler(AutoendpointHandler):
             d.addCallback(self._return_endpoint, new_uaid)
             d.addErrback(self._router_fail_err)
             d.addErrback(self._response_err)
-            d.callback(uaid)
+            with acting(self._db_action):
+                d.callback(uaid)
         else:
             d = self._make_endpoint(None)
             d.addCallback(self._return_endpoint, new_uaid)
@@ -535,6 +562,8 @@ class RegistrationHandler(AutoendpointHandler):
 
         self.add_header("Content-Type", "application/json")
         router = self.ap_settings.routers[router_type]
+        self._db_action = start_action(self.ap_settings.db_costs,
+                                       "registration.put")
 
         d = Deferred()
         d.addCallback(router.register, router_data)
@@ -542,7 +571,8 @@ class RegistrationHandler(AutoendpointHandler):
         d.addCallback(self._success)
         d.addErrback(self._router_fail_err)
         d.addErrback(self._response_err)
-        d.callback(uaid)
+        with acting(self._db_action):
+            d.callback(uaid)
 
     #############################################################
     #                    Callbacks
@@ -564,7 +594,7 @@ class RegistrationHandler(AutoendpointHandler):
             router_data=router_data,
             connected_at=int(time.time()*1000),
         )
-        return deferToThread(self.ap_settings.router.register_user, user_item)
+        return deferToDB(self.ap_settings.router.register_user, user_item)
 
     def _make_endpoint(self, result):
         """Called to create a new endpoint"""
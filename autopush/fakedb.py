@@ -0,0 +1,577 @@
+"""DynamoDB stand-in with injected latency, throttling and errors
+
+The ``autopush-fakedb`` script serves the DynamoDB API in front of a real
+implementation such as ``moto_server``, forwarding every request after a
+delay sampled from a latency distribution of its operation. Along the way
+it can answer with the errors DynamoDB answers with:
+
+* ``ProvisionedThroughputExceededException`` once the read or write
+  capacity units a table consumed exceed its capacity. Each table has a
+  token bucket per capacity filled at the table's rate, holding up to
+  ``burst_seconds`` of unused capacity as DynamoDB does. Units are counted
+  from the item sizes of the requests and responses, see
+  :func:`consumed_units`.
+* ``InternalServerError`` at the error rate of the operation.
+
+Profiles bundle these settings, so benchmarks of the nodes reproduce
+production-like conditions against a local moto server. A profile is a
+dict of:
+
+``latency``
+    Operation name (``"*"`` for the others) to the ``median`` and ``p99``
+    latency in milliseconds of its log-normal distribution.
+``errors``
+    Operation name (``"*"`` for the others) to the fraction of requests
+    failing with an ``InternalServerError``.
+``capacity``
+    ``"provisioned"`` to throttle each table at the throughput it's
+    provisioned with, or a dict of ``read`` and ``write`` units per second
+    to throttle every table at. Without it nothing is throttled.
+``burst_seconds``
+    Seconds of unused capacity kept for bursts, 300 by default.
+
+It also answers the CloudWatch ``GetMetricStatistics`` requests of the
+``ConsumedReadCapacityUnits`` and ``ConsumedWriteCapacityUnits`` metrics
+with the ``Sum`` of the units it saw each table consume, so the
+``autopush-autoscale`` script can run against it. Consumption is kept per
+minute for a day.
+
+"""
+import calendar
+import datetime
+import json
+import math
+import os
+import random
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+import configargparse
+import cyclone.web
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from autopush.sizes import READ_UNIT, WRITE_UNIT, item_size
+from autopush.utils import str2bool
+
+
+ERROR_PREFIX = "com.amazonaws.dynamodb.v20120810#"
+
+READ_OPERATIONS = frozenset(["GetItem", "BatchGetItem", "Query", "Scan"])
+WRITE_OPERATIONS = frozenset(["PutItem", "UpdateItem", "DeleteItem",
+                              "BatchWriteItem"])
+
+# CloudWatch metrics of the consumed read and write units
+CONSUMED_METRICS = {"ConsumedReadCapacityUnits": 0,
+                    "ConsumedWriteCapacityUnits": 1}
+
+# Seconds of consumption kept for the CloudWatch metrics
+METRICS_RETENTION = 86400
+
+CLOUDWATCH_XMLNS = "http://monitoring.amazonaws.com/doc/2010-08-01/"
+
+# Request headers not forwarded, the agent sets its own
+HOP_HEADERS = frozenset(["host", "content-length", "connection",
+                         "proxy-connection", "keep-alive"])
+
+# Latencies of a DynamoDB table in the same region, in milliseconds
+_region_latency = {
+    "*": {"median": 4, "p99": 25},
+    "Query": {"median": 6, "p99": 40},
+    "Scan": {"median": 15, "p99": 120},
+    "BatchGetItem": {"median": 8, "p99": 50},
+    "BatchWriteItem": {"median": 10, "p99": 60},
+    "CreateTable": {"median": 50, "p99": 200},
+}
+
+PROFILES = {
+    # Forward requests as they come
+    "local": {},
+    # A healthy production table
+    "production": {
+        "latency": _region_latency,
+        "errors": {"*": 0.0005},
+        "capacity": "provisioned",
+    },
+    # A table under load, an order of magnitude slower
+    "slow": {
+        "latency": {"*": {"median": 30, "p99": 300},
+                    "Query": {"median": 50, "p99": 500},
+                    "Scan": {"median": 100, "p99": 1000}},
+        "errors": {"*": 0.002},
+        "capacity": "provisioned",
+    },
+    # Tables provisioned too small for the load, with little burst
+    "throttled": {
+        "latency": _region_latency,
+        "capacity": {"read": 10, "write": 5},
+        "burst_seconds": 2,
+    },
+    # A service failing one request in twenty
+    "flaky": {
+        "latency": _region_latency,
+        "errors": {"*": 0.05},
+    },
+}
+
+
+def load_profile(name):
+    """Load a profile of :data:`PROFILES`, or from a JSON file
+
+    :raises: :exc:`ValueError` for unknown profiles.
+
+    """
+    if name in PROFILES:
+        return PROFILES[name]
+    if os.path.exists(name):
+        with open(name) as f:
+            return json.load(f)
+    raise ValueError("Unknown profile: %s" % name)
+
+
+def by_operation(settings, operation, default=None):
+    """Setting of an operation from a dict of operation names, ``"*"``
+    standing for the others"""
+    return settings.get(operation, settings.get("*", default))
+
+
+class LatencyDistribution(object):
+    """Log-normal latency distribution of a median and 99th percentile"""
+    # Standard normal quantile of the 99th percentile
+    z99 = 2.326
+
+    def __init__(self, median=0, p99=None):
+        """Create a new LatencyDistribution
+
+        :param median: Median latency in milliseconds.
+        :param p99: 99th percentile latency in milliseconds, the median if
+                    omitted.
+
+        """
+        self.median = median
+        self.p99 = max(p99 or median, median)
+
+    def sample(self, rng=random):
+        """Sample a latency in seconds"""
+        if self.median <= 0:
+            return 0
+        sigma = math.log(self.p99 / float(self.median)) / self.z99
+        return rng.lognormvariate(math.log(self.median), sigma) / 1000.0
+
+
+class CapacityBucket(object):
+    """Token bucket of the capacity units of a table
+
+    Consumed units are taken out after a request is served, so a bucket
+    may go into debt. Requests are throttled while it is.
+
+    """
+    def __init__(self, rate, burst_seconds=300, clock=reactor):
+        """Create a new CapacityBucket, full
+
+        :param rate: Capacity units per second.
+        :param burst_seconds: Seconds of unused capacity kept.
+        :param clock: Provider of ``seconds()``, the reactor by default.
+
+        """
+        self.rate = rate
+        self.size = rate * burst_seconds
+        self.tokens = self.size
+        self.clock = clock
+        self.updated = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.size,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def throttled(self):
+        """Whether requests are throttled, as the bucket is empty"""
+        self._refill()
+        return self.tokens <= 0
+
+    def consume(self, units):
+        """Take consumed units out of the bucket"""
+        self._refill()
+        self.tokens -= units
+
+
+def _read_units(size, consistent):
+    """Read capacity units of reading ``size`` bytes"""
+    units = max(int(math.ceil(size / float(READ_UNIT))), 1)
+    return units if consistent else units / 2.0
+
+
+def _write_units(size):
+    """Write capacity units of writing ``size`` bytes"""
+    return max(int(math.ceil(size / float(WRITE_UNIT))), 1)
+
+
+def consumed_units(operation, params, result):
+    """Capacity units a request consumed from each table
+
+    Reads count the size of the items returned, eventually consistent ones
+    half as much. Puts count the size of the item written, updates and
+    deletes the size of the old item when it's returned and a unit
+    otherwise.
+
+    :returns: Dict of table name to a tuple of the read and write units.
+
+    """
+    units = {}
+
+    def add(table, read=0, write=0):
+        before = units.get(table, (0, 0))
+        units[table] = (before[0] + read, before[1] + write)
+
+    table = params.get("TableName")
+    consistent = params.get("ConsistentRead", False)
+    if operation == "GetItem":
+        add(table, read=_read_units(item_size(result.get("Item", {})),
+                                    consistent))
+    elif operation in ("Query", "Scan"):
+        add(table, read=_read_units(
+            sum(item_size(item) for item in result.get("Items", [])),
+            consistent))
+    elif operation == "BatchGetItem":
+        for name, items in result.get("Responses", {}).items():
+            consistent = params["RequestItems"].get(name, {}).get(
+                "ConsistentRead", False)
+            for item in items:
+                add(name, read=_read_units(item_size(item), consistent))
+    elif operation == "PutItem":
+        add(table, write=_write_units(item_size(params.get("Item", {}))))
+    elif operation in ("UpdateItem", "DeleteItem"):
+        add(table, write=_write_units(
+            item_size(result.get("Attributes", {}))))
+    elif operation == "BatchWriteItem":
+        for name, requests in params.get("RequestItems", {}).items():
+            for request in requests:
+                item = request.get("PutRequest", {}).get("Item", {})
+                add(name, write=_write_units(item_size(item)))
+    return units
+
+
+def touched_tables(operation, params):
+    """Names of the tables a request reads from or writes to"""
+    if operation in ("BatchGetItem", "BatchWriteItem"):
+        return params.get("RequestItems", {}).keys()
+    if operation in READ_OPERATIONS or operation in WRITE_OPERATIONS:
+        return [params.get("TableName")]
+    return []
+
+
+def provisioned_throughput(result):
+    """Table name and provisioned read and write units of a table
+    description, None if the result has none"""
+    table = result.get("Table") or result.get("TableDescription")
+    if not table or "ProvisionedThroughput" not in table:
+        return None
+    throughput = table["ProvisionedThroughput"]
+    return (table["TableName"], throughput.get("ReadCapacityUnits"),
+            throughput.get("WriteCapacityUnits"))
+
+
+def parse_timestamp(value):
+    """Seconds since the epoch of an ISO 8601 UTC timestamp"""
+    value = value.rstrip("Z").split("+")[0]
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in value else "%Y-%m-%dT%H:%M:%S"
+    return calendar.timegm(datetime.datetime.strptime(value, fmt).timetuple())
+
+
+class FakeDynamoDB(object):
+    """Serves DynamoDB requests by forwarding them to an upstream service
+    with the latency, throttling and errors of a profile"""
+    def __init__(self, upstream, profile, agent=None, clock=reactor,
+                 seed=None):
+        """Create a new FakeDynamoDB
+
+        :param upstream: URL of the DynamoDB service requests are forwarded
+                         to.
+        :param profile: Profile dict, see :func:`load_profile`.
+        :param agent: Optional :class:`~twisted.web.client.Agent` to use
+                      instead of creating a new pooled one.
+        :param clock: Provider of ``seconds()`` and ``callLater``, the
+                      reactor by default.
+        :param seed: Seed of the random latencies and errors.
+
+        """
+        self.upstream = upstream.rstrip("/") + "/"
+        if agent is None:
+            agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
+        self.agent = agent
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.latency = dict(
+            (operation, LatencyDistribution(**latency))
+            for operation, latency in profile.get("latency", {}).items())
+        self.errors = profile.get("errors", {})
+        self.capacity = profile.get("capacity")
+        self.burst_seconds = profile.get("burst_seconds", 300)
+        # Read and write capacity buckets of each table
+        self.buckets = {}
+        # Read and write units each table consumed in each minute
+        self.consumed = {}
+        self.counts = {}
+
+    def _count(self, operation, name):
+        counts = self.counts.setdefault(
+            operation, dict(requests=0, throttled=0, errors=0))
+        counts[name] += 1
+
+    def _buckets(self, table):
+        """Read and write buckets of a table, None if it isn't throttled"""
+        if table not in self.buckets and isinstance(self.capacity, dict):
+            self.set_capacity(table, self.capacity.get("read"),
+                              self.capacity.get("write"))
+        return self.buckets.get(table)
+
+    def set_capacity(self, table, read, write):
+        """Throttle a table at ``read`` and ``write`` units per second"""
+        self.buckets[table] = tuple(
+            CapacityBucket(rate, self.burst_seconds, self.clock)
+            if rate else None for rate in (read, write))
+
+    def throttled(self, operation, params):
+        """Whether a request is throttled by a table out of capacity"""
+        kind = 0 if operation in READ_OPERATIONS else 1
+        for table in touched_tables(operation, params):
+            buckets = self._buckets(table)
+            if buckets and buckets[kind] and buckets[kind].throttled():
+                return True
+        return False
+
+    def account(self, operation, params, result):
+        """Take a served request's capacity units out of the buckets of its
+        tables, and learn the provisioned throughput of described ones"""
+        minute = int(self.clock.seconds() // 60) * 60
+        for table, units in consumed_units(operation, params,
+                                           result).items():
+            for bucket, used in zip(self._buckets(table) or (), units):
+                if bucket and used:
+                    bucket.consume(used)
+            self._record_consumed(table, minute, units)
+        described = provisioned_throughput(result)
+        if described and self.capacity == "provisioned":
+            self.set_capacity(*described)
+
+    def _record_consumed(self, table, minute, units):
+        """Add units to the consumption of a table in a minute, dropping
+        the minutes out of the retention"""
+        minutes = self.consumed.setdefault(table, {})
+        if minute not in minutes:
+            for expired in [m for m in minutes
+                            if m <= minute - METRICS_RETENTION]:
+                del minutes[expired]
+            minutes[minute] = [0, 0]
+        minutes[minute][0] += units[0]
+        minutes[minute][1] += units[1]
+
+    def metric_statistics(self, params):
+        """Serve a CloudWatch ``GetMetricStatistics`` request of the
+        consumed capacity of a table
+
+        :param params: Dict of the query parameters.
+        :returns: Tuple of the response status code and XML body, with
+                  the ``Sum`` of each period holding consumption.
+
+        """
+        if params.get("Action") != "GetMetricStatistics" or \
+                params.get("MetricName") not in CONSUMED_METRICS:
+            return 400, self.cloudwatch_error(
+                "InvalidAction", "Only the consumed capacity metrics are "
+                "served")
+        kind = CONSUMED_METRICS[params["MetricName"]]
+        table = None
+        index = 1
+        while "Dimensions.member.%d.Name" % index in params:
+            if params["Dimensions.member.%d.Name" % index] == "TableName":
+                table = params.get("Dimensions.member.%d.Value" % index)
+            index += 1
+        period = max(int(params.get("Period", 60)) // 60 * 60, 60)
+        start = parse_timestamp(params["StartTime"]) // 60 * 60
+        end = parse_timestamp(params["EndTime"])
+        sums = {}
+        for minute, units in self.consumed.get(table, {}).items():
+            if start <= minute < end:
+                slot = minute - (minute - start) % period
+                sums[slot] = sums.get(slot, 0) + units[kind]
+        members = "".join(
+            "<member><Timestamp>%s</Timestamp><Sum>%s</Sum>"
+            "<Unit>Count</Unit></member>" % (
+                datetime.datetime.utcfromtimestamp(slot).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"), float(sums[slot]))
+            for slot in sorted(sums))
+        return 200, (
+            '<GetMetricStatisticsResponse xmlns="%s">'
+            "<GetMetricStatisticsResult><Datapoints>%s</Datapoints>"
+            "<Label>%s</Label></GetMetricStatisticsResult>"
+            "</GetMetricStatisticsResponse>" % (
+                CLOUDWATCH_XMLNS, members, escape(params["MetricName"])))
+
+    def cloudwatch_error(self, code, message):
+        """XML body of a CloudWatch error"""
+        return ("<ErrorResponse><Error><Type>Sender</Type><Code>%s</Code>"
+                "<Message>%s</Message></Error></ErrorResponse>" %
+                (escape(code), escape(message)))
+
+    def error(self, name, message, code=400):
+        """Response tuple of a DynamoDB error"""
+        return code, json.dumps({"__type": ERROR_PREFIX + name,
+                                 "message": message})
+
+    @inlineCallbacks
+    def handle(self, operation, headers, body):
+        """Serve a request
+
+        :param operation: Name of the operation, from the ``X-Amz-Target``.
+        :param headers: Dict of the request headers.
+        :param body: JSON request body.
+        :returns: Deferred firing with a tuple of the response status code
+                  and body.
+
+        """
+        self._count(operation, "requests")
+        latency = self.latency.get(operation) or self.latency.get("*")
+        if latency is not None:
+            yield task.deferLater(self.clock, latency.sample(self.rng),
+                                  lambda: None)
+        params = json.loads(body or "{}")
+        if self.rng.random() < by_operation(self.errors, operation, 0):
+            self._count(operation, "errors")
+            returnValue(self.error("InternalServerError",
+                                   "Injected server error", 500))
+        if self.throttled(operation, params):
+            self._count(operation, "throttled")
+            returnValue(self.error(
+                "ProvisionedThroughputExceededException",
+                "The level of configured provisioned throughput for the "
+                "table was exceeded."))
+        code, response = yield self.forward(headers, body)
+        if code == 200 and response:
+            self.account(operation, params, json.loads(response))
+        returnValue((code, response))
+
+    @inlineCallbacks
+    def forward(self, headers, body):
+        """Send a request upstream
+
+        :returns: Deferred firing with a tuple of the response status code
+                  and body.
+
+        """
+        raw_headers = Headers()
+        for name, value in headers.items():
+            if name.lower() not in HOP_HEADERS:
+                raw_headers.addRawHeader(name, value)
+        response = yield self.agent.request(
+            "POST", self.upstream, raw_headers,
+            FileBodyProducer(StringIO(body)))
+        content = yield readBody(response)
+        returnValue((response.code, content))
+
+    def report(self):
+        """Print the requests, throttles and errors of each operation since
+        the last report"""
+        for operation in sorted(self.counts):
+            print ("FakeDB: %s requests %d, throttled %d, errors %d" %
+                   ((operation,) + tuple(self.counts[operation][name] for
+                                         name in ("requests", "throttled",
+                                                  "errors"))))
+        self.counts = {}
+
+
+class FakeDynamoDBHandler(cyclone.web.RequestHandler):
+    """HTTP handler of the DynamoDB API served by a :class:`FakeDynamoDB`"""
+    def initialize(self, fakedb):
+        """Setup basic attributes"""
+        self.fakedb = fakedb
+
+    @cyclone.web.asynchronous
+    def post(self, *args):
+        """HTTP POST
+
+        Serves the operation named by the ``X-Amz-Target`` header.
+
+        """
+        target = self.request.headers.get("X-Amz-Target", "")
+        d = self.fakedb.handle(target.split(".")[-1],
+                               dict(self.request.headers),
+                               self.request.body)
+        d.addCallback(self._respond)
+        d.addErrback(self._failed)
+
+    def get(self, *args):
+        """HTTP GET
+
+        Serves the CloudWatch query API requests of the consumed capacity,
+        see :meth:`FakeDynamoDB.metric_statistics`.
+
+        """
+        params = dict((name, values[-1]) for name, values in
+                      self.request.arguments.items())
+        self._respond(self.fakedb.metric_statistics(params),
+                      content_type="text/xml")
+
+    def _respond(self, result, content_type="application/x-amz-json-1.0"):
+        """Write the status code and body of a response"""
+        code, body = result
+        self.set_status(code)
+        self.set_header("Content-Type", content_type)
+        self.write(body)
+        self.finish()
+
+    def _failed(self, failure):
+        """Answer requests that couldn't be forwarded with a server error"""
+        log.err(failure)
+        self._respond(self.fakedb.error("InternalServerError",
+                                        "Upstream request failed", 500))
+
+
+def _parse_fakedb(sysargs):
+    """Parse out the arguments for the DynamoDB stand-in"""
+    parser = configargparse.ArgumentParser(
+        description='Serves DynamoDB in front of another DynamoDB service, '
+                    'with injected latency, throttling and errors.')
+    parser.register('type', bool, str2bool)
+    parser.add_argument('--port', help="Port to listen on", type=int,
+                        default=5000, env_var="FAKEDB_PORT")
+    parser.add_argument('--upstream',
+                        help="URL of the DynamoDB service to forward to",
+                        type=str, default="http://127.0.0.1:5001",
+                        env_var="FAKEDB_UPSTREAM")
+    parser.add_argument('--profile',
+                        help="Profile name (%s) or JSON file" %
+                        ", ".join(sorted(PROFILES)), type=str,
+                        default="local", env_var="FAKEDB_PROFILE")
+    parser.add_argument('--seed', help="Seed of the random latencies and "
+                        "errors", type=int, default=None)
+    parser.add_argument('--report_interval',
+                        help="Seconds between reports of the requests, "
+                        "0 disables them", type=int, default=10)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Serve the DynamoDB stand-in, aka the autopush-fakedb script"""
+    args = _parse_fakedb(sysargs)
+    fakedb = FakeDynamoDB(args.upstream, load_profile(args.profile),
+                          seed=args.seed)
+    # Requests to an HTTP proxy carry the full URL as their path
+    site = cyclone.web.Application([
+        (r".*", FakeDynamoDBHandler, dict(fakedb=fakedb)),
+    ])
+    reactor.listenTCP(args.port, site)
+    if args.report_interval:
+        reporter = task.LoopingCall(fakedb.report)
+        reporter.start(args.report_interval, now=False)
+    reactor.run()
@@ -1,14 +1,18 @@
 """Health Check HTTP Handler"""
+import json
+
 import cyclone.web
 
 from boto.dynamodb2.exceptions import (
     InternalServerError,
 )
-from twisted.internet.defer import DeferredList
-from twisted.internet.threads import deferToThread
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, succeed
 from twisted.python import log
+from twisted.web.client import Agent, readBody
 
 from autopush import __version__
+from autopush.db import deferToDB
 
 
 class MissingTableException(Exception):
@@ -32,15 +36,21 @@ class HealthHandler(cyclone.web.RequestHandler):
             "clients": len(self.ap_settings.clients)
         }
 
+        if not self.ap_settings.ready:
+            self._healthy = False
+            self._health_checks["database"] = {"status": "NOT OK",
+                                               "error": "Starting"}
+            return self._finish_response(None)
+
         dl = DeferredList([
-            self._check_table(self.ap_settings.router.table),
-            self._check_table(self.ap_settings.storage.table)
+            self._check_table(table) for table in
+            self.ap_settings.router_tables + self.ap_settings.storage_tables
         ])
         dl.addBoth(self._finish_response)
 
     def _check_table(self, table):
         """Checks the tables known about in DynamoDB"""
-        d = deferToThread(table.connection.list_tables)
+        d = deferToDB(table.connection.list_tables)
         d.addCallback(self._check_success, table.table_name)
         d.addErrback(self._check_error, table.table_name)
         return d
@@ -81,10 +91,111 @@ class StatusHandler(cyclone.web.RequestHandler):
     def get(self):
         """HTTP Get
 
-        Returns that this node is alive, and the version.
+        Returns that this node is alive, and the version. Until the node is
+        ready to serve requests the status is ``STARTING`` with a 503.
 
         """
+        status = "OK"
+        if not self.ap_settings.ready:
+            status = "STARTING"
+            self.set_status(503)
         self.write({
-            "status": "OK",
+            "status": status,
             "version": __version__
         })
+
+
+class CostsHandler(cyclone.web.RequestHandler):
+    """HTTP Database Costs Handler"""
+    def get(self):
+        """HTTP Get
+
+        Returns the database requests and capacity units of each protocol
+        action over the rolling window, see :mod:`autopush.costs`. Nodes
+        not accounting them return a 404.
+
+        """
+        costs = self.ap_settings.db_costs
+        if costs is None:
+            self.set_status(404)
+            return self.write({"status": "NOT ENABLED"})
+        self.write({
+            "window": costs.window,
+            "actions": costs.averages(),
+        })
+
+
+class WorkersHealthHandler(cyclone.web.RequestHandler):
+    """HTTP Health Handler of a supervisor, aggregating its workers'"""
+    def initialize(self, supervisor, health_port, agent=None):
+        """Setup the handler
+
+        :param supervisor: :class:`~autopush.workers.Supervisor` of the
+                           workers.
+        :param health_port: Port of the supervisor's health, worker N
+                            answers on ``health_port`` + 1 + N on the
+                            loopback interface.
+
+        """
+        self.supervisor = supervisor
+        self.health_port = health_port
+        self.agent = agent or Agent(reactor, connectTimeout=5)
+
+    @cyclone.web.asynchronous
+    def get(self):
+        """HTTP Get
+
+        Returns the health of each worker under ``workers``, and is only
+        OK when every worker is running and healthy.
+
+        """
+        self._healthy = True
+        self._health_checks = {
+            "version": __version__,
+            "workers": {}
+        }
+        dl = DeferredList([self._check_worker(index) for index in
+                           range(self.supervisor.count)])
+        dl.addBoth(self._finish_response)
+
+    def _check_worker(self, index):
+        """Fetches the health of a worker"""
+        if index not in self.supervisor.workers:
+            self._worker_error(index, "Not running")
+            return succeed(None)
+        url = "http://127.0.0.1:%d/health" % (self.health_port + 1 + index)
+        d = self.agent.request("GET", url)
+        d.addCallback(readBody)
+        d.addCallback(json.loads)
+        d.addCallback(self._check_success, index)
+        d.addErrback(self._check_error, index)
+        return d
+
+    def _check_success(self, health, index):
+        """Records the health a worker returned"""
+        if health.get("status") != "OK":
+            self._healthy = False
+        self._health_checks["workers"][str(index)] = health
+
+    def _check_error(self, failure, index):
+        """Records a worker that didn't answer"""
+        log.msg("Worker %d health failed: %s" %
+                (index, failure.getErrorMessage()))
+        self._worker_error(index, "Unreachable")
+
+    def _worker_error(self, index, error):
+        """Records an unhealthy worker, and why"""
+        self._healthy = False
+        self._health_checks["workers"][str(index)] = {"status": "NOT OK",
+                                                      "error": error}
+
+    def _finish_response(self, results):
+        """Returns whether all workers are healthy or not"""
+        if self._healthy:
+            self._health_checks["status"] = "OK"
+        else:
+            self.set_status(503)
+            self._health_checks["status"] = "NOT OK"
+
+        self.write(self._health_checks)
+        self.finish()
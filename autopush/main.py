@@ -1,11 +1,20 @@
 """autopush/autoendpoint daemon scripts"""
+import argparse
+import sys
+
 import configargparse
 import cyclone.web
 from autobahn.twisted.websocket import WebSocketServerFactory, listenWS
 from twisted.internet import reactor, task
+from twisted.python import log
 
 from autopush.endpoint import (EndpointHandler, RegistrationHandler)
-from autopush.health import (HealthHandler, StatusHandler)
+from autopush.health import (
+    CostsHandler,
+    HealthHandler,
+    StatusHandler,
+    WorkersHealthHandler,
+)
 from autopush.logging import setup_logging
 from autopush.settings import AutopushSettings
 from autopush.ssl import AutopushSSLContextFactory
@@ -16,6 +25,16 @@ from autopush.websocket import (
     NotificationHandler,
     periodic_reporter
 )
+from autopush.workers import (
+    Supervisor,
+    adopt_socket,
+    drain,
+    inherited_socket,
+    listening_socket,
+    reuseport_socket,
+    supervise,
+    worker_command,
+)
 
 
 shared_config_files = [
@@ -76,6 +95,84 @@ def add_shared_args(parser):
     parser.add_argument('--router_write_throughput',
                         help="DynamoDB router write throughput",
                         type=int, default=5, env_var="ROUTER_WRITE_THROUGHPUT")
+    parser.add_argument('--router_shards',
+                        help="Amount of router tables to spread UAIDs over",
+                        type=int, default=1, env_var="ROUTER_SHARDS")
+    parser.add_argument('--storage_shards',
+                        help="Amount of storage tables to spread UAIDs over",
+                        type=int, default=1, env_var="STORAGE_SHARDS")
+    parser.add_argument('--shard_migration',
+                        help="Also read the unsharded tables while their "
+                        "records are moved to shards", type=bool,
+                        default=False, env_var="SHARD_MIGRATION")
+    parser.add_argument('--storage_rotation',
+                        help="Store notifications in a table per month",
+                        type=bool, default=False, env_var="STORAGE_ROTATION")
+    parser.add_argument('--storage_retention',
+                        help="Amount of monthly storage tables kept, at "
+                        "least 2", type=int, default=3,
+                        env_var="STORAGE_RETENTION")
+    parser.add_argument('--compact_items',
+                        help="Use tables of the compact item schema, with "
+                        "binary UUIDs and registered node numbers",
+                        type=bool, default=False, env_var="COMPACT_ITEMS")
+    parser.add_argument('--compact_migration',
+                        help="Also read the original tables while their "
+                        "records are moved to the compact tables",
+                        type=bool, default=False, env_var="COMPACT_MIGRATION")
+    parser.add_argument('--storage_map',
+                        help="Keep the notifications of a UAID in a single "
+                        "storage item", type=bool, default=False,
+                        env_var="STORAGE_MAP")
+    parser.add_argument('--storage_map_migration',
+                        help="Also read the storage tables of a row per "
+                        "notification while their records are moved",
+                        type=bool, default=False,
+                        env_var="STORAGE_MAP_MIGRATION")
+    parser.add_argument('--db_backend',
+                        help="Database backend, dynamodb or memory (records "
+                        "kept in the process, only shared by the nodes of "
+                        "autopush-combined)", type=str, default="dynamodb",
+                        choices=["dynamodb", "memory"], env_var="DB_BACKEND")
+    parser.add_argument('--async_dynamodb',
+                        help="Use non-blocking DynamoDB requests instead of "
+                        "the thread pool", type=bool, default=False,
+                        env_var="ASYNC_DYNAMODB")
+    parser.add_argument('--dynamodb_max_connections',
+                        help="Maximum concurrent non-blocking DynamoDB "
+                        "requests", type=int, default=50,
+                        env_var="DYNAMODB_MAX_CONNECTIONS")
+    parser.add_argument('--db_throttle',
+                        help="Pace DynamoDB requests to the rate the tables "
+                        "sustain", type=bool, default=False,
+                        env_var="DB_THROTTLE")
+    parser.add_argument('--db_throttle_max_rate',
+                        help="Maximum requests per second of each table "
+                        "operation", type=int, default=1000,
+                        env_var="DB_THROTTLE_MAX_RATE")
+    parser.add_argument('--db_throttle_max_queue',
+                        help="Maximum requests of each table operation "
+                        "waiting to be sent", type=int, default=1000,
+                        env_var="DB_THROTTLE_MAX_QUEUE")
+    parser.add_argument('--db_metrics',
+                        help="Time every table operation and count the "
+                        "capacity units it consumes", type=bool,
+                        default=False, env_var="DB_METRICS")
+    parser.add_argument('--db_costs',
+                        help="Count the DynamoDB requests and capacity units "
+                        "of each protocol action", type=bool, default=False,
+                        env_var="DB_COSTS")
+    parser.add_argument('--db_costs_window',
+                        help="Seconds to average the requests and capacity "
+                        "units of each protocol action over", type=int,
+                        default=60, env_var="DB_COSTS_WINDOW")
+    parser.add_argument('--eventual_reads',
+                        help="Comma separated call sites reading eventually "
+                        "consistent (endpoint, router, redeliver, fetch)",
+                        type=str, default="", env_var="EVENTUAL_READS")
+    parser.add_argument('--skip_preflight',
+                        help="Skip the DynamoDB preflight check on startup",
+                        type=bool, default=False, env_var="SKIP_PREFLIGHT")
     parser.add_argument('--log_level', type=int, default=40,
                         env_var="LOG_LEVEL")
     parser.add_argument('--max_data', help="Max data segment length in bytes",
@@ -151,9 +248,33 @@ def _parse_connection(sysargs):
     parser.add_argument('--auto_ping_timeout',
                         help="Timeout in seconds for Websocket ping replys",
                         default=4, type=float, env_var="AUTO_PING_TIMEOUT")
+    parser.add_argument('--auto_ping_slice',
+                        help="Maximum amount of connections pinged at a "
+                        "time, the slices spread over the ping interval",
+                        default=1000, type=int, env_var="AUTO_PING_SLICE")
     parser.add_argument('--max_connections',
                         help="The maximum number of concurrent connections.",
                         default=0, type=int, env_var="MAX_CONNECTIONS")
+    parser.add_argument('--unregister_batch_window',
+                        help="Milliseconds to gather the notification "
+                        "deletes of unregistered channels of all "
+                        "connections into batch writes, 0 for a delete "
+                        "each", type=int, default=0,
+                        env_var="UNREGISTER_BATCH_WINDOW")
+    parser.add_argument('--fetch_page_size',
+                        help="Amount of stored notifications to fetch and "
+                        "send at a time, 0 fetches them all at once",
+                        type=int, default=0, env_var="FETCH_PAGE_SIZE")
+    parser.add_argument('--timer_resolution',
+                        help="Seconds per tick of the wheel scheduling the "
+                        "timers of connections", type=float, default=0.1,
+                        env_var="TIMER_RESOLUTION")
+    parser.add_argument('--workers',
+                        help="Worker processes sharing the websocket port, "
+                        "worker N listens on router_port + N",
+                        type=int, default=1, env_var="WORKERS")
+    parser.add_argument('--worker_index', help=argparse.SUPPRESS,
+                        type=int, default=None)
 
     add_external_router_args(parser)
     add_shared_args(parser)
@@ -179,6 +300,44 @@ def _parse_endpoint(sysargs):
                         type=int, default=8082, env_var="PORT")
     parser.add_argument('--cors', help='Allow CORS PUTs for update.',
                         type=bool, default=False, env_var='ALLOW_CORS')
+    parser.add_argument('--router_cache_size',
+                        help="Amount of router items to cache, 0 disables "
+                        "the cache", type=int, default=0,
+                        env_var="ROUTER_CACHE_SIZE")
+    parser.add_argument('--router_cache_ttl',
+                        help="Seconds to use a cached router item",
+                        type=int, default=30, env_var="ROUTER_CACHE_TTL")
+    parser.add_argument('--router_coalesce',
+                        help="Share concurrent lookups of the same UAID",
+                        type=bool, default=False, env_var="ROUTER_COALESCE")
+    parser.add_argument('--router_batch_window',
+                        help="Milliseconds to gather UAID lookups into one "
+                        "batch read, 0 disables batching", type=int,
+                        default=0, env_var="ROUTER_BATCH_WINDOW")
+    parser.add_argument('--storage_write_window',
+                        help="Milliseconds to queue notification writes "
+                        "and collapse them per channel, 0 disables the "
+                        "queue", type=int, default=0,
+                        env_var="STORAGE_WRITE_WINDOW")
+    parser.add_argument('--storage_write_batch',
+                        help="Amount of queued channels that flushes the "
+                        "notification write queue", type=int, default=500,
+                        env_var="STORAGE_WRITE_BATCH")
+    parser.add_argument('--workers',
+                        help="Worker processes accepting from the endpoint "
+                        "port", type=int, default=1, env_var="WORKERS")
+    parser.add_argument('--health_port',
+                        help="Port of the /health aggregating the workers', "
+                        "worker N answers on health_port + 1 + N locally",
+                        type=int, default=8090, env_var="HEALTH_PORT")
+    parser.add_argument('--shutdown_grace',
+                        help="Seconds a stopping worker gives its requests "
+                        "to finish", type=float, default=10,
+                        env_var="SHUTDOWN_GRACE")
+    parser.add_argument('--worker_index', help=argparse.SUPPRESS,
+                        type=int, default=None)
+    parser.add_argument('--listen_fd', help=argparse.SUPPRESS, type=int,
+                        default=None)
     add_shared_args(parser)
     add_external_router_args(parser)
 
@@ -216,11 +375,123 @@ def make_settings(args, **kwargs):
         storage_write_throughput=args.storage_write_throughput,
         router_read_throughput=args.router_read_throughput,
         router_write_throughput=args.router_write_throughput,
+        router_shards=args.router_shards,
+        storage_shards=args.storage_shards,
+        shard_migration=args.shard_migration,
+        storage_rotation=args.storage_rotation,
+        storage_retention=args.storage_retention,
+        compact_items=args.compact_items,
+        compact_migration=args.compact_migration,
+        storage_map=args.storage_map,
+        storage_map_migration=args.storage_map_migration,
+        db_backend=args.db_backend,
         resolve_hostname=args.resolve_hostname,
+        async_dynamodb=args.async_dynamodb,
+        dynamodb_max_connections=args.dynamodb_max_connections,
+        db_throttle=args.db_throttle,
+        db_throttle_max_rate=args.db_throttle_max_rate,
+        db_throttle_max_queue=args.db_throttle_max_queue,
+        db_metrics=args.db_metrics,
+        db_costs=args.db_costs,
+        db_costs_window=args.db_costs_window,
+        eventual_reads=[site.strip() for site in
+                        args.eventual_reads.split(",") if site.strip()],
+        preflight=not args.skip_preflight,
         **kwargs
     )
 
 
+def worker_tags(args):
+    """Metric tags of a worker process, None outside of workers"""
+    if args.worker_index is None:
+        return None
+    return ["worker:%d" % args.worker_index]
+
+
+def supervise_endpoint(args, sysargs):
+    """Supervise the workers of an endpoint node, sharing the endpoint
+    port the supervisor listens on
+
+    The supervisor serves the workers' aggregated ``/health``, and
+    rotates them on a ``SIGHUP``.
+
+    """
+    sock = listening_socket(args.port)
+    fd = sock.fileno()
+    supervisor = Supervisor(
+        worker_command("endpoint_main", sysargs) + ["--listen_fd=%d" % fd],
+        args.workers, child_fds={0: 0, 1: 1, 2: 2, fd: fd})
+    site = cyclone.web.Application([
+        (r"^/health", WorkersHealthHandler,
+         dict(supervisor=supervisor, health_port=args.health_port)),
+    ],
+        debug=args.debug, log_function=skip_request_logging
+    )
+    reactor.listenTCP(args.health_port, site)
+    return supervise(supervisor, rotate=True)
+
+
+def start_db(settings):
+    """Set up the database of a node that is already listening, stopping
+    the node if that fails"""
+    d = settings.start_db()
+    d.addCallback(lambda _: start_storage_rotation(settings))
+    d.addErrback(startup_failed)
+    return d
+
+
+def start_storage_rotation(settings, interval=3600):
+    """Rotate the storage tables of a node periodically, if they rotate
+
+    :returns: The :class:`~twisted.internet.task.LoopingCall`, or None.
+
+    """
+    if settings.rotating_storage is None:
+        return None
+    rotation = task.LoopingCall(rotate_storage, settings)
+    rotation.start(interval, now=False)
+    return rotation
+
+
+def rotate_storage(settings):
+    """Rotate the storage tables, logging failures so the rotation keeps
+    running"""
+    d = settings.rotate_storage()
+    d.addErrback(log.err, "Storage rotation failed")
+    return d
+
+
+def start_cost_reporting(settings, interval=10):
+    """Report the average costs of the protocol actions periodically, if
+    they are accounted
+
+    :returns: The :class:`~twisted.internet.task.LoopingCall`, or None.
+
+    """
+    if settings.db_costs is None:
+        return None
+    reporting = task.LoopingCall(settings.db_costs.report)
+    reporting.start(interval, now=False)
+    return reporting
+
+
+def start_ping_sweeper(settings):
+    """Start pinging the connections of a node, if pings are enabled
+
+    :returns: The :class:`~twisted.internet.task.LoopingCall`, or None.
+
+    """
+    if settings.ping_sweeper is None:
+        return None
+    return settings.ping_sweeper.start()
+
+
+def startup_failed(failure):
+    """errBack stopping the node when its database couldn't be set up"""
+    log.err(failure, "Database startup failed")
+    reactor.stop()
+
+
 def skip_request_logging(handler):
     """Ignores request logging"""
     pass
@@ -232,27 +503,62 @@ def mount_health_handlers(site, settings):
     status.ap_settings = settings
     health = HealthHandler
     health.ap_settings = settings
+    costs = CostsHandler
+    costs.ap_settings = settings
     site.add_handlers(".*$", [
         (r"^/status", status),
         (r"^/health", health),
+        (r"^/costs", costs),
     ])
 
 
-def connection_main(sysargs=None):
-    """Main entry point to setup a connection node, aka the autopush script"""
-    args, parser = _parse_connection(sysargs)
-    settings = make_settings(
+def reject_memory_workers(args, parser):
+    """Refuse workers sharing the records of the memory backend, which
+    each worker process would keep apart"""
+    if args.db_backend == "memory" and args.workers > 1:
+        parser.error("--db_backend=memory keeps the records in one process, "
+                     "it can't be used with --workers")
+
+
+def connection_router_port(args):
+    """Port the connection node routes on
+
+    Each worker routes on a port of its own, so the router_url stored as
+    the node_id of its clients reaches the worker holding them.
+
+    """
+    return args.router_port + (args.worker_index or 0)
+
+
+def connection_settings(args):
+    """Settings of a connection node"""
+    return make_settings(
         args,
+        metrics_tags=worker_tags(args),
         port=args.port,
         endpoint_scheme=args.endpoint_scheme,
         endpoint_hostname=args.endpoint_hostname,
         endpoint_port=args.endpoint_port,
         router_scheme="https" if args.router_ssl_key else "http",
         router_hostname=args.router_hostname,
-        router_port=args.router_port,
+        router_port=connection_router_port(args),
+        unregister_batch_window=args.unregister_batch_window,
+        fetch_page_size=args.fetch_page_size,
+        timer_resolution=args.timer_resolution,
+        auto_ping_interval=args.auto_ping_interval,
+        auto_ping_timeout=args.auto_ping_timeout,
+        auto_ping_slice=args.auto_ping_slice,
+        deferred_startup=True,
     )
-    setup_logging("Autopush")
 
+
+def connection_apps(args, settings):
+    """Internal routing site and public websocket factory of a connection
+    node
+
+    :returns: Tuple of the site and the factory.
+
+    """
     r = RouterHandler
     r.ap_settings = settings
     n = NotificationHandler
@@ -282,20 +588,70 @@ def connection_main(sysargs=None):
         maxFramePayloadSize=2048,
         maxMessagePayloadSize=2048,
         openHandshakeTimeout=5,
-        autoPingInterval=args.auto_ping_interval,
-        autoPingTimeout=args.auto_ping_timeout,
         maxConnections=args.max_connections
     )
     settings.factory = factory
+    return site, factory
+
+
+def start_connection_tasks(settings):
+    """Start the periodic tasks of a connection node
+
+    :returns: The :class:`~twisted.internet.task.LoopingCall` reporting
+              the node's metrics.
+
+    """
+    start_cost_reporting(settings)
+    start_ping_sweeper(settings)
+    reporter = task.LoopingCall(periodic_reporter, settings)
+    reporter.start(1.0)
+    return reporter
+
+
+def endpoint_site(settings, debug=False):
+    """Site of an endpoint node"""
+    site = cyclone.web.Application([
+        (r"/push/([^\/]+)", EndpointHandler, dict(ap_settings=settings)),
+        # PUT /register/ => connect info
+        # GET /register/uaid => chid + endpoint
+        (r"/register(?:/(.+))?", RegistrationHandler,
+         dict(ap_settings=settings)),
+    ],
+        default_host=settings.hostname, debug=debug,
+        log_function=skip_request_logging
+    )
+    mount_health_handlers(site, settings)
+    return site
+
+
+def connection_main(sysargs=None):
+    """Main entry point to setup a connection node, aka the autopush script"""
+    args, parser = _parse_connection(sysargs)
+    reject_memory_workers(args, parser)
+    if args.workers > 1 and args.worker_index is None:
+        # Supervise the workers, which run the rest
+        setup_logging("Autopush")
+        return supervise(Supervisor(
+            worker_command("connection_main",
+                           sys.argv[1:] if sysargs is None else sysargs),
+            args.workers))
+    settings = connection_settings(args)
+    setup_logging("Autopush")
+    site, factory = connection_apps(args, settings)
+    router_port = connection_router_port(args)
 
     settings.metrics.start()
 
     # Start the WebSocket listener.
+    contextFactory = None
     if args.ssl_key:
         contextFactory = AutopushSSLContextFactory(args.ssl_key,
                                                    args.ssl_cert)
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
+    if args.worker_index is not None:
+        adopt_socket(reuseport_socket(args.port), factory, contextFactory)
+    elif contextFactory:
         listenWS(factory, contextFactory)
     else:
         reactor.listenTCP(args.port, factory)
@@ -306,14 +662,13 @@ def connection_main(sysargs=None):
                                                    args.router_ssl_cert)
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
-        reactor.listenSSL(args.router_port, site, contextFactory)
+        reactor.listenSSL(router_port, site, contextFactory)
     else:
-        reactor.listenTCP(args.router_port, site)
+        reactor.listenTCP(router_port, site)
 
     reactor.suggestThreadPoolSize(50)
-
-    l = task.LoopingCall(periodic_reporter, settings)
-    l.start(1.0)
+    reactor.callWhenRunning(start_db, settings)
+    start_connection_tasks(settings)
     reactor.run()
 
 
@@ -321,39 +676,106 @@ def endpoint_main(sysargs=None):
     """Main entry point to setup an endpoint node, aka the autoendpoint
     script"""
     args, parser = _parse_endpoint(sysargs)
+    reject_memory_workers(args, parser)
+    if args.workers > 1 and args.worker_index is None:
+        setup_logging("Autoendpoint")
+        return supervise_endpoint(
+            args, sys.argv[1:] if sysargs is None else sysargs)
     settings = make_settings(
         args,
+        metrics_tags=worker_tags(args),
         endpoint_scheme="https" if args.ssl_key else "http",
         endpoint_hostname=args.hostname,
         endpoint_port=args.port,
-        enable_cors=args.cors
+        enable_cors=args.cors,
+        router_cache_size=args.router_cache_size,
+        router_cache_ttl=args.router_cache_ttl,
+        router_coalesce=args.router_coalesce,
+        router_batch_window=args.router_batch_window,
+        storage_write_window=args.storage_write_window,
+        storage_write_batch=args.storage_write_batch,
+        deferred_startup=True,
     )
 
     setup_logging("Autoendpoint")
-
-    # Endpoint HTTP router
-    site = cyclone.web.Application([
-        (r"/push/([^\/]+)", EndpointHandler, dict(ap_settings=settings)),
-        # PUT /register/ => connect info
-        # GET /register/uaid => chid + endpoint
-        (r"/register(?:/(.+))?", RegistrationHandler,
-         dict(ap_settings=settings)),
-    ],
-        default_host=settings.hostname, debug=args.debug,
-        log_function=skip_request_logging
-    )
-    mount_health_handlers(site, settings)
+    site = endpoint_site(settings, args.debug)
 
     settings.metrics.start()
 
+    contextFactory = None
     if args.ssl_key:
         contextFactory = AutopushSSLContextFactory(args.ssl_key,
                                                    args.ssl_cert)
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
+    if args.worker_index is not None:
+        # Accept from the supervisor's socket, and answer its health
+        # checks on a port of our own
+        ports = [
+            adopt_socket(inherited_socket(args.listen_fd), site,
+                         contextFactory),
+            reactor.listenTCP(args.health_port + 1 + args.worker_index,
+                              site, interface="127.0.0.1"),
+        ]
+        reactor.addSystemEventTrigger("before", "shutdown", drain, ports,
+                                      args.shutdown_grace)
+    elif contextFactory:
         reactor.listenSSL(args.port, site, contextFactory)
     else:
         reactor.listenTCP(args.port, site)
 
     reactor.suggestThreadPoolSize(50)
+    reactor.callWhenRunning(start_db, settings)
+    start_cost_reporting(settings)
+    reactor.run()
+
+
+def start_combined(args):
+    """Listen as a connection node and an endpoint node in one process
+
+    The endpoint node serves the connection node's ``endpoint_port``,
+    without TLS, and both nodes use the same database, which makes them
+    share the records of ``--db_backend=memory``.
+
+    :returns: Tuple of the settings of the connection node, those of the
+              endpoint node and the listening ports.
+
+    """
+    settings = connection_settings(args)
+    endpoint_settings = make_settings(
+        args,
+        endpoint_scheme=args.endpoint_scheme,
+        endpoint_hostname=args.endpoint_hostname,
+        endpoint_port=args.endpoint_port,
+        deferred_startup=True,
+    )
+    site, factory = connection_apps(args, settings)
+    ports = [
+        reactor.listenTCP(args.port, factory),
+        reactor.listenTCP(connection_router_port(args), site),
+        reactor.listenTCP(args.endpoint_port,
+                          endpoint_site(endpoint_settings, args.debug)),
+    ]
+    for node_settings in (settings, endpoint_settings):
+        node_settings.metrics.start()
+        reactor.callWhenRunning(start_db, node_settings)
+    return settings, endpoint_settings, ports
+
+
+def combined_main(sysargs=None):
+    """Main entry point to setup a connection node and an endpoint node in
+    one process, aka the autopush-combined script
+
+    Takes the arguments of a connection node. Separate processes don't
+    share the records of ``--db_backend=memory``, so this is the mode it
+    runs the push path in.
+
+    """
+    args, parser = _parse_connection(sysargs)
+    if args.workers > 1:
+        parser.error("--workers can't be used with combined nodes")
+    setup_logging("Autopush")
+    settings, _, _ = start_combined(args)
+    reactor.suggestThreadPoolSize(50)
+    start_connection_tasks(settings)
     reactor.run()
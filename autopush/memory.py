@@ -0,0 +1,199 @@
+"""In-memory database backend
+
+Keeps notifications and router items in dicts of the process instead of
+DynamoDB tables, so single box deployments and benchmarks run the push
+path without network round trips, or thread pool hops, for data access.
+Nodes set up with ``--db_backend=memory`` in the same process share the
+records, which are lost once it exits. Only ``autopush-combined`` runs a
+connection node and an endpoint node in one process, so it's the mode the
+push path runs in.
+
+Writes are conditioned the way the DynamoDB tables are written: a
+notification is only saved over an older version, a user is only
+registered over a record without a node or with an older ``connected_at``,
+and a node is only cleared while the record still holds it.
+
+"""
+from boto.dynamodb2.exceptions import ItemNotFound
+
+from autopush.backend import IBackend, IRouterTable, IStorage
+from autopush.db import preflight_router, preflight_storage
+
+
+class MemoryStorage(IStorage):
+    """Storage abstraction keeping the notifications of each UAID in a dict
+    of chid to version
+
+    The notifications are returned as dicts of the ``uaid``, ``chid`` and
+    ``version``.
+
+    """
+    deferred = True
+
+    def __init__(self, metrics, table=None):
+        """Create a new MemoryStorage
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param table: Dict of UAID to its dict of chid to version, to share
+                      with other instances.
+
+        """
+        self.table = {} if table is None else table
+        self.metrics = metrics
+
+    def fetch_notifications(self, uaid, consistent=True):
+        """Fetch all notifications for a UAID, see
+        :meth:`~autopush.backend.IStorage.fetch_notifications`"""
+        chids = self.table.get(uaid, {})
+        return [dict(uaid=uaid, chid=chid, version=chids[chid])
+                for chid in sorted(chids)]
+
+    def fetch_notifications_page(self, uaid, page_size, start_key=None,
+                                 consistent=True):
+        """Fetch a page of notifications for a UAID, see
+        :meth:`~autopush.backend.IStorage.fetch_notifications_page`
+
+        The page key is the last chid of the page.
+
+        """
+        notifs = self.fetch_notifications(uaid)
+        if start_key is not None:
+            notifs = [notif for notif in notifs if notif["chid"] > start_key]
+        page = notifs[:page_size]
+        if len(notifs) > page_size:
+            return page, page[-1]["chid"]
+        return page, None
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID, see
+        :meth:`~autopush.backend.IStorage.save_notification`"""
+        chids = self.table.setdefault(uaid, {})
+        if chid in chids and chids[chid] >= version:
+            return False
+        chids[chid] = version
+        return True
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID, see
+        :meth:`~autopush.backend.IStorage.delete_notification`"""
+        chids = self.table.get(uaid, {})
+        if chid in chids and (not version or chids[chid] == version):
+            self._remove(uaid, [chid])
+        return True
+
+    def delete_notifications(self, keys):
+        """Delete several notifications, see
+        :meth:`~autopush.backend.IStorage.delete_notifications`"""
+        for uaid, chid in keys:
+            self._remove(uaid, [chid])
+        return True
+
+    def _remove(self, uaid, chids):
+        """Remove channels of a UAID, dropping the UAID once it has none"""
+        stored = self.table.get(uaid)
+        if stored is None:
+            return
+        for chid in chids:
+            stored.pop(chid, None)
+        if not stored:
+            del self.table[uaid]
+
+
+class MemoryRouter(IRouterTable):
+    """Router abstraction keeping a dict of UAID to router item
+
+    Router items are returned as copies, so callers can't modify the
+    stored ones.
+
+    """
+    deferred = True
+
+    def __init__(self, metrics, table=None):
+        """Create a new MemoryRouter
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param table: Dict of UAID to router item, to share with other
+                      instances.
+
+        """
+        self.table = {} if table is None else table
+        self.metrics = metrics
+
+    def get_uaid(self, uaid, consistent=True):
+        """Get the router item for the UAID, see
+        :meth:`~autopush.backend.IRouterTable.get_uaid`"""
+        if uaid not in self.table:
+            raise ItemNotFound("uaid not found")
+        return dict(self.table[uaid])
+
+    def get_uaids(self, uaids, consistent=True):
+        """Get the router items for several UAIDs, see
+        :meth:`~autopush.backend.IRouterTable.get_uaids`"""
+        return dict((uaid, dict(self.table[uaid])) for uaid in uaids
+                    if uaid in self.table)
+
+    def register_user(self, data):
+        """Register this user, see
+        :meth:`~autopush.backend.IRouterTable.register_user`"""
+        uaid = data["uaid"]
+        old = self.table.get(uaid, {})
+        if old.get("node_id") is not None and \
+                not old.get("connected_at") < data.get("connected_at"):
+            return (False, {})
+        item = dict(old)
+        item.update(data)
+        self.table[uaid] = item
+        return (True, old)
+
+    def invalidate(self, uaid):
+        """Drop any locally cached record for the UAID
+
+        The records are kept by this router, so there is nothing to do.
+
+        """
+
+    def clear_node(self, item):
+        """Remove the node of a router item, see
+        :meth:`~autopush.backend.IRouterTable.clear_node`
+
+        The ``connected_at`` is removed as well, keeping the
+        ``last_connect`` of the record.
+
+        """
+        node_id = item.pop("node_id")
+        stored = self.table.get(item["uaid"], {})
+        if stored.get("node_id") != node_id or \
+                stored.get("connected_at") != item.get("connected_at"):
+            return False
+        del stored["node_id"]
+        stored.pop("connected_at", None)
+        return True
+
+
+class MemoryBackend(IBackend):
+    """Backend opening a :class:`MemoryStorage` and :class:`MemoryRouter`
+    over the records of the backend"""
+    deferred = True
+
+    def __init__(self):
+        """Create a new MemoryBackend with no records"""
+        self.notifications = {}
+        self.routers = {}
+
+    def open(self, metrics):
+        """Open the storage and router, see
+        :meth:`~autopush.backend.IBackend.open`"""
+        return (MemoryStorage(metrics, self.notifications),
+                MemoryRouter(metrics, self.routers))
+
+    def preflight(self, storage, router):
+        """Store, fetch and delete a notification and a router item, see
+        :meth:`~autopush.backend.IBackend.preflight`"""
+        preflight_storage(storage)
+        preflight_router(router)
+
+
+# Records shared by the nodes of the process
+shared_backend = MemoryBackend()
@@ -48,6 +48,30 @@ class SinkMetrics(IMetrics):
         pass
 
 
+class TaggedMetrics(object):
+    """Metrics wrapper adding tags to every metric, such as the table a
+    database shard uses"""
+    def __init__(self, metrics, tags):
+        self.metrics = metrics
+        self.tags = tags
+
+    def _tags(self, kwargs):
+        kwargs["tags"] = self.tags + (kwargs.get("tags") or [])
+        return kwargs
+
+    def start(self):
+        self.metrics.start()
+
+    def increment(self, name, count=1, **kwargs):
+        self.metrics.increment(name, count, **self._tags(kwargs))
+
+    def gauge(self, name, count, **kwargs):
+        self.metrics.gauge(name, count, **self._tags(kwargs))
+
+    def timing(self, name, duration, **kwargs):
+        self.metrics.timing(name, duration, **self._tags(kwargs))
+
+
 class TwistedMetrics(object):
     """Twisted implementation of statsd output"""
     def __init__(self, statsd_host="localhost", statsd_port=8125):
@@ -0,0 +1,344 @@
+"""Reaper of idle UAIDs
+
+Router items record the ``last_connect`` time of their UAID's latest
+hello, which the router table's ``AccessIndex`` global index is keyed on.
+The ``autopush-reaper`` script scans the index with a parallel segmented
+scan for UAIDs idle longer than a threshold, then deletes their stored
+notifications with batch writes paced by a rate limit, and their router
+item last.
+
+A UAID is skipped while its router item has a ``node_id``, as its client
+is still connected, or a ``last_connect`` other than the scanned one, as
+it said hello again. The router item is only deleted on the same
+conditions, and after the notifications, so an interrupted reap leaves
+the UAID to be found by the next scan rather than orphaned rows.
+
+Router items written before ``last_connect`` was recorded aren't in the
+index, and are only reaped once a hello records it.
+
+"""
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import configargparse
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException
+
+from autopush.db import (
+    compact_tablename,
+    get_map_storage_table,
+    get_router_table,
+    get_storage_table,
+    map_tablename,
+    shard_index,
+    shard_tablenames,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.utils import str2bool
+
+
+ACCESS_INDEX = "AccessIndex"
+
+
+def consumed_units(result):
+    """Sum the capacity units a DynamoDB response reports as consumed"""
+    consumed = result.get("ConsumedCapacity") or []
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(entry.get("CapacityUnits", 0) for entry in consumed)
+
+
+class RateLimiter(object):
+    """Thread safe token bucket pacing writes to a rate per second"""
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        """Create a new RateLimiter
+
+        :param rate: Writes allowed per second, 0 for no limit.
+        :param clock: Function returning the current time.
+        :param sleep: Function sleeping for some seconds.
+
+        """
+        self.rate = rate
+        self.tokens = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Take a token for each of ``count`` writes, sleeping as long as
+        it takes to earn the missing ones"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / float(self.rate)
+        if wait > 0:
+            self.sleep(wait)
+
+
+class Reaper(object):
+    """Deletes the router items and stored notifications of idle UAIDs"""
+    def __init__(self, router_tables, storage_tables, max_idle, segments=4,
+                 rate=0, page_size=100, dry_run=False, report_every=10000,
+                 clock=time.time):
+        """Create a new Reaper
+
+        :param router_tables: Router :class:`~boto.dynamodb2.table.Table`
+                              of each shard.
+        :param storage_tables: Storage tables of each shard, in shard
+                               order.
+        :param max_idle: Seconds since their last hello after which UAIDs
+                         are reaped.
+        :param segments: Amount of segments of each router table's index
+                         scanned in parallel.
+        :param rate: Maximum writes per second, 0 for no limit.
+        :param page_size: Maximum index entries read per scan request.
+        :param dry_run: Only count the idle UAIDs without deleting them.
+        :param report_every: Amount of scanned index entries between
+                             progress reports.
+        :param clock: Function returning the current time.
+
+        """
+        self.router_tables = router_tables
+        self.storage_tables = storage_tables
+        self.cutoff = int((clock() - max_idle) * 1000)
+        self.segments = segments
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.report_every = report_every
+        self.limiter = RateLimiter(rate)
+        self.clock = clock
+        self.started = clock()
+        self.counts = dict(scanned=0, idle=0, reaped=0, skipped=0,
+                           rows_freed=0, read_capacity=0, write_capacity=0)
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Reap every segment of every router table
+
+        :returns: Counts of the scanned index entries, idle UAIDs, reaped
+                  UAIDs, skipped UAIDs (still connected, or connected again
+                  since the scan), deleted rows and consumed read and write
+                  capacity units.
+        :rtype: dict
+
+        """
+        jobs = [(router, segment) for router in self.router_tables
+                for segment in range(self.segments)]
+        pool = ThreadPool(len(jobs))
+        try:
+            pool.map(self.reap_segment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.report()
+        return self.counts
+
+    def reap_segment(self, job):
+        """Reap the idle UAIDs of one segment of a router table's index
+
+        :param job: Tuple of the router table and segment number.
+
+        """
+        router, segment = job
+        for uaid, last_connect in self.scan_idle(router, segment):
+            if self.dry_run:
+                self._count(idle=1)
+                continue
+            rows, reaped = self.reap(router, uaid, last_connect)
+            if reaped:
+                self._count(idle=1, reaped=1, rows_freed=rows)
+            else:
+                self._count(idle=1, skipped=1, rows_freed=rows)
+
+    def scan_idle(self, router, segment):
+        """Yield the UAID and ``last_connect`` of the idle entries in one
+        segment of a router table's index"""
+        # boto's scan predates scanning indexes, so the request is made
+        # directly.
+        params = {
+            "TableName": router.table_name,
+            "IndexName": ACCESS_INDEX,
+            "ScanFilter": {"last_connect": {
+                "AttributeValueList": [{"N": str(self.cutoff)}],
+                "ComparisonOperator": "LT",
+            }},
+            "Segment": segment,
+            "TotalSegments": self.segments,
+            "Limit": self.page_size,
+            "ReturnConsumedCapacity": "TOTAL",
+        }
+        while True:
+            result = router.connection.make_request("Scan",
+                                                    json.dumps(params))
+            self._count(scanned=result.get("ScannedCount", 0),
+                        read_capacity=consumed_units(result))
+            for raw in result.get("Items", []):
+                yield (router._dynamizer.decode(raw["uaid"]),
+                       raw["last_connect"]["N"])
+            if not result.get("LastEvaluatedKey"):
+                return
+            params["ExclusiveStartKey"] = result["LastEvaluatedKey"]
+
+    def reap(self, router, uaid, last_connect):
+        """Delete the stored notifications of an idle UAID, then its router
+        item
+
+        :returns: Tuple of the amount of deleted rows and whether the UAID
+                  was reaped, which it isn't while connected or when it said
+                  hello again since it was scanned.
+
+        """
+        key = router._encode_keys({"uaid": uaid})
+        result = router.connection.get_item(
+            router.table_name, key,
+            attributes_to_get=["last_connect", "node_id"],
+            consistent_read=True,
+            return_consumed_capacity="TOTAL",
+        )
+        self._count(read_capacity=consumed_units(result))
+        item = result.get("Item") or {}
+        if "node_id" in item or \
+                item.get("last_connect", {}).get("N") != last_connect:
+            return 0, False
+
+        storage = self.storage_tables[shard_index(uaid,
+                                                  len(self.storage_tables))]
+        rows = self.delete_notifications(storage, uaid)
+        self.limiter.acquire()
+        try:
+            result = router.connection.delete_item(
+                router.table_name,
+                key=key,
+                condition_expression="last_connect = :last and "
+                                     "attribute_not_exists(node_id)",
+                expression_attribute_values={":last": {"N": last_connect}},
+                return_consumed_capacity="TOTAL",
+            )
+        except ConditionalCheckFailedException:
+            return rows, False
+        self._count(write_capacity=consumed_units(result))
+        return rows + 1, True
+
+    def delete_notifications(self, storage, uaid):
+        """Delete every stored notification of a UAID with batch writes
+
+        :returns: Amount of deleted notifications.
+
+        """
+        conditions = {"uaid": {
+            "AttributeValueList": [storage._dynamizer.encode(uaid)],
+            "ComparisonOperator": "EQ"}}
+        deleted = 0
+        start_key = None
+        while True:
+            result = storage.connection.query(
+                storage.table_name,
+                key_conditions=conditions,
+                attributes_to_get=["uaid", "chid"],
+                limit=25,
+                exclusive_start_key=start_key,
+                return_consumed_capacity="TOTAL",
+            )
+            self._count(read_capacity=consumed_units(result))
+            keys = result.get("Items", [])
+            if keys:
+                self._batch_delete(storage, keys)
+                deleted += len(keys)
+            start_key = result.get("LastEvaluatedKey")
+            if not start_key:
+                return deleted
+
+    def _batch_delete(self, storage, keys):
+        """Delete up to 25 keys, resending unprocessed ones"""
+        requests = [{"DeleteRequest": {"Key": key}} for key in keys]
+        attempt = 0
+        while requests:
+            if attempt:
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+            self.limiter.acquire(len(requests))
+            result = storage.connection.batch_write_item(
+                {storage.table_name: requests},
+                return_consumed_capacity="TOTAL",
+            )
+            self._count(write_capacity=consumed_units(result))
+            requests = (result.get("UnprocessedItems") or {}).get(
+                storage.table_name, [])
+            attempt += 1
+
+    def _count(self, **counts):
+        """Add to the counts, reporting the progress now and then"""
+        with self._lock:
+            before = self.counts["scanned"] // self.report_every
+            for name, count in counts.items():
+                self.counts[name] += count
+            if self.counts["scanned"] // self.report_every > before:
+                self.report()
+
+    def report(self):
+        """Print the progress of the reaper"""
+        counts = dict(self.counts)
+        counts["rate"] = counts["rows_freed"] / max(
+            self.clock() - self.started, 0.001)
+        print ("Reaper: scanned %(scanned)d, idle %(idle)d, reaped "
+               "%(reaped)d, skipped %(skipped)d, rows freed %(rows_freed)d "
+               "(%(rate).1f/s), read capacity %(read_capacity).1f, write "
+               "capacity %(write_capacity).1f" % counts)
+
+
+def _parse_reaper(sysargs):
+    """Parse out the arguments for the reaper"""
+    parser = configargparse.ArgumentParser(
+        description='Deletes the records of idle UAIDs.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('--max_idle_days',
+                        help="Days since their last hello after which UAIDs "
+                        "are reaped", type=float, default=60)
+    parser.add_argument('--segments',
+                        help="Amount of segments of a router table's index "
+                        "scanned in parallel", type=int, default=4)
+    parser.add_argument('--rate',
+                        help="Maximum deletes per second, 0 for no limit",
+                        type=float, default=100)
+    parser.add_argument('--page_size',
+                        help="Maximum index entries read per scan request",
+                        type=int, default=100)
+    parser.add_argument('--dry_run',
+                        help="Only count the idle UAIDs", type=bool,
+                        default=False)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Reap the records of idle UAIDs, aka the autopush-reaper script"""
+    args = _parse_reaper(sysargs)
+    router_tablename = args.router_tablename
+    storage_tablename = args.storage_tablename
+    if args.compact_items:
+        router_tablename = compact_tablename(router_tablename)
+        storage_tablename = compact_tablename(storage_tablename)
+    get_storage = get_storage_table
+    if args.storage_map:
+        storage_tablename = map_tablename(storage_tablename)
+        get_storage = get_map_storage_table
+    routers = [get_router_table(name, args.router_read_throughput,
+                                args.router_write_throughput,
+                                args.compact_items)
+               for name in shard_tablenames(router_tablename,
+                                            args.router_shards)]
+    storages = [get_storage(name, args.storage_read_throughput,
+                            args.storage_write_throughput,
+                            args.compact_items)
+                for name in shard_tablenames(storage_tablename,
+                                             args.storage_shards)]
+    return Reaper(routers, storages, args.max_idle_days * 86400,
+                  segments=args.segments, rate=args.rate,
+                  page_size=args.page_size, dry_run=args.dry_run).run()
@@ -14,7 +14,6 @@ from boto.dynamodb2.exceptions import (
     ProvisionedThroughputExceededException,
 )
 from repoze.lru import LRUCache
-from twisted.internet.threads import deferToThread
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.error import (
     ConnectError,
@@ -23,6 +22,8 @@ from twisted.internet.error import (
 )
 from twisted.web.client import FileBodyProducer
 
+from autopush.costs import call_in_action, current_action
+from autopush.db import deferToDB, stale_router_item
 from autopush.protocol import IgnoreBody
 from autopush.router.interface import (
     RouterException,
@@ -38,6 +39,15 @@ def node_key(node_id):
     return node_id + "-%s" % int(time.time()/3600)
 
 
+def stale_node(uaid_data):
+    """Whether router data read eventually consistent may be outdated, as
+    it has no ``connected_at`` or names a node that was found dead"""
+    if stale_router_item(uaid_data):
+        return True
+    node_id = uaid_data.get("node_id")
+    return bool(node_id and dead_cache.get(node_key(node_id)))
+
+
 class SimpleRouter(object):
     """Implements :class:`autopush.router.interface.IRouter` for internal
     routing to an Autopush node"""
@@ -50,14 +60,25 @@ class SimpleRouter(object):
         """Return no additional routing data"""
         return {}
 
+    def _outcome(self, action, outcome):
+        """Name the outcome of the push a database action accounts for"""
+        if action is not None:
+            action.outcome = outcome
+
     @inlineCallbacks
     def route_notification(self, notification, uaid_data):
         """Route a notification to an internal node, and store it if the node
-        can't deliver immediately or is no longer a valid node"""
+        can't deliver immediately or is no longer a valid node
+
+        The database requests are made for the action current when called,
+        named after the outcome of the push, see :mod:`autopush.costs`.
+
+        """
         # Determine if they're connected at the moment
         node_id = uaid_data.get("node_id")
         uaid = uaid_data["uaid"]
         router, storage = self.ap_settings.router, self.ap_settings.storage
+        action = current_action()
 
         # Node_id is present, attempt delivery.
         # - Send Notification to node
@@ -72,26 +93,32 @@ class SimpleRouter(object):
             except (ConnectError, UserError, ConnectionRefusedError):
                 self.metrics.increment("updates.client.host_gone")
                 dead_cache.put(node_key(node_id), True)
-                yield deferToThread(router.clear_node,
-                                    uaid_data).addErrback(self._eat_db_err)
+                self._outcome(action, "node_gone")
+                yield call_in_action(action, deferToDB, router.clear_node,
+                                     uaid_data).addErrback(self._eat_db_err)
                 raise RouterException("Node was invalid", status_code=503,
                                       response_body="Retry Request")
             if result.code == 200:
                 self.metrics.increment("router.broadcast.hit")
+                self._outcome(action, "delivered")
                 returnValue(RouterResponse(response_body="Delivered"))
+            # The node couldn't deliver, any cached node_id is stale
+            router.invalidate(uaid)
 
         # Save notification, node is not present or busy
         # - Save notification
         #   - Success (older version): Done, return 202
         #   - Error (db error): Done, return 503
         try:
-            result = yield deferToThread(storage.save_notification, uaid=uaid,
-                                         chid=notification.channel_id,
-                                         version=notification.version)
+            result = yield call_in_action(
+                action, deferToDB, storage.save_notification, uaid=uaid,
+                chid=notification.channel_id, version=notification.version)
             if result is False:
                 self.metrics.increment("router.broadcast.miss")
+                self._outcome(action, "superseded")
                 returnValue(RouterResponse(202, "Notification Stored"))
         except ProvisionedThroughputExceededException:
+            self._outcome(action, "throttled")
             raise RouterException("Provisioned throughput error",
                                   status_code=503,
                                   response_body="Retry Request")
@@ -105,13 +132,17 @@ class SimpleRouter(object):
         #   - Success (no node): Done, return 202
         #   - Error (db error): Done, return 202
         #   - Error (no client) : Done, return 404
+        self._outcome(action, "stored")
         try:
-            uaid_data = yield deferToThread(router.get_uaid, uaid)
+            uaid_data = yield call_in_action(
+                action, self.ap_settings.read_policy.get_uaid, router, uaid,
+                "router", stale=stale_node)
         except ProvisionedThroughputExceededException:
             self.metrics.increment("router.broadcast.miss")
             returnValue(RouterResponse(202, "Notification Stored"))
         except ItemNotFound:
             self.metrics.increment("updates.client.deleted")
+            self._outcome(action, "deleted")
             raise RouterException("User was deleted",
                                   status_code=404,
                                   response_body="Invalid UAID")
@@ -122,18 +153,20 @@ class SimpleRouter(object):
             self.metrics.increment("router.broadcast.miss")
             returnValue(RouterResponse(202, "Notification Stored"))
         try:
-            result = yield self._send_notification_check(uaid, node_id)
+            result = yield self._send_notification_check(uaid, node_id,
+                                                         notification)
         except (ConnectError, UserError, ConnectionRefusedError):
             self.metrics.increment("updates.client.host_gone")
             dead_cache.put(node_key(node_id), True)
-            yield deferToThread(
-                router.clear_node,
+            yield call_in_action(
+                action, deferToDB, router.clear_node,
                 uaid_data).addErrback(self._eat_db_err)
             self.metrics.increment("router.broadcast.miss")
             returnValue(RouterResponse(202, "Notification Stored"))
 
         if result.code == 200:
             self.metrics.increment("router.broadcast.save_hit")
+            self._outcome(action, "notified")
             returnValue(RouterResponse(response_body="Delivered"))
         else:
             self.metrics.increment("router.broadcast.miss")
@@ -156,12 +189,19 @@ class SimpleRouter(object):
         d.addCallback(IgnoreBody.ignore)
         return d
 
-    def _send_notification_check(self, uaid, node_id):
-        """Send a command to the node to check for notifications"""
+    def _send_notification_check(self, uaid, node_id, notification=None):
+        """Send a command to the node to check for notifications, naming
+        the version of the stored notification it should find"""
         url = node_id + "/notif/" + uaid
+        producer = None
+        if notification is not None:
+            payload = json.dumps({"channelID": notification.channel_id,
+                                  "version": notification.version})
+            producer = FileBodyProducer(StringIO(payload))
         return self.ap_settings.agent.request(
             "PUT",
             url.encode("utf8"),
+            bodyProducer=producer,
         ).addCallback(IgnoreBody.ignore)
 
     #############################################################
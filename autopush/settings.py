@@ -1,19 +1,58 @@
 """Autopush Settings Object and Setup"""
+import datetime
 import socket
 
 from cryptography.fernet import Fernet
 from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.internet.threads import deferToThread
 from twisted.web.client import Agent, HTTPConnectionPool
 
 from autopush.db import (
+    compact_tablename,
+    drop_expired_tables,
+    get_map_storage_table,
+    get_node_table,
     get_router_table,
     get_storage_table,
-    preflight_check,
+    preflight_router,
+    preflight_storage,
+    map_tablename,
+    rotating_tablename,
+    shard_tablenames,
+    unwrap_first_error,
+    AsyncMapStorage,
+    AsyncRouter,
+    AsyncStorage,
+    CachedRouter,
+    CoalescingRouter,
+    CompactTable,
+    DeleteQueue,
+    InstrumentedRouter,
+    InstrumentedStorage,
+    MapStorage,
+    NodeRegistry,
+    ReadPolicy,
+    RotatingStorage,
+    ShardedRouter,
+    ShardedStorage,
+    ThrottledRouter,
+    ThrottledStorage,
+    WriteBehindStorage,
     Storage,
-    Router
+    Router,
+    deferToDB,
 )
+from autopush.autoping import PingSweeper
+from autopush.costs import CostLedger
+from autopush.dynamodb import (
+    AsyncDynamoDBConnection,
+    MeteredDynamoDBConnection,
+)
+from autopush.memory import shared_backend
 from autopush.metrics import (
     DatadogMetrics,
+    TaggedMetrics,
     TwistedMetrics,
     SinkMetrics,
 )
@@ -22,9 +61,27 @@ from autopush.router import (
     GCMRouter,
     SimpleRouter,
 )
+from autopush.timers import TimerWheel
 from autopush.utils import canonical_url, resolve_ip
 
 
+# Backends other than the DynamoDB tables the settings set up themselves
+db_backends = {"memory": shared_backend}
+
+
+def storage_lookup(storage_map):
+    """Function looking up a storage table of the row per notification, or
+    single item per UAID, layout"""
+    return get_map_storage_table if storage_map else get_storage_table
+
+
+def storage_classes(storage_map):
+    """Blocking and deferred storage abstractions of a storage layout"""
+    if storage_map:
+        return MapStorage, AsyncMapStorage
+    return Storage, AsyncStorage
+
+
 class AutopushSettings(object):
     """Main Autopush Settings Object"""
     options = ["crypto_key", "hostname", "min_ping_interval",
@@ -54,13 +111,53 @@ class AutopushSettings(object):
                  statsd_port=8125,
                  resolve_hostname=False,
                  max_data=4096,
-                 enable_cors=False):
+                 enable_cors=False,
+                 async_dynamodb=False,
+                 dynamodb_max_connections=50,
+                 router_cache_size=0,
+                 router_cache_ttl=30,
+                 router_coalesce=False,
+                 router_batch_window=0,
+                 storage_write_window=0,
+                 storage_write_batch=500,
+                 unregister_batch_window=0,
+                 timer_resolution=0.1,
+                 metrics_tags=None,
+                 auto_ping_interval=0,
+                 auto_ping_timeout=4,
+                 auto_ping_slice=1000,
+                 fetch_page_size=0,
+                 db_throttle=False,
+                 db_throttle_max_rate=1000,
+                 db_throttle_max_queue=1000,
+                 db_metrics=False,
+                 db_costs=False,
+                 db_costs_window=60,
+                 eventual_reads=(),
+                 router_shards=1,
+                 storage_shards=1,
+                 shard_migration=False,
+                 storage_rotation=False,
+                 storage_retention=3,
+                 compact_items=False,
+                 compact_migration=False,
+                 storage_map=False,
+                 storage_map_migration=False,
+                 db_backend="dynamodb",
+                 deferred_startup=False,
+                 preflight=True):
         """Initialize the Settings object
 
         Upon creation, the HTTP agent will initialize, all configured routers
         will be setup and started, logging will be started, and the database
         will have a preflight check done.
 
+        With ``deferred_startup`` the database is left to :meth:`start_db`,
+        and ``preflight`` may be disabled for nodes known to have working
+        tables. A ``db_backend`` other than ``dynamodb`` names one of
+        :data:`db_backends` to provide the storage and router instead of
+        the DynamoDB tables.
+
         """
         # Use a persistent connection pool for HTTP requests.
         pool = HTTPConnectionPool(reactor)
@@ -77,6 +174,19 @@ class AutopushSettings(object):
             self.metrics = TwistedMetrics(statsd_host, statsd_port)
         else:
             self.metrics = SinkMetrics()
+        if metrics_tags:
+            # Tag every metric, such as with the worker process sending it
+            self.metrics = TaggedMetrics(self.metrics, metrics_tags)
+
+        # Timers of the connections, ticking every timer_resolution seconds
+        self.timers = TimerWheel(self.metrics, resolution=timer_resolution)
+
+        # Websocket pings of the connections, swept in slices
+        self.ping_sweeper = None
+        if auto_ping_interval:
+            self.ping_sweeper = PingSweeper(auto_ping_interval,
+                                            auto_ping_timeout,
+                                            slice_size=auto_ping_slice)
 
         key = crypto_key or Fernet.generate_key()
         self.fernet = Fernet(key)
@@ -108,18 +218,102 @@ class AutopushSettings(object):
             endpoint_port
         )
 
-        # Database objects
-        self.router_table = get_router_table(router_tablename,
-                                             router_read_throughput,
-                                             router_write_throughput)
-        self.storage_table = get_storage_table(storage_tablename,
-                                               storage_read_throughput,
-                                               storage_write_throughput)
-        self.storage = Storage(self.storage_table, self.metrics)
-        self.router = Router(self.router_table, self.metrics)
+        # Database objects, set up by setup_db or, without blocking the
+        # reactor, by start_db
+        self.ready = False
+        self.preflight = preflight
+        self.storage = self.router = self.delete_queue = None
+        self.rotating_storage = None
+        self.backend = None
+        # Requests and capacity units of each protocol action
+        self.db_costs = None
+        if db_costs:
+            self.db_costs = CostLedger(self.metrics, window=db_costs_window)
+        if db_backend != "dynamodb":
+            if db_backend not in db_backends:
+                raise ValueError("Unknown db_backend: %s" % db_backend)
+            self.backend = db_backends[db_backend]
+            # Rotating and migrating tables are DynamoDB's
+            storage_rotation = False
+        # Tables of the compact item schema are named apart, so the
+        # original tables can be read while migrating
+        self.compact_items = compact_items
+        compact_migration = compact_items and compact_migration
+        self._node_tablename = router_tablename + "_nodes"
+        legacy_router, legacy_storage = router_tablename, storage_tablename
+        if compact_items:
+            router_tablename = compact_tablename(router_tablename)
+            storage_tablename = compact_tablename(storage_tablename)
+            if not compact_migration:
+                legacy_router, legacy_storage = (router_tablename,
+                                                 storage_tablename)
+        # Storage tables holding the notifications of a UAID in one item
+        self.storage_map = storage_map
+        storage_map_migration = storage_map and storage_map_migration
+        self._legacy_map = storage_map and not storage_map_migration
+        if storage_map:
+            storage_tablename = map_tablename(storage_tablename)
+        if self._legacy_map:
+            legacy_storage = map_tablename(legacy_storage)
+        self._router_names = shard_tablenames(router_tablename,
+                                              router_shards)
+        self._storage_tablename = storage_tablename
+        self._storage_shards = storage_shards
+        self._storage_names = shard_tablenames(storage_tablename,
+                                               storage_shards)
+        # Monthly storage tables, the previous month's table is still read
+        # so at least two months are retained
+        self.storage_rotation = storage_rotation
+        self.storage_retention = max(storage_retention, 2)
+        self._previous_storage_names = []
+        if storage_rotation:
+            now = datetime.datetime.utcnow()
+            self._storage_names = self._month_storage_names(now)
+            self._previous_storage_names = self._month_storage_names(now, 1)
+        self._router_throughput = (router_read_throughput,
+                                   router_write_throughput)
+        self._storage_throughput = (storage_read_throughput,
+                                    storage_write_throughput)
+        # Unsharded tables still read while moving their records to shards,
+        # or original tables while moving them to the compact item schema
+        # or single item storage
+        self._legacy_compact = compact_items and not compact_migration
+        self._legacy_names = (
+            legacy_storage
+            if (compact_migration or storage_map_migration or
+                shard_migration and storage_shards > 1)
+            and not storage_rotation else None,
+            legacy_router
+            if compact_migration or shard_migration and router_shards > 1
+            else None,
+        )
+        self._db_conf = dict(
+            async_dynamodb=async_dynamodb,
+            dynamodb_max_connections=dynamodb_max_connections,
+            db_throttle=db_throttle,
+            db_throttle_max_rate=db_throttle_max_rate,
+            db_throttle_max_queue=db_throttle_max_queue,
+            db_metrics=db_metrics,
+        )
+        # Wrappers of the storage and router of any backend
+        self._wrap_conf = dict(
+            router_coalesce=router_coalesce,
+            router_batch_window=router_batch_window,
+            router_cache_size=router_cache_size,
+            router_cache_ttl=router_cache_ttl,
+            storage_write_window=storage_write_window,
+            storage_write_batch=storage_write_batch,
+            unregister_batch_window=unregister_batch_window,
+        )
+        if not deferred_startup:
+            self.setup_db()
+
+        # Call sites reading eventually consistent
+        self.read_policy = ReadPolicy(self.metrics, eventual_reads)
 
-        # Run preflight check
-        preflight_check(self.storage, self.router)
+        # Amount of notifications to fetch and send at a time, 0 fetches
+        # them all at once
+        self.fetch_page_size = fetch_page_size
 
         # CORS
         self.cors = enable_cors
@@ -132,6 +326,322 @@ class AutopushSettings(object):
         if 'gcm' in router_conf:
             self.routers["gcm"] = GCMRouter(self, router_conf["gcm"])
 
+    def _month_storage_names(self, when, months_ago=0):
+        """Names of the rotating storage tables, or their shards, of a
+        month"""
+        return shard_tablenames(
+            rotating_tablename(self._storage_tablename, when, months_ago),
+            self._storage_shards)
+
+    def _table_lookups(self):
+        """Functions and arguments looking up every table: the storage
+        shards, the router shards, the legacy tables being migrated, the
+        previous month's storage shards and the node registry"""
+        storage_args = self._storage_throughput + (self.compact_items,)
+        router_args = self._router_throughput + (self.compact_items,)
+        get_storage = storage_lookup(self.storage_map)
+        lookups = [(get_storage, (name,) + storage_args)
+                   for name in self._storage_names]
+        lookups.extend((get_router_table, (name,) + router_args)
+                       for name in self._router_names)
+        legacy_storage, legacy_router = self._legacy_names
+        if legacy_storage:
+            lookups.append((storage_lookup(self._legacy_map),
+                            (legacy_storage,) + self._storage_throughput +
+                            (self._legacy_compact,)))
+        if legacy_router:
+            lookups.append((get_router_table,
+                            (legacy_router,) + self._router_throughput +
+                            (self._legacy_compact,)))
+        lookups.extend((get_storage, (name,) + storage_args)
+                       for name in self._previous_storage_names)
+        if self.compact_items:
+            lookups.append((get_node_table, (self._node_tablename,) +
+                            self._router_throughput))
+        return lookups
+
+    def _split_tables(self, tables):
+        """Split the looked up tables into the storage shards, router
+        shards, legacy storage and router tables, previous month's storage
+        shards and node registry table"""
+        storage_count = len(self._storage_names)
+        router_count = len(self._router_names)
+        storage_tables = tables[:storage_count]
+        router_tables = tables[storage_count:storage_count + router_count]
+        legacy = iter(tables[storage_count + router_count:])
+        legacy_storage, legacy_router = self._legacy_names
+        legacy_storage = next(legacy) if legacy_storage else None
+        legacy_router = next(legacy) if legacy_router else None
+        previous = list(legacy)
+        node_table = previous.pop() if self.compact_items else None
+        return (storage_tables, router_tables, legacy_storage, legacy_router,
+                previous, node_table)
+
+    def _preflight_checks(self, tables):
+        """Preflight check functions and arguments for every shard"""
+        storage_tables, router_tables = tables[:2]
+        storage_cls = storage_classes(self.storage_map)[0]
+        checks = [(preflight_storage, storage_cls(table, self.metrics))
+                  for table in storage_tables]
+        checks.extend((preflight_router, Router(table, self.metrics))
+                      for table in router_tables)
+        return checks
+
+    def setup_db(self):
+        """Set up the database tables, blocking until they're ready"""
+        if self.backend is not None:
+            opened = self.backend.open(self.metrics)
+            if self.preflight:
+                self.backend.preflight(*opened)
+            return self._init_backend(*opened)
+        tables = self._split_tables([func(*args) for func, args
+                                     in self._table_lookups()])
+        if self.preflight:
+            for check, table in self._preflight_checks(tables):
+                check(table)
+        self._init_db(*tables, **self._db_conf)
+
+    def start_db(self):
+        """Set up the database tables without blocking the reactor
+
+        The tables are looked up, and then checked by their preflight, in
+        parallel from the reactor thread pool. :attr:`ready` is set once
+        they can be used.
+
+        :returns: Deferred firing once the database is ready.
+
+        """
+        if self.backend is not None:
+            d = deferToDB(self.backend.open, self.metrics)
+            d.addCallback(self._preflight_backend)
+            d.addCallback(lambda opened: self._init_backend(*opened))
+            return d
+        d = gatherResults([deferToThread(func, *args)
+                           for func, args in self._table_lookups()],
+                          consumeErrors=True)
+        d.addCallback(self._split_tables)
+        d.addCallback(self._preflight_tables)
+        d.addCallback(lambda tables: self._init_db(*tables, **self._db_conf))
+        d.addErrback(unwrap_first_error)
+        return d
+
+    def _preflight_tables(self, tables):
+        """Run the preflight checks of every shard in parallel"""
+        if not self.preflight:
+            return tables
+        d = gatherResults([deferToThread(check, table) for check, table
+                           in self._preflight_checks(tables)],
+                          consumeErrors=True)
+        d.addCallback(lambda _: tables)
+        return d
+
+    def _preflight_backend(self, opened):
+        """Run the preflight check of the backend's storage and router"""
+        if not self.preflight:
+            return opened
+        d = deferToDB(self.backend.preflight, *opened)
+        d.addCallback(lambda _: opened)
+        return d
+
+    def _open_table(self, table, metrics, table_cls, async_cls,
+                    instrumented_cls, throttled_cls, throttle, **options):
+        """Create the table abstraction of a single table"""
+        if self.dynamodb:
+            opened = async_cls(
+                type(table)(table.table_name, connection=self.dynamodb),
+                metrics, **options)
+        else:
+            if self._metered is not None:
+                table = type(table)(table.table_name,
+                                    connection=self._metered)
+            opened = table_cls(table, metrics, **options)
+
+        # Time every operation
+        if self._db_metrics:
+            opened = instrumented_cls(opened)
+
+        # Pace requests to the rate the table sustains
+        if throttle:
+            opened = throttled_cls(opened, **throttle)
+        return opened
+
+    def _open_shards(self, tables, legacy, table_cls, async_cls,
+                     instrumented_cls, throttled_cls, sharded_cls, throttle,
+                     **options):
+        """Create the table abstraction of a table, or of its shards with
+        metrics tagged by shard
+
+        The ``options`` are passed on to the table abstraction of every
+        table, ``legacy`` is the abstraction of the legacy table if any.
+
+        """
+        if len(tables) == 1 and legacy is None:
+            return self._open_table(tables[0], self.metrics, table_cls,
+                                    async_cls, instrumented_cls,
+                                    throttled_cls, throttle, **options)
+        shards = [
+            self._open_table(
+                table, TaggedMetrics(self.metrics,
+                                     ["table:%s" % table.table_name]),
+                table_cls, async_cls, instrumented_cls, throttled_cls,
+                throttle, **options)
+            for table in tables
+        ]
+        return sharded_cls(shards, self.metrics, legacy=legacy)
+
+    def _open_storage(self, tables, legacy=None):
+        """Create the storage abstraction of a set of storage shards, and
+        of the legacy storage table if given"""
+        if legacy is not None:
+            legacy_cls, legacy_async_cls = storage_classes(self._legacy_map)
+            legacy = self._open_table(legacy, self.metrics, legacy_cls,
+                                      legacy_async_cls, InstrumentedStorage,
+                                      ThrottledStorage, self._throttle)
+        storage_cls, async_cls = storage_classes(self.storage_map)
+        return self._open_shards(tables, legacy, storage_cls, async_cls,
+                                 InstrumentedStorage, ThrottledStorage,
+                                 ShardedStorage, self._throttle)
+
+    def _init_db(self, storage_tables, router_tables, legacy_storage=None,
+                 legacy_router=None, previous_storage=None,
+                 node_table=None, async_dynamodb=False,
+                 dynamodb_max_connections=50, db_throttle=False,
+                 db_throttle_max_rate=1000, db_throttle_max_queue=1000,
+                 db_metrics=False):
+        """Create the table abstractions for the tables and mark the node
+        ready"""
+        self.storage_tables = storage_tables
+        self.router_tables = router_tables
+        self.storage_table = storage_tables[0]
+        self.router_table = router_tables[0]
+
+        # Switch to non-blocking DynamoDB access once the tables are known
+        self.dynamodb = None
+        if async_dynamodb:
+            self.dynamodb = AsyncDynamoDBConnection(
+                max_connections=dynamodb_max_connections,
+                metrics=self.metrics if db_metrics else None,
+                costs=self.db_costs)
+
+        # Time the operations and count the capacity units they consume,
+        # in total or for each protocol action
+        self._db_metrics = db_metrics
+        self._metered = None
+        if (db_metrics or self.db_costs) and not async_dynamodb:
+            self._metered = MeteredDynamoDBConnection(
+                metrics=self.metrics if db_metrics else None,
+                costs=self.db_costs)
+
+        throttle = self._throttle = None
+        if db_throttle:
+            throttle = self._throttle = dict(
+                max_rate=db_throttle_max_rate,
+                max_queue=db_throttle_max_queue)
+        # Compact router items store registered integers for node URLs
+        self.node_registry = None
+        router_options = {}
+        if node_table is not None:
+            self.node_registry = NodeRegistry(node_table)
+            router_options["registry"] = self.node_registry
+        self.storage = self._open_storage(storage_tables, legacy_storage)
+        if legacy_router is not None:
+            legacy_router = self._open_table(
+                legacy_router, self.metrics, Router, AsyncRouter,
+                InstrumentedRouter, ThrottledRouter, throttle,
+                **(router_options if isinstance(legacy_router, CompactTable)
+                   else {}))
+        self.router = self._open_shards(
+            router_tables, legacy_router, Router, AsyncRouter,
+            InstrumentedRouter, ThrottledRouter, ShardedRouter, throttle,
+            **router_options)
+
+        # Save to this month's storage table, read last month's as well
+        if previous_storage:
+            self.storage = self.rotating_storage = RotatingStorage(
+                self.storage, self._open_storage(previous_storage),
+                self.metrics)
+        self._wrap_db(**self._wrap_conf)
+
+    def _init_backend(self, storage, router):
+        """Use the storage and router of a backend and mark the node
+        ready"""
+        # There are no DynamoDB tables to check the health of
+        self.storage_tables = self.router_tables = []
+        self.storage_table = self.router_table = None
+        self.dynamodb = self._throttle = self.node_registry = None
+        self.storage, self.router = storage, router
+        self._wrap_db(**self._wrap_conf)
+
+    def _wrap_db(self, router_coalesce=False, router_batch_window=0,
+                 router_cache_size=0, router_cache_ttl=30,
+                 storage_write_window=0, storage_write_batch=500,
+                 unregister_batch_window=0):
+        """Wrap the storage and router abstractions and mark the node
+        ready"""
+        # Share concurrent lookups of a UAID, optionally batching them
+        if router_coalesce or router_batch_window:
+            self.router = CoalescingRouter(
+                self.router, batch_window=router_batch_window / 1000.0)
+
+        # Cache router items for repeated lookups of the same UAID
+        if router_cache_size:
+            self.router = CachedRouter(self.router, size=router_cache_size,
+                                       ttl=router_cache_ttl)
+
+        # Queue and collapse notification writes
+        if storage_write_window:
+            self.storage = WriteBehindStorage(
+                self.storage, window=storage_write_window / 1000.0,
+                max_pending=storage_write_batch)
+
+        # Gather the deletes of unregistered channels across connections
+        if unregister_batch_window:
+            self.delete_queue = DeleteQueue(
+                self.storage, window=unregister_batch_window / 1000.0)
+
+        self.ready = True
+
+    def rotate_storage(self, when=None):
+        """Keep the rotating storage tables in step with the month
+
+        The next month's tables are created a day ahead, the storage moves
+        to them once the month begins, and the tables of months out of the
+        retention window are dropped. Called periodically by the nodes.
+
+        :returns: Deferred firing once done.
+
+        """
+        when = when or datetime.datetime.utcnow()
+        calls = [deferToThread(drop_expired_tables, self._storage_tablename,
+                               self.storage_retention, when)]
+        names = self._month_storage_names(when)
+        if names != self._storage_names:
+            d = self._lookup_storage(names)
+            d.addCallback(self._rotate, names)
+            calls.append(d)
+        else:
+            ahead = self._month_storage_names(
+                when + datetime.timedelta(days=1))
+            if ahead != names:
+                calls.append(self._lookup_storage(ahead))
+        d = gatherResults(calls, consumeErrors=True)
+        d.addErrback(unwrap_first_error)
+        return d
+
+    def _lookup_storage(self, names):
+        """Look up, or create, storage tables from the thread pool"""
+        return gatherResults([
+            deferToThread(storage_lookup(self.storage_map), name,
+                          *self._storage_throughput + (self.compact_items,))
+            for name in names], consumeErrors=True)
+
+    def _rotate(self, tables, names):
+        """Move the storage to a new month's tables"""
+        self._storage_names = names
+        self.storage_tables = tables
+        self.storage_table = tables[0]
+        self.rotating_storage.rotate(self._open_storage(tables))
+
     def update(self, **kwargs):
         """Update the arguments, if a ``crypto_key`` is in kwargs then the
         ``self.fernet`` attribute will be initialized"""
@@ -0,0 +1,234 @@
+"""Online migration of unsharded tables into their shards
+
+While nodes run with ``--shard_migration``, records missing from their
+shard are still read from the unsharded ``router`` and ``storage`` tables,
+and every write goes to the shards. The ``autopush-shard`` script then
+copies the records left in the unsharded tables into their shards with a
+parallel scan.
+
+A copy never replaces a record a node already wrote to its shard, and
+notifications are read again before they're copied, so one acked since
+the scan isn't brought back. The migration runs while the nodes keep
+serving clients. Once it's done the nodes can be restarted without
+``--shard_migration``.
+
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+import configargparse
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ItemNotFound,
+)
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+    shard_index,
+    shard_tablenames,
+    Storage,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.metrics import SinkMetrics
+from autopush.utils import str2bool
+
+
+class ShardMigration(object):
+    """Copies the records of an unsharded table into its shards"""
+    def __init__(self, source, shards, segments=4, delete=False,
+                 report_every=10000):
+        """Create a new ShardMigration
+
+        :param source: :class:`~boto.dynamodb2.table.Table` being migrated.
+        :param shards: Tables of each shard, in shard order.
+        :param segments: Amount of segments scanned in parallel.
+        :param delete: Whether to delete records from the source table
+                       once they're in their shard.
+        :param report_every: Amount of scanned records between progress
+                             reports.
+
+        """
+        self.source = source
+        self.shards = shards
+        self.segments = segments
+        self.delete = delete
+        self.report_every = report_every
+        self.counts = dict(scanned=0, copied=0, skipped=0, deleted=0)
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Migrate every segment of the source table
+
+        :returns: Counts of the scanned, copied, skipped (already in their
+                  shard, or changed since the scan) and deleted records.
+        :rtype: dict
+
+        """
+        pool = ThreadPool(self.segments)
+        try:
+            pool.map(self.migrate_segment, range(self.segments))
+        finally:
+            pool.close()
+            pool.join()
+        self.report()
+        return self.counts
+
+    def migrate_segment(self, segment):
+        """Copy the records of one segment of the source table"""
+        for item in self.source.scan(segment=segment,
+                                     total_segments=self.segments):
+            shard = self.shards[shard_index(item["uaid"], len(self.shards))]
+            copied = self.copy(item, shard)
+            deleted = self.delete and self.remove(item)
+            self._count(copied, deleted)
+
+    def _count(self, copied, deleted):
+        """Count a migrated record, reporting the progress now and then"""
+        with self._lock:
+            self.counts["scanned"] += 1
+            self.counts["copied" if copied else "skipped"] += 1
+            if deleted:
+                self.counts["deleted"] += 1
+            if self.counts["scanned"] % self.report_every == 0:
+                self.report()
+
+    def report(self):
+        """Print the progress of the migration"""
+        print "%s: %s" % (self.source.table_name, ", ".join(
+            "%s %d" % (name, self.counts[name])
+            for name in ("scanned", "copied", "skipped", "deleted")))
+
+    def copy(self, item, shard):
+        """Copy a record into its shard, unless the shard has a newer one
+
+        :returns: Whether the record was copied.
+
+        """
+        raise NotImplementedError("No copy implemented")
+
+    def remove(self, item):
+        """Delete a record from the source table, unless it changed since
+        it was scanned
+
+        :returns: Whether the record was deleted.
+
+        """
+        raise NotImplementedError("No remove implemented")
+
+    def _delete(self, item, **kwargs):
+        """Conditionally delete a record from the source table"""
+        try:
+            self.source.delete_item(**kwargs)
+            return True
+        except ConditionalCheckFailedException:
+            return False
+
+
+class RouterMigration(ShardMigration):
+    """Copies the records of an unsharded router table into its shards"""
+    def copy(self, item, shard):
+        """Copy a router record unless the UAID registered in its shard"""
+        try:
+            shard.connection.put_item(
+                shard.table_name,
+                item=item.prepare_full(),
+                condition_expression="attribute_not_exists(uaid)",
+            )
+            return True
+        except ConditionalCheckFailedException:
+            return False
+
+    def remove(self, item):
+        """Delete a router record unless the UAID connected again"""
+        connected_at = item.get("connected_at")
+        if connected_at is None:
+            expected = {"connected_at__null": True}
+        else:
+            expected = {"connected_at__eq": connected_at}
+        return self._delete(item, uaid=item["uaid"], expected=expected)
+
+
+class StorageMigration(ShardMigration):
+    """Copies the records of an unsharded storage table into its shards"""
+    # Storage abstraction saving the copies
+    storage_cls = Storage
+
+    def __init__(self, source, shards, **kwargs):
+        super(StorageMigration, self).__init__(source, shards, **kwargs)
+        self._storage = dict(
+            (shard.table_name, self.storage_cls(shard, SinkMetrics()))
+            for shard in shards)
+
+    def copy(self, item, shard):
+        """Copy a notification unless its shard has a newer version
+
+        The notification is read again first and skipped once it was
+        deleted, as acked, or replaced since it was scanned.
+
+        """
+        try:
+            current = self.source.get_item(uaid=item["uaid"],
+                                           chid=item["chid"],
+                                           consistent=True)
+        except ItemNotFound:
+            return False
+        if current["version"] != item["version"]:
+            return False
+        return self._storage[shard.table_name].save_notification(
+            uaid=item["uaid"], chid=item["chid"],
+            version=int(item["version"]))
+
+    def remove(self, item):
+        """Delete a notification unless a newer version was stored"""
+        return self._delete(item, uaid=item["uaid"], chid=item["chid"],
+                            expected={"version__eq": item["version"]})
+
+
+def _parse_shard(sysargs):
+    """Parse out the arguments for a shard migration"""
+    parser = configargparse.ArgumentParser(
+        description='Migrates unsharded tables into their shards.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('--segments',
+                        help="Amount of segments of a table scanned in "
+                        "parallel", type=int, default=4)
+    parser.add_argument('--delete',
+                        help="Delete records from the unsharded tables once "
+                        "they're in their shard", type=bool, default=False)
+    parser.add_argument('--skip_router', help="Leave the router table alone",
+                        type=bool, default=False)
+    parser.add_argument('--skip_storage',
+                        help="Leave the storage table alone", type=bool,
+                        default=False)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Migrate the unsharded tables into their shards, aka the
+    autopush-shard script"""
+    args = _parse_shard(sysargs)
+    options = dict(segments=args.segments, delete=args.delete)
+    migrations = []
+    if not args.skip_router and args.router_shards > 1:
+        shards = [get_router_table(name, args.router_read_throughput,
+                                   args.router_write_throughput)
+                  for name in shard_tablenames(args.router_tablename,
+                                               args.router_shards)]
+        migrations.append(RouterMigration(
+            get_router_table(args.router_tablename), shards, **options))
+    if not args.skip_storage and args.storage_shards > 1:
+        shards = [get_storage_table(name, args.storage_read_throughput,
+                                    args.storage_write_throughput)
+                  for name in shard_tablenames(args.storage_tablename,
+                                               args.storage_shards)]
+        migrations.append(StorageMigration(
+            get_storage_table(args.storage_tablename), shards, **options))
+
+    if not migrations:
+        print "No sharded tables to migrate"
+        return
+    for migration in migrations:
+        migration.run()
@@ -0,0 +1,158 @@
+"""Item size report of the compact item schema
+
+DynamoDB bills every write by the KB, and reads by the 4KB, of the items
+involved, with an item's size being the sum of the lengths of its
+attribute names and values. The ``autopush-sizes`` script samples the
+router and storage tables and reports the size of their items as stored,
+and as they would be stored in the compact item schema of
+:class:`~autopush.db.CompactTable`, along with the capacity units writing
+and reading the sample takes either way.
+
+"""
+import base64
+import math
+
+import configargparse
+from boto.dynamodb.types import NonBooleanDynamizer
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+    CompactDynamizer,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.utils import str2bool
+
+
+READ_UNIT = 4096
+WRITE_UNIT = 1024
+
+# Number standing in for the node URL of a compact router item, the
+# registry's integers stay this small
+NODE_PLACEHOLDER = 1000
+
+
+def attribute_size(value):
+    """Size in bytes DynamoDB counts for a raw attribute value"""
+    kind, data = value.items()[0]
+    if kind == "S":
+        return len(data.encode("utf8"))
+    if kind == "B":
+        return len(base64.b64decode(data))
+    if kind == "N":
+        # Two significant digits a byte, plus a byte
+        digits = data.lstrip("-").replace(".", "").strip("0") or "0"
+        return int(math.ceil(len(digits) / 2.0)) + 1
+    if kind in ("BOOL", "NULL"):
+        return 1
+    if kind in ("SS", "NS", "BS"):
+        return sum(attribute_size({kind[0]: element}) for element in data)
+    if kind == "L":
+        return 3 + sum(attribute_size(element) + 1 for element in data)
+    if kind == "M":
+        return 3 + sum(len(name.encode("utf8")) + attribute_size(element) + 1
+                       for name, element in data.items())
+    raise ValueError("Unknown attribute type %s" % kind)
+
+
+def item_size(raw):
+    """Size in bytes DynamoDB counts for a raw item"""
+    return sum(len(name.encode("utf8")) + attribute_size(value)
+               for name, value in raw.items())
+
+
+def compact_item(raw):
+    """Encode a raw item of the original schema in the compact one"""
+    plain, compact = NonBooleanDynamizer(), CompactDynamizer()
+    item = dict((name, plain.decode(value)) for name, value in raw.items())
+    if isinstance(item.get("node_id"), basestring):
+        item["node_id"] = NODE_PLACEHOLDER
+    return dict((name, compact.encode(value)) for name, value in item.items())
+
+
+def sample_items(table, sample):
+    """Scan up to ``sample`` raw items of a table"""
+    items = []
+    start_key = None
+    while len(items) < sample:
+        result = table.connection.scan(table.table_name,
+                                       limit=sample - len(items),
+                                       exclusive_start_key=start_key)
+        items.extend(result.get("Items", []))
+        start_key = result.get("LastEvaluatedKey")
+        if not start_key:
+            break
+    return items
+
+
+def measure(items):
+    """Total size, and write and read capacity units, of raw items
+
+    Each item is written on its own, while reads are counted as a scan or
+    query summing their sizes.
+
+    """
+    sizes = [item_size(item) for item in items]
+    return dict(
+        size=sum(sizes),
+        write_units=sum(int(math.ceil(size / float(WRITE_UNIT)))
+                        for size in sizes),
+        read_units=int(math.ceil(sum(sizes) / float(READ_UNIT))),
+    )
+
+
+def size_report(table, sample=1000):
+    """Measure a sample of a table's items in both schemas
+
+    :returns: Dict of the amount of sampled items, and the measures of
+              :func:`measure` of the ``original`` and ``compact`` items.
+
+    """
+    items = sample_items(table, sample)
+    return dict(
+        items=len(items),
+        original=measure(items),
+        compact=measure([compact_item(item) for item in items]),
+    )
+
+
+def print_report(name, report):
+    """Print the size report of a table"""
+    count = max(report["items"], 1)
+    original, compact = report["original"], report["compact"]
+    saved = 1 - compact["size"] / float(max(original["size"], 1))
+    print "%s: %d items sampled" % (name, report["items"])
+    for label, measures in (("original", original), ("compact", compact)):
+        print ("  %-8s %7.1f bytes per item, %d write units, %d read "
+               "units" % (label, measures["size"] / float(count),
+                          measures["write_units"], measures["read_units"]))
+    print "  compact items are %.0f%% smaller" % (saved * 100)
+
+
+def _parse_sizes(sysargs):
+    """Parse out the arguments for the size report"""
+    parser = configargparse.ArgumentParser(
+        description='Reports the item sizes of the compact item schema.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('--sample', help="Amount of items sampled per table",
+                        type=int, default=1000)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Report the item sizes of the original tables in both schemas, aka
+    the autopush-sizes script
+
+    :returns: Dict of table name to its :func:`size_report`.
+
+    """
+    args = _parse_sizes(sysargs)
+    tables = [get_router_table(args.router_tablename),
+              get_storage_table(args.storage_tablename)]
+    reports = {}
+    for table in tables:
+        reports[table.table_name] = size_report(table, args.sample)
+        print_report(table.table_name, reports[table.table_name])
+    return reports
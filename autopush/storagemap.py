@@ -0,0 +1,75 @@
+"""Online migration of storage tables into the single item per UAID layout
+
+While nodes run with ``--storage_map`` and ``--storage_map_migration``,
+notifications are fetched from both the single item per UAID storage
+tables (``storage_map``) and the row per notification ones, and new
+notifications are only saved to the former. The ``autopush-storage-map``
+script then copies the rows left in the row per notification tables into
+the items of their UAIDs with a parallel scan.
+
+A copy never replaces a newer version a node already saved, so the
+migration runs while the nodes keep serving clients. Once it's done the
+nodes can be restarted without ``--storage_map_migration``.
+
+"""
+import configargparse
+
+from autopush.db import (
+    compact_tablename,
+    get_map_storage_table,
+    get_storage_table,
+    map_tablename,
+    shard_tablenames,
+    MapStorage,
+)
+from autopush.main import add_shared_args, shared_config_files
+from autopush.shard import StorageMigration
+from autopush.utils import str2bool
+
+
+class MapMigration(StorageMigration):
+    """Copies the notification rows of a storage table into the items of
+    their UAIDs in a single item per UAID storage table"""
+    storage_cls = MapStorage
+
+
+def _parse_storage_map(sysargs):
+    """Parse out the arguments for a storage layout migration"""
+    parser = configargparse.ArgumentParser(
+        description='Migrates storage tables into the single item per UAID '
+                    'layout.',
+        default_config_files=shared_config_files)
+    parser.register('type', bool, str2bool)
+    add_shared_args(parser)
+    parser.add_argument('--segments',
+                        help="Amount of segments of a table scanned in "
+                        "parallel", type=int, default=4)
+    parser.add_argument('--delete',
+                        help="Delete rows from the row per notification "
+                        "tables once copied", type=bool, default=False)
+    return parser.parse_args(sysargs)
+
+
+def main(sysargs=None):
+    """Migrate the storage tables, or each of their shards, into the single
+    item per UAID layout, aka the autopush-storage-map script
+
+    :returns: Counts of each migration, see :meth:`MapMigration.run`.
+
+    """
+    args = _parse_storage_map(sysargs)
+    tablename = args.storage_tablename
+    if args.compact_items:
+        tablename = compact_tablename(tablename)
+    throughput = (args.storage_read_throughput,
+                  args.storage_write_throughput, args.compact_items)
+    sources = shard_tablenames(tablename, args.storage_shards)
+    targets = shard_tablenames(map_tablename(tablename), args.storage_shards)
+    counts = []
+    for source, target in zip(sources, targets):
+        migration = MapMigration(
+            get_storage_table(source, *throughput),
+            [get_map_storage_table(target, *throughput)],
+            segments=args.segments, delete=args.delete)
+        counts.append(migration.run())
+    return counts
@@ -0,0 +1,96 @@
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+from twisted.internet import task
+
+from autopush.autoping import PingSweeper
+
+
+class FakeConnection(object):
+    def __init__(self, pinged=True):
+        self.pinged = pinged
+        self.sweeps = []
+        self.expired = []
+
+    def sweep_ping(self, now, interval):
+        self.sweeps.append(now)
+        return self.pinged
+
+    def expire_ping(self, sent):
+        self.expired.append(sent)
+
+
+class PingSweeperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sweeper = PingSweeper(30, 10, slice_size=2, clock=self.clock)
+
+    def tearDown(self):
+        self.sweeper.stop()
+
+    def _connections(self, count, **kwargs):
+        connections = [FakeConnection(**kwargs) for _ in range(count)]
+        for connection in connections:
+            self.sweeper.add(connection)
+        return connections
+
+    def test_slices(self):
+        connections = self._connections(8, pinged=False)
+        loop = self.sweeper.start()
+        self.clock.advance(30)
+        # 4 slices of 2, spread over the interval
+        eq_(loop.interval, 7.5)
+        eq_(sum(len(c.sweeps) for c in connections), 2)
+        for _ in range(3):
+            self.clock.advance(7.5)
+        eq_([len(c.sweeps) for c in connections], [1] * 8)
+        eq_(sorted(set(c.sweeps[0] for c in connections)),
+            [30, 37.5, 45, 52.5])
+        # The next sweep starts an interval later
+        self.clock.advance(7.5)
+        eq_(sum(len(c.sweeps) for c in connections), 10)
+
+    def test_timeout_steps(self):
+        connections = self._connections(2)
+        loop = self.sweeper.start()
+        self.clock.advance(30)
+        # Enough steps to expire pings on time
+        eq_(loop.interval, 10)
+        eq_(sum(len(c.sweeps) for c in connections), 1)
+        self.clock.advance(10)
+        first, second = sorted(connections, key=lambda c: c.sweeps)
+        eq_((first.sweeps, second.sweeps), ([30], [40]))
+        eq_((first.expired, second.expired), ([30], []))
+        self.clock.advance(10)
+        eq_(second.expired, [40])
+
+    def test_closed(self):
+        connections = self._connections(4)
+        self.sweeper.start()
+        self.clock.advance(30)
+        for connection in connections:
+            self.sweeper.discard(connection)
+        for _ in range(3):
+            self.clock.advance(10)
+        eq_(sum(len(c.sweeps) for c in connections), 2)
+        eq_(sum(len(c.expired) for c in connections), 0)
+        eq_(self.sweeper._sweep, [])
+
+    def test_no_timeout(self):
+        self.sweeper.timeout = 0
+        connection = self._connections(1)[0]
+        loop = self.sweeper.start()
+        self.clock.advance(30)
+        eq_(loop.interval, 30)
+        self.clock.advance(30)
+        eq_(connection.sweeps, [30, 60])
+        eq_(connection.expired, [])
+
+    def test_no_connections(self):
+        loop = self.sweeper.start()
+        self.clock.advance(30)
+        eq_(loop.interval, 10)
+        self.sweeper.add(Mock())
+        self.clock.advance(30)
+        eq_(len(self.sweeper._sweep), 0)
@@ -0,0 +1,169 @@
+import datetime
+import unittest
+import uuid
+
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from mock import Mock, patch
+from moto import mock_dynamodb2
+from nose.tools import eq_
+
+from autopush.autoscale import (
+    ThroughputController,
+    _parse_autoscale,
+    autoscaled_tables,
+    desired_throughput,
+    main,
+)
+from autopush.db import create_router_table
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+NOW = 1000000000
+BOUNDS = dict(read=(5, 100), write=(5, 50))
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+class DesiredThroughputTestCase(unittest.TestCase):
+    def test_desired(self):
+        eq_(desired_throughput(7, 0.7, (5, 100)), 10)
+        eq_(desired_throughput(0, 0.7, (5, 100)), 5)
+        eq_(desired_throughput(700, 0.7, (5, 100)), 100)
+
+
+class ThroughputControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tablename = "router_%s" % uuid.uuid4().hex
+        create_router_table(self.tablename, 10, 10)
+        self.connection = DynamoDBConnection()
+        self.consumed = dict(ConsumedReadCapacityUnits=0,
+                             ConsumedWriteCapacityUnits=0)
+        self.cloudwatch = Mock()
+        self.cloudwatch.get_metric_statistics.side_effect = (
+            lambda period, start, end, metric, *args, **kwargs: [
+                {"Sum": self.consumed[metric] * 60.0}])
+        self.now = NOW
+        self.controller = ThroughputController(
+            self.connection, self.cloudwatch, {self.tablename: BOUNDS},
+            scale_down_wait=600, max_decreases=2, clock=lambda: self.now)
+
+    def _throughput(self):
+        throughput = self.connection.describe_table(self.tablename)[
+            "Table"]["ProvisionedThroughput"]
+        return (throughput["ReadCapacityUnits"],
+                throughput["WriteCapacityUnits"])
+
+    def test_consumed(self):
+        self.cloudwatch.get_metric_statistics.side_effect = None
+        self.cloudwatch.get_metric_statistics.return_value = [
+            {"Sum": 60.0}, {"Sum": 300.0}]
+        eq_(self.controller.consumed(self.tablename, "write", NOW), 5.0)
+        args, kwargs = self.cloudwatch.get_metric_statistics.call_args
+        eq_(args[0], 60)
+        eq_(args[2] - args[1], datetime.timedelta(seconds=300))
+        eq_(args[3:], ("ConsumedWriteCapacityUnits", "AWS/DynamoDB",
+                       ["Sum"]))
+        eq_(kwargs, dict(dimensions={"TableName": self.tablename}))
+        self.cloudwatch.get_metric_statistics.return_value = []
+        eq_(self.controller.consumed(self.tablename, "read", NOW), 0)
+
+    def test_scale_up(self):
+        self.consumed["ConsumedReadCapacityUnits"] = 35
+        self.consumed["ConsumedWriteCapacityUnits"] = 7
+        decisions = self.controller.poll()
+        eq_([(d["read"], d["write"]) for d in decisions],
+            [((10, 50), (10, 10))])
+        eq_(self._throughput(), (50, 10))
+        self.consumed["ConsumedWriteCapacityUnits"] = 700
+        self.controller.poll()
+        eq_(self._throughput(), (50, 50))
+        eq_(self.controller.counts["increases"], 2)
+        eq_(self.controller.counts["updates"], 2)
+
+    def test_scale_down(self):
+        self.controller.poll()
+        eq_(self._throughput(), (10, 10))
+        self.now += 599
+        eq_(self.controller.poll(), [])
+        self.now += 1
+        self.controller.poll()
+        eq_(self._throughput(), (5, 5))
+        eq_(self.controller.counts["decreases"], 1)
+
+    def test_decrease_limit(self):
+        controller = self.controller
+        controller.scale_down_wait = 0
+        for read in (9, 8, 7):
+            self.consumed["ConsumedReadCapacityUnits"] = read * 0.7
+            controller.poll()
+        eq_(self._throughput()[0], 8)
+        eq_(controller.counts["deferred"], 1)
+        # Increases are still allowed
+        self.consumed["ConsumedReadCapacityUnits"] = 14
+        controller.poll()
+        eq_(self._throughput()[0], 20)
+        # A new UTC day allows decreases again
+        self.now += 86400
+        self.consumed["ConsumedReadCapacityUnits"] = 0
+        controller.poll()
+        eq_(self._throughput(), (5, 5))
+
+    def test_reported_decreases(self):
+        self.controller.scale_down_wait = 0
+        description = self.connection.describe_table(self.tablename)
+        description["Table"]["ProvisionedThroughput"][
+            "NumberOfDecreasesToday"] = 2
+        self.controller.connection = Mock()
+        self.controller.connection.describe_table.return_value = description
+        eq_(self.controller.poll(), [])
+        eq_(self.controller.counts["deferred"], 2)
+
+    def test_dry_run(self):
+        self.controller.dry_run = True
+        self.consumed["ConsumedReadCapacityUnits"] = 35
+        eq_(len(self.controller.poll()), 1)
+        eq_(self._throughput(), (10, 10))
+        eq_(self.controller.counts["updates"], 0)
+
+    def test_not_active(self):
+        self.controller.connection = Mock()
+        self.controller.connection.describe_table.return_value = {
+            "Table": {"TableStatus": "UPDATING"}}
+        eq_(self.controller.poll(), [])
+        eq_(self.controller.counts["skipped"], 1)
+        eq_(len(self.controller.connection.update_table.mock_calls), 0)
+
+    def test_run(self):
+        sleep = Mock()
+        counts = self.controller.run(30, polls=3, sleep=sleep)
+        eq_(counts["polls"], 3)
+        eq_(sleep.call_args_list, [((30,), {})] * 2)
+
+
+class MainTestCase(unittest.TestCase):
+    def test_autoscaled_tables(self):
+        args = _parse_autoscale(["--router_shards=2", "--storage_shards=2",
+                                 "--storage_rotation=true",
+                                 "--router_read_throughput=3",
+                                 "--router_max_read_throughput=30"])
+        tables = autoscaled_tables(args, datetime.datetime(2016, 3, 1))
+        eq_(sorted(tables), ["router_0", "router_1", "storage_2016_03_0",
+                             "storage_2016_03_1"])
+        eq_(tables["router_1"]["read"], (3, 30))
+        eq_(tables["storage_2016_03_0"]["write"], (5, 100))
+
+    @patch("autopush.autoscale.CloudWatchConnection")
+    def test_main(self, mock_cloudwatch):
+        mock_cloudwatch.return_value.get_metric_statistics.return_value = []
+        create_router_table("autoscale_router")
+        counts = main(["--router_tablename=autoscale_router",
+                       "--storage_tablename=autoscale_router",
+                       "--polls=1", "--dry_run=true"])
+        eq_(counts["polls"], 1)
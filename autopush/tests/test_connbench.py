@@ -0,0 +1,36 @@
+import unittest
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+from autopush.connbench import (
+    BenchSettings,
+    main,
+    measure,
+    open_connections,
+    resident_bytes,
+)
+
+
+class ConnBenchTestCase(unittest.TestCase):
+    def test_open_connections(self):
+        settings = BenchSettings()
+        connections = open_connections(4, settings)
+        eq_(len(settings.clients), 4)
+        eq_(connections[3].uaid, "%032x" % 3)
+        ok_(connections[0].base_tags is connections[3].base_tags)
+        eq_(open_connections(2, settings, hello=False)[1].uaid, None)
+
+    def test_resident_bytes(self):
+        ok_(resident_bytes() > 0)
+        with patch("autopush.connbench.open", create=True,
+                   side_effect=IOError):
+            ok_(resident_bytes() > 0)
+
+    def test_measure(self):
+        report = measure(100)
+        eq_(report["count"], 100)
+        eq_(report["per_connection"], report["total"] / 100.0)
+
+    def test_main(self):
+        eq_(main(["--connections=10", "--no_hello=true"])["count"], 10)
@@ -0,0 +1,103 @@
+import threading
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+from twisted.trial import unittest as trial
+
+from autopush.costs import (
+    CostLedger,
+    acting,
+    bound,
+    current_action,
+    finish_action,
+    start_action,
+)
+from autopush.db import deferToDB
+
+
+class CostLedgerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.metrics = Mock()
+        self.ledger = CostLedger(self.metrics, window=60,
+                                 clock=lambda: self.now)
+
+    def test_averages(self):
+        for units in (1, 3):
+            action = self.ledger.start("hello")
+            action.request(units)
+            action.request(0)
+            action.finish()
+        self.ledger.request(None, 2)
+        self.ledger.request("router.batch", 1)
+        averages = self.ledger.averages()
+        eq_(averages["hello"], dict(count=2, calls=4, units=4,
+                                    calls_per_action=2.0,
+                                    units_per_action=2.0))
+        eq_(averages["unattributed"]["calls"], 1)
+        eq_(averages["router.batch"]["calls_per_action"], None)
+        self.metrics.increment.assert_any_call("db.action.hello", 1)
+        self.metrics.increment.assert_any_call("db.action.hello.calls", 2)
+
+    def test_window(self):
+        self.ledger.start("ack").finish()
+        self.now += 50
+        self.ledger.start("ack").finish()
+        eq_(self.ledger.averages()["ack"]["count"], 2)
+        self.now += 20
+        eq_(self.ledger.averages()["ack"]["count"], 1)
+        self.now += 60
+        eq_(self.ledger.averages(), {})
+
+    def test_outcome(self):
+        action = self.ledger.start("push")
+        action.request(1)
+        action.outcome = "stored"
+        action.finish()
+        action.finish()
+        # Requests completing later are recorded on their own
+        action.request(1)
+        eq_(self.ledger.averages()["push.stored"],
+            dict(count=1, calls=2, units=2, calls_per_action=2.0,
+                 units_per_action=2.0))
+
+    def test_report(self):
+        self.ledger.start("fetch").finish()
+        self.ledger.request("storage.delete_queue", 1)
+        self.ledger.report()
+        self.metrics.gauge.assert_any_call(
+            "db.action.fetch.calls_per_action", 0.0)
+        eq_(len(self.metrics.gauge.mock_calls), 2)
+
+
+class ActionContextTestCase(trial.TestCase):
+    def test_acting(self):
+        eq_(current_action(), None)
+        with acting("outer"):
+            with acting("inner"):
+                eq_(current_action(), "inner")
+            check = bound(current_action)
+        eq_(current_action(), None)
+        eq_(check(), "outer")
+        eq_(bound(current_action), current_action)
+
+    def test_start_finish(self):
+        eq_(start_action(None, "hello"), None)
+        eq_(finish_action("result", None), "result")
+        ledger = CostLedger(Mock())
+        action = start_action(ledger, "hello")
+        eq_(finish_action("result", action, "ok"), "result")
+        eq_(ledger.averages().keys(), ["hello.ok"])
+
+    def test_thread(self):
+        def run():
+            return current_action(), threading.current_thread()
+        with acting("fetch"):
+            d = deferToDB(run)
+
+        def check(result):
+            action, thread = result
+            eq_(action, "fetch")
+            self.assertNotEqual(thread, threading.current_thread())
+        return d.addCallback(check)
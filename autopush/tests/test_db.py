@@ -1,3 +1,4 @@
+import datetime
 import unittest
 import uuid
 
@@ -5,20 +6,59 @@ from boto.dynamodb2.exceptions import (
     ConditionalCheckFailedException,
     ProvisionedThroughputExceededException,
     ItemNotFound,
+    ResourceInUseException,
 )
 from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.exception import JSONResponseError
 from boto.dynamodb2.items import Item
+from boto.dynamodb2.table import Table
 from mock import Mock
 from moto import mock_dynamodb2
-from nose.tools import eq_
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, DeferredList, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest as trial
 
 from autopush.db import (
     get_router_table,
     get_storage_table,
     create_router_table,
     create_storage_table,
+    deferToDB,
+    drop_expired_tables,
+    expired_tablenames,
+    get_map_storage_table,
+    get_node_table,
+    pack_uuid,
     preflight_check,
+    rotating_tablename,
+    shard_index,
+    shard_tablenames,
+    storage_month,
+    table_exists,
+    AdaptiveThrottle,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    AsyncMapStorage,
+    AsyncRouter,
+    AsyncStorage,
+    CachedRouter,
+    CoalescingRouter,
+    CompactTable,
+    DeleteQueue,
+    InstrumentedRouter,
+    InstrumentedStorage,
+    MapStorage,
+    NodeRegistry,
+    ReadPolicy,
+    RotatingStorage,
+    ShardedRouter,
+    ShardedStorage,
     Storage,
+    ThrottledRouter,
+    ThrottledStorage,
+    WriteBehindStorage,
     Router,
 )
 from autopush.metrics import SinkMetrics
@@ -76,6 +116,32 @@ class StorageTestCase(unittest.TestCase):
         assert s.throughput["read"] is 8
         assert s.throughput["write"] is 11
 
+    def test_fetch_notifications_page(self):
+        s = get_storage_table()
+        storage = Storage(s, SinkMetrics())
+        uaid = str(uuid.uuid4())
+        chids = sorted(str(uuid.uuid4()) for _ in range(3))
+        for chid in chids:
+            storage.save_notification(uaid, chid, 12)
+        notifs, last_key = storage.fetch_notifications_page(uaid, 2)
+        eq_([n["chid"] for n in notifs], chids[:2])
+        ok_(last_key is not None)
+        notifs, last_key = storage.fetch_notifications_page(uaid, 2,
+                                                            last_key)
+        eq_([(n["chid"], n["version"]) for n in notifs], [(chids[2], 12)])
+
+    def test_fetch_notifications_page_over_provisioned(self):
+        s = get_storage_table()
+        storage = Storage(s, SinkMetrics())
+        storage.table.connection = Mock()
+
+        def raise_error(*args, **kwargs):
+            raise ProvisionedThroughputExceededException(None, None)
+
+        storage.table.connection.query.side_effect = raise_error
+        self.assertRaises(ProvisionedThroughputExceededException,
+                          storage.fetch_notifications_page, "asdf", 10)
+
     def test_dont_save_older(self):
         s = get_storage_table()
         storage = Storage(s, SinkMetrics())
@@ -126,6 +192,29 @@ class StorageTestCase(unittest.TestCase):
         results = storage.delete_notification("asdf", "asdf")
         eq_(results, False)
 
+    def test_delete_notifications(self):
+        s = get_storage_table()
+        storage = Storage(s, SinkMetrics())
+        uaid = str(uuid.uuid4())
+        chids = [str(uuid.uuid4()) for _ in range(30)]
+        for chid in chids:
+            storage.save_notification(uaid, chid, 12)
+        eq_(len(storage.fetch_notifications(uaid)), 30)
+        eq_(storage.delete_notifications([(uaid, chid) for chid in chids]),
+            True)
+        eq_(storage.fetch_notifications(uaid), [])
+
+    def test_delete_notifications_over_provisioned(self):
+        s = get_storage_table()
+        storage = Storage(s, SinkMetrics())
+        storage.table.connection = Mock()
+
+        def raise_error(*args, **kwargs):
+            raise ProvisionedThroughputExceededException(None, None)
+
+        storage.table.connection.batch_write_item.side_effect = raise_error
+        eq_(storage.delete_notifications([("asdf", "asdf")]), False)
+
 
 class RouterTestCase(unittest.TestCase):
     def setUp(self):
@@ -136,6 +225,20 @@ class RouterTestCase(unittest.TestCase):
     def tearDown(self):
         self.real_table.connection = self.real_connection
 
+    def test_table_exists(self):
+        eq_(table_exists(get_router_table()), True)
+        eq_(table_exists(Table("router_%s" % uuid.uuid4())), False)
+
+    def test_table_exists_error(self):
+        table = Table("router", connection=Mock())
+
+        def raise_error(*args, **kwargs):
+            raise JSONResponseError(400, "Bad Request",
+                                    body={"__type": "AccessDeniedException"})
+
+        table.connection.describe_table.side_effect = raise_error
+        self.assertRaises(JSONResponseError, table_exists, table)
+
     def test_custom_tablename(self):
         db = DynamoDBConnection()
         db_name = "router_%s" % uuid.uuid4()
@@ -188,12 +291,12 @@ class RouterTestCase(unittest.TestCase):
     def test_clear_node_provision_failed(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
-        router.table.connection.put_item = Mock()
+        router.table.connection.update_item = Mock()
 
         def raise_error(*args, **kwargs):
             raise ProvisionedThroughputExceededException(None, None)
 
-        router.table.connection.put_item.side_effect = raise_error
+        router.table.connection.update_item.side_effect = raise_error
         with self.assertRaises(ProvisionedThroughputExceededException):
             router.clear_node(Item(r, dict(uaid="asdf", connected_at="1234",
                                            node_id="asdf")))
@@ -212,6 +315,28 @@ class RouterTestCase(unittest.TestCase):
         eq_(bool(result), True)
         eq_(result["node_id"], "me")
 
+    def test_get_uaids(self):
+        uaid = str(uuid.uuid4())
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        router.register_user(dict(uaid=uaid, node_id="me",
+                                  connected_at=1234))
+        result = router.get_uaids([uaid, str(uuid.uuid4())])
+        eq_(result.keys(), [uaid])
+        eq_(result[uaid]["node_id"], "me")
+
+    def test_get_uaids_over_provisioned(self):
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        router.table.connection.batch_get_item = Mock()
+
+        def raise_error(*args, **kwargs):
+            raise ProvisionedThroughputExceededException(None, None)
+
+        router.table.connection.batch_get_item.side_effect = raise_error
+        self.assertRaises(ProvisionedThroughputExceededException,
+                          router.get_uaids, ["asdf"])
+
     def test_save_new(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
@@ -262,8 +387,1444 @@ class RouterTestCase(unittest.TestCase):
         def raise_condition(*args, **kwargs):
             raise ConditionalCheckFailedException(None, None)
 
-        router.table.connection.put_item = Mock()
-        router.table.connection.put_item.side_effect = raise_condition
+        router.table.connection.update_item = Mock()
+        router.table.connection.update_item.side_effect = raise_condition
         data = dict(uaid="asdf", node_id="asdf", connected_at=1234)
         result = router.clear_node(Item(r, data))
         eq_(result, False)
+
+
+class DeferToDBTestCase(trial.TestCase):
+    def test_blocking_in_thread(self):
+        storage = Storage(get_storage_table(), SinkMetrics())
+        d = deferToDB(storage.fetch_notifications, str(uuid.uuid4()))
+        d.addCallback(eq_, [])
+        return d
+
+    def test_deferred_called_directly(self):
+        conn = Mock()
+        conn.query.return_value = succeed({"Items": []})
+        storage = AsyncStorage(Table("storage", connection=conn),
+                               SinkMetrics())
+        d = deferToDB(storage.fetch_notifications, "asdf")
+        ok_(d.called)
+        return d
+
+
+class AsyncStorageTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.storage = AsyncStorage(Table("storage", connection=self.conn),
+                                    self.metrics)
+
+    def test_fetch_pages(self):
+        self.conn.query.side_effect = [
+            succeed({"Items": [{"uaid": {"S": "asdf"}, "chid": {"S": "a"},
+                                "version": {"N": "1"}}],
+                     "LastEvaluatedKey": {"uaid": {"S": "asdf"},
+                                          "chid": {"S": "a"}}}),
+            succeed({"Items": [{"uaid": {"S": "asdf"}, "chid": {"S": "b"},
+                                "version": {"N": "2"}}]}),
+        ]
+        d = self.storage.fetch_notifications("asdf")
+
+        def check(notifs):
+            eq_([(n["chid"], n["version"]) for n in notifs],
+                [("a", 1), ("b", 2)])
+            eq_(self.conn.query.call_args[1]["exclusive_start_key"],
+                {"uaid": {"S": "asdf"}, "chid": {"S": "a"}})
+        d.addCallback(check)
+        return d
+
+    def test_fetch_page(self):
+        last_key = {"uaid": {"S": "asdf"}, "chid": {"S": "a"}}
+        self.conn.query.return_value = succeed({
+            "Items": [{"chid": {"S": "a"}, "version": {"N": "1"}}],
+            "LastEvaluatedKey": last_key})
+        d = self.storage.fetch_notifications_page("asdf", 1, "start")
+
+        def check(page):
+            notifs, key = page
+            eq_([(n["chid"], n["version"]) for n in notifs], [("a", 1)])
+            eq_(key, last_key)
+            kwargs = self.conn.query.call_args[1]
+            eq_(kwargs["limit"], 1)
+            eq_(kwargs["attributes_to_get"], ["chid", "version"])
+            eq_(kwargs["exclusive_start_key"], "start")
+        d.addCallback(check)
+        return d
+
+    def test_fetch_over_provisioned(self):
+        self.conn.query.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.fetch_notifications("asdf")
+        self.metrics.increment.assert_called_with(
+            "error.provisioned.fetch_notifications")
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_save(self):
+        self.conn.put_item.return_value = succeed({})
+        d = self.storage.save_notification("asdf", "asdf", 12)
+        d.addCallback(eq_, True)
+        return d
+
+    def test_dont_save_older(self):
+        self.conn.put_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d = self.storage.save_notification("asdf", "asdf", 12)
+        d.addCallback(eq_, False)
+        return d
+
+    def test_delete_version(self):
+        self.conn.delete_item.return_value = succeed({})
+        d = self.storage.delete_notification("asdf", "asdf", 12)
+        d.addCallback(eq_, True)
+        kwargs = self.conn.delete_item.call_args[1]
+        eq_(kwargs["condition_expression"], "version = :ver")
+        return d
+
+    def test_delete_over_provisioned(self):
+        self.conn.delete_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.delete_notification("asdf", "asdf")
+        d.addCallback(eq_, False)
+        return d
+
+    def test_delete_notifications(self):
+        unprocessed = {"DeleteRequest": {"Key": self.storage.encode(
+            dict(uaid="asdf", chid="0"))}}
+        self.conn.batch_write_item.side_effect = [
+            succeed({"UnprocessedItems": {"storage": [unprocessed]}}),
+            succeed({}),
+        ]
+        keys = [("asdf", str(i)) for i in range(30)]
+        d = self.storage.delete_notifications(keys)
+
+        def check(result):
+            eq_(result, True)
+            calls = self.conn.batch_write_item.call_args_list
+            # The unprocessed item is resent with the remaining 5
+            eq_([len(call[0][0]["storage"]) for call in calls], [25, 6])
+        d.addCallback(check)
+        return d
+
+    def test_delete_notifications_over_provisioned(self):
+        self.conn.batch_write_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.delete_notifications([("asdf", "asdf")])
+        d.addCallback(eq_, False)
+        self.metrics.increment.assert_called_with(
+            "error.provisioned.delete_notifications")
+        return d
+
+
+class AsyncRouterTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.router = AsyncRouter(Table("router", connection=self.conn),
+                                  self.metrics)
+
+    def test_get_uaid(self):
+        self.conn.get_item.return_value = succeed(
+            {"Item": {"uaid": {"S": "asdf"}, "node_id": {"S": "me"}}})
+        d = self.router.get_uaid("asdf")
+
+        def check(item):
+            eq_(item["node_id"], "me")
+            eq_(self.conn.get_item.call_args[1]["consistent_read"], True)
+        d.addCallback(check)
+        return d
+
+    def test_get_uaid_eventual(self):
+        self.conn.get_item.return_value = succeed(
+            {"Item": {"uaid": {"S": "asdf"}}})
+        d = self.router.get_uaid("asdf", consistent=False)
+        d.addCallback(lambda _: eq_(
+            self.conn.get_item.call_args[1]["consistent_read"], False))
+        return d
+
+    def test_no_uaid_found(self):
+        self.conn.get_item.return_value = succeed({})
+        d = self.router.get_uaid("asdf")
+        return self.assertFailure(d, ItemNotFound)
+
+    def test_register_user(self):
+        self.conn.update_item.return_value = succeed(
+            {"Attributes": {"uaid": {"S": "asdf"}, "node_id": {"S": "old"}}})
+        d = self.router.register_user(dict(uaid="asdf", node_id="me",
+                                           connected_at=1234))
+        d.addCallback(eq_, (True, {"uaid": "asdf", "node_id": "old"}))
+        return d
+
+    def test_register_user_fail(self):
+        self.conn.update_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d = self.router.register_user(dict(uaid="asdf", node_id="me",
+                                           connected_at=1234))
+        d.addCallback(eq_, (False, {}))
+        return d
+
+    def test_register_user_provision_failed(self):
+        self.conn.update_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.router.register_user(dict(uaid="asdf", node_id="me",
+                                           connected_at=1234))
+        self.metrics.increment.assert_called_with(
+            "error.provisioned.register_user")
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_clear_node(self):
+        self.conn.update_item.return_value = succeed({})
+        d = self.router.clear_node(dict(uaid="asdf", node_id="me",
+                                        connected_at=1234))
+        d.addCallback(eq_, True)
+        args, kwargs = self.conn.update_item.call_args
+        eq_(args, ("router", {"uaid": {"S": "asdf"}}))
+        eq_(kwargs["expression_attribute_values"][":node"], {"S": "me"})
+        return d
+
+    def test_clear_node_keeps_last_connect(self):
+        self.conn.update_item.return_value = succeed({})
+        d = self.router.clear_node(dict(uaid="asdf", node_id="me",
+                                        connected_at=1234, last_connect=1234))
+        d.addCallback(eq_, True)
+        eq_(self.conn.update_item.call_args[1]["update_expression"],
+            "REMOVE node_id, connected_at")
+        return d
+
+    def test_clear_node_fail(self):
+        self.conn.update_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d = self.router.clear_node(dict(uaid="asdf", node_id="me",
+                                        connected_at=1234))
+        d.addCallback(eq_, False)
+        return d
+
+
+class CachedRouterTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.router = AsyncRouter(Table("router", connection=self.conn),
+                                  self.metrics)
+        self.cache = CachedRouter(self.router, size=10, ttl=30)
+
+    def _item(self, **data):
+        return {"Item": self.router.encode(dict(data, uaid="asdf"))}
+
+    def test_read_through(self):
+        self.conn.get_item.return_value = succeed(self._item(node_id="me"))
+        d = self.cache.get_uaid("asdf")
+
+        def check_hit(item):
+            eq_(item["node_id"], "me")
+            self.metrics.increment.assert_called_with("router.cache.hit")
+            eq_(self.conn.get_item.call_count, 1)
+
+        def check_miss(item):
+            eq_(item["node_id"], "me")
+            self.metrics.increment.assert_called_with("router.cache.miss")
+            # Modifying a returned item leaves the cached one alone
+            del item["node_id"]
+            return self.cache.get_uaid("asdf").addCallback(check_hit)
+        d.addCallback(check_miss)
+        return d
+
+    def test_expired(self):
+        self.cache.ttl = -1
+        self.conn.get_item.side_effect = lambda *args, **kwargs: succeed(
+            self._item(node_id="me"))
+        d = self.cache.get_uaid("asdf")
+
+        def check(item):
+            self.metrics.increment.assert_called_with("router.cache.stale")
+            eq_(self.conn.get_item.call_count, 2)
+        d.addCallback(lambda _: self.cache.get_uaid("asdf"))
+        d.addCallback(check)
+        return d
+
+    def test_not_found_not_cached(self):
+        self.conn.get_item.return_value = succeed({})
+        d = self.cache.get_uaid("asdf")
+        self.assertFailure(d, ItemNotFound)
+        d.addCallback(lambda _: eq_(self.cache._cache.get("asdf"), None))
+        return d
+
+    def test_invalidate(self):
+        self.conn.get_item.return_value = succeed(self._item(node_id="me"))
+        d = self.cache.get_uaid("asdf")
+
+        def check(result):
+            self.cache.invalidate("asdf")
+            self.metrics.increment.assert_called_with("router.cache.stale")
+            eq_(self.cache._cache.get("asdf"), None)
+        d.addCallback(check)
+        return d
+
+    def test_register_user_drops(self):
+        self.conn.get_item.return_value = succeed(self._item(node_id="me"))
+        self.conn.update_item.return_value = succeed({})
+        d = self.cache.get_uaid("asdf")
+        d.addCallback(lambda _: self.cache.register_user(
+            dict(uaid="asdf", node_id="you", connected_at=1234)))
+
+        def check(result):
+            eq_(result, (True, {}))
+            eq_(self.cache._cache.get("asdf"), None)
+        d.addCallback(check)
+        return d
+
+    def test_clear_node_during_lookup(self):
+        lookup = Deferred()
+        self.conn.get_item.return_value = lookup
+        self.conn.put_item.return_value = succeed({})
+        d = self.cache.get_uaid("asdf")
+        self.cache.clear_node(dict(uaid="asdf", node_id="me",
+                                   connected_at=1234))
+        lookup.callback(self._item(node_id="me"))
+
+        def check(item):
+            # The lookup started before the node was cleared, so its
+            # result isn't cached
+            eq_(item["node_id"], "me")
+            eq_(self.cache._cache.get("asdf"), None)
+        d.addCallback(check)
+        return d
+
+
+class CoalescingRouterTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.router = AsyncRouter(Table("router", connection=self.conn),
+                                  self.metrics)
+        self.coalesce = CoalescingRouter(self.router)
+
+    def _raw(self, uaid, **data):
+        return self.router.encode(dict(data, uaid=uaid))
+
+    def test_shared_lookup(self):
+        lookup = Deferred()
+        self.conn.get_item.return_value = lookup
+        d1 = self.coalesce.get_uaid("asdf")
+        d2 = self.coalesce.get_uaid("asdf")
+        eq_(self.conn.get_item.call_count, 1)
+        self.metrics.increment.assert_called_with("router.coalesce.shared")
+        lookup.callback({"Item": self._raw("asdf", node_id="me")})
+
+        def check(results):
+            items = [item for _, item in results]
+            eq_([item["node_id"] for item in items], ["me", "me"])
+            ok_(items[0] is not items[1])
+            eq_(self.coalesce._waiting, {})
+        return DeferredList([d1, d2]).addCallback(check)
+
+    def test_shared_failure(self):
+        lookup = Deferred()
+        self.conn.get_item.return_value = lookup
+        d1 = self.coalesce.get_uaid("asdf")
+        d2 = self.coalesce.get_uaid("asdf")
+        lookup.callback({})
+        self.assertFailure(d1, ItemNotFound)
+        self.assertFailure(d2, ItemNotFound)
+        return DeferredList([d1, d2])
+
+    def test_register_user_detaches(self):
+        self.conn.get_item.side_effect = [Deferred(), Deferred()]
+        self.conn.update_item.return_value = succeed({})
+        self.coalesce.get_uaid("asdf")
+        self.coalesce.register_user(dict(uaid="asdf", node_id="me",
+                                         connected_at=1234))
+        self.coalesce.get_uaid("asdf")
+        eq_(self.conn.get_item.call_count, 2)
+
+    def test_batch(self):
+        self.coalesce = CoalescingRouter(self.router, batch_window=1)
+        self.conn.batch_get_item.side_effect = [
+            succeed({
+                "Responses": {"router": [self._raw("a", node_id="me")]},
+                "UnprocessedKeys": {"router": {"Keys": [
+                    self._raw("b")]}},
+            }),
+            succeed({
+                "Responses": {"router": [self._raw("b", node_id="you")]},
+            }),
+        ]
+        da = self.coalesce.get_uaid("a")
+        db = self.coalesce.get_uaid("b")
+        dc = self.coalesce.get_uaid("c")
+        self.coalesce._flush()
+        request = self.conn.batch_get_item.call_args_list[0][0][0]
+        eq_(len(request["router"]["Keys"]), 3)
+        eq_(request["router"]["ConsistentRead"], True)
+        self.assertFailure(dc, ItemNotFound)
+
+        def check(results):
+            eq_(results[0][1]["node_id"], "me")
+            eq_(results[1][1]["node_id"], "you")
+            eq_(self.conn.batch_get_item.call_count, 2)
+        return DeferredList([da, db, dc]).addCallback(check)
+
+    def test_consistency_not_shared(self):
+        self.conn.get_item.side_effect = [Deferred(), Deferred()]
+        self.coalesce.get_uaid("asdf", consistent=False)
+        self.coalesce.get_uaid("asdf")
+        eq_(self.conn.get_item.call_count, 2)
+        eq_([c[1]["consistent_read"]
+             for c in self.conn.get_item.call_args_list], [False, True])
+        self.coalesce.invalidate("asdf")
+        eq_(self.coalesce._waiting, {})
+
+    def test_batch_by_consistency(self):
+        self.coalesce = CoalescingRouter(self.router, batch_window=1)
+        self.conn.batch_get_item.return_value = Deferred()
+        self.coalesce.get_uaid("a")
+        self.coalesce.get_uaid("b", consistent=False)
+        self.coalesce._flush()
+        eq_([c[0][0]["router"]["ConsistentRead"]
+             for c in self.conn.batch_get_item.call_args_list],
+            [True, False])
+
+    def test_batch_size_flushes(self):
+        self.coalesce = CoalescingRouter(self.router, batch_window=1,
+                                         batch_size=2)
+        self.conn.batch_get_item.return_value = Deferred()
+        self.coalesce.get_uaid("a")
+        eq_(self.conn.batch_get_item.call_count, 0)
+        self.coalesce.get_uaid("b")
+        eq_(self.conn.batch_get_item.call_count, 1)
+        eq_(self.coalesce._batch_call, None)
+
+    def test_batch_over_provisioned(self):
+        self.coalesce = CoalescingRouter(self.router, batch_window=1)
+        self.conn.batch_get_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.coalesce.get_uaid("a")
+        self.coalesce._flush()
+        self.metrics.increment.assert_called_with(
+            "error.provisioned.get_uaid")
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+
+class WriteBehindStorageTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.storage = AsyncStorage(Table("storage", connection=self.conn),
+                                    self.metrics)
+        self.queue = WriteBehindStorage(self.storage, window=1)
+
+    def tearDown(self):
+        if self.queue._flush_call:
+            self.queue._flush_call.cancel()
+
+    def test_collapse(self):
+        self.conn.put_item.return_value = succeed({})
+        d1 = self.queue.save_notification("asdf", "chid", 10)
+        d2 = self.queue.save_notification("asdf", "chid", 12)
+        d3 = self.queue.save_notification("asdf", "chid", 11)
+        d4 = self.queue.save_notification("asdf", "other", 5)
+        eq_(self.conn.put_item.call_count, 0)
+        self.queue.flush()
+        eq_(self.conn.put_item.call_count, 2)
+        versions = sorted(
+            call[1]["item"]["version"]["N"]
+            for call in self.conn.put_item.call_args_list)
+        eq_(versions, ["12", "5"])
+        self.metrics.gauge.assert_any_call(
+            "storage.writebehind.queue_depth", 2)
+        self.metrics.gauge.assert_any_call(
+            "storage.writebehind.collapse_ratio", 0.5)
+        eq_(self.queue._flush_call, None)
+
+        def check(results):
+            eq_([result for _, result in results], [True, True, False, True])
+        return DeferredList([d1, d2, d3, d4]).addCallback(check)
+
+    def test_condition_failed(self):
+        self.conn.put_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d1 = self.queue.save_notification("asdf", "chid", 10)
+        d2 = self.queue.save_notification("asdf", "chid", 12)
+        self.queue.flush()
+        d1.addCallback(eq_, False)
+        d2.addCallback(eq_, False)
+        return DeferredList([d1, d2])
+
+    def test_save_over_provisioned(self):
+        self.conn.put_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.queue.save_notification("asdf", "chid", 10)
+        self.queue.flush()
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_max_pending_flushes(self):
+        self.queue = WriteBehindStorage(self.storage, window=1,
+                                        max_pending=2)
+        self.conn.put_item.return_value = Deferred()
+        self.queue.save_notification("asdf", "a", 10)
+        eq_(self.conn.put_item.call_count, 0)
+        self.queue.save_notification("asdf", "b", 10)
+        eq_(self.conn.put_item.call_count, 2)
+        eq_(self.queue._pending, {})
+
+    def test_passthrough(self):
+        self.conn.delete_item.return_value = succeed({})
+        self.conn.query.return_value = succeed({"Items": []})
+        d1 = self.queue.delete_notification("asdf", "chid")
+        d1.addCallback(eq_, True)
+        d2 = self.queue.fetch_notifications("asdf")
+        d2.addCallback(eq_, [])
+        return DeferredList([d1, d2])
+
+    def test_delete_notifications_passthrough(self):
+        self.conn.batch_write_item.return_value = succeed({})
+        d = self.queue.delete_notifications([("asdf", "1"), ("asdf", "2")])
+        eq_(self.conn.batch_write_item.call_count, 1)
+        request = self.conn.batch_write_item.call_args[0][0]
+        eq_(len(request["storage"]), 2)
+        d.addCallback(eq_, True)
+        return d
+
+
+class DeleteQueueTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.storage = AsyncStorage(Table("storage", connection=self.conn),
+                                    self.metrics)
+        self.queue = DeleteQueue(self.storage, window=1)
+
+    def tearDown(self):
+        if self.queue._flush_call:
+            self.queue._flush_call.cancel()
+
+    def test_gathers_connections(self):
+        self.conn.batch_write_item.return_value = succeed({})
+        d1 = self.queue.delete_notifications([("a", "1"), ("a", "2")])
+        d2 = self.queue.delete_notifications([("b", "1"), ("a", "1")])
+        eq_(self.conn.batch_write_item.call_count, 0)
+        self.queue.flush()
+        eq_(self.conn.batch_write_item.call_count, 1)
+        request = self.conn.batch_write_item.call_args[0][0]
+        eq_(len(request["storage"]), 3)
+        self.metrics.gauge.assert_called_with("storage.delete_queue.size", 3)
+        d1.addCallback(eq_, True)
+        d2.addCallback(eq_, True)
+        return DeferredList([d1, d2])
+
+    def test_max_pending_flushes(self):
+        self.queue = DeleteQueue(self.storage, window=1, max_pending=2)
+        self.conn.batch_write_item.return_value = Deferred()
+        self.queue.delete_notifications([("a", "1")])
+        eq_(self.conn.batch_write_item.call_count, 0)
+        self.queue.delete_notifications([("b", "1")])
+        eq_(self.conn.batch_write_item.call_count, 1)
+        eq_(self.queue._flush_call, None)
+
+    def test_over_provisioned(self):
+        self.conn.batch_write_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.queue.delete_notifications([("a", "1")])
+        self.queue.flush()
+        d.addCallback(eq_, False)
+        return d
+
+
+class ReadPolicyTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.router = AsyncRouter(Table("router", connection=self.conn),
+                                  self.metrics)
+        self.storage = AsyncStorage(Table("storage", connection=self.conn),
+                                    self.metrics)
+        self.policy = ReadPolicy(self.metrics, eventual=["endpoint", "fetch"])
+
+    def _item(self, **data):
+        return succeed({"Item": self.router.encode(dict(data, uaid="asdf"))})
+
+    def _consistency(self, calls):
+        return [c[1]["consistent_read"] for c in calls.call_args_list]
+
+    def test_unknown_site(self):
+        self.assertRaises(ValueError, ReadPolicy, self.metrics, ["nope"])
+
+    def test_consistent_site(self):
+        self.conn.get_item.return_value = self._item(connected_at=1)
+        d = self.policy.get_uaid(self.router, "asdf", "router")
+
+        def check(item):
+            eq_(self._consistency(self.conn.get_item), [True])
+            eq_(len(self.metrics.increment.mock_calls), 0)
+        return d.addCallback(check)
+
+    def test_eventual_fresh(self):
+        self.conn.get_item.return_value = self._item(connected_at=1)
+        d = self.policy.get_uaid(self.router, "asdf", "endpoint")
+
+        def check(item):
+            eq_(item["connected_at"], 1)
+            eq_(self._consistency(self.conn.get_item), [False])
+            self.metrics.increment.assert_called_with(
+                "db.read.eventual.endpoint")
+        return d.addCallback(check)
+
+    def test_eventual_stale(self):
+        self.router.invalidate = Mock()
+        self.conn.get_item.side_effect = [
+            self._item(), self._item(connected_at=2)]
+        d = self.policy.get_uaid(self.router, "asdf", "endpoint")
+
+        def check(item):
+            eq_(item["connected_at"], 2)
+            eq_(self._consistency(self.conn.get_item), [False, True])
+            self.router.invalidate.assert_called_with("asdf")
+            self.metrics.increment.assert_called_with(
+                "db.read.fallback.endpoint")
+        return d.addCallback(check)
+
+    def test_eventual_missing(self):
+        self.conn.get_item.side_effect = [
+            succeed({}), self._item(connected_at=2)]
+        d = self.policy.get_uaid(self.router, "asdf", "endpoint")
+
+        def check(item):
+            eq_(item["connected_at"], 2)
+            eq_(self._consistency(self.conn.get_item), [False, True])
+        return d.addCallback(check)
+
+    def test_eventual_missing_consistently(self):
+        self.conn.get_item.side_effect = lambda *args, **kwargs: succeed({})
+        d = self.policy.get_uaid(self.router, "asdf", "endpoint")
+        return self.assertFailure(d, ItemNotFound)
+
+    def test_fetch_stale(self):
+        self.conn.query.side_effect = [
+            succeed({"Items": []}),
+            succeed({"Items": [{"uaid": {"S": "asdf"}, "chid": {"S": "a"},
+                                "version": {"N": "1"}}]}),
+        ]
+        d = self.policy.fetch_notifications(self.storage, "asdf", "fetch",
+                                            stale=lambda notifs: not notifs)
+
+        def check(notifs):
+            eq_(len(notifs), 1)
+            eq_(self._consistency(self.conn.query), [False, True])
+        return d.addCallback(check)
+
+    def test_fetch_page(self):
+        self.conn.query.return_value = succeed({"Items": []})
+        d = self.policy.fetch_notifications_page(self.storage, "asdf", 10,
+                                                 "fetch")
+
+        def check(page):
+            eq_(page, ([], None))
+            eq_(self._consistency(self.conn.query), [False])
+        return d.addCallback(check)
+
+
+class AdaptiveThrottleTestCase(trial.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock()
+        self.throttle = AdaptiveThrottle("storage", "save", self.metrics,
+                                         max_rate=2, max_queue=8,
+                                         clock=self.clock)
+
+    def _fired(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_queue_and_drain(self):
+        first = self._fired(self.throttle.acquire())
+        second = self._fired(self.throttle.acquire())
+        third = self._fired(self.throttle.acquire())
+        eq_(first, [None])
+        eq_(second, [None])
+        eq_(third, [])
+        eq_(self.throttle.queued, 1)
+        self.metrics.gauge.assert_called_with("throttle.storage.save.queue",
+                                              1)
+        self.clock.advance(0.5)
+        eq_(third, [None])
+        eq_(self.throttle.queued, 0)
+
+    def test_priority_order(self):
+        self.throttle.acquire()
+        self.throttle.acquire()
+        low = self._fired(self.throttle.acquire(PRIORITY_LOW))
+        high = self._fired(self.throttle.acquire(PRIORITY_HIGH))
+        self.clock.advance(0.5)
+        eq_(high, [None])
+        eq_(low, [])
+        self.clock.advance(0.5)
+        eq_(low, [None])
+
+    def test_shed_low_first(self):
+        self.throttle.acquire()
+        self.throttle.acquire()
+        for _ in range(2):
+            self.throttle.acquire(PRIORITY_LOW)
+        low = self._fired(self.throttle.acquire(PRIORITY_LOW))
+        high = self._fired(self.throttle.acquire(PRIORITY_HIGH))
+        eq_(self.throttle.queued, 3)
+        self.metrics.increment.assert_called_with(
+            "throttle.storage.save.shed")
+        # The shed request fails once a token could be available
+        eq_(low, [])
+        self.clock.advance(0.5)
+        ok_(low[0].check(ProvisionedThroughputExceededException))
+        eq_(high, [None])
+
+    def test_shed_thresholds(self):
+        self.throttle.acquire()
+        self.throttle.acquire()
+        # A quarter of max_queue for low priority, half for normal and
+        # all of it for high
+        limits = [(PRIORITY_LOW, 2), (PRIORITY_NORMAL, 4),
+                  (PRIORITY_HIGH, 8)]
+        for shed, (priority, limit) in enumerate(limits, 1):
+            for _ in range(limit - self.throttle.queued):
+                self.throttle.acquire(priority)
+            eq_(self.throttle.queued, limit)
+            eq_(self.metrics.increment.call_count, shed - 1)
+            self.throttle.acquire(priority)
+            eq_(self.throttle.queued, limit)
+            eq_(self.metrics.increment.call_count, shed)
+
+    def test_aimd(self):
+        self.throttle.throttled()
+        eq_(self.throttle.rate, 1)
+        self.metrics.gauge.assert_called_with("throttle.storage.save.rate",
+                                              1)
+        # Within the cooldown the rate is only cut once
+        self.throttle.throttled()
+        eq_(self.throttle.rate, 1)
+        self.clock.advance(1)
+        self.throttle.throttled()
+        eq_(self.throttle.rate, 1)
+        self.throttle.succeeded()
+        eq_(self.throttle.rate, 2)
+        self.throttle.succeeded()
+        eq_(self.throttle.rate, 2)
+
+
+class ThrottledTableTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.clock = Clock()
+        self.storage = ThrottledStorage(
+            AsyncStorage(Table("storage", connection=self.conn),
+                         self.metrics),
+            max_rate=4, clock=self.clock)
+
+    def test_throughput_exceeded(self):
+        self.conn.put_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.save_notification("asdf", "chid", 10)
+        eq_(self.storage.throttle("save_notification").rate, 2)
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_condition_failed_keeps_rate(self):
+        self.conn.put_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d = self.storage.save_notification("asdf", "chid", 10)
+        d.addCallback(eq_, False)
+        eq_(self.storage.throttle("save_notification").rate, 4)
+        return d
+
+    def test_delete_not_deleted(self):
+        self.conn.delete_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.delete_notification("asdf", "chid")
+        d.addCallback(eq_, False)
+        eq_(self.storage.throttle("delete_notification").rate, 2)
+        return d
+
+    def test_shed_keeps_rate(self):
+        self.storage = ThrottledStorage(self.storage.target, max_rate=1,
+                                        max_queue=1, clock=self.clock)
+        self.conn.delete_item.return_value = succeed({})
+        d1 = self.storage.delete_notification("asdf", "chid")
+        d1.addCallback(eq_, True)
+        d2 = self.storage.delete_notification("asdf", "chid")
+        d2.addCallback(eq_, True)
+        d3 = self.storage.delete_notification("asdf", "chid")
+        self.clock.advance(1)
+        eq_(self.storage.throttle("delete_notification").rate, 1)
+        self.assertFailure(d3, ProvisionedThroughputExceededException)
+        return DeferredList([d1, d2, d3])
+
+    def test_router(self):
+        router = ThrottledRouter(
+            AsyncRouter(Table("router", connection=self.conn), self.metrics),
+            clock=self.clock)
+        self.conn.get_item.return_value = succeed(
+            {"Item": router.target.encode(dict(uaid="asdf", node_id="me"))})
+        d = router.get_uaid("asdf")
+        d.addCallback(lambda item: eq_(item["node_id"], "me"))
+        router.invalidate("asdf")
+        return d
+
+
+class InstrumentedTableTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+
+    def _timings(self):
+        return dict((call[1]["tags"][1], call[0][0]) for call in
+                    self.metrics.timing.call_args_list)
+
+    def test_deferred(self):
+        storage = InstrumentedStorage(
+            AsyncStorage(Table("storage", connection=self.conn),
+                         self.metrics))
+        self.conn.put_item.return_value = succeed({})
+        d = storage.save_notification("asdf", "chid", 10)
+
+        def check(result):
+            eq_(result, True)
+            eq_(self._timings(), {
+                "operation:save_notification": "db.save_notification.service"
+            })
+            eq_(self.metrics.timing.call_args[1]["tags"][0], "table:storage")
+        return d.addCallback(check)
+
+    def test_thread_pool(self):
+        router = InstrumentedRouter(Mock(deferred=False, metrics=self.metrics))
+        router.target.get_uaid.return_value = {"uaid": "asdf"}
+        d = router.get_uaid("asdf")
+
+        def check(result):
+            eq_(result, {"uaid": "asdf"})
+            eq_(sorted(call[0][0] for call in
+                       self.metrics.timing.call_args_list),
+                ["db.get_uaid.service", "db.get_uaid.wait"])
+            router.invalidate("asdf")
+            router.target.invalidate.assert_called_with("asdf")
+        return d.addCallback(check)
+
+    def test_failure_timed(self):
+        router = InstrumentedRouter(
+            AsyncRouter(Table("router", connection=self.conn), self.metrics))
+        self.conn.update_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = router.register_user(dict(uaid="asdf", node_id="me",
+                                      connected_at=1))
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        d.addCallback(lambda _: eq_(self._timings().keys(),
+                                    ["operation:register_user"]))
+        return d
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_shard_tablenames(self):
+        eq_(shard_tablenames("router"), ["router"])
+        eq_(shard_tablenames("router", 3),
+            ["router_0", "router_1", "router_2"])
+
+    def test_shard_index(self):
+        uaid = str(uuid.uuid4())
+        eq_(shard_index(uaid, 1), 0)
+        eq_(shard_index(uaid, 8), shard_index(unicode(uaid), 8))
+        indexes = set(shard_index(str(uuid.uuid4()), 4) for _ in range(100))
+        eq_(indexes, set(range(4)))
+
+
+class ShardedRouterTestCase(trial.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.shards = [
+            AsyncRouter(Table("router_%d" % shard, connection=Mock()),
+                        self.metrics)
+            for shard in range(2)
+        ]
+        self.legacy = AsyncRouter(Table("router", connection=Mock()),
+                                  self.metrics)
+        self.router = ShardedRouter(self.shards, self.metrics,
+                                    legacy=self.legacy)
+        self.uaid = str(uuid.uuid4())
+        self.conn = self.router.shard(self.uaid).table.connection
+
+    def _item(self, uaid, **data):
+        return {"Item": self.legacy.encode(dict(data, uaid=uaid))}
+
+    def test_get_uaid(self):
+        self.conn.get_item.return_value = succeed(
+            self._item(self.uaid, node_id="me"))
+        d = self.router.get_uaid(self.uaid)
+
+        def check(item):
+            eq_(item["node_id"], "me")
+            table = self.router.shard(self.uaid).table.table_name
+            self.metrics.increment.assert_called_with(
+                "db.shard.%s.get_uaid" % table)
+            eq_(len(self.legacy.table.connection.get_item.mock_calls), 0)
+        return d.addCallback(check)
+
+    def test_get_uaid_legacy(self):
+        self.conn.get_item.return_value = succeed({})
+        self.legacy.table.connection.get_item.return_value = succeed(
+            self._item(self.uaid, node_id="old"))
+        d = self.router.get_uaid(self.uaid)
+        return d.addCallback(lambda item: eq_(item["node_id"], "old"))
+
+    def test_get_uaids(self):
+        uaids = [str(uuid.uuid4()) for _ in range(8)]
+        found = uaids[:4]
+
+        def batch_get(table_name):
+            def batch_get_item(request):
+                keys = request[table_name]["Keys"]
+                return succeed({"Responses": {table_name: [
+                    key for key in keys if key["uaid"]["S"] in found]}})
+            return batch_get_item
+        for shard in self.shards + [self.legacy]:
+            shard.table.connection.batch_get_item.side_effect = batch_get(
+                shard.table.table_name)
+        found_legacy = uaids[4:6]
+
+        def legacy_batch_get_item(request):
+            keys = request["router"]["Keys"]
+            eq_(len(keys), 4)
+            return succeed({"Responses": {"router": [
+                key for key in keys if key["uaid"]["S"] in found_legacy]}})
+        self.legacy.table.connection.batch_get_item.side_effect = \
+            legacy_batch_get_item
+        d = self.router.get_uaids(uaids)
+        return d.addCallback(
+            lambda items: eq_(sorted(items), sorted(uaids[:6])))
+
+    def test_register_user_legacy_previous(self):
+        self.conn.update_item.return_value = succeed({})
+        self.legacy.table.connection.get_item.return_value = succeed(
+            self._item(self.uaid, node_id="old", connected_at=10))
+        d = self.router.register_user(dict(uaid=self.uaid, node_id="me",
+                                           connected_at=20))
+
+        def check(result):
+            eq_(result, (True, {"uaid": self.uaid, "node_id": "old",
+                                "connected_at": 10}))
+        return d.addCallback(check)
+
+    def test_register_user_no_legacy_record(self):
+        self.conn.update_item.return_value = succeed({})
+        self.legacy.table.connection.get_item.return_value = succeed({})
+        d = self.router.register_user(dict(uaid=self.uaid, node_id="me",
+                                           connected_at=20))
+        return d.addCallback(eq_, (True, {}))
+
+    def test_clear_node(self):
+        self.conn.update_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        self.legacy.table.connection.update_item.return_value = succeed({})
+        d = self.router.clear_node(dict(uaid=self.uaid, node_id="me",
+                                        connected_at=10))
+        return d.addCallback(eq_, True)
+
+
+class ShardedStorageTestCase(trial.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.shards = [
+            AsyncStorage(Table("storage_%d" % shard, connection=Mock()),
+                         self.metrics)
+            for shard in range(2)
+        ]
+        self.legacy = AsyncStorage(Table("storage", connection=Mock()),
+                                   self.metrics)
+        self.storage = ShardedStorage(self.shards, self.metrics,
+                                      legacy=self.legacy)
+        self.uaid = str(uuid.uuid4())
+        self.conn = self.storage.shard(self.uaid).table.connection
+
+    def _items(self, *versions):
+        return succeed({"Items": [
+            {"uaid": {"S": self.uaid}, "chid": {"S": chid},
+             "version": {"N": str(version)}}
+            for chid, version in versions]})
+
+    def test_fetch_notifications(self):
+        self.conn.query.return_value = self._items(("a", 12), ("b", 10))
+        self.legacy.table.connection.query.return_value = self._items(
+            ("a", 10), ("c", 10))
+        d = self.storage.fetch_notifications(self.uaid)
+
+        def check(notifs):
+            eq_(sorted((n["chid"], n["version"]) for n in notifs),
+                [("a", 12), ("b", 10), ("c", 10)])
+        return d.addCallback(check)
+
+    def test_fetch_notifications_page(self):
+        self.conn.query.return_value = self._items(("a", 12))
+        self.legacy.table.connection.query.side_effect = [
+            succeed({"Items": [], "LastEvaluatedKey": {"chid": {"S": "b"}}}),
+            self._items(("c", 10)),
+        ]
+        d = self.storage.fetch_notifications_page(self.uaid, 10)
+
+        def check_shard(page):
+            notifs, key = page
+            eq_([n["chid"] for n in notifs], ["a"])
+            eq_(key, (True, None))
+            return self.storage.fetch_notifications_page(
+                self.uaid, 10, key).addCallback(check_legacy)
+
+        def check_legacy(page):
+            notifs, key = page
+            eq_(key, (True, {"chid": {"S": "b"}}))
+            return self.storage.fetch_notifications_page(
+                self.uaid, 10, key).addCallback(check_last)
+
+        def check_last(page):
+            notifs, key = page
+            eq_([n["chid"] for n in notifs], ["c"])
+            eq_(key, None)
+        return d.addCallback(check_shard)
+
+    def test_delete_notification(self):
+        self.conn.delete_item.return_value = succeed({})
+        legacy_conn = self.legacy.table.connection
+        legacy_conn.query.return_value = self._items(("a", 10), ("b", 12))
+        legacy_conn.delete_item.return_value = succeed({})
+        d = self.storage.delete_notification(self.uaid, "a", 12)
+
+        def check(result):
+            eq_(result, True)
+            ok_("condition_expression" in self.conn.delete_item.call_args[1])
+            # The older legacy version is deleted on the version read
+            eq_(legacy_conn.delete_item.call_args[1][
+                "expression_attribute_values"], {":ver": {"N": "10"}})
+        return d.addCallback(check)
+
+    def test_delete_notification_keeps_newer_legacy(self):
+        self.conn.delete_item.return_value = succeed({})
+        legacy_conn = self.legacy.table.connection
+        # Saved by a node that isn't migrating yet
+        legacy_conn.query.return_value = self._items(("a", 13))
+        d = self.storage.delete_notification(self.uaid, "a", 12)
+
+        def check(result):
+            eq_(result, True)
+            eq_(legacy_conn.delete_item.call_count, 0)
+        return d.addCallback(check)
+
+    def test_delete_notification_unversioned(self):
+        self.conn.delete_item.return_value = succeed({})
+        legacy_conn = self.legacy.table.connection
+        legacy_conn.delete_item.return_value = succeed({})
+        d = self.storage.delete_notification(self.uaid, "a")
+
+        def check(result):
+            eq_(result, True)
+            eq_(legacy_conn.query.call_count, 0)
+            eq_(legacy_conn.delete_item.call_args[1], {})
+        return d.addCallback(check)
+
+    def test_delete_notifications(self):
+        keys = [(str(uuid.uuid4()), "a") for _ in range(8)]
+        for shard in self.shards + [self.legacy]:
+            shard.table.connection.batch_write_item.return_value = succeed(
+                {})
+        d = self.storage.delete_notifications(keys)
+
+        def check(result):
+            eq_(result, True)
+            deleted = sum(
+                len(c[0][0][shard.table.table_name])
+                for shard in self.shards
+                for c in
+                shard.table.connection.batch_write_item.call_args_list)
+            eq_(deleted, 8)
+            eq_(self.legacy.table.connection.batch_write_item.call_count, 1)
+        return d.addCallback(check)
+
+
+class RotationTestCase(unittest.TestCase):
+    def test_storage_month(self):
+        when = datetime.datetime(2016, 2, 29)
+        eq_(storage_month(when), (2016, 2))
+        eq_(storage_month(when, 2), (2015, 12))
+        eq_(rotating_tablename("storage", when, 1), "storage_2016_01")
+
+    def test_expired_tablenames(self):
+        names = ["storage", "storage_0", "storage_2015_11",
+                 "storage_2015_12_0", "storage_2015_12_1", "storage_2016_01",
+                 "storage_2016_02", "router_2015_01", "storage_x_2015_01"]
+        eq_(expired_tablenames(names, "storage",
+                               datetime.datetime(2016, 2, 1), 3),
+            ["storage_2015_11"])
+        eq_(expired_tablenames(names, "storage",
+                               datetime.datetime(2016, 3, 1), 3),
+            ["storage_2015_11", "storage_2015_12_0", "storage_2015_12_1"])
+
+    def test_drop_expired_tables(self):
+        conn = Mock()
+        conn.list_tables.side_effect = [
+            {"TableNames": ["storage_2015_01", "storage_2015_02"],
+             "LastEvaluatedTableName": "storage_2015_02"},
+            {"TableNames": ["storage_2015_03", "storage_2016_01"]},
+        ]
+        conn.delete_table.side_effect = [
+            None, ResourceInUseException(None, None), None]
+        dropped = drop_expired_tables("storage", 2,
+                                      datetime.datetime(2016, 1, 1),
+                                      connection=conn)
+        eq_(dropped, ["storage_2015_01", "storage_2015_03"])
+        conn.list_tables.assert_called_with(
+            exclusive_start_table_name="storage_2015_02")
+
+    def test_drop_expired_tables_moto(self):
+        table = create_storage_table("storage_1999_01")
+        eq_(drop_expired_tables("storage", 3), ["storage_1999_01"])
+        eq_(table_exists(table), False)
+
+
+class RotatingStorageTestCase(trial.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.months = [
+            AsyncStorage(Table("storage_2016_0%d" % month,
+                               connection=Mock()), self.metrics)
+            for month in range(1, 4)
+        ]
+        self.storage = RotatingStorage(self.months[1], self.months[0],
+                                       self.metrics)
+
+    def test_save_notification(self):
+        self.months[1].table.connection.put_item.return_value = succeed({})
+        d = self.storage.save_notification("asdf", "chid", 12)
+
+        def check(result):
+            eq_(result, True)
+            self.metrics.increment.assert_called_with(
+                "db.rotation.storage_2016_02.save_notification")
+            eq_(len(self.months[0].table.connection.put_item.mock_calls), 0)
+        return d.addCallback(check)
+
+    def test_fetch_notifications(self):
+        def items(*versions):
+            return succeed({"Items": [
+                {"uaid": {"S": "asdf"}, "chid": {"S": chid},
+                 "version": {"N": str(version)}}
+                for chid, version in versions]})
+        self.months[1].table.connection.query.return_value = items(
+            ("a", 12))
+        self.months[0].table.connection.query.return_value = items(
+            ("a", 10), ("b", 10))
+        d = self.storage.fetch_notifications("asdf")
+
+        def check(notifs):
+            eq_(sorted((n["chid"], n["version"]) for n in notifs),
+                [("a", 12), ("b", 10)])
+        return d.addCallback(check)
+
+    def test_delete_notification(self):
+        # The previous month still holds an older version
+        for month in self.months[:2]:
+            month.table.connection.delete_item.return_value = succeed({})
+        d = self.storage.delete_notification("asdf", "chid", 12)
+
+        def check(result):
+            eq_(result, True)
+            previous = self.months[0].table.connection.delete_item
+            eq_(len(previous.mock_calls), 1)
+            ok_("condition_expression" not in previous.call_args[1])
+        return d.addCallback(check)
+
+    def test_rotate(self):
+        self.storage.rotate(self.months[2])
+        eq_(self.storage.current, self.months[2])
+        eq_(self.storage.previous, self.months[1])
+        eq_(self.storage.table, self.months[2].table)
+
+
+def mock_counter(registry, node):
+    """Stand in for the atomic counter update moto doesn't support"""
+    registry.table.connection.update_item = Mock(
+        return_value={"Attributes": {"node": {"N": str(node)}}})
+
+
+class CompactTestCase(unittest.TestCase):
+    def setUp(self):
+        suffix = uuid.uuid4().hex
+        self.registry = NodeRegistry(get_node_table("nodes_%s" % suffix))
+        mock_counter(self.registry, 3)
+        self.router = Router(
+            get_router_table("router_%s" % suffix, compact=True),
+            SinkMetrics(), registry=self.registry)
+        self.storage = Storage(
+            get_storage_table("storage_%s" % suffix, compact=True),
+            SinkMetrics())
+        self.uaid = str(uuid.uuid4())
+
+    def test_pack_uuid(self):
+        eq_(len(pack_uuid(self.uaid)), 16)
+        eq_(pack_uuid(self.uaid.upper()), self.uaid.upper())
+        table = self.storage.table
+        for value in (self.uaid, self.uaid.upper(), "me"):
+            eq_(table._dynamizer.decode(table._dynamizer.encode(value)),
+                value)
+        with self.assertRaises(ValueError):
+            pack_uuid("me")
+
+    def test_storage(self):
+        chids = [str(uuid.uuid4()) for _ in range(5)]
+        for chid in chids:
+            self.storage.save_notification(self.uaid, chid, 10)
+        notifs = self.storage.fetch_notifications(self.uaid)
+        eq_(sorted(notif["chid"] for notif in notifs), sorted(chids))
+        self.storage.delete_notification(self.uaid, chids[0], 10)
+        notifs, _ = self.storage.fetch_notifications_page(self.uaid, 10)
+        eq_(len(notifs), 4)
+
+        raw = self.storage.table.connection.scan(
+            self.storage.table.table_name)["Items"][0]
+        ok_("B" in raw["uaid"])
+
+    def test_router(self):
+        result = self.router.register_user(dict(
+            uaid=self.uaid, node_id="http://node", connected_at=10))
+        eq_(result, (True, {}))
+        raw = self.router.table.connection.get_item(
+            self.router.table.table_name,
+            self.router.encode({"uaid": self.uaid}))["Item"]
+        eq_(raw["node_id"], {"N": "3"})
+
+        # Another node resolves the node integer from the registry
+        registry = NodeRegistry(self.registry.table)
+        router = Router(self.router.table, SinkMetrics(), registry=registry)
+        item = router.get_uaid(self.uaid)
+        eq_(item["node_id"], "http://node")
+        eq_(router.get_uaids([self.uaid])[self.uaid]["node_id"],
+            "http://node")
+
+        eq_(router.clear_node(item), True)
+        item = router.get_uaid(self.uaid)
+        eq_(item.get("node_id"), None)
+
+
+class NodeRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = NodeRegistry(
+            get_node_table("nodes_%s" % uuid.uuid4().hex))
+
+    def test_node_id(self):
+        mock_counter(self.registry, 7)
+        eq_(self.registry.node_id("http://a"), 7)
+        eq_(self.registry.node_id("http://a"), 7)
+        eq_(self.registry.table.connection.update_item.call_count, 1)
+        d = self.registry.lookup_url(7)
+        ok_(d.called)
+
+        registry = NodeRegistry(self.registry.table)
+        eq_(registry.node_url(7), "http://a")
+        eq_(registry.node_id("http://a"), 7)
+
+    def test_registered_concurrently(self):
+        self.registry.table.put_item(data={"key": "url:http://a", "node": 2})
+        mock_counter(self.registry, 8)
+        conn = self.registry.table.connection
+        put_item = conn.put_item
+
+        def conflict(*args, **kwargs):
+            if "condition_expression" in kwargs:
+                raise ConditionalCheckFailedException(None, None)
+            return put_item(*args, **kwargs)
+        conn.put_item = Mock(side_effect=conflict)
+        eq_(self.registry._register("http://a"), 2)
+
+    def test_unknown_node(self):
+        with self.assertRaises(ItemNotFound):
+            self.registry.node_url(5)
+
+
+class AsyncCompactRouterTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.registry = Mock()
+        self.registry.lookup_id.return_value = succeed(3)
+        self.registry.lookup_url.return_value = succeed("http://node")
+        self.router = AsyncRouter(CompactTable("router", connection=self.conn),
+                                  SinkMetrics(), registry=self.registry)
+        self.uaid = str(uuid.uuid4())
+
+    def test_get_uaid(self):
+        self.conn.get_item.return_value = succeed({"Item": {
+            "uaid": self.router.encode({"uaid": self.uaid})["uaid"],
+            "node_id": {"N": "3"}}})
+        d = self.router.get_uaid(self.uaid)
+        d.addCallback(lambda item: eq_(item["node_id"], "http://node"))
+        return d
+
+    def test_register_user(self):
+        self.conn.update_item.return_value = succeed(
+            {"Attributes": {"node_id": {"N": "3"}}})
+        d = self.router.register_user(dict(uaid=self.uaid,
+                                           node_id="http://node",
+                                           connected_at=10))
+
+        def check(result):
+            eq_(result, (True, {"node_id": "http://node"}))
+            values = self.conn.update_item.call_args[1][
+                "expression_attribute_values"]
+            eq_(values[":node_id"], {"N": "3"})
+        return d.addCallback(check)
+
+    def test_clear_node(self):
+        self.conn.update_item.return_value = succeed({})
+        d = self.router.clear_node(dict(uaid=self.uaid,
+                                        node_id="http://node",
+                                        connected_at=10))
+
+        def check(result):
+            eq_(result, True)
+            self.registry.lookup_id.assert_called_with("http://node")
+            values = self.conn.update_item.call_args[1][
+                "expression_attribute_values"]
+            eq_(values[":node"], {"N": "3"})
+        return d.addCallback(check)
+
+
+def condition_failed(*args, **kwargs):
+    raise ConditionalCheckFailedException(None, None)
+
+
+class MapStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = get_map_storage_table("storage_%s" % uuid.uuid4().hex)
+        self.conn = self.table.connection = Mock()
+        self.storage = MapStorage(self.table, SinkMetrics())
+
+    def test_fetch_notifications(self):
+        self.conn.get_item.return_value = {"Item": {
+            "uaid": {"S": "asdf"},
+            "chids": {"M": {"b": {"N": "12"}, "a": {"N": "10"}}}}}
+        notifs = self.storage.fetch_notifications("asdf")
+        eq_(notifs, [dict(uaid="asdf", chid="a", version=10),
+                     dict(uaid="asdf", chid="b", version=12)])
+        eq_(self.conn.get_item.call_args[0][1], {"uaid": {"S": "asdf"}})
+
+        eq_(self.storage.fetch_notifications_page("asdf", 1),
+            ([dict(uaid="asdf", chid="a", version=10)], "a"))
+        eq_(self.storage.fetch_notifications_page("asdf", 1, "a"),
+            ([dict(uaid="asdf", chid="b", version=12)], None))
+
+    def test_fetch_no_item(self):
+        self.conn.get_item.return_value = {}
+        eq_(self.storage.fetch_notifications("asdf"), [])
+
+    def test_fetch_provisioned(self):
+        self.conn.get_item.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        with self.assertRaises(ProvisionedThroughputExceededException):
+            self.storage.fetch_notifications("asdf")
+
+    def test_save_notification(self):
+        eq_(self.storage.save_notification("asdf", "chid", 12), True)
+        kwargs = self.conn.update_item.call_args[1]
+        eq_(kwargs["update_expression"], "SET #map.#chid = :ver")
+        eq_(kwargs["expression_attribute_names"],
+            {"#map": "chids", "#chid": "chid"})
+
+    def test_save_creates_item(self):
+        self.conn.update_item.side_effect = [
+            ConditionalCheckFailedException(None, None), {}]
+        eq_(self.storage.save_notification("asdf", "chid", 12), True)
+        kwargs = self.conn.update_item.call_args[1]
+        eq_(kwargs["expression_attribute_values"],
+            {":map": {"M": {"chid": {"N": "12"}}}})
+
+    def test_save_newer_version(self):
+        self.conn.update_item.side_effect = condition_failed
+        eq_(self.storage.save_notification("asdf", "chid", 12), False)
+        eq_(self.conn.update_item.call_count, 3)
+
+    def test_delete_notification(self):
+        self.conn.update_item.side_effect = condition_failed
+        eq_(self.storage.delete_notification("asdf", "chid", 12), True)
+        kwargs = self.conn.update_item.call_args[1]
+        eq_(kwargs["update_expression"], "REMOVE #map.#c0")
+        eq_(kwargs["condition_expression"],
+            "attribute_exists(#map) and #map.#c0 = :ver")
+
+        self.conn.update_item.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        eq_(self.storage.delete_notification("asdf", "chid"), False)
+
+    def test_delete_notifications(self):
+        self.storage.max_remove = 2
+        eq_(self.storage.delete_notifications(
+            [("a", "1"), ("b", "2"), ("a", "3"), ("a", "4")]), True)
+        removals = sorted(
+            (call[0][1]["uaid"]["S"], call[1]["update_expression"])
+            for call in self.conn.update_item.call_args_list)
+        eq_(removals, [("a", "REMOVE #map.#c0"),
+                       ("a", "REMOVE #map.#c0, #map.#c1"),
+                       ("b", "REMOVE #map.#c0")])
+
+        self.conn.update_item.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        eq_(self.storage.delete_notifications([("a", "1")]), False)
+
+
+class AsyncMapStorageTestCase(trial.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        self.metrics = Mock()
+        self.storage = AsyncMapStorage(Table("storage", connection=self.conn),
+                                       self.metrics)
+
+    def test_fetch_notifications_page(self):
+        self.conn.get_item.return_value = succeed({"Item": {
+            "chids": {"M": {"a": {"N": "10"}, "b": {"N": "12"}}}}})
+        d = self.storage.fetch_notifications_page("asdf", 5)
+        d.addCallback(eq_, ([dict(uaid="asdf", chid="a", version=10),
+                             dict(uaid="asdf", chid="b", version=12)], None))
+        return d
+
+    def test_save_notification(self):
+        self.conn.update_item.side_effect = [
+            fail(ConditionalCheckFailedException(None, None)),
+            fail(ConditionalCheckFailedException(None, None)),
+            succeed({})]
+        d = self.storage.save_notification("asdf", "chid", 12)
+        d.addCallback(eq_, True)
+        return d
+
+    def test_save_provisioned(self):
+        self.conn.update_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.save_notification("asdf", "chid", 12)
+        self.metrics.increment.assert_called_with(
+            "error.provisioned.save_notification")
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_delete_notification(self):
+        self.conn.update_item.return_value = fail(
+            ConditionalCheckFailedException(None, None))
+        d = self.storage.delete_notification("asdf", "chid", 12)
+        d.addCallback(eq_, True)
+        return d
+
+    def test_delete_notifications(self):
+        self.conn.update_item.return_value = succeed({})
+        d = self.storage.delete_notifications([("a", "1"), ("a", "2")])
+
+        def check(result):
+            eq_(result, True)
+            eq_(self.conn.update_item.call_count, 1)
+        return d.addCallback(check)
+
+    def test_delete_notifications_provisioned(self):
+        self.conn.update_item.return_value = fail(
+            ProvisionedThroughputExceededException(None, None))
+        d = self.storage.delete_notifications([("a", "1")])
+        d.addCallback(eq_, False)
+        return d
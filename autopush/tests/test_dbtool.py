@@ -0,0 +1,215 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from mock import Mock
+from moto import mock_dynamodb2
+from nose.tools import eq_, ok_
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+)
+from autopush.dbtool import (
+    Snapshot,
+    TableExport,
+    TableImport,
+    main,
+)
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+def _lines(path):
+    with gzip.open(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_snapshot(self):
+        snapshot = Snapshot(os.path.join(self.path, "new"))
+        eq_(snapshot.manifest, None)
+        snapshot.save_manifest(kind="router", segments=2)
+        eq_(Snapshot(snapshot.path).manifest,
+            dict(kind="router", segments=2))
+        eq_(snapshot.segment_path(3),
+            os.path.join(snapshot.path, "segment-0003.jsonl.gz"))
+        eq_(snapshot.progress(3, "export"), {})
+        snapshot.save_progress(3, "export", size=10, done=False)
+        eq_(snapshot.progress(3, "export"), dict(size=10, done=False))
+        eq_(snapshot.progress(3, "import"), {})
+
+
+class TableSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.snapshot = Snapshot(self.path)
+        self.storage = get_storage_table("storage_%s" % uuid.uuid4().hex)
+        self.uaids = [uuid.uuid4().hex for _ in range(3)]
+        for uaid in self.uaids:
+            for chid in ("a", "b"):
+                self.storage.put_item(data=dict(uaid=uaid, chid=chid,
+                                                version=10))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _export(self, **kwargs):
+        kwargs.setdefault("segments", 1)
+        return TableExport(self.storage, self.snapshot, "storage",
+                           page_size=4, **kwargs)
+
+    def _import(self, tablename=None, **kwargs):
+        target = get_storage_table(tablename or
+                                   "storage_%s" % uuid.uuid4().hex)
+        return target, TableImport(target, self.snapshot, "storage",
+                                   checkpoint_every=1, **kwargs)
+
+    def _keys(self, table):
+        return sorted((item["uaid"], item["chid"]) for item in table.scan())
+
+    def test_export_import(self):
+        counts = self._export().run()
+        eq_((counts["items"], counts["segments"]), (6, 1))
+        eq_(self.snapshot.manifest["table"], self.storage.table_name)
+        eq_(len(_lines(self.snapshot.segment_path(0))), 6)
+        eq_(self.snapshot.progress(0, "export")["done"], True)
+        target, job = self._import()
+        counts = job.run()
+        eq_((counts["items"], counts["segments"]), (6, 1))
+        eq_(self._keys(target), self._keys(self.storage))
+        eq_(self.snapshot.progress(0, "import"), dict(lines=6, done=True))
+        # Done segments are skipped
+        eq_(self._export().run()["skipped"], 1)
+        eq_(TableImport(target, self.snapshot, "storage").run()["skipped"],
+            1)
+
+    def test_export_resumed(self):
+        export = self._export()
+        scan = self.storage.connection.scan
+        calls = []
+
+        def fail_second(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise IOError("connection lost")
+            return scan(*args, **kwargs)
+
+        self.storage.connection.scan = Mock(side_effect=fail_second)
+        self.assertRaises(IOError, export.run)
+        progress = self.snapshot.progress(0, "export")
+        eq_(progress["done"], False)
+        # A page written without recording its progress is dropped
+        with open(self.snapshot.segment_path(0), "ab") as f:
+            f.write("partial")
+        self.storage.connection.scan = scan
+        counts = self._export().run()
+        eq_((counts["items"], counts["resumed"]), (2, 1))
+        lines = _lines(self.snapshot.segment_path(0))
+        eq_(len(lines), 6)
+        eq_(len(set(json.dumps(line, sort_keys=True) for line in lines)), 6)
+
+    def test_import_resumed(self):
+        self._export().run()
+        self.snapshot.save_progress(0, "import", lines=4, done=False)
+        target, job = self._import()
+        counts = job.run()
+        eq_((counts["items"], counts["resumed"]), (2, 1))
+        eq_(len(self._keys(target)), 2)
+
+    def test_import_unprocessed(self):
+        self._export().run()
+        target, job = self._import()
+        batch_write = target.connection.batch_write_item
+        results = []
+
+        def unprocessed_once(request_items, **kwargs):
+            if not results:
+                results.append(request_items)
+                name, requests = request_items.items()[0]
+                batch_write({name: requests[1:]})
+                return {"UnprocessedItems": {name: requests[:1]}}
+            return batch_write(request_items, **kwargs)
+
+        target.connection.batch_write_item = Mock(
+            side_effect=unprocessed_once)
+        counts = job.run()
+        eq_((counts["items"], counts["retries"]), (6, 1))
+        eq_(len(self._keys(target)), 6)
+
+    def test_import_checks(self):
+        target, job = self._import()
+        self.assertRaises(ValueError, job.run)
+        self._export().run()
+        router = get_router_table("router_%s" % uuid.uuid4().hex)
+        self.assertRaises(ValueError, TableImport(
+            router, self.snapshot, "router").run)
+        self.assertRaises(ValueError, TableImport(
+            target, self.snapshot, "storage", compact=True).run)
+        self.snapshot.save_progress(0, "export", done=False)
+        self.assertRaises(ValueError, job.run)
+
+    def test_export_other_table(self):
+        self._export().run()
+        other = get_storage_table("storage_%s" % uuid.uuid4().hex)
+        self.assertRaises(ValueError, TableExport(
+            other, self.snapshot, "storage").run)
+
+    def test_segments(self):
+        table = Mock(table_name="storage")
+        table.connection.scan.side_effect = lambda name, **kwargs: {
+            "Items": [{"uaid": {"S": "u%d" % kwargs["segment"]}}]}
+        counts = TableExport(table, self.snapshot, "storage",
+                             segments=3).run()
+        eq_(counts["segments"], 3)
+        eq_([_lines(self.snapshot.segment_path(segment)) for segment in
+             range(3)],
+            [[{"uaid": {"S": "u%d" % segment}}] for segment in range(3)])
+        eq_(set(call[1]["total_segments"] for call in
+                table.connection.scan.call_args_list), set([3]))
+
+
+class MainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_main(self):
+        router = get_router_table("dbtool_router")
+        router.put_item(data=dict(uaid=uuid.uuid4().hex, node_id="node",
+                                  connected_at=10, last_connect=10))
+        snapshot = os.path.join(self.path, "router")
+        counts = main(["export", "router", "--snapshot=%s" % snapshot,
+                       "--router_tablename=dbtool_router",
+                       "--segments=1"])
+        eq_(counts["items"], 1)
+        counts = main(["import", "router", "--snapshot=%s" % snapshot,
+                       "--table=dbtool_router_copy"])
+        eq_(counts["items"], 1)
+        ok_("dbtool_router_copy" in
+            DynamoDBConnection().list_tables()["TableNames"])
+        self.assertRaises(ValueError, main, [
+            "export", "router", "--snapshot=%s" % snapshot,
+            "--table=missing"])
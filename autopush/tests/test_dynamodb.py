@@ -0,0 +1,240 @@
+import json
+
+import boto
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ProvisionedThroughputExceededException,
+)
+from boto.exception import DynamoDBResponseError, JSONResponseError
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import succeed
+from twisted.trial import unittest
+from twisted.web.client import ProxyAgent
+
+import autopush.dynamodb as dynamodb
+from autopush.costs import acting
+from autopush.dynamodb import (
+    AsyncDynamoDBConnection,
+    MeteredDynamoDBConnection,
+)
+
+
+def make_response(code, body):
+    response = Mock()
+    response.code = code
+    response.phrase = "Status"
+    response._body = json.dumps(body) if body is not None else ""
+    return response
+
+
+class AsyncDynamoDBConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.agent = Mock()
+        self.conn = AsyncDynamoDBConnection(
+            agent=self.agent,
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+        )
+        self.conn._truncated_exponential_time = lambda i: 0
+        self.patch(dynamodb, "readBody", lambda r: succeed(r._body))
+
+    def _respond(self, *responses):
+        self.agent.request.side_effect = [succeed(r) for r in responses]
+
+    def test_request_signed(self):
+        self._respond(make_response(200, {"Item": {"uaid": {"S": "a"}}}))
+        d = self.conn.get_item("router", {"uaid": {"S": "a"}})
+
+        def check(result):
+            eq_(result, {"Item": {"uaid": {"S": "a"}}})
+            method, url, headers, producer = self.agent.request.call_args[0]
+            eq_(method, "POST")
+            eq_(url, "%s://dynamodb.us-east-1.amazonaws.com/" %
+                self.conn.protocol)
+            eq_(headers.getRawHeaders("X-Amz-Target"),
+                ["DynamoDB_20120810.GetItem"])
+            ok_(headers.getRawHeaders("Authorization")[0].startswith(
+                "AWS4-HMAC-SHA256"))
+            ok_(not headers.hasHeader("Content-Length"))
+        d.addCallback(check)
+        return d
+
+    def test_proxy(self):
+        conn = AsyncDynamoDBConnection(
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+            is_secure=False,
+            proxy="127.0.0.1",
+            proxy_port=5000,
+        )
+        ok_(isinstance(conn.agent, ProxyAgent))
+        eq_(conn.agent._proxyEndpoint._port, 5000)
+
+        # Requests are sent to the proxy with the absolute URL
+        conn.agent = self.agent
+        self._respond(make_response(200, {}))
+        d = conn.get_item("router", {"uaid": {"S": "a"}})
+
+        def check(result):
+            url = self.agent.request.call_args[0][1]
+            eq_(url, "http://dynamodb.us-east-1.amazonaws.com/")
+        d.addCallback(check)
+        return d
+
+    def test_secure_proxy(self):
+        # Keep the boto configuration from overriding is_secure
+        with patch.object(boto.config, "has_option", return_value=False):
+            self.assertRaises(ValueError, AsyncDynamoDBConnection,
+                              aws_access_key_id="key",
+                              aws_secret_access_key="secret",
+                              is_secure=True, proxy="127.0.0.1",
+                              proxy_port=5000)
+
+    def test_empty_body(self):
+        self._respond(make_response(200, None))
+        d = self.conn.delete_item("storage", {"uaid": {"S": "a"}})
+        d.addCallback(eq_, None)
+        return d
+
+    def test_condition_failed(self):
+        self._respond(make_response(400, {
+            "__type": "com.amazonaws.dynamodb.v20120810#"
+                      "ConditionalCheckFailedException",
+            "message": "The conditional request failed"}))
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+        return self.assertFailure(d, ConditionalCheckFailedException)
+
+    def test_unknown_error(self):
+        self._respond(make_response(400, {"__type": "Oops"}))
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+        return self.assertFailure(d, JSONResponseError)
+
+    def test_non_json_error(self):
+        response = make_response(502, None)
+        response.phrase = "Bad Gateway"
+        response._body = "<html><body>502 Bad Gateway</body></html>"
+        self._respond(response)
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+
+        def check(fail):
+            fail.trap(DynamoDBResponseError)
+            eq_((fail.value.status, fail.value.reason), (502, "Bad Gateway"))
+            eq_(fail.value.body, "<html><body>502 Bad Gateway</body></html>")
+        d.addCallbacks(lambda _: self.fail("No error raised"), check)
+        return d
+
+    def test_throughput_retried(self):
+        throttled = {
+            "__type": "com.amazonaws.dynamodb.v20120810#"
+                      "ProvisionedThroughputExceededException"}
+        self._respond(make_response(400, throttled),
+                      make_response(200, {}))
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+
+        def check(result):
+            eq_(result, {})
+            eq_(self.agent.request.call_count, 2)
+            eq_(self.conn.throughput_exceeded_events, 1)
+        d.addCallback(check)
+        return d
+
+    def test_throughput_retries_exhausted(self):
+        throttled = {
+            "__type": "com.amazonaws.dynamodb.v20120810#"
+                      "ProvisionedThroughputExceededException"}
+        self.conn.NumberRetries = 2
+        self._respond(make_response(400, throttled),
+                      make_response(400, throttled))
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+        return self.assertFailure(d, ProvisionedThroughputExceededException)
+
+    def test_server_error_retried(self):
+        self._respond(make_response(500, {
+            "__type": "com.amazonaws.dynamodb.v20120810#InternalServerError"}),
+            make_response(200, {}))
+        d = self.conn.put_item("storage", {"uaid": {"S": "a"}})
+        d.addCallback(eq_, {})
+        return d
+
+    def test_consumed_capacity(self):
+        self.conn.metrics = Mock()
+        self._respond(make_response(200, {"ConsumedCapacity": {
+            "TableName": "router", "CapacityUnits": 0.5}}))
+        d = self.conn.get_item("router", {"uaid": {"S": "a"}})
+
+        def check(result):
+            body = self.agent.request.call_args[0][3]._inputFile.getvalue()
+            eq_(json.loads(body)["ReturnConsumedCapacity"], "TOTAL")
+            self.conn.metrics.increment.assert_called_with(
+                "db.capacity.GetItem", 0.5,
+                tags=["table:router", "operation:GetItem"])
+        d.addCallback(check)
+        return d
+
+    def test_costs(self):
+        self.conn.costs = Mock()
+        self._respond(make_response(200, {"ConsumedCapacity": {
+            "TableName": "router", "CapacityUnits": 0.5}}),
+            make_response(400, {
+                "__type": "com.amazonaws.dynamodb.v20120810#"
+                          "ConditionalCheckFailedException"}))
+        with acting("hello"):
+            d = self.conn.get_item("router", {"uaid": {"S": "a"}})
+            failed = self.conn.put_item("router", {"uaid": {"S": "a"}})
+
+        def check(result):
+            body = self.agent.request.call_args[0][3]._inputFile.getvalue()
+            eq_(json.loads(body)["ReturnConsumedCapacity"], "TOTAL")
+            eq_([call[0] for call in self.conn.costs.request.call_args_list],
+                [("hello", 0.5), ("hello", 0)])
+        d.addCallback(lambda _: self.assertFailure(
+            failed, ConditionalCheckFailedException))
+        d.addCallback(check)
+        return d
+
+    def test_pending(self):
+        eq_(self.conn.pending, 0)
+
+
+class MeteredDynamoDBConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.conn = MeteredDynamoDBConnection(
+            metrics=self.metrics,
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+        )
+
+    def test_batch_capacity(self):
+        result = {"ConsumedCapacity": [
+            {"TableName": "storage_0", "CapacityUnits": 2},
+            {"TableName": "storage_1", "CapacityUnits": 1}]}
+        self.patch(dynamodb.DynamoDBConnection, "make_request",
+                   Mock(return_value=result))
+        eq_(self.conn.batch_write_item({}), result)
+        body = dynamodb.DynamoDBConnection.make_request.call_args[0][1]
+        eq_(json.loads(body)["ReturnConsumedCapacity"], "TOTAL")
+        eq_([call[0][1] for call in self.metrics.increment.call_args_list],
+            [2, 1])
+
+    def test_costs(self):
+        self.conn.metrics = None
+        self.conn.costs = Mock()
+        self.patch(dynamodb.DynamoDBConnection, "make_request",
+                   Mock(side_effect=[
+                       {"ConsumedCapacity": {"CapacityUnits": 1}},
+                       ProvisionedThroughputExceededException(400, "")]))
+        with acting("ack"):
+            self.conn.delete_item("storage", {})
+            self.assertRaises(ProvisionedThroughputExceededException,
+                              self.conn.delete_item, "storage", {})
+        eq_([call[0] for call in self.conn.costs.request.call_args_list],
+            [("ack", 1), ("ack", 0)])
+
+    def test_unmetered(self):
+        self.conn.metrics = None
+        eq_(self.conn._with_capacity("GetItem", "{}"), "{}")
+        self.metrics.increment = Mock()
+        eq_(self.conn._with_capacity("ListTables", "{}"), "{}")
+        eq_(self.conn._record_capacity("GetItem", {}), {})
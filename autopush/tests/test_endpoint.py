@@ -295,6 +295,13 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint.put(dummy_uaid)
         return self.finish_deferred
 
+    def test_not_ready(self):
+        self.endpoint.ap_settings.ready = False
+        self.endpoint.prepare()
+        self.status_mock.assert_called_with(503)
+        self.write_mock.assert_called_with("Service starting")
+        return self.finish_deferred
+
     def test_cors(self):
         ch1 = "Access-Control-Allow-Origin"
         ch2 = "Access-Control-Allow-Methods"
@@ -0,0 +1,277 @@
+import datetime
+import json
+import random
+import unittest
+import xml.sax
+
+from boto.ec2.cloudwatch.datapoint import Datapoint
+from boto.handler import XmlHandler
+from boto.resultset import ResultSet
+from cyclone.web import Application
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest as trial
+
+from autopush.fakedb import (
+    CapacityBucket,
+    FakeDynamoDB,
+    FakeDynamoDBHandler,
+    LatencyDistribution,
+    consumed_units,
+    load_profile,
+    parse_timestamp,
+    provisioned_throughput,
+)
+
+
+def _item(size):
+    return {"uaid": {"S": "u"}, "data": {"S": "x" * (size - 9)}}
+
+
+class LatencyDistributionTestCase(unittest.TestCase):
+    def test_sample(self):
+        rng = random.Random(1)
+        latency = LatencyDistribution(median=10, p99=100)
+        samples = sorted(latency.sample(rng) for _ in range(5000))
+        ok_(0.009 < samples[2500] < 0.011)
+        ok_(0.08 < samples[4950] < 0.125)
+
+    def test_zero(self):
+        eq_(LatencyDistribution().sample(), 0)
+        self.assertAlmostEqual(LatencyDistribution(median=5).sample(),
+                               0.005)
+
+
+class CapacityBucketTestCase(unittest.TestCase):
+    def test_throttled(self):
+        clock = Clock()
+        bucket = CapacityBucket(10, burst_seconds=1, clock=clock)
+        eq_(bucket.throttled(), False)
+        bucket.consume(15)
+        eq_(bucket.throttled(), True)
+        clock.advance(0.6)
+        eq_(bucket.throttled(), False)
+        clock.advance(60)
+        bucket.consume(0)
+        eq_(bucket.tokens, 10)
+
+
+class ConsumedUnitsTestCase(unittest.TestCase):
+    def test_reads(self):
+        eq_(consumed_units("GetItem", {"TableName": "t",
+                                       "ConsistentRead": True},
+                           {"Item": _item(5000)}), {"t": (2, 0)})
+        eq_(consumed_units("Query", {"TableName": "t"},
+                           {"Items": [_item(3000), _item(3000)]}),
+            {"t": (1, 0)})
+        eq_(consumed_units("BatchGetItem",
+                           {"RequestItems": {"t": {"ConsistentRead": True}}},
+                           {"Responses": {"t": [_item(10), _item(10)]}}),
+            {"t": (2, 0)})
+
+    def test_writes(self):
+        eq_(consumed_units("PutItem", {"TableName": "t",
+                                       "Item": _item(2000)}, {}),
+            {"t": (0, 2)})
+        eq_(consumed_units("DeleteItem", {"TableName": "t"}, {}),
+            {"t": (0, 1)})
+        eq_(consumed_units("BatchWriteItem", {"RequestItems": {"t": [
+            {"PutRequest": {"Item": _item(1500)}},
+            {"DeleteRequest": {"Key": _item(10)}},
+        ]}}, {}), {"t": (0, 3)})
+        eq_(consumed_units("ListTables", {}, {}), {})
+
+    def test_provisioned_throughput(self):
+        eq_(provisioned_throughput({"Table": {
+            "TableName": "t", "ProvisionedThroughput": {
+                "ReadCapacityUnits": 5, "WriteCapacityUnits": 3}}}),
+            ("t", 5, 3))
+        eq_(provisioned_throughput({"TableNames": []}), None)
+
+    def test_parse_timestamp(self):
+        eq_(parse_timestamp("2016-03-01T00:01:00"), 1456790460)
+        eq_(parse_timestamp("2016-03-01T00:01:00.250000Z"), 1456790460)
+
+
+class ProfileTestCase(unittest.TestCase):
+    def test_load_profile(self):
+        eq_(load_profile("local"), {})
+        ok_("latency" in load_profile("production"))
+        self.assertRaises(ValueError, load_profile, "nonexistent")
+
+
+class FakeDynamoDBTestCase(trial.TestCase):
+    def _fakedb(self, profile):
+        self.clock = Clock()
+        fakedb = FakeDynamoDB("http://upstream", profile, agent=Mock(),
+                              clock=self.clock, seed=1)
+        self.response = (200, "{}")
+        fakedb.forward = Mock(side_effect=lambda *args: succeed(
+            self.response))
+        return fakedb
+
+    def _handle(self, fakedb, operation, params):
+        results = []
+        fakedb.handle(operation, {}, json.dumps(params)).addCallback(
+            results.append)
+        return results
+
+    def test_latency(self):
+        fakedb = self._fakedb({"latency": {"*": {"median": 100}}})
+        results = self._handle(fakedb, "GetItem", {"TableName": "t"})
+        eq_(results, [])
+        self.clock.advance(0.11)
+        eq_(results, [(200, "{}")])
+
+    def test_throttled(self):
+        fakedb = self._fakedb({"capacity": {"read": 0, "write": 1},
+                               "burst_seconds": 1})
+        put = {"TableName": "t", "Item": _item(10)}
+        eq_(self._handle(fakedb, "PutItem", put)[0][0], 200)
+        code, body = self._handle(fakedb, "PutItem", put)[0]
+        eq_(code, 400)
+        ok_(json.loads(body)["__type"].endswith(
+            "#ProvisionedThroughputExceededException"))
+        eq_(self._handle(fakedb, "GetItem", {"TableName": "t"})[0][0], 200)
+        self.clock.advance(1)
+        eq_(self._handle(fakedb, "PutItem", put)[0][0], 200)
+        eq_(fakedb.counts["PutItem"],
+            dict(requests=3, throttled=1, errors=0))
+
+    def test_provisioned(self):
+        fakedb = self._fakedb({"capacity": "provisioned",
+                               "burst_seconds": 1})
+        self.response = (200, json.dumps({"Table": {
+            "TableName": "t", "ProvisionedThroughput": {
+                "ReadCapacityUnits": 1, "WriteCapacityUnits": 1}}}))
+        self._handle(fakedb, "DescribeTable", {"TableName": "t"})
+        self.response = (200, "{}")
+        params = {"TableName": "t", "Item": _item(3000)}
+        eq_(self._handle(fakedb, "PutItem", params)[0][0], 200)
+        eq_(self._handle(fakedb, "PutItem", params)[0][0], 400)
+        eq_(self._handle(fakedb, "PutItem", {"TableName": "other"})[0][0],
+            200)
+
+    def test_errors(self):
+        fakedb = self._fakedb({"errors": {"*": 1, "GetItem": 0}})
+        eq_(self._handle(fakedb, "GetItem", {})[0][0], 200)
+        eq_(self._handle(fakedb, "PutItem", {})[0][0], 500)
+        eq_(fakedb.counts["PutItem"]["errors"], 1)
+        fakedb.report()
+        eq_(fakedb.counts, {})
+
+    def _statistics(self, fakedb, metric, start, end, period=60):
+        code, body = fakedb.metric_statistics({
+            "Action": "GetMetricStatistics", "MetricName": metric,
+            "Period": str(period), "Statistics.member.1": "Sum",
+            "Dimensions.member.1.Name": "TableName",
+            "Dimensions.member.1.Value": "t",
+            "StartTime": datetime.datetime.utcfromtimestamp(
+                start).isoformat(),
+            "EndTime": datetime.datetime.utcfromtimestamp(end).isoformat()})
+        eq_(code, 200)
+        # Parsed the way boto's CloudWatchConnection parses it
+        points = ResultSet([("member", Datapoint)])
+        xml.sax.parseString(body, XmlHandler(points, None))
+        return [(point["Timestamp"], point["Sum"]) for point in points]
+
+    def test_metric_statistics(self):
+        fakedb = self._fakedb({})
+        put = {"TableName": "t", "Item": _item(10)}
+        self.clock.advance(600)
+        self._handle(fakedb, "PutItem", put)
+        self._handle(fakedb, "PutItem", put)
+        self.clock.advance(70)
+        self._handle(fakedb, "PutItem", put)
+        self.response = (200, json.dumps({"Item": _item(10)}))
+        self._handle(fakedb, "GetItem", {"TableName": "t"})
+        eq_(self._statistics(fakedb, "ConsumedWriteCapacityUnits", 590,
+                             720),
+            [(datetime.datetime(1970, 1, 1, 0, 10), 2.0),
+             (datetime.datetime(1970, 1, 1, 0, 11), 1.0)])
+        eq_(self._statistics(fakedb, "ConsumedWriteCapacityUnits", 540,
+                             720, period=300),
+            [(datetime.datetime(1970, 1, 1, 0, 9), 3.0)])
+        eq_(self._statistics(fakedb, "ConsumedReadCapacityUnits", 0, 720),
+            [(datetime.datetime(1970, 1, 1, 0, 10), 0.0),
+             (datetime.datetime(1970, 1, 1, 0, 11), 0.5)])
+        eq_(self._statistics(fakedb, "ConsumedReadCapacityUnits", 0, 600),
+            [])
+        # Minutes out of the retention are dropped
+        self.clock.advance(86400)
+        self._handle(fakedb, "PutItem", put)
+        eq_(sorted(fakedb.consumed["t"]), [87060])
+
+    def test_metric_statistics_unknown(self):
+        fakedb = self._fakedb({})
+        code, body = fakedb.metric_statistics({"Action": "ListMetrics"})
+        eq_(code, 400)
+        ok_("InvalidAction" in body)
+
+    @patch("autopush.fakedb.readBody")
+    def test_forward(self, mock_read):
+        mock_read.return_value = succeed("{}")
+        agent = Mock()
+        agent.request.return_value = succeed(Mock(code=200))
+        fakedb = FakeDynamoDB("http://upstream:5001", {}, agent=agent)
+        d = fakedb.forward({"Host": "dynamodb", "X-Amz-Target": "x.GetItem"},
+                           "{}")
+
+        def check(result):
+            eq_(result, (200, "{}"))
+            args = agent.request.call_args[0]
+            eq_(args[:2], ("POST", "http://upstream:5001/"))
+            eq_(args[2].hasHeader("Host"), False)
+            eq_(args[2].getRawHeaders("X-Amz-Target"), ["x.GetItem"])
+        return d.addCallback(check)
+
+
+class FakeDynamoDBHandlerTestCase(trial.TestCase):
+    def setUp(self):
+        self.fakedb = Mock()
+        self.fakedb.error = FakeDynamoDB.error.__func__.__get__(self.fakedb)
+        request = Mock(body="{}", headers={
+            "X-Amz-Target": "DynamoDB_20120810.GetItem"})
+        self.handler = FakeDynamoDBHandler(Application(), request,
+                                           fakedb=self.fakedb)
+        self.handler.set_status = Mock()
+        self.handler.write = Mock()
+        self.finished = Deferred()
+        self.handler.finish = lambda: self.finished.callback(True)
+
+    def test_post(self):
+        self.fakedb.handle.return_value = succeed((400, "throttled"))
+        self.handler.post()
+
+        def check(result):
+            eq_(self.fakedb.handle.call_args[0][0], "GetItem")
+            self.handler.set_status.assert_called_with(400)
+            self.handler.write.assert_called_with("throttled")
+        return self.finished.addCallback(check)
+
+    def test_get(self):
+        self.fakedb.metric_statistics.return_value = (200, "<xml/>")
+        self.handler.request.arguments = {"Action": ["GetMetricStatistics"]}
+        self.handler.set_header = Mock()
+        self.handler.get()
+
+        def check(result):
+            self.fakedb.metric_statistics.assert_called_with(
+                {"Action": "GetMetricStatistics"})
+            self.handler.set_header.assert_called_with("Content-Type",
+                                                       "text/xml")
+            self.handler.write.assert_called_with("<xml/>")
+        return self.finished.addCallback(check)
+
+    @patch("autopush.fakedb.log")
+    def test_post_failed(self, mock_log):
+        self.fakedb.handle.return_value = Deferred()
+        self.handler.post()
+        self.fakedb.handle.return_value.errback(ValueError("refused"))
+
+        def check(result):
+            self.handler.set_status.assert_called_with(500)
+            eq_(len(mock_log.err.mock_calls), 1)
+        return self.finished.addCallback(check)
@@ -1,3 +1,5 @@
+import json
+
 import twisted.internet.base
 
 from boto.dynamodb2.exceptions import (
@@ -6,14 +8,18 @@ from boto.dynamodb2.exceptions import (
 from cyclone.web import Application
 from mock import (Mock, patch)
 from moto import mock_dynamodb2
-from twisted.internet.defer import Deferred
+from nose.tools import eq_
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionRefusedError
 from twisted.trial import unittest
 
 from autopush import __version__
 from autopush.health import (
+    CostsHandler,
     HealthHandler,
     MissingTableException,
     StatusHandler,
+    WorkersHealthHandler,
 )
 from autopush.settings import AutopushSettings
 
@@ -55,6 +61,15 @@ class HealthTestCase(unittest.TestCase):
             "router": {"status": "OK"}
         })
 
+    def test_not_ready(self):
+        self.settings.ready = False
+        return self._assert_reply({
+            "status": "NOT OK",
+            "version": __version__,
+            "clients": 0,
+            "database": {"status": "NOT OK", "error": "Starting"},
+        })
+
     def test_aws_error(self):
         def raise_error(*args, **kwargs):
             raise InternalServerError(None, None)
@@ -149,3 +164,95 @@ class StatusTestCase(unittest.TestCase):
             "status": "OK",
             "version": __version__
         })
+
+    def test_status_starting(self):
+        self.status.set_status = status_mock = Mock()
+        self.settings.ready = False
+        self.status.get()
+        status_mock.assert_called_with(503)
+        self.write_mock.assert_called_with({
+            "status": "STARTING",
+            "version": __version__
+        })
+
+
+class CostsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = CostsHandler.ap_settings = Mock(db_costs=None)
+        self.costs = CostsHandler(Application(), Mock())
+        self.status_mock = self.costs.set_status = Mock()
+        self.write_mock = self.costs.write = Mock()
+
+    def test_costs(self):
+        self.settings.db_costs = Mock(window=60)
+        self.settings.db_costs.averages.return_value = {"hello": {}}
+        self.costs.get()
+        self.write_mock.assert_called_with({
+            "window": 60,
+            "actions": {"hello": {}},
+        })
+
+    def test_costs_disabled(self):
+        self.costs.get()
+        self.status_mock.assert_called_with(404)
+
+
+class WorkersHealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Mock(count=2, workers={0: Mock(), 1: Mock()})
+        self.agent = Mock()
+        self.bodies = {}
+        self.agent.request.side_effect = lambda method, url: (
+            succeed(self.bodies[url]) if url in self.bodies else
+            fail(ConnectionRefusedError()))
+        self.read_body = patch("autopush.health.readBody",
+                               side_effect=succeed).start()
+        self.handler = WorkersHealthHandler(
+            Application(), Mock(), supervisor=self.supervisor,
+            health_port=9000, agent=self.agent)
+        self.status_mock = self.handler.set_status = Mock()
+        self.write_mock = self.handler.write = Mock()
+        self.handler.finish = Mock()
+
+    def tearDown(self):
+        self.read_body.stop()
+
+    def _health(self, port, status):
+        self.bodies["http://127.0.0.1:%d/health" % port] = json.dumps(
+            {"status": status, "clients": 0})
+
+    def test_healthy(self):
+        self._health(9001, "OK")
+        self._health(9002, "OK")
+        self.handler.get()
+        eq_(len(self.status_mock.mock_calls), 0)
+        self.write_mock.assert_called_with({
+            "status": "OK",
+            "version": __version__,
+            "workers": {
+                "0": {"status": "OK", "clients": 0},
+                "1": {"status": "OK", "clients": 0},
+            }
+        })
+
+    def test_unhealthy(self):
+        self._health(9001, "NOT OK")
+        del self.supervisor.workers[1]
+        self.handler.get()
+        self.status_mock.assert_called_with(503)
+        self.write_mock.assert_called_with({
+            "status": "NOT OK",
+            "version": __version__,
+            "workers": {
+                "0": {"status": "NOT OK", "clients": 0},
+                "1": {"status": "NOT OK", "error": "Not running"},
+            }
+        })
+
+    def test_unreachable(self):
+        self._health(9001, "OK")
+        self.handler.get()
+        self.status_mock.assert_called_with(503)
+        reply = self.write_mock.call_args[0][0]
+        eq_(reply["workers"]["1"], {"status": "NOT OK",
+                                    "error": "Unreachable"})
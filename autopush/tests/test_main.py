@@ -1,16 +1,59 @@
+import datetime
+import json
+import socket
 import unittest
 import uuid
+from StringIO import StringIO
 
-from mock import Mock, patch
+from autobahn.twisted.websocket import (
+    WebSocketClientFactory,
+    WebSocketClientProtocol,
+    connectWS,
+)
+from boto.dynamodb2.table import Table
+from mock import ANY, Mock, patch
 from moto import mock_dynamodb2
-from nose.tools import eq_
+from nose.tools import eq_, ok_
+import txaio
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    DeferredQueue,
+    fail,
+    inlineCallbacks,
+    maybeDeferred,
+)
+from twisted.trial import unittest as trial
+from twisted.web.client import Agent, FileBodyProducer
+from twisted.web.http_headers import Headers
 
+import autopush.settings
+from autopush.db import (
+    create_storage_table,
+    rotating_tablename,
+    table_exists,
+    CompactTable,
+    InstrumentedRouter,
+    InstrumentedStorage,
+    MapStorage,
+)
+from autopush.dynamodb import MeteredDynamoDBConnection
 from autopush.main import (
+    _parse_connection,
+    combined_main,
     connection_main,
     endpoint_main,
     make_settings,
+    rotate_storage,
     skip_request_logging,
+    start_cost_reporting,
+    start_ping_sweeper,
+    start_storage_rotation,
+    start_combined,
+    startup_failed,
+    worker_tags,
 )
+from autopush.memory import MemoryStorage, shared_backend
 from autopush.utils import (
     str2bool,
     resolve_ip,
@@ -18,6 +61,7 @@ from autopush.utils import (
     validate_hash,
 )
 from autopush.settings import AutopushSettings
+from autopush.workers import drain
 
 
 mock_dynamodb2 = mock_dynamodb2()
@@ -62,6 +106,226 @@ class SettingsTestCase(unittest.TestCase):
         eq_(ip, "google.com")
 
 
+class StartDBTestCase(trial.TestCase):
+    def setUp(self):
+        # moto can't serve concurrent requests from the thread pool
+        self.patch(autopush.settings, "deferToThread", maybeDeferred)
+
+    def _settings(self, **kwargs):
+        return AutopushSettings(hostname="localhost", statsd_host=None,
+                                deferred_startup=True, **kwargs)
+
+    def test_start_db(self):
+        settings = self._settings()
+        eq_(settings.ready, False)
+        eq_(settings.storage, None)
+
+        def check(result):
+            eq_(settings.ready, True)
+            eq_(settings.storage.table.table_name, "storage")
+            eq_(settings.router.table.table_name, "router")
+        return settings.start_db().addCallback(check)
+
+    def test_start_db_sharded(self):
+        settings = self._settings(router_shards=2, storage_shards=3,
+                                  shard_migration=True, preflight=False)
+
+        def check(result):
+            eq_(settings.ready, True)
+            eq_([table.table_name for table in settings.router_tables],
+                ["router_0", "router_1"])
+            eq_(len(settings.storage_tables), 3)
+            eq_(settings.router.table.table_name, "router_0")
+            eq_(settings.storage.shards[0].table.table_name, "storage_0")
+            eq_(settings.storage.legacy.table.table_name, "storage")
+        return settings.start_db().addCallback(check)
+
+    def test_start_db_compact(self):
+        settings = self._settings(compact_items=True, compact_migration=True)
+
+        def check(result):
+            eq_(settings.ready, True)
+            router = settings.router
+            eq_(router.table.table_name, "router_compact")
+            ok_(isinstance(router.table, CompactTable))
+            eq_(router.shards[0].registry, settings.node_registry)
+            eq_(settings.node_registry.table.table_name, "router_nodes")
+            eq_(router.legacy.table.table_name, "router")
+            eq_(router.legacy.registry, None)
+            eq_(settings.storage.legacy.table.table_name, "storage")
+        return settings.start_db().addCallback(check)
+
+    def test_start_db_storage_map(self):
+        settings = self._settings(storage_map=True, storage_map_migration=True,
+                                  preflight=False)
+
+        def check(result):
+            storage = settings.storage
+            ok_(isinstance(storage.shards[0], MapStorage))
+            eq_(storage.table.table_name, "storage_map")
+            ok_(not isinstance(storage.legacy, MapStorage))
+            eq_(storage.legacy.table.table_name, "storage")
+        return settings.start_db().addCallback(check)
+
+    def test_start_db_memory(self):
+        settings = self._settings(db_backend="memory",
+                                  storage_rotation=True, router_cache_size=10)
+
+        def check(result):
+            eq_(settings.ready, True)
+            ok_(isinstance(settings.storage, MemoryStorage))
+            eq_(settings.router.router.table, shared_backend.routers)
+            eq_(settings.router_tables, [])
+            eq_(settings.rotating_storage, None)
+        return settings.start_db().addCallback(check)
+
+    def test_setup_db_memory(self):
+        settings = AutopushSettings(hostname="localhost", statsd_host=None,
+                                    db_backend="memory")
+        eq_(settings.ready, True)
+        eq_(settings.storage.table, shared_backend.notifications)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, self._settings, db_backend="redis")
+
+    def test_start_db_metrics(self):
+        settings = self._settings(db_metrics=True, db_throttle=True,
+                                  preflight=False)
+
+        def check(result):
+            storage = settings.storage.target
+            ok_(isinstance(storage, InstrumentedStorage))
+            ok_(isinstance(storage.target.table.connection,
+                           MeteredDynamoDBConnection))
+            eq_(storage.target.table.connection.metrics, settings.metrics)
+            ok_(isinstance(settings.router.target, InstrumentedRouter))
+        return settings.start_db().addCallback(check)
+
+    def test_start_db_costs(self):
+        settings = self._settings(db_costs=True, preflight=False)
+
+        def check(result):
+            connection = settings.storage.table.connection
+            ok_(isinstance(connection, MeteredDynamoDBConnection))
+            eq_(connection.metrics, None)
+            eq_(connection.costs, settings.db_costs)
+        return settings.start_db().addCallback(check)
+
+    def test_skip_preflight(self):
+        mock_preflight = Mock()
+        self.patch(autopush.settings, "preflight_storage", mock_preflight)
+        settings = self._settings(preflight=False)
+
+        def check(result):
+            eq_(settings.ready, True)
+            eq_(len(mock_preflight.mock_calls), 0)
+        return settings.start_db().addCallback(check)
+
+    def test_preflight_failed(self):
+        mock_preflight = Mock(side_effect=ValueError("preflight failed"))
+        self.patch(autopush.settings, "preflight_router", mock_preflight)
+        settings = self._settings()
+        d = settings.start_db()
+
+        def check(result):
+            eq_(settings.ready, False)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(check)
+        return d
+
+    def test_start_db_rotation(self):
+        settings = self._settings(storage_rotation=True, preflight=False)
+        now = datetime.datetime.utcnow()
+
+        def check(result):
+            storage = settings.rotating_storage
+            eq_(settings.storage, storage)
+            eq_(storage.current.table.table_name,
+                rotating_tablename("storage", now))
+            eq_(storage.previous.table.table_name,
+                rotating_tablename("storage", now, 1))
+        return settings.start_db().addCallback(check)
+
+    def test_rotate_storage(self):
+        settings = self._settings(storage_rotation=True, preflight=False)
+        when = datetime.datetime(2100, 2, 1)
+        expired = create_storage_table("storage_2099_11")
+        d = settings.start_db()
+
+        def rotate(result):
+            self.current = settings.rotating_storage.current
+            return settings.rotate_storage(when)
+
+        def check(result):
+            storage = settings.rotating_storage
+            eq_(storage.current.table.table_name, "storage_2100_02")
+            eq_(storage.previous, self.current)
+            eq_(settings.storage_table.table_name, "storage_2100_02")
+            eq_(table_exists(expired), False)
+        d.addCallback(rotate)
+        d.addCallback(check)
+        return d
+
+    def test_rotate_storage_ahead(self):
+        settings = self._settings(storage_rotation=True, preflight=False)
+        now = datetime.datetime.utcnow()
+        d = settings.start_db()
+
+        def rotate(result):
+            self.current = settings.rotating_storage.current
+            # An hour before the next month begins
+            year, month = divmod(now.year * 12 + now.month, 12)
+            ahead = datetime.datetime(year, month + 1, 1)
+            self.ahead = rotating_tablename("storage", ahead)
+            return settings.rotate_storage(
+                ahead - datetime.timedelta(hours=1))
+
+        def check(result):
+            eq_(settings.rotating_storage.current, self.current)
+            eq_(table_exists(Table(self.ahead)), True)
+        d.addCallback(rotate)
+        d.addCallback(check)
+        return d
+
+    def test_start_storage_rotation(self):
+        settings = Mock(rotating_storage=None)
+        eq_(start_storage_rotation(settings), None)
+        settings.rotating_storage = Mock()
+        with patch("autopush.main.task"):
+            rotation = start_storage_rotation(settings)
+        rotation.start.assert_called_with(3600, now=False)
+
+    def test_start_cost_reporting(self):
+        settings = Mock(db_costs=None)
+        eq_(start_cost_reporting(settings), None)
+        settings.db_costs = Mock()
+        with patch("autopush.main.task") as mock_task:
+            reporting = start_cost_reporting(settings)
+        mock_task.LoopingCall.assert_called_with(settings.db_costs.report)
+        reporting.start.assert_called_with(10, now=False)
+
+    def test_start_ping_sweeper(self):
+        settings = Mock(ping_sweeper=None)
+        eq_(start_ping_sweeper(settings), None)
+        settings.ping_sweeper = Mock()
+        eq_(start_ping_sweeper(settings),
+            settings.ping_sweeper.start.return_value)
+
+    @patch("autopush.main.log")
+    def test_rotate_storage_failed(self, mock_log):
+        settings = Mock()
+        settings.rotate_storage.return_value = fail(ValueError("no"))
+        rotate_storage(settings)
+        eq_(mock_log.err.call_count, 1)
+
+    @patch("autopush.main.reactor")
+    @patch("autopush.main.log")
+    def test_startup_failed(self, mock_log, mock_reactor):
+        startup_failed(Mock())
+        eq_(len(mock_log.err.mock_calls), 1)
+        mock_reactor.stop.assert_called_with()
+
+
 class ConnectionMainTestCase(unittest.TestCase):
     def setUp(self):
         patchers = [
@@ -81,6 +345,8 @@ class ConnectionMainTestCase(unittest.TestCase):
 
     def test_basic(self):
         connection_main([])
+        eq_(len(self.mocks["autopush.main.reactor"].callWhenRunning
+                .mock_calls), 1)
 
     def test_ssl(self):
         connection_main([
@@ -91,6 +357,37 @@ class ConnectionMainTestCase(unittest.TestCase):
             "--router_ssl_key=keys/server.key",
         ])
 
+    @patch("autopush.main.supervise")
+    def test_workers(self, mock_supervise):
+        connection_main(["--workers=2", "--port=9000"])
+        supervisor = mock_supervise.call_args[0][0]
+        eq_(supervisor.command[-2:], ["--workers=2", "--port=9000"])
+        eq_(supervisor.count, 2)
+        eq_(len(self.mocks["autopush.main.reactor"].listenTCP.mock_calls), 0)
+
+    def test_memory_workers(self):
+        with patch("sys.stderr"):
+            self.assertRaises(SystemExit, connection_main,
+                              ["--workers=2", "--db_backend=memory"])
+
+    def test_worker_tags(self):
+        args = Mock(worker_index=None)
+        eq_(worker_tags(args), None)
+        args.worker_index = 2
+        eq_(worker_tags(args), ["worker:2"])
+
+    @patch("autopush.main.adopt_socket")
+    @patch("autopush.main.reuseport_socket")
+    def test_worker(self, mock_socket, mock_adopt):
+        connection_main(["--workers=2", "--worker_index=1"])
+        mock_socket.assert_called_with(8080)
+        eq_(mock_adopt.call_args[0][0], mock_socket.return_value)
+        self.mocks["autopush.main.reactor"].listenTCP.assert_called_with(
+            8082, ANY)
+        settings = mock_adopt.call_args[0][1].protocol.ap_settings
+        eq_(settings.router_url, "http://%s:8082" % settings.hostname)
+        eq_(settings.metrics.tags, ["worker:1"])
+
     def test_skip_logging(self):
         # Should skip setting up logging on the handler
         mock_handler = Mock()
@@ -98,13 +395,108 @@ class ConnectionMainTestCase(unittest.TestCase):
         eq_(len(mock_handler.mock_calls), 0)
 
 
+class PushClient(WebSocketClientProtocol):
+    def onOpen(self):
+        self.messages = DeferredQueue()
+        self.factory.opened.callback(self)
+
+    def onMessage(self, payload, isBinary):
+        self.messages.put(json.loads(payload))
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.closed.callback(None)
+
+    def send(self, **msg):
+        self.sendMessage(json.dumps(msg))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class CombinedMainTestCase(unittest.TestCase):
+    @patch("autopush.main.task")
+    @patch("autopush.main.reactor")
+    @patch("autopush.main.setup_logging")
+    @patch("autopush.settings.TwistedMetrics")
+    def test_combined(self, mock_metrics, mock_logging, mock_reactor,
+                      mock_task):
+        combined_main(["--endpoint_port=8082"])
+        ports = [args[0] for args, _ in mock_reactor.listenTCP.call_args_list]
+        eq_(ports, [8080, 8081, 8082])
+        eq_(len(mock_reactor.callWhenRunning.mock_calls), 2)
+        mock_reactor.run.assert_called_with()
+
+    def test_workers(self):
+        with patch("sys.stderr"):
+            self.assertRaises(SystemExit, combined_main, ["--workers=2"])
+
+
+class CombinedPushTestCase(trial.TestCase):
+    def setUp(self):
+        # moto swaps out the socket module, the memory backend needs
+        # real connections instead
+        mock_dynamodb2.stop()
+        self.addCleanup(mock_dynamodb2.start)
+        txaio.use_twisted()
+
+    @inlineCallbacks
+    def test_push(self):
+        port, router_port, endpoint_port = [free_port() for _ in range(3)]
+        args, _ = _parse_connection([
+            "--db_backend=memory", "--statsd_host=",
+            "--hostname=127.0.0.1", "--port=%d" % port,
+            "--router_port=%d" % router_port,
+            "--endpoint_port=%d" % endpoint_port,
+        ])
+        settings, endpoint_settings, ports = start_combined(args)
+        for listening in ports:
+            self.addCleanup(listening.stopListening)
+        for node_settings in (settings, endpoint_settings):
+            self.addCleanup(node_settings.agent._pool.closeCachedConnections)
+
+        factory = WebSocketClientFactory("ws://127.0.0.1:%d/" % port)
+        factory.protocol = PushClient
+        factory.opened, factory.closed = Deferred(), Deferred()
+        connectWS(factory)
+        client = yield factory.opened
+        self.addCleanup(lambda: factory.closed)
+        self.addCleanup(client.transport.loseConnection)
+
+        client.send(messageType="hello", channelIDs=[])
+        msg = yield client.messages.get()
+        eq_(msg["status"], 200)
+        chid = str(uuid.uuid4())
+        client.send(messageType="register", channelID=chid)
+        msg = yield client.messages.get()
+        eq_(msg["status"], 200)
+
+        # The endpoint finds the client the connection node registered
+        response = yield Agent(reactor).request(
+            "PUT", msg["pushEndpoint"].encode("utf8"),
+            Headers({"Content-Type": ["application/x-www-form-urlencoded"]}),
+            FileBodyProducer(StringIO("version=12")))
+        eq_(response.code, 200)
+        msg = yield client.messages.get()
+        eq_(msg["messageType"], "notification")
+        update = msg["updates"][0]
+        eq_(update["channelID"], chid)
+        eq_(update["version"], 12)
+        client.send(messageType="ack", updates=msg["updates"])
+
+
 class EndpointMainTestCase(unittest.TestCase):
     def setUp(self):
         patchers = [
             "autopush.main.task",
             "autopush.main.reactor",
             "autopush.settings.TwistedMetrics",
-            "autopush.settings.preflight_check",
+            "autopush.settings.preflight_storage",
+            "autopush.settings.preflight_router",
         ]
         self.mocks = {}
         for name in patchers:
@@ -125,6 +517,39 @@ class EndpointMainTestCase(unittest.TestCase):
             "--ssl_key=keys/server.key",
         ])
 
+    @patch("autopush.main.supervise")
+    @patch("autopush.main.listening_socket")
+    def test_workers(self, mock_socket, mock_supervise):
+        mock_socket.return_value.fileno.return_value = 7
+        endpoint_main(["--workers=2"])
+        mock_socket.assert_called_with(8082)
+        supervisor = mock_supervise.call_args[0][0]
+        eq_(supervisor.command[-1], "--listen_fd=7")
+        eq_(supervisor.child_fds[7], 7)
+        eq_(mock_supervise.call_args[1], dict(rotate=True))
+        self.mocks["autopush.main.reactor"].listenTCP.assert_called_with(
+            8090, ANY)
+
+    def test_memory_workers(self):
+        with patch("sys.stderr"):
+            self.assertRaises(SystemExit, endpoint_main,
+                              ["--workers=2", "--db_backend=memory"])
+
+    @patch("autopush.main.adopt_socket")
+    @patch("autopush.main.inherited_socket")
+    def test_worker(self, mock_inherited, mock_adopt):
+        endpoint_main(["--workers=2", "--worker_index=1", "--listen_fd=7"])
+        mock_inherited.assert_called_with(7)
+        mock_reactor = self.mocks["autopush.main.reactor"]
+        mock_reactor.listenTCP.assert_called_with(8092, ANY,
+                                                  interface="127.0.0.1")
+        site = mock_reactor.listenTCP.call_args[0][1]
+        eq_(mock_adopt.call_args[0][1], site)
+        mock_reactor.addSystemEventTrigger.assert_called_with(
+            "before", "shutdown", drain,
+            [mock_adopt.return_value, mock_reactor.listenTCP.return_value],
+            10)
+
     def test_ping_settings(self):
         class arg:
             # important stuff
@@ -152,9 +577,30 @@ class EndpointMainTestCase(unittest.TestCase):
             storage_write_throughput = 0
             router_read_throughput = 0
             router_write_throughput = 0
+            router_shards = 1
+            storage_shards = 1
+            shard_migration = False
+            storage_rotation = False
+            storage_retention = 3
+            compact_items = False
+            compact_migration = False
+            storage_map = False
+            storage_map_migration = False
+            db_backend = "dynamodb"
+            db_metrics = False
+            db_costs = False
+            db_costs_window = 60
             resolve_hostname = False
+            async_dynamodb = False
+            dynamodb_max_connections = 50
+            db_throttle = False
+            db_throttle_max_rate = 1000
+            db_throttle_max_queue = 1000
+            eventual_reads = "endpoint, fetch"
+            skip_preflight = False
 
         ap = make_settings(arg)
         eq_(ap.routers["gcm"].gcm.api_key, arg.gcm_apikey)
         eq_(ap.routers["apns"].apns.cert_file, arg.apns_cert_file)
         eq_(ap.routers["apns"].apns.key_file, arg.apns_key_file)
+        eq_(ap.read_policy.eventual, frozenset(["endpoint", "fetch"]))
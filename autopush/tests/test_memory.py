@@ -0,0 +1,104 @@
+import unittest
+import uuid
+
+from boto.dynamodb2.exceptions import ItemNotFound
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.trial import unittest as trial
+
+from autopush.db import deferToDB
+from autopush.memory import (
+    MemoryBackend,
+    MemoryRouter,
+    MemoryStorage,
+)
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage(Mock())
+        self.uaid = str(uuid.uuid4())
+
+    def test_save_fetch(self):
+        storage = self.storage
+        eq_(storage.fetch_notifications(self.uaid), [])
+        ok_(storage.save_notification(self.uaid, "b", 10))
+        ok_(storage.save_notification(self.uaid, "a", 12))
+        eq_(storage.save_notification(self.uaid, "a", 11), False)
+        eq_(storage.save_notification(self.uaid, "a", 12), False)
+        eq_([(n["chid"], n["version"])
+             for n in storage.fetch_notifications(self.uaid)],
+            [("a", 12), ("b", 10)])
+
+    def test_fetch_page(self):
+        for chid in "abc":
+            self.storage.save_notification(self.uaid, chid, 10)
+        page, key = self.storage.fetch_notifications_page(self.uaid, 2)
+        eq_([n["chid"] for n in page], ["a", "b"])
+        page, key = self.storage.fetch_notifications_page(self.uaid, 2, key)
+        eq_(([n["chid"] for n in page], key), (["c"], None))
+
+    def test_delete(self):
+        storage = self.storage
+        storage.save_notification(self.uaid, "a", 10)
+        storage.save_notification(self.uaid, "b", 10)
+        ok_(storage.delete_notification(self.uaid, "a", 11))
+        eq_(len(storage.fetch_notifications(self.uaid)), 2)
+        ok_(storage.delete_notification(self.uaid, "a", 10))
+        ok_(storage.delete_notifications([(self.uaid, "b"),
+                                          (self.uaid, "c")]))
+        eq_(storage.table, {})
+
+
+class MemoryRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = MemoryRouter(Mock())
+        self.uaid = str(uuid.uuid4())
+
+    def _register(self, connected_at, node_id="http://node"):
+        return self.router.register_user(dict(
+            uaid=self.uaid, node_id=node_id, connected_at=connected_at))
+
+    def test_register(self):
+        router = self.router
+        self.assertRaises(ItemNotFound, router.get_uaid, self.uaid)
+        eq_(self._register(10), (True, {}))
+        eq_(self._register(5), (False, {}))
+        eq_(self._register(10), (False, {}))
+        result, old = self._register(20, "http://other")
+        ok_(result)
+        eq_(old["node_id"], "http://node")
+        eq_(router.get_uaid(self.uaid)["node_id"], "http://other")
+        eq_(router.get_uaids([self.uaid, "missing"]).keys(), [self.uaid])
+
+    def test_get_uaid_copy(self):
+        self._register(10)
+        self.router.get_uaid(self.uaid)["node_id"] = "changed"
+        eq_(self.router.get_uaid(self.uaid)["node_id"], "http://node")
+
+    def test_clear_node(self):
+        router = self.router
+        self._register(10)
+        item = router.get_uaid(self.uaid)
+        self._register(20)
+        eq_(router.clear_node(item), False)
+        ok_(router.clear_node(router.get_uaid(self.uaid)))
+        eq_(router.get_uaid(self.uaid), dict(uaid=self.uaid))
+        eq_(self._register(5), (True, dict(uaid=self.uaid)))
+
+
+class MemoryBackendTestCase(trial.TestCase):
+    def test_open(self):
+        backend = MemoryBackend()
+        storage, router = backend.open(Mock())
+        backend.preflight(storage, router)
+        storage.save_notification("uaid", "chid", 10)
+        eq_(backend.open(Mock())[0].fetch_notifications("uaid")[0]["version"],
+            10)
+
+    def test_deferred(self):
+        storage = MemoryStorage(Mock())
+        d = deferToDB(storage.save_notification, "uaid", "chid", 10)
+        # Called directly in the reactor, not the thread pool
+        eq_(storage.table, {"uaid": {"chid": 10}})
+        return d.addCallback(eq_, True)
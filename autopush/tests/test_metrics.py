@@ -12,6 +12,7 @@ from autopush.metrics import (
     DatadogMetrics,
     TwistedMetrics,
     SinkMetrics,
+    TaggedMetrics,
 )
 
 
@@ -33,6 +34,23 @@ class SinkMetricsTestCase(unittest.TestCase):
         eq_(None, sm.timing("test", 10))
 
 
+class TaggedMetricsTestCase(unittest.TestCase):
+    def test_tags(self):
+        metrics = Mock()
+        tm = TaggedMetrics(metrics, ["table:router_0"])
+        tm.start()
+        tm.increment("test")
+        metrics.increment.assert_called_with("test", 1,
+                                             tags=["table:router_0"])
+        tm.gauge("test", 10, tags=["extra"])
+        metrics.gauge.assert_called_with("test", 10,
+                                         tags=["table:router_0", "extra"])
+        tm.timing("test", 10)
+        metrics.timing.assert_called_with("test", 10,
+                                          tags=["table:router_0"])
+        eq_(len(metrics.start.mock_calls), 1)
+
+
 class TwistedMetricsTestCase(unittest.TestCase):
     @patch("autopush.metrics.reactor")
     def test_basic(self, mock_reactor):
@@ -0,0 +1,177 @@
+import unittest
+import uuid
+
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException
+from boto.dynamodb2.table import Table
+from mock import Mock
+from moto import mock_dynamodb2
+from nose.tools import eq_, ok_
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+    table_exists,
+)
+from autopush.reaper import (
+    RateLimiter,
+    Reaper,
+    consumed_units,
+    main,
+)
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+NOW = 1000000000
+DAY = 86400
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_acquire(self):
+        clock = Mock(return_value=10.0)
+        sleep = Mock()
+        limiter = RateLimiter(10, clock=clock, sleep=sleep)
+        limiter.acquire(10)
+        eq_(len(sleep.mock_calls), 0)
+        limiter.acquire(5)
+        sleep.assert_called_with(0.5)
+        clock.return_value = 11.5
+        limiter.acquire(5)
+        eq_(len(sleep.mock_calls), 1)
+
+    def test_unlimited(self):
+        sleep = Mock()
+        RateLimiter(0, sleep=sleep).acquire(100)
+        eq_(len(sleep.mock_calls), 0)
+
+
+class ReaperTestCase(unittest.TestCase):
+    def setUp(self):
+        suffix = uuid.uuid4().hex
+        self.router = get_router_table("router_%s" % suffix)
+        self.storage = get_storage_table("storage_%s" % suffix)
+
+    def _reaper(self, **kwargs):
+        return Reaper([self.router], [self.storage], 30 * DAY, segments=1,
+                      clock=lambda: NOW, **kwargs)
+
+    def _compact(self):
+        suffix = uuid.uuid4().hex
+        self.router = get_router_table("router_%s" % suffix, compact=True)
+        self.storage = get_storage_table("storage_%s" % suffix,
+                                         compact=True)
+
+    def _connect(self, days_ago, notifications=0, connected=False):
+        uaid = str(uuid.uuid4())
+        last_connect = (NOW - days_ago * DAY) * 1000
+        item = dict(uaid=uaid, last_connect=last_connect)
+        if connected:
+            item.update(node_id="http://node", connected_at=last_connect)
+        self.router.put_item(data=item)
+        for _ in range(notifications):
+            self.storage.put_item(data=dict(uaid=uaid,
+                                            chid=str(uuid.uuid4()),
+                                            version=10))
+        return uaid
+
+    def _stored(self, uaid):
+        return len(list(self.storage.query_2(uaid__eq=uaid)))
+
+    def test_consumed_units(self):
+        eq_(consumed_units({}), 0)
+        eq_(consumed_units({"ConsumedCapacity": {"CapacityUnits": 2.5}}),
+            2.5)
+        eq_(consumed_units({"ConsumedCapacity": [{"CapacityUnits": 1},
+                                                 {"CapacityUnits": 2}]}), 3)
+
+    def test_reap(self):
+        idle = self._connect(40, notifications=30)
+        active = self._connect(1, notifications=2)
+        unknown = str(uuid.uuid4())
+        self.router.put_item(data=dict(uaid=unknown))
+
+        counts = self._reaper().run()
+        eq_(counts["idle"], 1)
+        eq_(counts["reaped"], 1)
+        eq_(counts["rows_freed"], 31)
+        eq_(self._stored(idle), 0)
+        eq_(self._stored(active), 2)
+        eq_(sorted(item["uaid"] for item in self.router.scan()),
+            sorted([active, unknown]))
+
+    def test_reap_compact(self):
+        self._compact()
+        idle = self._connect(40, notifications=3)
+        active = self._connect(1)
+        counts = self._reaper().run()
+        eq_((counts["reaped"], counts["rows_freed"]), (1, 4))
+        eq_(self._stored(idle), 0)
+        eq_([item["uaid"] for item in self.router.scan()], [active])
+
+    def test_dry_run(self):
+        idle = self._connect(40, notifications=2)
+        counts = self._reaper(dry_run=True).run()
+        eq_((counts["idle"], counts["reaped"]), (1, 0))
+        eq_(self._stored(idle), 2)
+
+    def test_reconnected_skipped(self):
+        uaid = self._connect(40, notifications=2)
+        reaper = self._reaper()
+        self.router.connection.delete_item = Mock(
+            side_effect=ConditionalCheckFailedException(None, None))
+        counts = reaper.run()
+        eq_((counts["idle"], counts["skipped"], counts["reaped"]), (1, 1, 0))
+        # The notifications go first, the router item stays to be scanned
+        eq_(self._stored(uaid), 0)
+        eq_([item["uaid"] for item in self.router.scan()], [uaid])
+
+    def test_connected_skipped(self):
+        uaid = self._connect(40, notifications=2, connected=True)
+        counts = self._reaper().run()
+        eq_((counts["idle"], counts["skipped"], counts["reaped"]), (1, 1, 0))
+        eq_(self._stored(uaid), 2)
+        eq_([item["uaid"] for item in self.router.scan()], [uaid])
+
+    def test_hello_since_scan_skipped(self):
+        uaid = self._connect(40, notifications=2)
+        scanned = str((NOW - 50 * DAY) * 1000)
+        eq_(self._reaper().reap(self.router, uaid, scanned), (0, False))
+        eq_(self._stored(uaid), 2)
+
+    def test_unprocessed_resent(self):
+        uaid = self._connect(40)
+        storage = Mock()
+        storage.table_name = "storage"
+        storage.connection.query.return_value = {"Items": [
+            {"uaid": {"S": uaid}, "chid": {"S": "a"}}]}
+        unprocessed = {"UnprocessedItems": {"storage": [
+            {"DeleteRequest": {"Key": {"uaid": {"S": uaid}}}}]}}
+        storage.connection.batch_write_item.side_effect = [
+            unprocessed, {"ConsumedCapacity": [{"CapacityUnits": 1}]}]
+        reaper = Reaper([self.router], [storage], 30 * DAY, segments=1,
+                        clock=lambda: NOW)
+        eq_(reaper.delete_notifications(storage, uaid), 1)
+        eq_(storage.connection.batch_write_item.call_count, 2)
+        eq_(reaper.counts["write_capacity"], 1)
+
+    def test_main(self):
+        name = uuid.uuid4().hex
+        counts = main(["--router_tablename=router_%s" % name,
+                       "--storage_tablename=storage_%s" % name,
+                       "--segments=1", "--dry_run=true"])
+        eq_(counts["idle"], 0)
+
+    def test_main_compact(self):
+        name = uuid.uuid4().hex
+        main(["--router_tablename=router_%s" % name,
+              "--storage_tablename=storage_%s" % name,
+              "--compact_items=true", "--segments=1", "--dry_run=true"])
+        ok_(table_exists(Table("router_%s_compact" % name)))
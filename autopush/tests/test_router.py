@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
+import json
 import uuid
 
 from mock import Mock, PropertyMock
@@ -11,7 +12,9 @@ from twisted.internet.error import ConnectError
 import apns
 import gcmclient
 
+from autopush.costs import CostLedger, acting, current_action
 from autopush.db import (
+    ReadPolicy,
     Router,
     Storage,
     ProvisionedThroughputExceededException,
@@ -393,6 +396,37 @@ class SimplePushRouterTestCase(unittest.TestCase):
         d.addBoth(verify_deliver)
         return d
 
+    def test_route_check_names_stored_version(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 202
+        self.storage_mock.save_notification.return_value = True
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        self.router_mock.get_uaid.return_value = router_data
+
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_check(result):
+            args, kwargs = self.agent_mock.request.call_args
+            eq_(args, ("PUT", "http://somewhere/notif/" + dummy_uaid))
+            body = kwargs["bodyProducer"]._inputFile.getvalue()
+            eq_(json.loads(body), {"channelID": dummy_chid, "version": 10})
+        d.addCallback(verify_check)
+        return d
+
+    def test_route_to_busy_node_invalidates_cached_node(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 404
+        self.storage_mock.save_notification.return_value = True
+        self.router_mock.get_uaid.return_value = dict()
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 202)
+            self.router_mock.invalidate.assert_called_with(dummy_uaid)
+        d.addBoth(verify_deliver)
+        return d
+
     def test_route_to_busy_node_saves_looks_up_and_send_check_fails(self):
         import autopush.router.simple as simple
         response_mock = Mock()
@@ -457,3 +491,59 @@ class SimplePushRouterTestCase(unittest.TestCase):
             )
         d.addBoth(verify_deliver)
         return d
+
+    def test_route_outcome(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        type(response_mock).code = PropertyMock(
+            side_effect=MockAssist([202, 200]))
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        self.router_mock.get_uaid.return_value = router_data
+        actions = []
+
+        def save_notification(**kwargs):
+            actions.append(current_action())
+            return True
+        self.storage_mock.save_notification.side_effect = save_notification
+        action = CostLedger(Mock()).start("push")
+
+        with acting(action):
+            d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            eq_(actions, [action])
+            eq_(action.label, "push.notified")
+        d.addCallback(verify_deliver)
+        return d
+
+    def test_stale_node(self):
+        import autopush.router.simple as simple
+        ok_(simple.stale_node(dict(uaid=dummy_uaid)))
+        ok_(not simple.stale_node(dict(uaid=dummy_uaid, connected_at=1234)))
+        node_id = "http://dead.%s" % uuid.uuid4().hex
+        simple.dead_cache.put(simple.node_key(node_id), True)
+        ok_(simple.stale_node(dict(uaid=dummy_uaid, connected_at=1234,
+                                   node_id=node_id)))
+
+    def test_route_eventual_lookup_falls_back(self):
+        settings = self.router.ap_settings
+        settings.read_policy = ReadPolicy(Mock(), eventual=["router"])
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        response_mock.code = 200
+        self.storage_mock.save_notification.return_value = True
+        self.router_mock.get_uaid.side_effect = [
+            dict(uaid=dummy_uaid),
+            dict(uaid=dummy_uaid, node_id="http://somewhere",
+                 connected_at=1234),
+        ]
+
+        d = self.router.route_notification(self.notif, dict(uaid=dummy_uaid))
+
+        def verify_deliver(result):
+            eq_(result.status_code, 200)
+            calls = self.router_mock.get_uaid.call_args_list
+            eq_([call[1] for call in calls], [{"consistent": False}, {}])
+            self.router_mock.invalidate.assert_called_with(dummy_uaid)
+        d.addCallback(verify_deliver)
+        return d
@@ -0,0 +1,103 @@
+import unittest
+import uuid
+
+from moto import mock_dynamodb2
+from nose.tools import eq_
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+    shard_index,
+    shard_tablenames,
+)
+from autopush.shard import (
+    RouterMigration,
+    StorageMigration,
+    main,
+)
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+class MigrationTestCase(unittest.TestCase):
+    def _shards(self, get_table, name):
+        return [get_table(shard_name)
+                for shard_name in shard_tablenames(name, 2)]
+
+    def test_router_migration(self):
+        name = "router_%s" % uuid.uuid4().hex
+        source = get_router_table(name)
+        shards = self._shards(get_router_table, name)
+        moved, newer = str(uuid.uuid4()), str(uuid.uuid4())
+        source.put_item(data=dict(uaid=moved, node_id="http://old",
+                                  connected_at=10))
+        source.put_item(data=dict(uaid=newer, node_id="http://old",
+                                  connected_at=10))
+        newer_shard = shards[shard_index(newer, 2)]
+        newer_shard.put_item(data=dict(uaid=newer, node_id="http://new",
+                                       connected_at=20))
+
+        counts = RouterMigration(source, shards, segments=1,
+                                 delete=True).run()
+        eq_(counts, dict(scanned=2, copied=1, skipped=1, deleted=2))
+        item = shards[shard_index(moved, 2)].get_item(uaid=moved)
+        eq_(item["node_id"], "http://old")
+        eq_(newer_shard.get_item(uaid=newer)["node_id"], "http://new")
+        eq_(list(source.scan()), [])
+
+    def test_storage_migration(self):
+        name = "storage_%s" % uuid.uuid4().hex
+        source = get_storage_table(name)
+        shards = self._shards(get_storage_table, name)
+        uaid = str(uuid.uuid4())
+        source.put_item(data=dict(uaid=uaid, chid="a", version=10))
+        source.put_item(data=dict(uaid=uaid, chid="b", version=12))
+        shard = shards[shard_index(uaid, 2)]
+
+        counts = StorageMigration(source, shards, segments=1).run()
+        eq_(counts, dict(scanned=2, copied=2, skipped=0, deleted=0))
+        versions = dict((item["chid"], item["version"])
+                        for item in shard.query_2(uaid__eq=uaid))
+        eq_(versions, {"a": 10, "b": 12})
+        eq_(len(list(source.scan())), 2)
+
+    def test_storage_copy_skips_deleted(self):
+        name = "storage_%s" % uuid.uuid4().hex
+        source = get_storage_table(name)
+        shards = self._shards(get_storage_table, name)
+        uaid = str(uuid.uuid4())
+        source.put_item(data=dict(uaid=uaid, chid="a", version=10))
+        source.put_item(data=dict(uaid=uaid, chid="b", version=10))
+        migration = StorageMigration(source, shards, segments=1)
+        scanned = dict((item["chid"], item) for item in source.scan())
+
+        # Acked and deleted, or replaced, since the scan
+        source.delete_item(uaid=uaid, chid="a")
+        source.put_item(data=dict(uaid=uaid, chid="b", version=12),
+                        overwrite=True)
+        shard = shards[shard_index(uaid, 2)]
+        eq_(migration.copy(scanned["a"], shard), False)
+        eq_(migration.copy(scanned["b"], shard), False)
+        eq_(list(shard.query_2(uaid__eq=uaid)), [])
+
+    def test_main_unsharded(self):
+        main(["--router_tablename=router_%s" % uuid.uuid4().hex,
+              "--storage_tablename=storage_%s" % uuid.uuid4().hex])
+
+    def test_main(self):
+        name = "router_%s" % uuid.uuid4().hex
+        get_router_table(name).put_item(data=dict(uaid=str(uuid.uuid4()),
+                                                  connected_at=10))
+        main(["--router_tablename=%s" % name, "--router_shards=2",
+              "--segments=1", "--skip_storage=true"])
+        eq_(sum(len(list(shard.scan())) for shard in
+                self._shards(get_router_table, name)), 1)
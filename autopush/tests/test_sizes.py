@@ -0,0 +1,66 @@
+import unittest
+import uuid
+
+from moto import mock_dynamodb2
+from nose.tools import eq_, ok_
+
+from autopush.db import (
+    get_router_table,
+    get_storage_table,
+)
+from autopush.sizes import (
+    compact_item,
+    item_size,
+    main,
+    measure,
+)
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+class SizesTestCase(unittest.TestCase):
+    def test_item_size(self):
+        eq_(item_size({"uaid": {"S": "abc"}}), 7)
+        eq_(item_size({"b": {"B": "AAAA"}}), 4)
+        eq_(item_size({"n": {"N": "12345"}}), 5)
+        eq_(item_size({"m": {"M": {"a": {"S": "x"}}}}), 7)
+        eq_(item_size({"l": {"L": [{"BOOL": True}, {"NULL": True}]}}), 8)
+
+    def test_compact_item(self):
+        uaid = str(uuid.uuid4())
+        raw = {"uaid": {"S": uaid}, "node_id": {"S": "http://node:8082"},
+               "connected_at": {"N": "1450000000000"}}
+        compact = compact_item(raw)
+        eq_(compact["node_id"], {"N": "1000"})
+        eq_(item_size(raw) - item_size(compact), (36 - 16) + (16 - 2))
+
+    def test_measure(self):
+        items = [{"data": {"S": "x" * 1500}}, {"data": {"S": "x" * 3000}}]
+        eq_(measure(items), dict(size=4508, write_units=5, read_units=2))
+
+    def test_main(self):
+        name = uuid.uuid4().hex
+        router = get_router_table("router_%s" % name)
+        storage = get_storage_table("storage_%s" % name)
+        uaid = str(uuid.uuid4())
+        router.put_item(data=dict(uaid=uaid, node_id="http://node",
+                                  connected_at=10))
+        for _ in range(3):
+            storage.put_item(data=dict(uaid=uaid, chid=str(uuid.uuid4()),
+                                       version=10))
+        reports = main(["--router_tablename=router_%s" % name,
+                        "--storage_tablename=storage_%s" % name,
+                        "--sample=2"])
+        report = reports["storage_%s" % name]
+        eq_(report["items"], 2)
+        ok_(report["compact"]["size"] < report["original"]["size"])
+        eq_(reports["router_%s" % name]["items"], 1)
@@ -0,0 +1,50 @@
+import unittest
+import uuid
+
+from mock import Mock
+from moto import mock_dynamodb2
+from nose.tools import eq_
+
+from autopush.db import get_storage_table
+from autopush.storagemap import (
+    MapMigration,
+    main,
+)
+
+
+mock_dynamodb2 = mock_dynamodb2()
+
+
+def setUp():
+    mock_dynamodb2.start()
+
+
+def tearDown():
+    mock_dynamodb2.stop()
+
+
+class MapMigrationTestCase(unittest.TestCase):
+    def test_migration(self):
+        source = get_storage_table("storage_%s" % uuid.uuid4().hex)
+        uaid = str(uuid.uuid4())
+        source.put_item(data=dict(uaid=uaid, chid="a", version=10))
+        source.put_item(data=dict(uaid=uaid, chid="b", version=12))
+        target = Mock()
+        target.table_name = "storage_map"
+        target._encode_keys.side_effect = lambda key: key
+
+        counts = MapMigration(source, [target], segments=1,
+                              delete=True).run()
+        eq_(counts, dict(scanned=2, copied=2, skipped=0, deleted=2))
+        versions = dict(
+            (call[1]["expression_attribute_names"]["#chid"],
+             call[1]["expression_attribute_values"][":ver"]["N"])
+            for call in target.connection.update_item.call_args_list)
+        eq_(versions, {"a": "10", "b": "12"})
+        eq_(list(source.scan()), [])
+
+    def test_main(self):
+        name = "storage_%s" % uuid.uuid4().hex
+        counts = main(["--storage_tablename=%s" % name,
+                       "--storage_shards=2", "--segments=1"])
+        eq_([count["scanned"] for count in counts], [0, 0])
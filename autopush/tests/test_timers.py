@@ -0,0 +1,90 @@
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet import task
+
+from autopush.timers import TimerWheel
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.metrics = Mock()
+        self.wheel = TimerWheel(self.metrics, resolution=0.1, slots=4,
+                                levels=3, clock=self.clock)
+
+    def _advance(self, seconds):
+        for _ in range(int(round(seconds / 0.1))):
+            self.clock.advance(0.1)
+
+    def test_fire(self):
+        func = Mock()
+        timer = self.wheel.call_later(0.25, func, 1, two=2)
+        eq_(self.wheel.pending, 1)
+        self._advance(0.2)
+        eq_(len(func.mock_calls), 0)
+        self._advance(0.1)
+        func.assert_called_with(1, two=2)
+        eq_(timer.active(), False)
+        eq_(self.wheel.pending, 0)
+        # The ticker stops once nothing is pending
+        eq_(self.clock.getDelayedCalls(), [])
+
+    def test_cascade(self):
+        fired = []
+        # Beyond the first level (0.4s) and the second one (1.6s)
+        for delay in (0.3, 1.0, 2.5, 10.0):
+            self.wheel.call_later(delay, lambda d=delay: fired.append(
+                (d, self.clock.seconds())))
+        self._advance(11)
+        eq_([d for d, _ in fired], [0.3, 1.0, 2.5, 10.0])
+        for delay, when in fired:
+            lag = when - 1000 - delay
+            self.assertTrue(0 <= lag < 0.1 + 1e-9, (delay, lag))
+
+    def test_cancel(self):
+        func = Mock()
+        timer = self.wheel.call_later(1.0, func)
+        other = self.wheel.call_later(1.0, Mock())
+        timer.cancel()
+        timer.cancel()
+        eq_(self.wheel.pending, 1)
+        self._advance(1.1)
+        eq_(len(func.mock_calls), 0)
+        eq_(other.active(), False)
+
+    def test_restart(self):
+        func = Mock()
+        self.wheel.call_later(0.1, func)
+        self._advance(0.5)
+        eq_(self.clock.getDelayedCalls(), [])
+        # Idle time is skipped rather than ticked through
+        self.clock.advance(100)
+        self.wheel.call_later(0.1, func)
+        # Up to a tick late
+        self._advance(0.2)
+        eq_(len(func.mock_calls), 2)
+
+    def test_report(self):
+        self.wheel.call_later(0.05, Mock())
+        self.wheel.call_later(5, Mock())
+        self._advance(0.1)
+        self.wheel.report()
+        gauges = dict(call[1] for call in self.metrics.gauge.mock_calls)
+        eq_(gauges["timers.pending"], 1)
+        self.assertAlmostEqual(gauges["timers.lag.avg"], 50)
+        self.assertAlmostEqual(gauges["timers.lag.max"], 50)
+        self.metrics.reset_mock()
+        self.wheel.report()
+        eq_(len(self.metrics.gauge.mock_calls), 1)
+
+    def test_exception(self):
+        func = Mock()
+        self.wheel.call_later(0.1, Mock(side_effect=KeyError("boom")))
+        self.wheel.call_later(0.1, func)
+        with patch("autopush.timers.log") as mock_log:
+            self._advance(0.1)
+        eq_(len(mock_log.err.mock_calls), 1)
+        eq_(len(func.mock_calls), 1)
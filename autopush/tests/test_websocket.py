@@ -16,12 +16,14 @@ from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError
 from twisted.trial import unittest
 
+from autopush.costs import CostLedger, current_action
+from autopush.db import ReadPolicy
+from autopush.memory import MemoryStorage
 from autopush.settings import AutopushSettings
 from autopush.websocket import (
     SimplePushServerProtocol,
     RouterHandler,
     NotificationHandler,
-    WebSocketServerProtocol,
 )
 
 
@@ -101,46 +103,83 @@ class WebsocketTestCase(unittest.TestCase):
 
         req.headers.get.assert_called_with("user-agent")
 
-    @patch("autopush.websocket.reactor")
-    def test_autoping_no_uaid(self, mock_reactor):
-        # restore our sendClose
-        WebSocketServerProtocol.sendClose = self.proto.sendClose
-        WebSocketServerProtocol._sendAutoPing = Mock()
-        self.proto.sendClose = self.orig_close
+    def test_autoping_new_connection(self):
         self._connect()
-        self.proto._sendAutoPing()
-        mock_reactor.callLater.assert_called()
-        WebSocketServerProtocol.sendClose.assert_called()
+        now = self.proto.connected_at / 1000.0 + 1
+        eq_(self.proto.sweep_ping(now, 30), False)
+        eq_(len(self.close_mock.mock_calls), 0)
 
-    @patch("autopush.websocket.reactor")
-    def test_autoping_uaid_not_in_clients(self, mock_reactor):
-        # restore our sendClose
-        WebSocketServerProtocol.sendClose = self.proto.sendClose
-        WebSocketServerProtocol._sendAutoPing = Mock()
-        self.proto.sendClose = self.orig_close
+    def test_autoping_no_uaid(self):
+        self._connect()
+        now = self.proto.connected_at / 1000.0 + 30
+        eq_(self.proto.sweep_ping(now, 30), False)
+        self.close_mock.assert_called_with()
+        self.proto.metrics.increment.assert_called_with(
+            "client.autoping.no_uaid", tags=None)
+
+    def test_autoping_uaid_not_in_clients(self):
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
-        self.proto._sendAutoPing()
-        mock_reactor.callLater.assert_called()
-        WebSocketServerProtocol.sendClose.assert_called()
+        now = self.proto.connected_at / 1000.0 + 30
+        eq_(self.proto.sweep_ping(now, 30), False)
+        self.close_mock.assert_called_with()
+        self.proto.metrics.increment.assert_called_with(
+            "client.autoping.invalid_client", tags=None)
 
-    @patch("autopush.websocket.reactor")
-    def test_nuke_connection(self, mock_reactor):
+    def test_autoping(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.clients[self.proto.uaid] = self.proto
+        self.proto.sendPing = Mock()
+        self.proto.dropConnection = Mock()
+        now = self.proto.connected_at / 1000.0 + 30
+        eq_(self.proto.sweep_ping(now, 30), True)
+        # Pinged again, but the first ping is still the one awaited
+        eq_(self.proto.sweep_ping(now + 30, 30), False)
+        eq_(len(self.proto.sendPing.mock_calls), 2)
+        self.proto.expire_ping(now + 30)
+        eq_(len(self.proto.dropConnection.mock_calls), 0)
+        self.proto.expire_ping(now)
+        self.proto.dropConnection.assert_called_with(abort=True)
+        self.proto.metrics.increment.assert_called_with(
+            "client.autoping.timeout", tags=None)
+
+    def test_autoping_pong(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.clients[self.proto.uaid] = self.proto
+        self.proto.sendPing = Mock()
+        self.proto.dropConnection = Mock()
+        now = self.proto.connected_at / 1000.0 + 30
+        self.proto.sweep_ping(now, 30)
+        self.proto.onPong("")
+        self.proto.expire_ping(now)
+        eq_(len(self.proto.dropConnection.mock_calls), 0)
+
+    def test_autoping_sweeper(self):
+        sweeper = self.proto.ap_settings.ping_sweeper = Mock()
+        self._connect()
+        sweeper.add.assert_called_with(self.proto)
+        self.proto.cleanUp()
+        sweeper.discard.assert_called_with(self.proto)
+
+    def test_nuke_connection(self):
         self.proto.transport = Mock()
+        timers = self.proto.ap_settings.timers = Mock()
         self._connect()
         self.proto.state = ""
         self.proto.uaid = str(uuid.uuid4())
         self.proto.nukeConnection()
-        mock_reactor.callLater.assert_called_with(60, self.proto.verifyNuke)
+        timers.call_later.assert_called_with(60, self.proto.verifyNuke)
 
-    @patch("autopush.websocket.reactor")
-    def test_nuke_connection_shutdown_ran(self, mock_reactor):
+    def test_nuke_connection_shutdown_ran(self):
         self.proto.transport = Mock()
+        timers = self.proto.ap_settings.timers = Mock()
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
         self.proto._shutdown_ran = True
         self.proto.nukeConnection()
-        eq_(len(mock_reactor.mock_calls), 0)
+        eq_(len(timers.mock_calls), 0)
 
     def test_verify_nuke(self):
         self._connect()
@@ -172,6 +211,34 @@ class WebsocketTestCase(unittest.TestCase):
                                 [], [])
         self.proto.onConnect(req)
         eq_(self.proto._user_agent, "Me")
+        eq_(self.proto.base_tags, ["user-agent:Me"])
+
+        # Connections of a user agent share its tags
+        other = SimplePushServerProtocol()
+        other.ap_settings = self.proto.ap_settings
+        other.transport = Mock()
+        other.onConnect(req)
+        ok_(other.base_tags is self.proto.base_tags)
+
+    def test_compact_state(self):
+        self._connect()
+        proto = self.proto
+        eq_(proto.base_tags, None)
+        eq_((proto._pending, proto._updates_sent, proto._direct_updates),
+            (None, None, None))
+
+        # Containers are created once used and freed once empty
+        proto.send_notifications([dict(channelID="chid", version=10)])
+        eq_(proto._direct_updates, {"chid": 10})
+        eq_(proto._updates_sent, None)
+        proto._track_ack(dict(channelID="chid", version=10))
+        eq_(proto._direct_updates, None)
+
+        d = Deferred()
+        proto._track_deferred(d)
+        eq_(proto._pending, set([d]))
+        d.callback(True)
+        eq_(proto._pending, None)
 
     def test_reporter(self):
         from autopush.websocket import periodic_reporter
@@ -263,7 +330,7 @@ class WebsocketTestCase(unittest.TestCase):
 
         # Stick a mock on
         notif_mock = Mock()
-        self.proto._callbacks.append(notif_mock)
+        self.proto._add_pending(notif_mock)
         self.proto.onClose(True, None, None)
         eq_(len(self.proto.ap_settings.clients), 0)
         eq_(len(list(notif_mock.mock_calls)), 1)
@@ -365,6 +432,24 @@ class WebsocketTestCase(unittest.TestCase):
             eq_(msg["status"], 200)
         return self._check_response(check_result)
 
+    def test_hello_costs(self):
+        self._connect()
+        settings = self.proto.ap_settings
+        settings.db_costs = CostLedger(Mock())
+        actions = []
+
+        def register_user(user_item):
+            actions.append(current_action())
+            return (True, {})
+        settings.router.register_user = Mock(side_effect=register_user)
+        self._send_message(dict(messageType="hello", channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 200)
+            eq_([action.name for action in actions], ["hello"])
+            eq_(settings.db_costs.averages()["hello"]["count"], 1)
+        return self._check_response(check_result)
+
     def test_hello_with_uaid(self):
         self._connect()
         uaid = str(uuid.uuid4())
@@ -413,6 +498,16 @@ class WebsocketTestCase(unittest.TestCase):
 
         return self._check_response(check_result)
 
+    def test_hello_not_ready(self):
+        self._connect()
+        self.proto.ap_settings.ready = False
+        self._send_message(dict(messageType="hello", channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 503)
+            eq_(msg["reason"], "starting")
+        return self._check_response(check_result)
+
     def test_hello_check_fail(self):
         self._connect()
 
@@ -517,6 +612,18 @@ class WebsocketTestCase(unittest.TestCase):
         d.addCallback(check_result)
         d.addErrback(fail2)
         ok_(d is not None)
+        return d
+
+    def test_deferToLater_cancel(self):
+        self._connect()
+        timers = self.proto.ap_settings.timers
+        func = Mock()
+        d = self.proto.deferToLater(5, func)
+        eq_(timers.pending, 1)
+        d.cancel()
+        eq_(timers.pending, 0)
+        timers.tick()
+        eq_(len(func.mock_calls), 0)
 
     def test_register(self):
         self._connect()
@@ -913,6 +1020,42 @@ class WebsocketTestCase(unittest.TestCase):
         reactor.callLater(0.1, wait_for_delete)
         return d
 
+    def test_ack_keeps_newer_version(self):
+        self._connect()
+        uaid = self.proto.uaid = str(uuid.uuid4())
+        chid = str(uuid.uuid4())
+        # Moto doesn't check the conditions of deletes
+        storage = self.proto.ap_settings.storage = MemoryStorage(Mock())
+        storage.save_notification(uaid, chid, 12)
+        # Version 12 was fetched and sent, then the endpoint stores a newer
+        # version before the client acks
+        self.proto.updates_sent[chid] = 12
+        storage.save_notification(uaid, chid, 13)
+
+        d = self.proto.ack_update({"channelID": chid, "version": 12})
+
+        def check(result):
+            notifs = storage.fetch_notifications(uaid)
+            eq_([(n["chid"], n["version"]) for n in notifs], [(chid, 13)])
+        return d.addCallback(check)
+
+    def test_unregister_batched(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.delete_queue = Mock(
+            **{"delete_notifications.return_value": True})
+        self.proto.ap_settings.storage = Mock()
+        chid = str(uuid.uuid4())
+        d = self.proto.delete_unregistered(chid)
+
+        def check(result):
+            queue = self.proto.ap_settings.delete_queue
+            queue.delete_notifications.assert_called_with(
+                [(self.proto.uaid, chid)])
+            storage = self.proto.ap_settings.storage
+            eq_(len(storage.delete_notification.mock_calls), 0)
+        return d.addCallback(check)
+
     def test_ack_missing_updates(self):
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
@@ -975,6 +1118,150 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto._notification_fetch.addErrback(lambda x: d.errback(x))
         return d
 
+    def test_process_notifications_paged(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.fetch_page_size = 1
+        chids = [str(uuid.uuid4()) for _ in range(2)]
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications_page.side_effect": [
+                ([dict(chid=chids[0], version=10)], "next"),
+                ([dict(chid=chids[1], version=12)], None),
+            ]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications()
+        d = Deferred()
+
+        def wait_for_pages():  # pragma: nocover
+            if self.proto._notification_fetch:
+                reactor.callLater(0.1, wait_for_pages)
+                return
+
+            storage = self.proto.ap_settings.storage
+            calls = storage.fetch_notifications_page.call_args_list
+            eq_(calls[1][0], (self.proto.uaid, 1, "next"))
+            sent = [call[0][0]["updates"]
+                    for call in self.proto.sendJSON.call_args_list]
+            eq_(sent, [[{"channelID": chids[0], "version": 10}],
+                       [{"channelID": chids[1], "version": 12}]])
+            eq_(self.proto.updates_sent, {chids[0]: 10, chids[1]: 12})
+            d.callback(True)
+
+        reactor.callLater(0.1, wait_for_pages)
+        return d
+
+    def test_process_notifications_check_eventual(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.read_policy = ReadPolicy(
+            Mock(), eventual=["fetch"])
+        chid = str(uuid.uuid4())
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications.side_effect": [
+                [], [dict(chid=chid, version=10)],
+            ]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications(check=True)
+
+        def check(result):
+            storage = self.proto.ap_settings.storage
+            calls = storage.fetch_notifications.call_args_list
+            eq_([call[1] for call in calls], [{"consistent": False}, {}])
+            eq_(self.proto.updates_sent, {chid: 10})
+        return self.proto._notification_fetch.addCallback(check)
+
+    def test_process_notifications_check_other_rows(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.read_policy = ReadPolicy(
+            Mock(), eventual=["fetch"])
+        chid, other = str(uuid.uuid4()), str(uuid.uuid4())
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications.side_effect": [
+                [dict(chid=other, version=5)],
+                [dict(chid=other, version=5), dict(chid=chid, version=10)],
+            ]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications(check=True, expected=(chid, 10))
+
+        def check(result):
+            storage = self.proto.ap_settings.storage
+            calls = storage.fetch_notifications.call_args_list
+            eq_([call[1] for call in calls], [{"consistent": False}, {}])
+            eq_(self.proto.updates_sent, {other: 5, chid: 10})
+        return self.proto._notification_fetch.addCallback(check)
+
+    def test_process_notifications_check_older_version(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.read_policy = ReadPolicy(
+            Mock(), eventual=["fetch"])
+        chid = str(uuid.uuid4())
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications.side_effect": [
+                [dict(chid=chid, version=9)], [dict(chid=chid, version=10)],
+            ]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications(check=True, expected=(chid, 10))
+
+        def check(result):
+            storage = self.proto.ap_settings.storage
+            eq_(len(storage.fetch_notifications.call_args_list), 2)
+            eq_(self.proto.updates_sent, {chid: 10})
+        return self.proto._notification_fetch.addCallback(check)
+
+    def test_process_notifications_check_found(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.read_policy = ReadPolicy(
+            Mock(), eventual=["fetch"])
+        chid = str(uuid.uuid4())
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications.return_value": [
+                dict(chid=chid, version=11)]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications(check=True, expected=(chid, 10))
+
+        def check(result):
+            storage = self.proto.ap_settings.storage
+            calls = storage.fetch_notifications.call_args_list
+            eq_([call[1] for call in calls], [{"consistent": False}])
+            eq_(self.proto.updates_sent, {chid: 11})
+        return self.proto._notification_fetch.addCallback(check)
+
+    def test_process_notifications_check_paged(self):
+        self._connect()
+        self.proto.uaid = str(uuid.uuid4())
+        self.proto.ap_settings.fetch_page_size = 1
+        self.proto.ap_settings.read_policy = ReadPolicy(
+            Mock(), eventual=["fetch"])
+        chid, other = str(uuid.uuid4()), str(uuid.uuid4())
+        self.proto.ap_settings.storage = Mock(
+            **{"fetch_notifications_page.side_effect": [
+                ([dict(chid=other, version=5)], "next"),
+                ([], None),
+                ([dict(chid=chid, version=10)], None),
+            ]})
+        self.proto.sendJSON = Mock()
+        self.proto.process_notifications(check=True, expected=(chid, 10))
+        d = Deferred()
+
+        def wait_for_pages():  # pragma: nocover
+            if self.proto._notification_fetch:
+                reactor.callLater(0.1, wait_for_pages)
+                return
+            storage = self.proto.ap_settings.storage
+            calls = storage.fetch_notifications_page.call_args_list
+            # Only the last page, lacking the channel, is read again
+            eq_([call[1] for call in calls],
+                [{"consistent": False}, {"consistent": False}, {}])
+            eq_([call[0][2] for call in calls], [None, "next", "next"])
+            eq_(self.proto.updates_sent, {other: 5, chid: 10})
+            d.callback(True)
+
+        reactor.callLater(0.1, wait_for_pages)
+        return d
+
     def test_process_notification_error(self):
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
@@ -1014,9 +1301,9 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
         self.proto.pauseProducing()
-        with patch("autopush.websocket.reactor") as mr:
-            self.proto.process_notifications()
-            ok_(mr.callLater.mock_calls > 0)
+        timers = self.proto.ap_settings.timers = Mock()
+        self.proto.process_notifications()
+        ok_(timers.call_later.mock_calls > 0)
 
     def test_process_notif_doesnt_run_after_stop(self):
         self._connect()
@@ -1029,9 +1316,9 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         self.proto.uaid = str(uuid.uuid4())
         self.proto.pauseProducing()
-        with patch("autopush.websocket.reactor") as mr:
-            self.proto.finish_notifications(None)
-            ok_(mr.callLater.mock_calls > 0)
+        timers = self.proto.ap_settings.timers = Mock()
+        self.proto.finish_notifications(None)
+        ok_(timers.call_later.mock_calls > 0)
 
     def test_notification_results(self):
         # Populate the database for ourself
@@ -1251,6 +1538,19 @@ class NotificationHandlerTestCase(unittest.TestCase):
         self.handler.put(uaid)
         eq_(len(self.write_mock.mock_calls), 1)
         eq_(len(client_mock.mock_calls), 1)
+        client_mock.process_notifications.assert_called_with(
+            check=True, expected=None)
+
+    def test_connected_with_version(self):
+        uaid = str(uuid.uuid4())
+        chid = str(uuid.uuid4())
+        self.mock_request.body = json.dumps(
+            {"channelID": chid, "version": 10})
+        self.ap_settings.clients[uaid] = client_mock = Mock()
+        client_mock.paused = False
+        self.handler.put(uaid)
+        client_mock.process_notifications.assert_called_with(
+            check=True, expected=(chid, 10))
 
     def test_connected_and_busy(self):
         uaid = str(uuid.uuid4())
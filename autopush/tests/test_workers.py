@@ -0,0 +1,192 @@
+import os
+import socket
+import sys
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet import reactor, task
+from twisted.internet.error import ProcessExitedAlready, ProcessTerminated
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python.failure import Failure
+from twisted.trial import unittest as trialtest
+
+from autopush.workers import (
+    Supervisor,
+    adopt_socket,
+    drain,
+    inherited_socket,
+    listening_socket,
+    reuseport_socket,
+    worker_command,
+)
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, **kwargs):
+        protocol.transport = Mock()
+        self.spawned.append((protocol, args, kwargs))
+
+
+def _ended(worker):
+    worker.processEnded(Failure(ProcessTerminated(exitCode=1)))
+
+
+class SocketTestCase(trialtest.TestCase):
+    def test_reuseport_socket(self):
+        first = reuseport_socket(0, "127.0.0.1")
+        port = first.getsockname()[1]
+        second = reuseport_socket(port, "127.0.0.1")
+        eq_(second.getsockname()[1], port)
+        first.close()
+        second.close()
+
+    def test_reuseport_unavailable(self):
+        with patch("autopush.workers.socket") as mock_socket:
+            del mock_socket.SO_REUSEPORT
+            self.assertRaises(ValueError, reuseport_socket, 0)
+
+    def test_reuseport_in_use(self):
+        taken = socket.socket()
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        self.assertRaises(socket.error, reuseport_socket,
+                          taken.getsockname()[1], "127.0.0.1")
+        taken.close()
+
+    def test_inherited_socket(self):
+        sock = listening_socket(0, "127.0.0.1")
+        fd = os.dup(sock.fileno())
+        inherited = inherited_socket(fd)
+        eq_(inherited.getsockname(), sock.getsockname())
+        self.assertRaises(OSError, os.fstat, fd)
+        inherited.close()
+        sock.close()
+
+    def test_drain(self):
+        clock = task.Clock()
+        ports = [Mock(), Mock()]
+        drained = []
+        drain(ports, 5, clock=clock).addCallback(drained.append)
+        for port in ports:
+            port.stopListening.assert_called_with()
+        clock.advance(4)
+        eq_(drained, [])
+        clock.advance(1)
+        eq_(drained, [None])
+
+    def test_adopt_socket(self):
+        sock = reuseport_socket(0, "127.0.0.1")
+        address = sock.getsockname()
+        port = adopt_socket(sock, Factory.forProtocol(Protocol))
+        eq_(port.getHost().port, address[1])
+        return port.stopListening()
+
+    def test_adopt_socket_tls(self):
+        mock_reactor = Mock()
+        factory = Mock()
+        sock = Mock()
+        adopt_socket(sock, factory, Mock(), reactor=mock_reactor)
+        wrapped = mock_reactor.adoptStreamPort.call_args[0][2]
+        ok_(wrapped.wrappedFactory is factory)
+        sock.close.assert_called_with()
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.supervisor = Supervisor(["worker"], 2, reactor=self.reactor)
+
+    def test_worker_command(self):
+        command = worker_command("connection_main", ["--port=9000"])
+        eq_(command[0], sys.executable)
+        eq_(command[-1], "--port=9000")
+        ok_("connection_main(sys.argv[1:])" in command[2])
+
+    def test_start(self):
+        self.supervisor.start()
+        eq_([args for _, args, _ in self.reactor.spawned],
+            [["worker", "--worker_index=0"], ["worker", "--worker_index=1"]])
+        eq_(self.reactor.spawned[0][2]["childFDs"], {0: 0, 1: 1, 2: 2})
+
+    def test_restart(self):
+        self.supervisor.start()
+        worker = self.supervisor.workers[1]
+        _ended(worker)
+        eq_(sorted(self.supervisor.workers), [0])
+        self.reactor.advance(1)
+        eq_(self.reactor.spawned[-1][1], ["worker", "--worker_index=1"])
+        ok_(self.supervisor.workers[1] is not worker)
+        eq_(self.supervisor.restarts, 1)
+
+    def test_stop(self):
+        self.supervisor.start()
+        workers = self.supervisor.workers.values()
+        workers[0].transport.signalProcess.side_effect = ProcessExitedAlready
+        d = self.supervisor.stop()
+        for worker in workers:
+            worker.transport.signalProcess.assert_called_with("TERM")
+        stopped = []
+        d.addCallback(stopped.append)
+        for worker in workers:
+            _ended(worker)
+        eq_(len(stopped), 1)
+        # Not restarted
+        self.reactor.advance(1)
+        eq_(len(self.reactor.spawned), 2)
+        eq_(self.supervisor.spawn(0), None)
+
+    def test_rotate(self):
+        self.supervisor.start()
+        first, second = [self.supervisor.workers[i] for i in range(2)]
+        rotated = []
+        d = self.supervisor.rotate()
+        d.addCallback(rotated.append)
+        ok_(self.supervisor.rotate() is d)
+        first.transport.signalProcess.assert_called_with("TERM")
+        eq_(len(second.transport.signalProcess.mock_calls), 0)
+        # Replaced once stopped, rather than restarted
+        _ended(first)
+        eq_(len(self.reactor.spawned), 3)
+        eq_(self.supervisor.restarts, 0)
+        self.reactor.advance(1)
+        second.transport.signalProcess.assert_called_with("TERM")
+        _ended(second)
+        self.reactor.advance(1)
+        eq_(rotated, [None])
+        eq_([args[-1] for _, args, _ in self.reactor.spawned[2:]],
+            ["--worker_index=0", "--worker_index=1"])
+        ok_(self.supervisor.rotate() is not d)
+
+    def test_rotate_stopping(self):
+        self.supervisor.start()
+        self.supervisor.stopping = True
+        rotated = []
+        self.supervisor.rotate().addCallback(rotated.append)
+        eq_(rotated, [None])
+
+    def test_wait_ended(self):
+        self.supervisor.start()
+        worker = self.supervisor.workers[0]
+        _ended(worker)
+        reasons = []
+        worker.wait().addCallback(reasons.append)
+        ok_(isinstance(reasons[0], ProcessTerminated))
+
+
+class SpawnTestCase(trialtest.TestCase):
+    def test_spawn(self):
+        supervisor = Supervisor([sys.executable, "-c", "import sys"], 1,
+                                reactor=reactor)
+        supervisor.start()
+        worker = supervisor.workers[0]
+        supervisor.stopping = True
+
+        def check(reason):
+            eq_(supervisor.workers, {})
+
+        return worker.wait().addCallback(check)
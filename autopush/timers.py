@@ -0,0 +1,185 @@
+"""Hierarchical timer wheel shared by the connections of a node
+
+Every connection schedules timers of its own: delayed ping replies,
+retries of notification checks, and the checks that a closed connection
+really went away. With hundreds of thousands of connections, keeping each
+of them in the reactor's timer heap makes every reactor iteration pay for
+it. Connections schedule them into the node's :class:`TimerWheel`
+instead, which keeps a single reactor timer running while it has timers.
+
+The wheel has levels of ``slots`` slots. Each level 0 slot holds the
+timers due in one tick of ``resolution`` seconds, and each slot of a
+level holds as many ticks as the whole level below it. Timers are kept in
+the lowest level their delay fits in, and moved down a level once the
+lower level reaches their slot, so scheduling and cancelling are O(1) and
+each tick only looks at the timers due. Timers fire up to a tick late,
+which is fine for their second-granularity delays.
+
+"""
+import math
+
+from twisted.internet import reactor, task
+from twisted.python import failure, log
+
+
+class Timer(object):
+    """A call scheduled on a :class:`TimerWheel`"""
+    __slots__ = ("wheel", "deadline", "func", "args", "kwargs", "slot")
+
+    def __init__(self, wheel, deadline, func, args, kwargs):
+        """Create a new Timer
+
+        :param wheel: :class:`TimerWheel` the timer is scheduled on.
+        :param deadline: Time in seconds the timer is due at.
+        :param func: Function to call, with ``args`` and ``kwargs``.
+
+        """
+        self.wheel = wheel
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # Set of the slot holding the timer, None once fired or cancelled
+        self.slot = None
+
+    def active(self):
+        """Whether the timer is still due to fire"""
+        return self.slot is not None
+
+    def cancel(self):
+        """Cancel the timer, nothing happens if it already fired or was
+        cancelled"""
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.pending -= 1
+
+
+class TimerWheel(object):
+    """Hierarchical timer wheel, ticking on the reactor while it has
+    timers"""
+    def __init__(self, metrics, resolution=0.1, slots=64, levels=4,
+                 clock=reactor):
+        """Create a new TimerWheel
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param resolution: Seconds per tick.
+        :param slots: Amount of slots of each level.
+        :param levels: Amount of levels, timers due after more than
+                       ``resolution * slots ** levels`` seconds wait in the
+                       last level until they fit.
+        :param clock: Provider of ``seconds()`` and ``callLater``, the
+                      reactor by default.
+
+        """
+        self.metrics = metrics
+        self.resolution = resolution
+        self.slots = slots
+        self.clock = clock
+        self.wheels = [[set() for _ in range(slots)]
+                       for _ in range(levels)]
+        self.ticks = self._tick_of(clock.seconds())
+        self.pending = 0
+        self._ticker = None
+        # Timers fired since the last report and their total and
+        # maximum lag
+        self._fired = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def _tick_of(self, when):
+        """Tick a time falls in"""
+        return int(when / self.resolution)
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Call a function after ``delay`` seconds
+
+        :returns: The :class:`Timer`, which can be cancelled.
+
+        """
+        now = self.clock.seconds()
+        if self._ticker is None:
+            # Catch up with the time passed while idle
+            self.ticks = self._tick_of(now)
+        timer = Timer(self, now + delay, func, args, kwargs)
+        self._place(timer)
+        self.pending += 1
+        if self._ticker is None:
+            self._ticker = task.LoopingCall(self.tick)
+            self._ticker.clock = self.clock
+            self._ticker.start(self.resolution, now=False)
+        return timer
+
+    def _place(self, timer):
+        """Put a timer in the slot of the lowest level its tick fits in"""
+        due = max(int(math.ceil(timer.deadline / self.resolution)),
+                  self.ticks + 1)
+        ahead = due - self.ticks
+        level = 0
+        span = self.slots
+        while ahead >= span and level < len(self.wheels) - 1:
+            level += 1
+            span *= self.slots
+        index = (due * self.slots // span) % self.slots
+        timer.slot = self.wheels[level][index]
+        timer.slot.add(timer)
+
+    def tick(self):
+        """Advance to the current time, firing the timers due"""
+        now = self.clock.seconds()
+        target = self._tick_of(now)
+        while self.ticks < target and self.pending:
+            self.ticks += 1
+            self._cascade()
+            slot = self.wheels[0][self.ticks % self.slots]
+            if slot:
+                self._fire(slot, now)
+        self.ticks = max(self.ticks, target)
+        if not self.pending and self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+
+    def _cascade(self):
+        """Move the timers of the upper level slots the tick reached down
+        to lower levels"""
+        span = 1
+        for level in range(1, len(self.wheels)):
+            span *= self.slots
+            if self.ticks % span:
+                return
+            index = (self.ticks // span) % self.slots
+            timers = self.wheels[level][index]
+            if timers:
+                self.wheels[level][index] = set()
+                for timer in timers:
+                    self._place(timer)
+
+    def _fire(self, slot, now):
+        """Call the timers of a slot"""
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer.slot = None
+            self.pending -= 1
+            lag = max(now - timer.deadline, 0)
+            self._fired += 1
+            self._lag_total += lag
+            self._lag_max = max(self._lag_max, lag)
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except Exception:
+                log.err(failure.Failure())
+
+    def report(self):
+        """Gauge the pending timers as ``timers.pending``, and the average
+        and maximum lag in milliseconds of the timers fired since the last
+        report as ``timers.lag.avg`` and ``timers.lag.max``"""
+        self.metrics.gauge("timers.pending", self.pending)
+        if self._fired:
+            self.metrics.gauge("timers.lag.avg",
+                               self._lag_total / self._fired * 1000)
+            self.metrics.gauge("timers.lag.max", self._lag_max * 1000)
+        self._fired = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
@@ -16,7 +16,9 @@ not be publicly exposed.
 
 .. http:put:: /notif/(uuid:uaid)
 
-    Trigger a stored notification check for a connected client.
+    Trigger a stored notification check for a connected client. The optional
+    JSON body names the ``channelID`` and ``version`` of the notification
+    just stored, which the check should find.
 
     :statuscode 200: Client is connected, and has started checking.
     :statuscode 202: Client is connected but busy, will check notifications
@@ -32,7 +34,7 @@ not be publicly exposed.
 import json
 import time
 import uuid
-from functools import wraps
+from functools import partial, wraps
 
 import cyclone.web
 from autobahn.twisted.websocket import WebSocketServerProtocol
@@ -50,15 +52,74 @@ from twisted.internet.threads import deferToThread
 from twisted.python import failure, log
 from zope.interface import implements
 
+from autopush.costs import acting, bound, finish_action, start_action
+from autopush.db import deferToDB
 from autopush.protocol import IgnoreBody
 from autopush.utils import validate_uaid
 
 
+# Amount of user agents whose metric tags are kept for new connections
+AGENT_TAGS_SIZE = 1000
+
+# User agent to the interned user agent and its metric tags
+_agent_tags = {}
+
+
 def ms_time():
     """Return current time.time call as ms and a Python int"""
     return int(time.time() * 1000)
 
 
+def agent_tags(user_agent):
+    """Interned user agent string and its metric tags list, shared by the
+    connections of the user agent
+
+    The first :data:`AGENT_TAGS_SIZE` user agents seen are kept, the tags
+    of the others are made for each connection.
+
+    """
+    entry = _agent_tags.get(user_agent)
+    if entry is None:
+        entry = (user_agent, ["user-agent:%s" % user_agent])
+        if len(_agent_tags) < AGENT_TAGS_SIZE:
+            _agent_tags[user_agent] = entry
+    return entry
+
+
+class LazyContainer(object):
+    """Attribute holding a container only created once it's accessed
+
+    The container is kept in a slot that stays None until then, and
+    deleting the attribute frees it. Code that only looks up entries
+    should read the slot, to not create containers for idle connections.
+
+    """
+    def __init__(self, slot, factory):
+        """Create a new LazyContainer
+
+        :param slot: Name of the slot keeping the container.
+        :param factory: Callable making an empty container.
+
+        """
+        self.slot = slot
+        self.factory = factory
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        container = getattr(obj, self.slot)
+        if container is None:
+            container = self.factory()
+            setattr(obj, self.slot, container)
+        return container
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+    def __delete__(self, obj):
+        setattr(obj, self.slot, None)
+
+
 def periodic_reporter(settings):
     """Twisted Task function that runs every few seconds to emit general
     metrics regarding twisted and client counts"""
@@ -70,6 +131,7 @@ def periodic_reporter(settings):
                            len(settings.clients))
     settings.metrics.gauge("update.client.ws_connections",
                            settings.factory.countConnections)
+    settings.timers.report()
 
 
 def log_exception(func):
@@ -85,25 +147,43 @@ def log_exception(func):
 
 
 class SimplePushServerProtocol(WebSocketServerProtocol):
-    """Main Websocket Connection Protocol"""
+    """Main Websocket Connection Protocol
+
+    Most connections sit idle for hours, so their state is kept small: the
+    containers tracking notifications and outstanding deferreds are only
+    created once needed and freed once empty, and the user agent and its
+    tags are shared across connections.
+
+    """
     implements(IProducer)
 
     # Testing purposes
     parent_class = WebSocketServerProtocol
 
+    # Reflects updates sent that haven't been ack'd
+    updates_sent = LazyContainer("_updates_sent", dict)
+
+    # Track notifications we don't need to delete separately
+    direct_updates = LazyContainer("_direct_updates", dict)
+
     # Defer helpers
     def deferToThread(self, func, *args, **kwargs):
         """deferToThread helper that tracks defers outstanding"""
-        d = deferToThread(func, *args, **kwargs)
+        return self._track_deferred(deferToThread(func, *args, **kwargs))
+
+    def deferToDB(self, func, *args, **kwargs):
+        """deferToDB helper that tracks defers outstanding"""
+        return self._track_deferred(deferToDB(func, *args, **kwargs))
 
+    def _track_deferred(self, d):
+        """Track a deferred as outstanding until it fires"""
         def trapCancel(fail):
             fail.trap(CancelledError)
 
-        self._callbacks.append(d)
+        self._add_pending(d)
 
         def f(result):
-            if d in self._callbacks:
-                self._callbacks.remove(d)
+            self._discard_pending(d)
             return result
         d.addBoth(f)
         d.addErrback(trapCancel)
@@ -111,25 +191,58 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
 
     def deferToLater(self, when, func, *args, **kwargs):
         """deferToLater helper that tracks defers outstanding"""
-        d = Deferred()
+        d = Deferred(lambda d: timer.cancel())
 
         def trapCancel(fail):
             fail.trap(CancelledError)
 
         d.addErrback(trapCancel)
-        self._callbacks.append(d)
+        self._add_pending(d)
 
         def f():
-            if d in self._callbacks:
-                self._callbacks.remove(d)
+            self._discard_pending(d)
             try:
                 result = func(*args, **kwargs)
                 d.callback(result)
             except:
                 d.errback(failure.Failure())
-        reactor.callLater(when, f)
+        timer = self.ap_settings.timers.call_later(when, f)
         return d
 
+    def _add_pending(self, d):
+        """Track a deferred as outstanding, to cancel it on close"""
+        if self._pending is None:
+            self._pending = set()
+        self._pending.add(d)
+
+    def _discard_pending(self, d):
+        """Stop tracking a deferred, freeing the set once it's empty"""
+        if self._pending:
+            self._pending.discard(d)
+            if not self._pending:
+                self._pending = None
+
+    def _untrack(self, slot, chid):
+        """Remove a channel from the container of a slot, freeing the
+        container once it's empty"""
+        container = getattr(self, slot)
+        if not container:
+            return
+        container.pop(chid, None)
+        if not container:
+            setattr(self, slot, None)
+
+    def _sent_version(self, chid):
+        """Version of a channel sent and not ack'd yet, 0 if none"""
+        return self._updates_sent.get(chid, 0) if self._updates_sent else 0
+
+    def _direct_version(self, chid):
+        """Version of a channel delivered directly and not ack'd yet, 0 if
+        none"""
+        if not self._direct_updates:
+            return 0
+        return self._direct_updates.get(chid, 0)
+
     @property
     def base_tags(self):
         """Property that uses None if there's no tags due to a DataDog library
@@ -159,25 +272,60 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         return self._paused
 
     @log_exception
-    def _sendAutoPing(self):
-        """Override for sanity checking during auto-ping interval"""
+    def sweep_ping(self, now, interval):
+        """Sanity check and ping of the node's
+        :class:`~autopush.autoping.PingSweeper`, run every ``interval``
+        seconds
+
+        Connections are left alone for their first interval, then closed
+        if they still have no UAID or aren't the client of their UAID
+        anymore, and pinged otherwise.
+
+        :returns: Whether the ping sent is awaited from ``now`` on.
+
+        """
+        if (now * 1000 - self.connected_at) < interval * 1000:
+            return False
         if not self.uaid:
             # No uaid yet, drop the connection
             self.metrics.increment("client.autoping.no_uaid",
                                    tags=self.base_tags)
             self.sendClose()
+            return False
         elif self.ap_settings.clients.get(self.uaid) != self:
             # UAID, but we're not in clients anymore for some reason
             self.metrics.increment("client.autoping.invalid_client",
                                    tags=self.base_tags)
             self.sendClose()
-        return WebSocketServerProtocol._sendAutoPing(self)
+            return False
+        self.sendPing()
+        if self._ping_sent is not None:
+            # Still waiting on an earlier ping
+            return False
+        self._ping_sent = now
+        return True
+
+    @log_exception
+    def expire_ping(self, sent):
+        """Drop the connection if the ping sent at ``sent`` is still
+        unanswered"""
+        if self._ping_sent != sent:
+            return
+        self._ping_sent = None
+        self.metrics.increment("client.autoping.timeout",
+                               tags=self.base_tags)
+        self.dropConnection(abort=True)
+
+    def onPong(self, payload):
+        """autobahn onPong handler, the client answered our pings"""
+        self._ping_sent = None
 
     @log_exception
     def sendClose(self, code=None, reason=None):
         """Override to add tracker that ensures the connection is truly
         torn down"""
-        reactor.callLater(5+self.closeHandshakeTimeout, self.nukeConnection)
+        self.ap_settings.timers.call_later(5+self.closeHandshakeTimeout,
+                                           self.nukeConnection)
         return WebSocketServerProtocol.sendClose(self, code, reason)
 
     @log_exception
@@ -195,7 +343,7 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
 
         self.transport.abortConnection()
         # Add a last callback to verify onClose finally was run
-        reactor.callLater(60, self.verifyNuke)
+        self.ap_settings.timers.call_later(60, self.verifyNuke)
 
     @log_exception
     def verifyNuke(self):
@@ -214,15 +362,13 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         self.transport.bufferSize = 2 * 1024
         self.transport.registerProducer(self, True)
 
-        self._callbacks = []
+        self._pending = None
 
-        if request:
-            self._user_agent = request.headers.get("user-agent")
+        user_agent = request.headers.get("user-agent") if request else None
+        if user_agent:
+            self._user_agent, self._base_tags = agent_tags(user_agent)
         else:
-            self._user_agent = None
-        self._base_tags = []
-        if self._user_agent:
-            self._base_tags.append("user-agent:%s" % self._user_agent)
+            self._user_agent = self._base_tags = None
         self._should_stop = False
         self._paused = False
         self.metrics = self.ap_settings.metrics
@@ -231,18 +377,20 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         self.last_ping = 0
         self.check_storage = False
         self.connected_at = ms_time()
+        self._ping_sent = None
+        if self.ap_settings.ping_sweeper is not None:
+            self.ap_settings.ping_sweeper.add(self)
 
         self._check_notifications = False
 
         # Hanger for common actions we defer
         self._notification_fetch = None
+        self._fetch_action = None
         self._register = None
 
-        # Reflects updates sent that haven't been ack'd
-        self.updates_sent = {}
-
-        # Track notifications we don't need to delete separately
-        self.direct_updates = {}
+        # Created once used, see updates_sent and direct_updates
+        self._updates_sent = None
+        self._direct_updates = None
 
     #############################################################
     #                    Connection Methods
@@ -326,29 +474,34 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         # Cleanup our client entry
         if self.uaid and self.ap_settings.clients.get(self.uaid) == self:
             del self.ap_settings.clients[self.uaid]
+        if self.ap_settings.ping_sweeper is not None:
+            self.ap_settings.ping_sweeper.discard(self)
 
         # Cancel any outstanding deferreds
-        for d in self._callbacks:
+        for d in list(self._pending or ()):
             d.cancel()
 
         # Attempt to deliver any notifications not originating from storage
-        if self.direct_updates:
+        if self._direct_updates:
+            action = start_action(self.ap_settings.db_costs, "redeliver")
             defers = []
-            for chid, version in self.direct_updates.items():
-                d = deferToThread(
-                    self.ap_settings.storage.save_notification,
-                    self.uaid,
-                    chid,
-                    version
-                )
-                d.addErrback(self.log_err)
-                defers.append(d)
-
-            # Tag on the notifier once everything has been stored
-            dl = DeferredList(defers)
-            dl.addBoth(self._lookup_node)
-
-        # Delete and remove remaining dicts and lists
+            with acting(action):
+                for chid, version in self.direct_updates.items():
+                    d = deferToDB(
+                        self.ap_settings.storage.save_notification,
+                        self.uaid,
+                        chid,
+                        version
+                    )
+                    d.addErrback(self.log_err)
+                    defers.append(d)
+
+                # Tag on the notifier once everything has been stored
+                dl = DeferredList(defers)
+                dl.addBoth(bound(self._lookup_node))
+            dl.addBoth(finish_action, action)
+
+        # Free the remaining dicts
         del self.direct_updates
         del self.updates_sent
 
@@ -356,12 +509,14 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         """Looks up the node to send a notify for it to check storage if
         connected"""
         # Locate the node that has this client connected
-        d = deferToThread(
-            self.ap_settings.router.get_uaid,
-            self.uaid
+        d = self.ap_settings.read_policy.get_uaid(
+            self.ap_settings.router,
+            self.uaid,
+            "redeliver"
         )
         d.addCallback(self._notify_node)
         d.addErrback(self.log_err, extra="Failed to get UAID for redeliver")
+        return d
 
     def _notify_node(self, result):
         """Checks the result of lookup node to send the notify if the client is
@@ -409,6 +564,10 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         if self.uaid:
             return self.returnError("hello", "duplicate hello", 401)
 
+        # Turn clients away until the database is set up
+        if not self.ap_settings.ready:
+            return self.returnError("hello", "starting", 503)
+
         uaid = data.get("uaid")
         _, uaid = validate_uaid(uaid)
         self.uaid = uaid
@@ -418,9 +577,13 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             uaid=self.uaid,
             node_id=self.ap_settings.router_url,
             connected_at=self.connected_at,
+            last_connect=self.connected_at,
         )
-        d = self.deferToThread(self.ap_settings.router.register_user,
+        action = start_action(self.ap_settings.db_costs, "hello")
+        with acting(action):
+            d = self.deferToDB(self.ap_settings.router.register_user,
                                user_item)
+        d.addBoth(finish_action, action)
         d.addCallback(self._check_other_nodes)
         d.addErrback(self.err_hello)
         self._register = d
@@ -478,8 +641,18 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         self.metrics.increment("updates.client.hello", tags=self.base_tags)
         self.process_notifications()
 
-    def process_notifications(self):
-        """Run a notification check against storage"""
+    def process_notifications(self, check=False, expected=None):
+        """Run a notification check against storage
+
+        :param check: Whether the check was requested as a notification was
+                      just stored, so an eventually consistent fetch that
+                      misses it is repeated consistently.
+        :param expected: Tuple of the channel ID and version of the stored
+                         notification, which the fetch misses when it lacks
+                         that version. Without it, the fetch misses when it
+                         finds nothing.
+
+        """
         # Bail immediately if we are closed.
         if self._should_stop:
             return
@@ -495,55 +668,135 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             self._notification_fetch.cancel()
 
         self._check_notifications = False
+        # Account the fetch, and every page of it, as one action
+        self._fetch_action = start_action(self.ap_settings.db_costs, "fetch")
 
         # Prevent repeat calls
-        d = self.deferToThread(self.ap_settings.storage.fetch_notifications,
-                               self.uaid)
+        if self.ap_settings.fetch_page_size:
+            self._notification_fetch = self.fetch_notifications_page(
+                check=check, expected=expected)
+            return
+        stale = None
+        if check:
+            stale = partial(self._missed_check, expected=expected)
+        with acting(self._fetch_action):
+            d = self._track_deferred(
+                self.ap_settings.read_policy.fetch_notifications(
+                    self.ap_settings.storage, self.uaid, "fetch",
+                    stale=stale))
         d.addErrback(self.error_notifications)
         d.addCallback(self.finish_notifications)
         self._notification_fetch = d
 
+    def fetch_notifications_page(self, start_key=None, check=False,
+                                 expected=None):
+        """Fetch a page of notifications from storage"""
+        stale = None
+        if check:
+            stale = partial(self._missed_page_check, expected=expected)
+        with acting(self._fetch_action):
+            d = self._track_deferred(
+                self.ap_settings.read_policy.fetch_notifications_page(
+                    self.ap_settings.storage, self.uaid,
+                    self.ap_settings.fetch_page_size, "fetch",
+                    start_key=start_key, stale=stale))
+        d.addErrback(self.error_notifications)
+        d.addCallback(self.finish_notifications_page, expected)
+        return d
+
+    def _missed_check(self, notifs, expected=None, last=True):
+        """Whether a notification check missed the stored notification, as
+        it may not be visible yet to an eventual read
+
+        With the ``expected`` channel ID and version, the check misses when
+        the notifications lack the channel, or hold an older version of it.
+        A page that isn't the ``last`` may lack the channel, as a later page
+        may hold it. Without it, the check misses when it found nothing.
+
+        """
+        if expected is None:
+            return not notifs
+        chid, version = expected
+        for notif in notifs:
+            if notif["chid"] == chid:
+                return int(notif["version"]) < version
+        return last
+
+    def _missed_page_check(self, page, expected=None):
+        """Whether a page of a notification check missed the stored
+        notification"""
+        notifs, last_key = page
+        return self._missed_check(notifs, expected, last=not last_key)
+
     def error_notifications(self, fail):
         """errBack for notification check failing"""
         # If we error'd out on this important check, we drop the connection
+        self._finish_fetch()
         self.log_err(fail)
         self.sendClose()
 
+    def _finish_fetch(self):
+        """Record the database requests of the notification fetch"""
+        finish_action(None, self._fetch_action)
+        self._fetch_action = None
+
     def finish_notifications(self, notifs):
         """callback for processing notifications from storage"""
         self._notification_fetch = None
+        self._finish_fetch()
 
         # Are we paused, try again later
         if self.paused:
             self.deferToLater(1, self.process_notifications)
 
+        self.send_stored(notifs or [])
+
+        # Were we told to check notifications again?
+        if self._check_notifications:
+            self._check_notifications = False
+            self.deferToLater(1, self.process_notifications)
+
+    def finish_notifications_page(self, page, expected=None):
+        """callback for a page of notifications from storage, sending them
+        before fetching the next page
+
+        The next page is checked for the ``expected`` notification of a
+        check, unless this page held its channel.
+
+        """
+        notifs, last_key = page or ([], None)
+        if not last_key:
+            return self.finish_notifications(notifs)
+
+        self.send_stored(notifs)
+        if expected and any(n["chid"] == expected[0] for n in notifs):
+            expected = None
+        self._notification_fetch = self.fetch_notifications_page(
+            last_key, check=expected is not None, expected=expected)
+
+    def send_stored(self, notifs):
+        """Send notifications from storage the client hasn't been sent"""
         updates = []
-        notifs = notifs or []
         # Track outgoing, screen out things we've seen that weren't
         # ack'd yet
         for s in notifs:
             chid = s['chid']
             version = int(s['version'])
-            if self.updates_sent.get(chid, 0) >= version:
+            if self._sent_version(chid) >= version:
                 continue
-            direct_notif = self.direct_updates.get(chid)
+            direct_notif = self._direct_version(chid)
             if direct_notif and direct_notif >= version:
                 continue
             elif direct_notif:
                 # We're going to send a newer one, ignore the direct older
                 # one for acks
-                del self.direct_updates[chid]
+                self._untrack("_direct_updates", chid)
             self.updates_sent[chid] = version
             updates.append({"channelID": chid, "version": version})
         if updates:
             msg = {"messageType": "notification", "updates": updates}
             self.sendJSON(msg)
 
-        # Were we told to check notifications again?
-        if self._check_notifications:
-            self._check_notifications = False
-            self.deferToLater(1, self.process_notifications)
-
     def _send_ping(self):
         """Helper for ping sending that tracks when the ping was sent"""
         self.last_ping = time.time()
@@ -585,7 +838,10 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             return self.bad_message("register")
         self.transport.pauseProducing()
 
+        # Registering makes no database requests, counted all the same
+        action = start_action(self.ap_settings.db_costs, "register")
         d = self.deferToThread(self.ap_settings.make_endpoint, self.uaid, chid)
+        d.addBoth(finish_action, action)
         d.addCallback(self.finish_register, chid)
         d.addErrback(self.error_register)
         return d
@@ -621,28 +877,45 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
                                tags=self.base_tags)
 
         # Delete any record from storage, we don't wait for this
-        d = self.deferToThread(self.ap_settings.storage.delete_notification,
-                               self.uaid, chid)
-        d.addErrback(self.force_delete, chid)
+        action = start_action(self.ap_settings.db_costs, "unregister")
+        with acting(action):
+            d = self.delete_unregistered(chid)
+        d.addBoth(finish_action, action)
         data["status"] = 200
         self.sendJSON(data)
 
+    def delete_unregistered(self, chid):
+        """Delete any stored notification of an unregistered channel,
+        batched with the deletes of other connections if the node gathers
+        them"""
+        queue = self.ap_settings.delete_queue
+        if queue is None:
+            d = self.deferToDB(self.ap_settings.storage.delete_notification,
+                               self.uaid, chid)
+        else:
+            # The delete isn't conditioned on a version, so it may be
+            # batched
+            d = self.deferToDB(queue.delete_notifications,
+                               [(self.uaid, chid)])
+        d.addErrback(bound(self.force_delete), chid)
+        return d
+
     def force_delete(self, result, chid):
         """Forces another delete call through until it works"""
         if isinstance(result, failure.Failure):
             # This is an exception, log it
             self.log_err(result)
 
-        d = self.deferToThread(self.ap_settings.storage.delete_notification,
-                               self.uaid, chid)
-        d.addErrback(self.force_delete, chid)
+        d = self.deferToDB(self.ap_settings.storage.delete_notification,
+                           self.uaid, chid)
+        d.addErrback(bound(self.force_delete), chid)
         return d
 
-    def ack_update(self, update):
-        """Helper function for tracking ack'd updates
+    def _track_ack(self, update):
+        """Remove an ack'd update from tracking
 
-        Returns either None, if no delete_notification call is needed, or a
-        deferred for the delete_notification call if it was needed.
+        Returns the channel ID and version if the notification has to be
+        deleted from storage, otherwise None.
 
         """
         chid = update.get("channelID")
@@ -651,22 +924,36 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             return
 
         # If its a direct update, remove it and return
-        if self.direct_updates.get(chid) == version:
-            del self.direct_updates[chid]
+        if self._direct_version(chid) == version:
+            self._untrack("_direct_updates", chid)
             return
 
         # Remove the update if version matches
-        if self.updates_sent.get(chid) == version:
-            del self.updates_sent[chid]
-        else:
+        if self._sent_version(chid) == version:
+            self._untrack("_updates_sent", chid)
+            return chid, version
+
+    def ack_update(self, update):
+        """Helper function for tracking ack'd updates
+
+        Returns either None, if no delete_notification call is needed, or a
+        deferred for the delete_notification call if it was needed.
+
+        """
+        acked = self._track_ack(update)
+        if not acked:
             return
 
         # If we ack'd a notification that wasn't direct, delete it
-        # Note: Not using self.deferToThread because this should run even if
+        return self.delete_ack(*acked)
+
+    def delete_ack(self, chid, version):
+        """Delete an ack'd notification if its version is still stored"""
+        # Note: Not using self.deferToDB because this should run even if
         # the client dropped
-        d = deferToThread(self.ap_settings.storage.delete_notification,
-                          self.uaid, chid, version)
-        d.addCallback(self.check_ack, self.uaid, chid, version)
+        d = deferToDB(self.ap_settings.storage.delete_notification,
+                      self.uaid, chid, version)
+        d.addCallback(bound(self.check_ack), self.uaid, chid, version)
         d.addErrback(self.log_err)
         return d
 
@@ -678,13 +965,17 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             return
 
         self.metrics.increment("updates.client.ack", tags=self.base_tags)
-        defers = filter(None, map(self.ack_update, updates))
+        action = start_action(self.ap_settings.db_costs, "ack")
+        with acting(action):
+            defers = filter(None, map(self.ack_update, updates))
 
         if defers:
             self.transport.pauseProducing()
             dl = DeferredList(defers)
+            dl.addBoth(finish_action, action)
             dl.addBoth(self.check_missed_notifications, True)
         else:
+            finish_action(None, action)
             self.check_missed_notifications(None)
 
     def check_ack(self, result, uaid, chid, version):
@@ -693,9 +984,9 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
             return None
 
         # Retry the operation and return its new deferred
-        d = deferToThread(self.ap_settings.storage.delete_notification, uaid,
-                          chid, version)
-        d.addCallback(self.check_ack, uaid, chid, version)
+        d = deferToDB(self.ap_settings.storage.delete_notification, uaid,
+                      chid, version)
+        d.addCallback(bound(self.check_ack), uaid, chid, version)
         d.addErrback(self.log_err)
         return d
 
@@ -726,8 +1017,8 @@ class SimplePushServerProtocol(WebSocketServerProtocol):
         toSend = []
         for update in updates:
             chid, version = update["channelID"], update["version"]
-            older = self.updates_sent.get(chid, 0) >= version or \
-                self.direct_updates.get(chid, 0) >= version
+            older = self._sent_version(chid) >= version or \
+                self._direct_version(chid) >= version
             if not older:
                 # Otherwise we can record we sent this version
                 self.direct_updates[chid] = version
@@ -790,8 +1081,13 @@ class NotificationHandler(cyclone.web.RequestHandler):
             settings.metrics.increment("updates.notification.flagged")
             return self.write("Flagged for Notification check")
 
-        # Client is online and idle, start a notification check
-        client.process_notifications()
+        # Client is online and idle, start a notification check for the
+        # stored notification it names
+        hint = json.loads(self.request.body or "{}")
+        expected = None
+        if "channelID" in hint:
+            expected = (hint["channelID"], hint["version"])
+        client.process_notifications(check=True, expected=expected)
         settings.metrics.increment("updates.notification.checking")
         self.write("Notification check started")
 
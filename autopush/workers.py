@@ -0,0 +1,261 @@
+"""Worker processes of a node
+
+A node started with ``--workers`` runs as a supervisor of that many worker
+processes, so it can use more than one core. Each worker is a fresh
+Python process running the node's entry point with a ``--worker_index``,
+rather than a fork of the supervisor, as forked reactors would share
+their poller. Workers that die are restarted.
+
+Workers accept connections on the node's public port, either each
+binding it with ``SO_REUSEPORT`` so the kernel spreads connections across
+them, or all accepting from a socket the supervisor bound and passed on.
+Supervisors of interchangeable workers may replace them one at a time,
+each worker stopping to listen and draining its requests before its
+replacement starts.
+
+"""
+import os
+import signal
+import socket
+import sys
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    gatherResults,
+    maybeDeferred,
+    succeed,
+)
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import log
+
+
+def listening_socket(port, interface="", backlog=50, reuse_port=False):
+    """Non-blocking listening socket, which worker processes may inherit
+
+    :param reuse_port: Whether other processes can bind the port too.
+    :raises: :exc:`ValueError` where ``SO_REUSEPORT`` isn't available.
+
+    """
+    if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT isn't available on this platform")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def reuseport_socket(port, interface="", backlog=50):
+    """Listening socket on a port other processes can bind too, see
+    :func:`listening_socket`"""
+    return listening_socket(port, interface, backlog, reuse_port=True)
+
+
+def inherited_socket(fd):
+    """Listening socket of a descriptor inherited from the supervisor"""
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    return sock
+
+
+def drain(ports, grace, clock=reactor):
+    """Stop listening on ports, then give the requests in flight ``grace``
+    seconds to finish
+
+    :returns: Deferred firing once the grace period is over.
+
+    """
+    d = gatherResults([maybeDeferred(port.stopListening) for port in ports])
+    d.addCallback(lambda _: task.deferLater(clock, grace, lambda: None))
+    return d
+
+
+def adopt_socket(sock, factory, context_factory=None, reactor=reactor):
+    """Serve a factory on a listening socket, over TLS with a context
+    factory
+
+    The reactor listens on a copy of the socket, which is closed.
+
+    :returns: The listening port.
+
+    """
+    if context_factory is not None:
+        factory = TLSMemoryBIOFactory(context_factory, False, factory)
+    port = reactor.adoptStreamPort(sock.fileno(), sock.family, factory)
+    sock.close()
+    return port
+
+
+def worker_command(entry, sysargs):
+    """Command line of a worker process running an entry point of
+    :mod:`autopush.main` with the node's arguments"""
+    code = ("import sys; from autopush.main import %s; %s(sys.argv[1:])" %
+            (entry, entry))
+    return [sys.executable, "-c", code] + list(sysargs)
+
+
+class WorkerProtocol(ProcessProtocol):
+    """Process protocol of a worker, telling the supervisor once it
+    ended"""
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        # Whether the worker is being replaced rather than restarted
+        self.retired = False
+        self.reason = None
+        self._waiters = []
+
+    def processEnded(self, reason):
+        self.reason = reason
+        self.supervisor.worker_ended(self, reason)
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(reason.value)
+
+    def wait(self):
+        """Deferred firing with the exception the process ended with, once
+        it ended"""
+        if self.reason is not None:
+            return succeed(self.reason.value)
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+
+class Supervisor(object):
+    """Runs worker processes, restarting the ones that die"""
+    def __init__(self, command, count, restart_delay=1.0, child_fds=None,
+                 reactor=reactor):
+        """Create a new Supervisor
+
+        :param command: Command line of the workers, which get a
+                        ``--worker_index`` appended.
+        :param count: Amount of workers.
+        :param restart_delay: Seconds to wait before restarting a worker.
+        :param child_fds: File descriptors of the workers, see
+                          :meth:`~twisted.internet.interfaces.IReactorProcess.spawnProcess`,
+                          by default they share the supervisor's standard
+                          input and output.
+        :param reactor: Provider of ``spawnProcess`` and ``callLater``.
+
+        """
+        self.command = command
+        self.count = count
+        self.restart_delay = restart_delay
+        self.child_fds = child_fds or {0: 0, 1: 1, 2: 2}
+        self.reactor = reactor
+        self.workers = {}
+        self.restarts = 0
+        self.stopping = False
+        self._rotation = None
+
+    def start(self):
+        """Start the workers"""
+        for index in range(self.count):
+            self.spawn(index)
+
+    def spawn(self, index):
+        """Start the worker of an index"""
+        if self.stopping:
+            return None
+        worker = WorkerProtocol(self, index)
+        args = self.command + ["--worker_index=%d" % index]
+        self.reactor.spawnProcess(worker, args[0], args, env=os.environ,
+                                  childFDs=self.child_fds)
+        self.workers[index] = worker
+        log.msg("Started worker %d" % index)
+        return worker
+
+    def worker_ended(self, worker, reason):
+        """Restart a worker that died, unless it's being replaced or the
+        supervisor is stopping"""
+        if self.workers.get(worker.index) is not worker:
+            return
+        del self.workers[worker.index]
+        if self.stopping or worker.retired:
+            return
+        log.msg("Worker %d ended (%s), restarting" %
+                (worker.index, reason.getErrorMessage()))
+        self.restarts += 1
+        self.reactor.callLater(self.restart_delay, self.spawn, worker.index)
+
+    def signal(self, worker, signal="TERM"):
+        """Signal a worker, if it's still running"""
+        try:
+            worker.transport.signalProcess(signal)
+        except ProcessExitedAlready:
+            pass
+
+    def stop(self):
+        """Stop the workers
+
+        :returns: Deferred firing once they all ended.
+
+        """
+        self.stopping = True
+        workers = self.workers.values()
+        for worker in workers:
+            self.signal(worker)
+        return DeferredList([worker.wait() for worker in workers])
+
+    def rotate(self):
+        """Replace the workers one at a time, each stopping before its
+        replacement starts, which the others cover for
+
+        :returns: Deferred firing once all were replaced.
+
+        """
+        if self._rotation is not None:
+            # Already rotating
+            return self._rotation
+        d = self._rotation = succeed(None)
+        for index in sorted(self.workers):
+            d.addCallback(lambda _, index=index: self._replace(index))
+
+        def finished(result):
+            self._rotation = None
+            return result
+        d.addBoth(finished)
+        return d
+
+    def _replace(self, index):
+        """Stop the worker of an index, then start its replacement and
+        wait ``restart_delay`` for it to start"""
+        worker = self.workers.get(index)
+        if worker is None or self.stopping:
+            return None
+        log.msg("Replacing worker %d" % index)
+        worker.retired = True
+        self.signal(worker)
+        d = worker.wait()
+        d.addCallback(lambda _: self.spawn(index))
+        d.addCallback(lambda _: task.deferLater(
+            self.reactor, self.restart_delay, lambda: None))
+        return d
+
+
+def supervise(supervisor, rotate=False):
+    """Run a :class:`Supervisor` until the supervisor process is stopped,
+    stopping the workers along with it
+
+    :param rotate: Whether a ``SIGHUP`` rotates the workers.
+
+    """
+    reactor.callWhenRunning(supervisor.start)
+    reactor.addSystemEventTrigger("before", "shutdown", supervisor.stop)
+    if rotate:
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+                      reactor.callFromThread(supervisor.rotate))
+    reactor.run()
+    return supervisor
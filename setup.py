@@ -56,7 +56,16 @@ setup(name="AutoPush",
       [console_scripts]
       autopush = autopush.main:connection_main
       autoendpoint = autopush.main:endpoint_main
+      autopush-combined = autopush.main:combined_main
       autokey = autokey:main
+      autopush-shard = autopush.shard:main
+      autopush-reaper = autopush.reaper:main
+      autopush-sizes = autopush.sizes:main
+      autopush-storage-map = autopush.storagemap:main
+      autopush-fakedb = autopush.fakedb:main
+      autopush-autoscale = autopush.autoscale:main
+      autopush-db = autopush.dbtool:main
+      autopush-connbench = autopush.connbench:main
       """,
       **extra_options
       )